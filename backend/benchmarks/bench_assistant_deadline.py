@@ -0,0 +1,285 @@
+"""
+Benchmark assistant-request con budget di latenza (handle_assistant_request)
+
+Il primo saluto del chiamante aspetta la risposta ad assistant-request.
+Confronta, contro Firestore finto con latenza RPC iniettata:
+- sequential: come prima (rate limit con scrittura, controllo costi,
+  tenant, scrittura inizio chiamata, uno dopo l'altro)
+- deadline:   vapi_webhook / vapi_webhook_async (rate limit, bucket e
+  inizio chiamata in parallelo, attesi entro ASSISTANT_REQUEST_BUDGET_MS;
+  solo il controllo costi dopo la risposta)
+a latenza crescente, fino a un Firestore più lento del budget. Verifica:
+- risposta entro il budget (+ margine) anche con Firestore lento, con il
+  firstMessage di default
+- entro il budget, documento di inizio chiamata e bucket rate limit già
+  scritti quando arriva la risposta (niente lavoro essenziale dopo la
+  risposta, quando Cloud Functions limita la CPU); oltre il budget scritti
+  comunque dopo il drain, anche quando end-of-call-report arriva subito
+  dopo (la chiamata completata non viene sovrascritta)
+- assistant-request arrivato dopo end-of-call-report non cambia lo
+  started_at su cui sono stati contati rollup e analytics
+- un numero oltre il rate limit viene ancora rifiutato
+Esce con codice 1 se qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_assistant_deadline.py
+    ASSISTANT_REQUEST_BUDGET_MS=500 python backend/benchmarks/bench_assistant_deadline.py --latencies-ms 10,50,800
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import time
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+import vapi_webhook_async  # noqa: E402
+from fakes import FakeAsyncFirestore, FakeFirestore, FakeTwilio  # noqa: E402
+
+MARGIN_MS = 50  # Scheduling dei thread / event loop oltre il budget
+_batches = iter(range(10 ** 6))
+
+
+def reset_process_state():
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+
+
+def setup(mode, args):
+    """Fake senza latenza (seed e tenant in cache), latenza impostata dopo"""
+    clients.set_twilio(FakeTwilio())
+    if mode == 'async':
+        db = FakeAsyncFirestore()
+        sync_db = db.sync
+        clients.set_async_firestore(db)
+    else:
+        db = sync_db = FakeFirestore()
+    clients.set_firestore(sync_db)
+    harness.seed_dataset(sync_db, 0, n_tenants=args.tenants)
+    reset_process_state()
+    for i in range(args.tenants):
+        vapi_webhook.get_tenant_context(harness.tenant_ids(i)[0])  # Istanza calda: tenant in cache
+    return db, sync_db
+
+
+def set_latency(db, ms):
+    db.read_latency = db.write_latency = ms / 1000
+
+
+def make_events(n, args, event='assistant-request'):
+    batch = next(_batches)
+    return [json.dumps(harness.make_event(event, f"deadline-{batch:03d}-{i:05d}", f"+39346{batch:03d}{i:04d}",
+                                          harness.tenant_ids(i % args.tenants)[0])).encode()
+            for i in range(n)]
+
+
+def sequential(body):
+    """assistant-request come prima: tutto in sequenza prima di rispondere"""
+    event = vapi_webhook.decode_event(body)
+    if not vapi_webhook._rate_limiter.check_and_record(event.customer_number):
+        return vapi_webhook.RATE_LIMITED_RESPONSE
+    vapi_webhook.check_cost_alerts()
+    user_id, order_id = vapi_webhook.get_user_id_from_assistant(event.assistant_id)
+    call_data = vapi_webhook.call_start_data(event.call_id, event.customer_number, user_id, order_id,
+                                             event.assistant_id)
+    clients.get_firestore().collection('calls').document(event.call_id).set(call_data)
+    return vapi_webhook.ASSISTANT_RESPONSE
+
+
+def written_on_response(db, sync_db, bodies):
+    """Prima del drain: scritture essenziali già fatte (latenza azzerata per leggerle)"""
+    set_latency(db, 0)
+    return essential_writes_done(sync_db, bodies)
+
+
+def run_sync(bodies, handler, db, sync_db):
+    latencies, responses = [], []
+    for body in bodies:
+        start = time.perf_counter()
+        responses.append(handler(body))
+        latencies.append((time.perf_counter() - start) * 1000)
+    written = written_on_response(db, sync_db, bodies)
+    vapi_webhook.drain_deferred()
+    return latencies, responses, written
+
+
+def run_async(bodies, db, sync_db):
+    async def _run():
+        latencies, responses = [], []
+        for body in bodies:
+            start = time.perf_counter()
+            responses.append(await vapi_webhook_async.process_webhook_async(harness.sign(body), body))
+            latencies.append((time.perf_counter() - start) * 1000)
+        written = written_on_response(db, sync_db, bodies)
+        await vapi_webhook_async.drain_background()
+        return latencies, responses, written
+
+    return asyncio.run(_run())
+
+
+def webhook(body):
+    return vapi_webhook.vapi_webhook(harness.signed_request(body))
+
+
+def essential_writes_done(db, bodies):
+    """Documento di inizio chiamata (con started_at) e bucket rate limit per ogni richiesta"""
+    for body in bodies:
+        event = vapi_webhook.decode_event(body)
+        if not (db.collection('calls').document(event.call_id).get().to_dict() or {}).get('started_at'):
+            return False
+        if not db.collection('rate_limits').document(event.customer_number).get().exists:
+            return False
+    return True
+
+
+def measure(mode, latency_ms, args):
+    """(p50, max, risposte ok, scritture alla risposta, scritture dopo il drain, contatori)"""
+    db, sync_db = setup(mode, args)
+    set_latency(db, latency_ms)
+    bodies = make_events(args.requests, args)
+    if mode == 'sequential':
+        latencies, responses, written = run_sync(bodies, sequential, db, sync_db)
+    elif mode == 'sync':
+        latencies, responses, written = run_sync(bodies, webhook, db, sync_db)
+    else:
+        latencies, responses, written = run_async(bodies, db, sync_db)
+    ok = all(r == vapi_webhook.ASSISTANT_RESPONSE for r in responses)
+    return (statistics.median(latencies), max(latencies), ok, written, essential_writes_done(sync_db, bodies),
+            sync_db.counters())
+
+
+def end_of_call_race(mode, args):
+    """assistant-request e subito end-of-call-report: la chiamata resta 'completed', con started_at"""
+    db, sync_db = setup(mode, args)
+    set_latency(db, 0.02)
+    starts = make_events(20, args)
+    ends = []
+    for body in starts:
+        event = vapi_webhook.decode_event(body)
+        ends.append(json.dumps(harness.make_event('end-of-call-report', event.call_id, event.customer_number,
+                                                  event.assistant_id)).encode())
+    if mode == 'sync':
+        for start, end in zip(starts, ends):
+            webhook(start)
+            webhook(end)
+        vapi_webhook.drain_deferred()
+    else:
+        async def _run():
+            for start, end in zip(starts, ends):
+                await vapi_webhook_async.process_webhook_async(harness.sign(start), start)
+                await vapi_webhook_async.process_webhook_async(harness.sign(end), end)
+            await vapi_webhook_async.drain_background()
+
+        asyncio.run(_run())
+    calls = [sync_db.collection('calls').document(vapi_webhook.decode_event(body).call_id).get().to_dict()
+             for body in starts]
+    return all(call.get('status') == 'completed' and call.get('started_at') for call in calls)
+
+
+def late_assistant_request(mode, args):
+    """end-of-call-report prima di assistant-request: status e started_at di fine chiamata restano"""
+    db, sync_db = setup(mode, args)
+    starts = make_events(10, args)
+    pairs = []
+    for body in starts:
+        event = vapi_webhook.decode_event(body)
+        end = json.dumps(harness.make_event('end-of-call-report', event.call_id, event.customer_number,
+                                            event.assistant_id)).encode()
+        pairs.append((end, body))
+    if mode == 'sync':
+        for end, start in pairs:
+            webhook(end)
+            webhook(start)
+        vapi_webhook.drain_deferred()
+    else:
+        async def _run():
+            for end, start in pairs:
+                await vapi_webhook_async.process_webhook_async(harness.sign(end), end)
+                await vapi_webhook_async.process_webhook_async(harness.sign(start), start)
+            await vapi_webhook_async.drain_background()
+
+        asyncio.run(_run())
+    for end, _ in pairs:
+        event = vapi_webhook.decode_event(end)
+        call = sync_db.collection('calls').document(event.call_id).get().to_dict()
+        if call.get('status') != 'completed' or call.get('started_at') != event.started_at:
+            return False
+    return True
+
+
+def rate_limit_still_enforced(args):
+    """Oltre MAX_CALLS_PER_NUMBER_PER_HOUR dallo stesso numero: rifiutato"""
+    db, _ = setup('sync', args)
+    set_latency(db, 0.005)
+    batch = next(_batches)
+    responses = []
+    for i in range(vapi_webhook.MAX_CALLS_PER_NUMBER_PER_HOUR + 1):
+        body = json.dumps(harness.make_event('assistant-request', f"spam-{batch}-{i}", '+393460000000',
+                                             harness.tenant_ids(0)[0])).encode()
+        responses.append(webhook(body))
+    vapi_webhook.drain_deferred()
+    return responses[-1] == vapi_webhook.RATE_LIMITED_RESPONSE and all(
+        r == vapi_webhook.ASSISTANT_RESPONSE for r in responses[:-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark assistant-request con budget di latenza')
+    parser.add_argument('--latencies-ms', default='5,25,100,400,1500', help='Latenza per RPC Firestore')
+    parser.add_argument('--requests', type=int, default=20, help='assistant-request per latenza e modo')
+    parser.add_argument('--tenants', type=int, default=10)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    budget = vapi_webhook.ASSISTANT_REQUEST_BUDGET_MS
+    print(f"budget {budget} ms (ASSISTANT_REQUEST_BUDGET_MS), {args.requests} requests from new numbers, "
+          f"tenant cache warm\n")
+    print(f"{'RPC ms':>7}  {'mode':<11} {'p50 ms':>8} {'max ms':>8}  {'reads':>5} {'writes':>6}  "
+          f"{'firstMessage':<12} {'on response':<12} after drain")
+    checks = []
+    for latency in (float(ms) for ms in args.latencies_ms.split(',')):
+        results = {}
+        for mode in ('sequential', 'sync', 'async'):
+            p50, worst, ok, written, done, counters = results[mode] = measure(mode, latency, args)
+            print(f"{latency:>7g}  {mode:<11} {p50:>8.1f} {worst:>8.1f}  {counters['reads']:>5} "
+                  f"{counters['writes']:>6}  {'ok' if ok else 'FAIL':<12} {'written' if written else 'pending':<12} "
+                  f"{'written' if done else 'MISSING'}")
+        for mode in ('sync', 'async'):
+            p50, worst, ok, written, done, _ = results[mode]
+            checks.append((f"{mode} at {latency:g} ms/RPC: answered within budget, writes done after drain",
+                           worst <= budget + MARGIN_MS and ok and done))
+            # Rate limit | tenant, poi bucket | inizio chiamata: due RPC in serie
+            if 2 * latency + MARGIN_MS < budget:
+                checks.append((f"{mode} at {latency:g} ms/RPC: writes done before the response", written))
+        if 2 * latency < budget:
+            checks.append((f"sync at {latency:g} ms/RPC: faster than sequential",
+                           results['sync'][0] < results['sequential'][0]))
+        print()
+
+    for mode in ('sync', 'async'):
+        checks.append((f"{mode}: end-of-call right after assistant-request stays completed, with started_at",
+                       end_of_call_race(mode, args)))
+        checks.append((f"{mode}: late assistant-request keeps the started_at counted by end-of-call",
+                       late_assistant_request(mode, args)))
+    checks.append(('rate limit still rejects the 21st call within the hour', rate_limit_still_enforced(args)))
+
+    passed = True
+    print('checks:')
+    for label, ok in checks:
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+        passed &= ok
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
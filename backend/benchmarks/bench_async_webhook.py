@@ -0,0 +1,263 @@
+"""
+Benchmark percorso asyncio vs sincrono del webhook (vapi_webhook_async.py)
+
+Stessi eventi firmati (assistant-request + end-of-call-report per
+chiamata) contro Firestore finto con latenza RPC simulata e Twilio finto
+con latenza. Misura:
+- latenza di una richiesta alla volta (RPC indipendenti in parallelo)
+- throughput con molte richieste in volo: sync con N thread (un thread
+  per richiesta) vs async su un solo event loop, migliore di --repeats giri
+- thread usati durante il carico
+Il throughput assoluto dipende dalla CPU libera (con un solo core e
+processo carico sync con molti thread può superare async): il confronto
+è con la migliore configurazione sync, per thread usato. Verifica che i
+due percorsi producano lo stesso stato (chiamate salvate, contatori
+mensili, WhatsApp inviati), che async usi meno thread e renda più
+chiamate/s per thread della migliore sync, e che un retry concorrente
+dello stesso evento non abbia side effect. Esce con codice 1 se qualcosa
+non torna.
+
+Uso:
+    python backend/benchmarks/bench_async_webhook.py
+    python backend/benchmarks/bench_async_webhook.py --calls 400 --in-flight 200 --read-latency-ms 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+import vapi_webhook_async  # noqa: E402
+from fakes import FakeAsyncFirestore, FakeFirestore, FakeTwilio  # noqa: E402
+
+_batches = iter(range(10 ** 6))
+n_tenants = 100
+
+
+def reset_process_state():
+    """Istanza nuova: cache in-process vuote"""
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+
+
+def setup(args, mode):
+    """Fake Firestore/Twilio con latenza per il percorso `mode` ('sync' | 'async')"""
+    global n_tenants
+    n_tenants = args.tenants
+    read, write = args.read_latency_ms / 1000, args.write_latency_ms / 1000
+    twilio = FakeTwilio(latency=args.twilio_latency_ms / 1000)
+    clients.set_twilio(twilio)
+    if mode == 'sync':
+        db = FakeFirestore(read_latency=read, write_latency=write)
+        harness.seed_dataset(db, 0, n_tenants=n_tenants)
+        clients.set_firestore(db)
+    else:
+        db = FakeAsyncFirestore(read_latency=read, write_latency=write)
+        harness.seed_dataset(db.sync, 0, n_tenants=n_tenants)
+        clients.set_async_firestore(db)
+        clients.set_firestore(db.sync)  # Solo notifiche nel pool bloccante (outbox/digest)
+    reset_process_state()
+    return db, twilio
+
+
+def make_calls(n):
+    """(assistant-request, end-of-call-report) firmati per n chiamate nuove"""
+    batch = next(_batches)
+    calls = []
+    for i in range(n):
+        assistant_id, _, _ = harness.tenant_ids(i % n_tenants)
+        call_id, number = f"async-{batch:03d}-{i:05d}", f"+39349{batch:03d}{i:05d}"
+        calls.append(tuple(
+            json.dumps(harness.make_event(event, call_id, number, assistant_id)).encode()
+            for event in ('assistant-request', 'end-of-call-report')
+        ))
+    return calls
+
+
+def sync_call(call):
+    latencies = []
+    for body in call:
+        start = time.perf_counter()
+        vapi_webhook.vapi_webhook(harness.signed_request(body))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def async_call(call):
+    latencies = []
+    for body in call:
+        start = time.perf_counter()
+        await vapi_webhook_async.process_webhook_async(harness.sign(body), body)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def warm_tenants(mode):
+    """Un primo giro per tenant: la cache tenant è calda come in produzione"""
+    calls = make_calls(n_tenants)
+    if mode == 'sync':
+        for call in calls:
+            sync_call(call)
+    else:
+        asyncio.run(_sequential_async(calls))
+
+
+async def _sequential_async(calls):
+    return [await async_call(call) for call in calls]
+
+
+def sequential(args, mode):
+    """Una richiesta alla volta: latenza per evento"""
+    setup(args, mode)
+    warm_tenants(mode)
+    calls = make_calls(args.sequential)
+    if mode == 'sync':
+        results = [sync_call(call) for call in calls]
+    else:
+        results = asyncio.run(_sequential_async(calls))
+    return statistics.median(r[0] for r in results), statistics.median(r[1] for r in results)
+
+
+def loaded(args, mode, workers):
+    """Molte chiamate in volo; ritorna (chiamate/s, picco thread, db, twilio)"""
+    db, twilio = setup(args, mode)
+    warm_tenants(mode)
+    calls = make_calls(args.calls)
+    peak = [threading.active_count()]
+    stop = threading.Event()
+
+    def _sample():
+        while not stop.is_set():
+            peak[0] = max(peak[0], threading.active_count())
+            time.sleep(0.005)
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    if mode == 'sync':
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(sync_call, calls))
+    else:
+        async def _run():
+            semaphore = asyncio.Semaphore(workers)
+
+            async def _one(call):
+                async with semaphore:
+                    await async_call(call)
+
+            await asyncio.gather(*(_one(call) for call in calls))
+
+        asyncio.run(_run())
+    seconds = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+    return len(calls) / seconds, peak[0] - 1, db, twilio  # -1: thread di campionamento
+
+
+def state(db, twilio):
+    sync_db = db.sync if isinstance(db, FakeAsyncFirestore) else db
+    completed = sum(1 for c in sync_db.collection('calls').stream() if c.to_dict().get('status') == 'completed')
+    monthly = sum(u.to_dict().get('monthly_calls', 0) for u in sync_db.collection('users').stream())
+    return {'completed_calls': completed, 'monthly_calls': monthly, 'whatsapp_sent': len(twilio.sent)}
+
+
+def duplicate_replay(args):
+    """Lo stesso end-of-call-report 8 volte in parallelo sul percorso async"""
+    db, twilio = setup(args, 'async')
+    (_, end_of_call), = make_calls(1)
+
+    async def _run():
+        return await asyncio.gather(*(
+            vapi_webhook_async.process_webhook_async(harness.sign(end_of_call), end_of_call) for _ in range(8)
+        ))
+
+    responses = asyncio.run(_run())
+    current = state(db, twilio)
+    return current['monthly_calls'] == 1 and current['whatsapp_sent'] == 1 and all(
+        r == {'status': 'success'} for r in responses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark webhook asyncio vs sincrono')
+    parser.add_argument('--calls', type=int, default=200, help='Chiamate (2 eventi ciascuna) nel test di carico')
+    parser.add_argument('--sequential', type=int, default=30, help='Chiamate per la latenza sequenziale')
+    parser.add_argument('--in-flight', type=int, default=100, help='Richieste in volo (thread sync / task async)')
+    parser.add_argument('--tenants', type=int, default=100,
+                        help='Tenant distinti: pochi tenant con molte chiamate in volo = contesa sul doc utente')
+    parser.add_argument('--sync-threads', type=int, default=8, help='Thread del worker sincrono')
+    parser.add_argument('--repeats', type=int, default=2, help='Giri per configurazione sotto carico (vale il migliore)')
+    parser.add_argument('--read-latency-ms', type=float, default=10.0)
+    parser.add_argument('--write-latency-ms', type=float, default=15.0)
+    parser.add_argument('--twilio-latency-ms', type=float, default=80.0)
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    print(f"RPC latency: read {args.read_latency_ms}ms, commit {args.write_latency_ms}ms, "
+          f"Twilio {args.twilio_latency_ms}ms\n")
+
+    print(f"{'one request at a time':<28} {'assistant-request':>18} {'end-of-call':>12}")
+    sequential_results = {}
+    for mode in ('sync', 'async'):
+        assistant_ms, end_ms = sequential_results[mode] = sequential(args, mode)
+        print(f"{mode:<28} {assistant_ms:>15.1f} ms {end_ms:>9.1f} ms")
+
+    print(f"\n{'under load (' + str(args.calls) + ' calls)':<28} {'calls/s':>10} {'threads':>8}")
+    states = {}
+    results = {}
+    for name, mode, workers in (
+        (f"sync, {args.sync_threads} threads", 'sync', args.sync_threads),
+        (f"sync, {args.in_flight} threads", 'sync', args.in_flight),
+        (f"async, {args.in_flight} in flight", 'async', args.in_flight),
+    ):
+        runs = []
+        for _ in range(max(args.repeats, 1)):
+            rate, threads, db, twilio = loaded(args, mode, workers)
+            runs.append((rate, threads))
+            states[name, len(runs)] = state(db, twilio)
+        rate, threads = results[name] = max(runs)
+        print(f"{name:<28} {rate:>10.1f} {threads:>8}")
+
+    print('\nchecks:')
+    passed = True
+    total = args.calls + args.tenants  # + giro di riscaldamento
+    expected = {'completed_calls': total, 'monthly_calls': total, 'whatsapp_sent': total}
+    same = all(s == expected for s in states.values())
+    print(f"  same state on both paths {expected}: {'ok' if same else 'FAIL ' + str(states)}")
+    passed &= same
+
+    faster = sequential_results['async'][1] < sequential_results['sync'][1]
+    print(f"  end-of-call faster with concurrent RPCs: {'ok' if faster else 'FAIL'}")
+    passed &= faster
+
+    async_rate, async_threads = results.pop(f"async, {args.in_flight} in flight")
+    best_name, (best_rate, best_threads) = max(results.items(), key=lambda item: item[1][0])
+    scales = async_threads < best_threads and async_rate / async_threads > best_rate / best_threads
+    print(f"  async vs best sync ({best_name}): {async_threads} vs {best_threads} threads, "
+          f"{async_rate / async_threads:.2f} vs {best_rate / best_threads:.2f} calls/s per thread: "
+          f"{'ok' if scales else 'FAIL'}")
+    passed &= scales
+
+    dedup = duplicate_replay(args)
+    print(f"  8 concurrent duplicates -> one side effect: {'ok' if dedup else 'FAIL'}")
+    passed &= dedup
+
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
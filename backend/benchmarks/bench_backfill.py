@@ -0,0 +1,210 @@
+"""
+Benchmark backfill delle chiamate storiche (backfill.py)
+
+Popola il fake con N chiamate (structured_data, zone scritte in modi
+diversi, transcript metà inline e metà compressi in subcollection) con
+latenza Firestore simulata e confronta:
+- legacy: stream unico + ricalcolo + un update per documento
+- backfill.Backfill senza worker e con un process pool
+Verifica anche che un run interrotto e ripreso dal checkpoint produca le
+stesse modifiche di un run completo, anche con worker e --usage (crash
+con pagine ancora in volo: l'utilizzo non viene contato due volte) e
+che l'utilizzo ricalcolato coincida con rebuild_monthly_rollups (solo
+chiamate concluse, una su IN_PROGRESS_EVERY resta in corso). Riporta
+documenti/s e il tempo stimato per 500k chiamate.
+
+Uso:
+    python backend/benchmarks/bench_backfill.py
+    python backend/benchmarks/bench_backfill.py --calls 20000 --workers 4 --read-latency-ms 20
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import harness
+
+harness.setup_path()
+
+import backfill  # noqa: E402
+import transcript_store  # noqa: E402
+import usage_rollup  # noqa: E402
+from fakes import FakeFirestore  # noqa: E402
+
+TARGET_CALLS = 500_000
+IN_PROGRESS_EVERY = 50  # Chiamate mai chiuse da end-of-call-report: fuori dall'utilizzo
+
+
+class Crash(Exception):
+    pass
+
+ZONE_TEXTS = ['Porta Romana', 'P.ta Romana, Milano', 'zona navigli', 'Darsena', 'Brera', 'isola',
+              'Città Studi', 'citta studi', 'Porta Venezia', 'Lambrate']
+NOTES = ['Vuole terrazzo e box auto, urgente', 'Cerca casa luminosa', 'Nessuna',
+         'Appartamento arredato con ascensore', 'Richiamerà di nuovo domani']
+
+
+def seed(db, n_calls, n_tenants=20, seed=5):
+    rng = random.Random(seed)
+    harness.seed_dataset(db, 0, n_tenants=n_tenants)
+    transcript = (
+        "AI: Buongiorno, come posso aiutarla?\n"
+        "User: Cerco un trilocale con balcone, piano alto se possibile.\n"
+        "AI: Ha un budget indicativo?\n"
+        "User: Intorno ai 450 mila, vorrei trasferirmi presto.\n"
+    ) * 10
+    chunks = transcript_store.compress_transcript(transcript)
+    for n in range(n_calls):
+        assistant_id, user_id, order_id = harness.tenant_ids(rng.randrange(n_tenants))
+        call_id = f"hist-{n:07d}"
+        structured = {'nome': 'Giulia Bianchi', 'zona': rng.choice(ZONE_TEXTS), 'tipo_richiesta': 'comprare',
+                      'tipo_immobile': 'trilocale', 'budget': '450.000', 'note': rng.choice(NOTES)}
+        data = {
+            'call_id': call_id,
+            'customer_number': f"+39347{n:07d}",
+            'user_id': user_id,
+            'order_id': order_id,
+            'started_at': datetime(2025, 1, 1) + timedelta(minutes=n * 13),
+            'duration': rng.randrange(20, 600),
+            'status': 'in_progress' if n % IN_PROGRESS_EVERY == IN_PROGRESS_EVERY - 1 else 'completed',
+            'structured_data': structured,
+            # client_info "vecchio": zona non ancora normalizzata / campi mancanti
+            'client_info': {'nome': 'Giulia Bianchi', 'zona': structured['zona']},
+        }
+        if n % 3:
+            data['assistant_id'] = assistant_id
+        if n % 2:
+            data['transcript'] = transcript
+        else:
+            data.update(transcript_store.transcript_fields(transcript, chunks))
+            for index, chunk in enumerate(chunks):
+                db.seed(f"calls/{call_id}/transcript/{index:04d}", {'index': index, 'data': chunk})
+        db.seed(f"calls/{call_id}", data)
+    db.reset_counters()
+
+
+def legacy_backfill(db, fields):
+    """Una query, ricalcolo e un update sincrono per documento"""
+    tenants = backfill._Tenants(db)
+    changed = 0
+    for snapshot in db.collection('calls').stream():
+        data = snapshot.to_dict()
+        chunks = transcript_store.read_transcript_chunks(db, [snapshot]).get(snapshot.id)
+        _, spec = tenants.spec(data)
+        updates = backfill.recompute_call((snapshot.id, data, chunks), backfill._tenant(spec), fields)
+        if updates:
+            snapshot.reference.update({k: v for k, v in updates.items() if v is not None})
+            changed += 1
+    return changed
+
+
+def crash_after_first_page(run):
+    """Il run si interrompe appena salvato il primo checkpoint (altre pagine in volo)"""
+    save = run._save_checkpoint
+
+    def _save(done=False):
+        save(done)
+        if not done:
+            raise Crash()
+
+    run._save_checkpoint = _save
+    return run
+
+
+def fresh_db(args):
+    db = FakeFirestore(read_latency=args.read_latency_ms / 1000, write_latency=args.write_latency_ms / 1000)
+    seed(db, args.calls)
+    return db
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark backfill chiamate storiche')
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=4, help='Worker del pool (serve più di una CPU)')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--read-latency-ms', type=float, default=10.0, help='Latenza per RPC di lettura')
+    parser.add_argument('--write-latency-ms', type=float, default=10.0, help='Latenza per commit')
+    parser.add_argument('--legacy-calls', type=int, default=1000, help='Chiamate per il run legacy (lento)')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    fields = backfill.FIELDS
+
+    print(f"calls: {args.calls}, cpus: {os.cpu_count()}, "
+          f"read {args.read_latency_ms}ms/RPC, write {args.write_latency_ms}ms/commit\n")
+    print(f"{'mode':<24} {'docs':>8} {'changed':>8} {'write RPC':>9} {'seconds':>8} {'docs/s':>8} {'500k est':>10}")
+
+    def _row(name, docs, changed, commits, seconds):
+        rate = docs / seconds if seconds else 0
+        estimate = TARGET_CALLS / rate / 60 if rate else 0
+        print(f"{name:<24} {docs:>8} {changed:>8} {commits:>9} {seconds:>8.2f} {rate:>8.0f} {estimate:>8.1f}m")
+
+    legacy_args = argparse.Namespace(**{**vars(args), 'calls': min(args.legacy_calls, args.calls)})
+    db = fresh_db(legacy_args)
+    changed, seconds = timed(lambda: legacy_backfill(db, fields))
+    _row('legacy per-doc update', legacy_args.calls, changed, db.counters()['writes'], seconds)
+
+    reports = {}
+    usage = {}
+    for name, workers in (('backfill, no workers', 0), (f"backfill, {args.workers} workers", args.workers)):
+        db = fresh_db(args)
+        run = backfill.Backfill(db, fields, args.page_size, workers, usage=True)
+        report = run.run()
+        reports[name] = report
+        usage[name] = run._usage
+        usage_db = db
+        stats = report['stats']
+        _row(name, stats['scanned'], stats['changed'], stats['commits'], report['seconds'])
+
+    # Interruzione a metà + resume dal checkpoint
+    db = fresh_db(args)
+    half = (args.calls // 2 // args.page_size) * args.page_size or args.page_size
+    backfill.Backfill(db, fields, args.page_size, 0, checkpoint='bench', limit=half).run()
+    resumed = backfill.Backfill(db, fields, args.page_size, 0, checkpoint='bench')
+    resumed.resume()
+    report = resumed.run()
+    full = reports['backfill, no workers']
+    same = report['stats']['changed'] == full['stats']['changed'] and report['changes'] == full['changes']
+    print(f"\nresume after {half} docs: {report['stats']['scanned']} scanned, "
+          f"{report['stats']['changed']} changed ({'same as full run' if same else 'MISMATCH'})")
+
+    # Crash con pagine in volo nei worker + resume, con --usage
+    db = fresh_db(args)
+    try:
+        crash_after_first_page(backfill.Backfill(db, fields, args.page_size, args.workers, usage=True,
+                                                 checkpoint='bench-usage')).run()
+    except Crash:
+        pass
+    resumed = backfill.Backfill(db, fields, args.page_size, args.workers, usage=True, checkpoint='bench-usage')
+    resumed.resume()
+    report = resumed.run()
+    calls = sum(month['global']['call_count'] for month in resumed._usage.values())
+    completed = args.calls - args.calls // IN_PROGRESS_EVERY
+    same_usage = resumed._usage == usage['backfill, no workers'] and report['changes'] == full['changes'] \
+        and calls == completed
+    print(f"resume with {args.workers} workers + usage after a crash: call_count {calls} "
+          f"(expected {completed} completed, {'same as full run' if same_usage else 'MISMATCH'})")
+
+    # Stesso conteggio del rebuild dei rollup (solo chiamate concluse)
+    rebuilt = {month: usage_rollup.rebuild_monthly_rollups(usage_db, month) for month in full['usage_months']}
+    same_rebuild = all(
+        {key: rebuilt[month][key] for key in ('call_count', 'total_duration')} == totals['global']
+        for month, totals in usage['backfill, no workers'].items())
+    print(f"usage == rebuild_monthly_rollups: {'ok' if same_rebuild else 'MISMATCH'}")
+
+    print('changes per field: ' + ', '.join(f"{k} {v}" for k, v in full['changes'].items()))
+    print(f"usage rollups rewritten: {', '.join(full['usage_months'])}")
+    return 0 if same and same_usage and same_rebuild else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
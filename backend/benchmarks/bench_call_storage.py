@@ -0,0 +1,166 @@
+"""
+Benchmark bytes letti dalle query lista su `calls`
+
+Popola il fake con N chiamate nel vecchio formato (transcript inline), misura
+i bytes dei documenti restituiti dalla query lista della dashboard
+(user_id == X, ultime 200), esegue la migrazione di transcript_store e
+rimisura. Riporta anche il costo dell'apertura di una singola chiamata.
+
+Le dimensioni seguono le regole di storage Firestore (nome campo + 1,
+stringhe + 1, numeri/timestamp 8 byte, nome documento, 32 byte di overhead).
+
+Uso:
+    python backend/benchmarks/bench_call_storage.py --calls 1000 --minutes 2,6,12
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+
+import harness
+
+harness.setup_path()
+
+import transcript_store  # noqa: E402
+from fakes import FakeFirestore  # noqa: E402
+
+LIST_LIMIT = 200
+
+_TURNS_AI = [
+    "Buongiorno, sono l'assistente virtuale dell'agenzia. Come posso aiutarla?",
+    "Perfetto. In quale zona sta cercando?",
+    "Ha già un budget indicativo per l'acquisto?",
+    "Quante camere da letto le servirebbero?",
+    "Preferisce un piano alto o va bene anche un piano basso?",
+    "Le serve anche un box o un posto auto?",
+    "Mi può lasciare un nome e un numero per essere ricontattato?",
+    "Grazie, un nostro agente la ricontatterà entro oggi.",
+]
+_TURNS_USER = [
+    "Buongiorno, sto cercando un {tipo} in zona {zona}.",
+    "Direi intorno ai {budget} mila euro, massimo {budget_max}.",
+    "Almeno {camere} camere, meglio se con un secondo bagno.",
+    "Piano alto se possibile, con ascensore perché ho dei bambini piccoli.",
+    "Sì, il box sarebbe importante, abitiamo in {n} e abbiamo due macchine.",
+    "Mi chiamo {nome}, il numero è quello da cui sto chiamando.",
+    "Vorremmo trasferirci entro {mesi} mesi, abbiamo già venduto la casa attuale.",
+    "Ah, e sarebbe bello avere un balcone o un terrazzino per le piante.",
+]
+
+
+def make_transcript(rng, minutes):
+    """Transcript plausibile: ~150 parole parlate al minuto, turni alternati"""
+    target = int(minutes * 150 * 6)
+    lines = []
+    length = 0
+    while length < target:
+        ai = rng.choice(_TURNS_AI)
+        user = rng.choice(_TURNS_USER).format(
+            tipo=rng.choice(['bilocale', 'trilocale', 'quadrilocale', 'attico']),
+            zona=rng.choice(['Porta Romana', 'Navigli', 'Isola', 'Città Studi', 'Brera']),
+            budget=rng.randrange(200, 900, 10), budget_max=rng.randrange(300, 1000, 10),
+            camere=rng.randrange(1, 5), n=rng.randrange(2, 6), mesi=rng.randrange(1, 12),
+            nome=rng.choice(['Giulia Bianchi', 'Marco Rossi', 'Luca Ferri', 'Anna Galli']),
+        )
+        for line in (f"AI: {ai}", f"User: {user}"):
+            lines.append(line)
+            length += len(line) + 1
+    return '\n'.join(lines)
+
+
+def value_size(value):
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(k.encode('utf-8')) + 1 + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(v) for v in value)
+    return 8
+
+
+def document_size(path, data):
+    name = sum(len(part.encode('utf-8')) + 1 for part in path.split('/')) + 16
+    return name + value_size(data) + 32
+
+
+def list_query_bytes(db, user_id):
+    """Bytes restituiti dalla query lista calls della dashboard"""
+    docs = db.collection('calls').where('user_id', '==', user_id)\
+        .order_by('started_at', direction='DESCENDING').limit(LIST_LIMIT).stream()
+    sizes = [document_size(doc.reference.path, doc.to_dict()) for doc in docs]
+    return sum(sizes), len(sizes)
+
+
+def seed_calls(db, n_calls, minutes, user_id, seed=11):
+    rng = random.Random(seed)
+    start = datetime(2025, 3, 1)
+    for n in range(n_calls):
+        call_minutes = rng.choice(minutes)
+        transcript = make_transcript(rng, call_minutes)
+        db.seed(f"calls/call-{n:06d}", {
+            'call_id': f"call-{n:06d}",
+            'customer_number': f"+39347{rng.randrange(10 ** 7):07d}",
+            'user_id': user_id,
+            'started_at': start + timedelta(minutes=n * 7),
+            'ended_at': start + timedelta(minutes=n * 7 + call_minutes),
+            'duration': int(call_minutes * 60),
+            'status': 'completed',
+            'ended_reason': 'customer-ended-call',
+            'client_info': {'nome': 'Giulia Bianchi', 'telefono': '+393471234567', 'zona': 'Porta Romana',
+                            'tipo_richiesta': 'comprare', 'tipo_immobile': 'trilocale',
+                            'budget': '450.000 €', 'note': 'Balcone, piano alto, box.'},
+            'structured_data': {'nome': 'Giulia Bianchi', 'zona': 'Porta Romana', 'tipo_immobile': 'trilocale'},
+            'transcript': transcript,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes per query lista calls, prima/dopo offload transcript')
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--minutes', default='2,6,12', help='Durate chiamata (minuti) estratte a caso')
+    args = parser.parse_args()
+
+    user_id = 'agency@example.com'
+    minutes = [float(m) for m in args.minutes.split(',') if m]
+    db = FakeFirestore()
+    seed_calls(db, args.calls, minutes, user_id)
+
+    before_bytes, listed = list_query_bytes(db, user_id)
+    largest_before = max(document_size(f"calls/{doc.id}", doc.to_dict()) for doc in db.collection('calls').stream())
+
+    stats = transcript_store.migrate_inline_transcripts(db)
+    after_bytes, _ = list_query_bytes(db, user_id)
+    largest_after = max(document_size(f"calls/{doc.id}", doc.to_dict()) for doc in db.collection('calls').stream())
+
+    # Apertura di una chiamata: doc + chunk del transcript
+    call_id = 'call-000000'
+    db.reset_counters()
+    call_doc = db.collection('calls').document(call_id).get().to_dict()
+    transcript = transcript_store.read_transcript(db, call_id, call_doc)
+    detail_reads = db.counters()['reads']
+    chunk_bytes = sum(
+        document_size(doc.reference.path, doc.to_dict())
+        for doc in db.collection('calls').document(call_id).collection('transcript').stream()
+    )
+
+    print(f"calls: {args.calls}, list query: {listed} docs (limit {LIST_LIMIT})")
+    print(f"transcript inline -> gzip:   {stats['inline_bytes']:>12,} -> {stats['compressed_bytes']:,} bytes "
+          f"({stats['compressed_bytes'] / stats['inline_bytes']:.0%})")
+    print(f"list query bytes before:     {before_bytes:>12,}  ({before_bytes / listed:,.0f} per doc)")
+    print(f"list query bytes after:      {after_bytes:>12,}  ({after_bytes / listed:,.0f} per doc)")
+    print(f"reduction:                   {1 - after_bytes / before_bytes:>12.0%}")
+    print(f"largest call doc:            {largest_before:>12,} -> {largest_after:,} bytes")
+    print(f"open one call:               {detail_reads} reads, "
+          f"{document_size('calls/' + call_id, call_doc) + chunk_bytes:,} bytes "
+          f"({len(transcript):,} chars transcript)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
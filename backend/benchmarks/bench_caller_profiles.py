@@ -0,0 +1,214 @@
+"""
+Benchmark profili chiamante (caller_profiles.py)
+
+Richiamate dallo stesso numero via webhook firmato, percorso sincrono e
+asyncio. Verifica:
+- call_count e client_info uniti sul profilo (un 'Non specificato' non
+  cancella un dato già noto), uguali sui due percorsi
+- WhatsApp della richiamata: "Lead di ritorno", "Nª chiamata", nome
+  completato dal profilo
+- con `duplicate_lead_window` una richiamata senza novità non genera un
+  nuovo WhatsApp; sì con informazioni nuove, se urgente o senza finestra
+- al massimo una lettura del profilo per numero (poi cache in-process)
+Riporta le letture per sapere se un numero ha già chiamato: profilo vs
+query su `calls` per customer_number con storico. Esce con codice 1 se
+qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_caller_profiles.py
+    python backend/benchmarks/bench_caller_profiles.py --numbers 200 --history 50000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+import harness
+
+harness.setup_path()
+
+import caller_profiles  # noqa: E402
+import clients  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+import vapi_webhook_async  # noqa: E402
+from fakes import FakeAsyncFirestore, FakeFirestore, FakeTwilio  # noqa: E402
+
+CALM_TRANSCRIPT = ("AI: Buongiorno! Come posso aiutarla?\nUser: Cerco un trilocale da comprare in zona "
+                   "Porta Romana, con balcone.\nAI: Perfetto, la ricontattiamo noi.")
+WINDOW = 600  # duplicate_lead_window del tenant 1
+
+
+def reset_process_state():
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+
+
+def setup(mode, history=0):
+    """Fake per `mode` ('sync' | 'async'): tenant 0 senza finestra, tenant 1 con WINDOW"""
+    twilio = FakeTwilio()
+    clients.set_twilio(twilio)
+    if mode == 'sync':
+        db = sync_db = FakeFirestore()
+        clients.set_firestore(db)
+    else:
+        db = FakeAsyncFirestore()
+        sync_db = db.sync
+        clients.set_async_firestore(db)
+        clients.set_firestore(sync_db)
+    harness.seed_dataset(sync_db, history, n_tenants=2)
+    user_id = harness.tenant_ids(1)[1]
+    sync_db.seed(f"users/{user_id}", {
+        **sync_db.collection('users').document(user_id).get().to_dict(), 'duplicate_lead_window': WINDOW})
+    sync_db.reset_counters()
+    reset_process_state()
+    return db, sync_db, twilio
+
+
+def end_of_call(call_id, number, tenant, note='', **fields):
+    """end-of-call-report non urgente, con i campi del lead sovrascritti"""
+    payload = harness.make_event('end-of-call-report', call_id, number, harness.tenant_ids(tenant)[0])
+    payload['message']['transcript'] = CALM_TRANSCRIPT
+    payload['message']['structuredData'].update(note=note, **fields)
+    return json.dumps(payload).encode()
+
+
+def send(mode, body):
+    if mode == 'sync':
+        vapi_webhook.vapi_webhook(harness.signed_request(body))
+    else:
+        asyncio.run(vapi_webhook_async.process_webhook_async(harness.sign(body), body))
+
+
+def repeat_calls(mode, numbers):
+    """Tre chiamate per numero: completa, senza nome ma con nuovo budget, di nuovo completa"""
+    _, sync_db, twilio = setup(mode)
+    calls = (
+        {'budget': 'Non specificato'},
+        {'nome': 'Non specificato', 'budget': '300.000 €'},
+        {},
+    )
+    bodies = []
+    for n, fields in enumerate(calls):
+        for i in range(numbers):
+            send(mode, end_of_call(f"{mode}-{n}-{i:05d}", f"+39347{i:07d}", 0, **fields))
+            bodies.append(twilio.sent[-1]['body'] if twilio.sent else '')
+    user_id = harness.tenant_ids(0)[1]
+    profiles = {}
+    for i in range(numbers):
+        number = f"+39347{i:07d}"
+        doc = sync_db.collection(caller_profiles.PROFILE_COLLECTION).document(
+            caller_profiles.profile_id(user_id, number)).get()
+        data = doc.to_dict() or {}
+        profiles[number] = (data.get('call_count'), data.get('client_info'))
+    second, third = bodies[numbers:2 * numbers], bodies[2 * numbers:]
+    return {
+        'profiles': profiles,
+        'whatsapp': len(twilio.sent),
+        'second_ok': all('Lead di ritorno' in b and '2ª chiamata' in b and 'Giulia Bianchi' in b for b in second),
+        'third_ok': all('3ª chiamata' in b for b in third),
+        'first_ok': not any('Lead di ritorno' in b for b in bodies[:numbers]),
+        'loads': vapi_webhook._caller_profiles.stats()['loads'],
+    }
+
+
+def duplicate_window(mode):
+    """WhatsApp inviati dopo ogni richiamata, per tenant con e senza finestra"""
+    _, _, twilio = setup(mode)
+    steps = (
+        ('first call', 1, {}),
+        ('same info again', 1, {}),
+        ('new budget', 1, {'budget': '600.000 €'}),
+        ('same info, urgent', 1, {'budget': '600.000 €', 'note': 'Urgente, entro un mese'}),
+        ('same info, no window', 0, {}),
+        ('same info, no window', 0, {}),
+    )
+    results = []
+    for n, (label, tenant, fields) in enumerate(steps):
+        before = len(twilio.sent)
+        send(mode, end_of_call(f"dup-{mode}-{n}", '+393480000001', tenant, **fields))
+        results.append((label, len(twilio.sent) - before))
+    return results
+
+
+def history_reads(args):
+    """Letture per sapere se un numero ha già chiamato: query su calls vs profilo"""
+    db, _, _ = setup('sync', args.history)
+    user_id = harness.tenant_ids(0)[1]
+    numbers = [f"+39347{i:07d}" for i in range(args.numbers)]
+    start = time.perf_counter()
+    for number in numbers:
+        list(db.collection('calls').where('user_id', '==', user_id).where('customer_number', '==', number).stream())
+    scan_ms, scan_reads = (time.perf_counter() - start) * 1000, db.reads
+    for number in numbers:
+        send('sync', end_of_call(f"hist-new-{number}", number, 0))
+    db.reset_counters()
+    profiles = caller_profiles.CallerProfiles(lambda: db)
+    start = time.perf_counter()
+    for number in numbers:
+        profiles.get(user_id, number)
+    profile_ms, profile_reads = (time.perf_counter() - start) * 1000, db.reads
+    db.reset_counters()
+    for number in numbers:
+        profiles.get(user_id, number)
+    return scan_reads, scan_ms, profile_reads, profile_ms, db.reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark profili chiamante')
+    parser.add_argument('--numbers', type=int, default=50, help='Numeri che richiamano')
+    parser.add_argument('--history', type=int, default=20000, help='Chiamate storiche per il confronto letture')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    checks = []
+    results = {}
+    for mode in ('sync', 'async'):
+        start = time.perf_counter()
+        result = results[mode] = repeat_calls(mode, args.numbers)
+        print(f"{mode:<5} {3 * args.numbers} calls from {args.numbers} numbers in "
+              f"{time.perf_counter() - start:.2f}s, {result['whatsapp']} WhatsApp, "
+              f"{result['loads']} profile loads")
+        merged = all(count == 3 and info.get('nome') == 'Giulia Bianchi' and info.get('zona') == 'Porta Romana'
+                     and info.get('budget') == '450.000 - 500.000 €'
+                     for count, info in result['profiles'].values())
+        checks += [
+            (f"{mode}: call_count 3 and merged client_info on every profile", merged),
+            (f"{mode}: returning-caller WhatsApp (Lead di ritorno, Nª chiamata, known name)",
+             result['first_ok'] and result['second_ok'] and result['third_ok']),
+            (f"{mode}: at most one profile read per number", result['loads'] <= args.numbers),
+        ]
+    checks.append(('sync and async profiles match', results['sync']['profiles'] == results['async']['profiles']))
+
+    print(f"\nduplicate_lead_window {WINDOW}s (WhatsApp sent per call):")
+    expected = [1, 0, 1, 1, 1, 1]
+    for mode in ('sync', 'async'):
+        steps = duplicate_window(mode)
+        print(f"  {mode:<5} " + ', '.join(f"{label}: {sent}" for label, sent in steps))
+        checks.append((f"{mode}: near-duplicate suppressed, new info / urgent / no window notified",
+                       [sent for _, sent in steps] == expected))
+
+    scan_reads, scan_ms, profile_reads, profile_ms, cached_reads = history_reads(args)
+    print(f"\nhas this number called before? ({args.history} calls of history, {args.numbers} numbers)")
+    print(f"  query calls by customer_number: {scan_reads} reads, {scan_ms:.1f} ms")
+    print(f"  caller profile:                 {profile_reads} reads, {profile_ms:.1f} ms; "
+          f"{cached_reads} reads once cached")
+    checks.append(('profile lookup: one read per number, none from cache',
+                   profile_reads == args.numbers and cached_reads == 0))
+
+    passed = True
+    print('\nchecks:')
+    for label, ok in checks:
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+        passed &= ok
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
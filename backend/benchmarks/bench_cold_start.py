@@ -0,0 +1,105 @@
+"""
+Benchmark cold start del webhook
+
+Per ogni run avvia un processo Python nuovo che:
+1. misura il tempo di `import main` (quello che paga ogni nuova istanza)
+2. inietta fake Firestore (Twilio NON configurato)
+3. misura la latenza della prima assistant-request
+4. verifica quali moduli pesanti sono stati importati
+
+Uso:
+    python backend/benchmarks/bench_cold_start.py --runs 5 --max-import-ms 300
+
+Esce con codice 1 se le soglie sono superate o se una assistant-request
+importa Twilio (regressione).
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ('google.cloud.firestore', 'grpc', 'twilio')
+
+
+def child():
+    import harness
+    harness.setup_path()
+
+    start = time.perf_counter()
+    import main  # noqa: F401
+    import_ms = (time.perf_counter() - start) * 1000
+    after_import = [m for m in HEAVY_MODULES if m in sys.modules]
+
+    import clients
+    import vapi_webhook
+    from fakes import FakeFirestore
+
+    db = FakeFirestore()
+    db.seed('orders/o1', {'vapi_assistant_id': 'asst-1', 'user_id': 'agency@example.com'})
+    db.seed('users/agency@example.com', {'zone_assignments': {}})
+    clients.set_firestore(db)
+
+    request = harness.signed_request({
+        'message': {
+            'type': 'assistant-request',
+            'call': {'id': 'call-1', 'assistantId': 'asst-1', 'customer': {'number': '+390200000001'}}
+        }
+    })
+
+    start = time.perf_counter()
+    vapi_webhook.vapi_webhook(request)
+    first_request_ms = (time.perf_counter() - start) * 1000
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_request_ms': first_request_ms,
+        'after_import': after_import,
+        'after_request': [m for m in HEAVY_MODULES if m in sys.modules],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import time e prima richiesta')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--max-first-request-ms', type=float, default=None)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return 0
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, __file__, '--child'],
+            capture_output=True, text=True, check=True,
+            cwd=sys.path[0] or '.'
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    import_ms = statistics.median(r['import_ms'] for r in results)
+    first_ms = statistics.median(r['first_request_ms'] for r in results)
+    print(f"import main (median of {args.runs}):      {import_ms:8.1f} ms")
+    print(f"first assistant-request (median):  {first_ms:8.1f} ms")
+    print(f"heavy modules after import:        {results[0]['after_import'] or 'none'}")
+    print(f"heavy modules after request:       {results[0]['after_request'] or 'none'}")
+
+    failed = False
+    if 'twilio' in results[0]['after_request']:
+        print("FAIL: assistant-request imported twilio")
+        failed = True
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"FAIL: import time {import_ms:.1f} ms > {args.max_import_ms} ms")
+        failed = True
+    if args.max_first_request_ms is not None and first_ms > args.max_first_request_ms:
+        print(f"FAIL: first request {first_ms:.1f} ms > {args.max_first_request_ms} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
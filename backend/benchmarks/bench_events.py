@@ -0,0 +1,181 @@
+"""
+Benchmark decode eventi Vapi (events.py)
+
+Payload end-of-call-report registrato, gonfiato a dimensioni realistiche
+(transcript + messages di chiamate lunghe, 50-200 KB). Confronta:
+- prima: request.get_json() + catene .get() nei handler
+- dopo: request.get_data() + decode_event (orjson se installato, e stdlib)
+- evento non gestito (conversation-update) della stessa dimensione:
+  parse completo vs lettura del solo message.type
+- message.type dopo un array messages lungo: la lettura del tipo si
+  ferma a PEEK_MAX_TOKENS e ripiega sul parse completo
+Verifica che gli oggetti evento abbiano gli stessi campi del parse
+completo, che la lettura del tipo non si lasci ingannare da "type"
+annidati o dentro stringhe e che con il type in fondo non costi più del
+parse completo (+ margine). Esce con codice 1 se qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_events.py
+    python backend/benchmarks/bench_events.py --sizes-kb 50,100,200,400 --repeat 300
+"""
+import argparse
+import copy
+import json
+import statistics
+import sys
+import time
+
+import harness
+
+harness.setup_path()
+
+import events  # noqa: E402
+
+
+def inflate(payload, size_kb):
+    """Allunga transcript e messages fino a ~size_kb di JSON"""
+    payload = copy.deepcopy(payload)
+    message = payload['message']
+    turns = list(message['messages'])
+    base_transcript = message['transcript']
+    n = 1
+    while len(json.dumps(payload).encode()) < size_kb * 1024:
+        n += 1
+        message['messages'] = turns * n
+        message['transcript'] = '\n'.join([base_transcript] * n)
+    return payload
+
+
+def old_fields(payload):
+    """Campi estratti come facevano i handler prima di events.py"""
+    message = payload.get('message', {})
+    call = message.get('call', {})
+    return {
+        'type': message.get('type', ''),
+        'call_id': call.get('id', ''),
+        'customer_number': call.get('customer', {}).get('number', ''),
+        'assistant_id': call.get('assistantId') or message.get('assistantId') or payload.get('assistantId', ''),
+        'duration': call.get('duration', 0),
+        'ended_reason': call.get('endedReason', 'unknown'),
+        'structured_data': message.get('structuredData', {}),
+        'transcript': message.get('transcript', ''),
+    }
+
+
+def new_fields(event):
+    return {name: getattr(event, name) for name in old_fields({})}
+
+
+def per_op_us(fn, make_items):
+    """Microsecondi per operazione (mediana di 5 giri, items nuovi a ogni giro: get_json fa cache)"""
+    runs = []
+    for _ in range(5):
+        items = make_items()
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        runs.append((time.perf_counter() - start) / len(items) * 1e6)
+    return statistics.median(runs)
+
+
+def requests_for(body, n):
+    return [harness.signed_request(body) for _ in range(n)]
+
+
+def peek_cases():
+    """(body, tipo atteso) con trappole per la lettura del tipo"""
+    return [
+        (b'{"message": {"type": "status-update", "status": "ended"}}', 'status-update'),
+        (b'{"message": {"messages": [{"type": "tool", "role": "bot"}], "type": "conversation-update"}}',
+         'conversation-update'),
+        (b'{"type": "root", "message": {"call": {"type": "webCall"}, "type": "end-of-call-report"}}',
+         'end-of-call-report'),
+        (b'{"message": {"transcript": "AI: \\"type\\": \\"x\\", {[", "type": "transcript"}}', 'transcript'),
+        (b'{"message": {"timestamp": 1, "note": "}", "type": "speech-update"}}', 'speech-update'),
+        (b'{"message": {"ty\\u0070e": "hidden", "call": {}}}', None),
+        (b'{"message": {"call": {"type": "webCall"}}, "type": "root"}', None),
+        (b'{"assistantId": "a", "message": {"type": "hang", "x": [1, {"type": "y"}]}}', 'hang'),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark decode eventi Vapi')
+    parser.add_argument('--sizes-kb', default='50,100,200', help='Dimensioni payload end-of-call (KB)')
+    parser.add_argument('--repeat', type=int, default=200, help='Decode per misura')
+    args = parser.parse_args()
+
+    decoder = 'orjson' if events.loads is not json.loads else 'json (orjson non installato)'
+    print(f"decoder: {decoder}\n")
+    print(f"{'payload':>9} {'get_json':>10} {'decode':>10} {'decode std':>11} {'unhandled':>10} "
+          f"{'peek':>8} {'speedup':>8}")
+
+    passed = True
+    template = harness.make_event('end-of-call-report', 'bench-events', '+393471234567', 'asst-0000')
+    fast_loads = events.loads
+    for size_kb in (int(s) for s in args.sizes_kb.split(',')):
+        payload = inflate(template, size_kb)
+        body = json.dumps(payload).encode()
+
+        old = per_op_us(lambda r: old_fields(r.get_json()), lambda: requests_for(body, args.repeat))
+        new = per_op_us(lambda r: events.decode_event(r.get_data()), lambda: requests_for(body, args.repeat))
+        events.loads = json.loads
+        std = per_op_us(lambda r: events.decode_event(r.get_data()), lambda: requests_for(body, args.repeat))
+        events.loads = fast_loads
+
+        unhandled = copy.deepcopy(payload)
+        unhandled['message']['type'] = 'conversation-update'
+        unhandled_body = json.dumps(unhandled).encode()
+        full = per_op_us(lambda b: old_fields(json.loads(b)), lambda: [unhandled_body] * args.repeat)
+        peek = per_op_us(events.decode_event, lambda: [unhandled_body] * args.repeat)
+
+        print(f"{len(body) / 1024:>6.0f} KB {old:>7.0f} us {new:>7.0f} us {std:>8.0f} us {full:>7.0f} us "
+              f"{peek:>5.0f} us {old / new:>7.1f}x")
+
+        same = new_fields(events.decode_event(body)) == old_fields(json.loads(body))
+        skipped = isinstance(events.decode_event(unhandled_body), events.UnhandledEvent)
+        passed &= same and skipped and peek < full / 10
+        if not same:
+            print('  FAIL: event fields differ from full parse')
+        if not skipped or peek >= full / 10:
+            print(f"  FAIL: unhandled event not skipped cheaply ({peek:.0f} vs {full:.0f} us)")
+
+    print()
+    for name in ('assistant-request', 'function-call'):
+        payload = harness.make_event(name, 'bench-events', '+393471234567', 'asst-0000')
+        event = events.decode_event(json.dumps(payload).encode())
+        ok = type(event) is events.EVENT_TYPES[name] and event.call_id == 'bench-events' \
+            and event.assistant_id == 'asst-0000' and not hasattr(event, '__dict__')
+        if name == 'function-call':
+            ok &= event.name == payload['message']['functionCall']['name'] \
+                and event.parameters == payload['message']['functionCall'].get('parameters', {})
+        passed &= ok
+        print(f"{name}: slotted {type(event).__name__}: {'ok' if ok else 'FAIL'}")
+
+    # conversation-update con message.type dopo migliaia di turni
+    late = {'message': {'messages': [{'role': 'user', 'message': 'Sì', 'time': i, 'secondsFromStart': i / 2}
+                                     for i in range(4000)],
+                        'type': 'conversation-update'}}
+    late_body = json.dumps(late).encode()
+    full = per_op_us(events.loads, lambda: [late_body] * args.repeat)
+    peek = per_op_us(events.decode_event, lambda: [late_body] * args.repeat)
+    uncapped = per_op_us(lambda b: events.peek_event_type(b, max_tokens=len(b)), lambda: [late_body] * args.repeat)
+    ok = isinstance(events.decode_event(late_body), events.UnhandledEvent) \
+        and events.decode_event(late_body).type == 'conversation-update' \
+        and events.peek_event_type(late_body) is None and peek < full * 1.5 + 50
+    passed &= ok
+    print(f"\ntype after {len(late['message']['messages'])} messages ({len(late_body) / 1024:.0f} KB): "
+          f"full parse {full:.0f} us, decode_event {peek:.0f} us (peek capped at {events.PEEK_MAX_TOKENS} "
+          f"tokens; uncapped peek alone {uncapped:.0f} us): {'ok' if ok else 'FAIL'}")
+
+    print('\npeek cases:')
+    for body, expected in peek_cases():
+        got = events.peek_event_type(body)
+        passed &= got == expected
+        print(f"  {body.decode()[:72]:<72} -> {got!r} {'ok' if got == expected else 'FAIL'}")
+
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Replay concorrente di eventi webhook duplicati (idempotency.py)
+
+Rimanda lo stesso end-of-call-report più volte in parallelo, su una
+istanza e su più istanze simulate (guard separati sullo stesso Firestore
+fake), e conta i side effect: incrementi di users.monthly_calls e messaggi
+WhatsApp inviati. Controlla anche retry dopo il completamento, rilascio
+del marker se l'handler fallisce e ripresa di una lease scaduta.
+Esce con codice 1 se un duplicato produce side effect.
+
+Uso:
+    python backend/benchmarks/bench_idempotency.py
+    python backend/benchmarks/bench_idempotency.py --replays 32 --instances 4 --write-latency-ms 5
+"""
+import argparse
+import logging
+import statistics
+import sys
+import threading
+import time
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import idempotency  # noqa: E402
+import vapi_webhook  # noqa: E402
+from events import event_from_payload  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+
+EVENT = 'end-of-call-report'
+_ids = iter(range(10 ** 6))
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def setup(write_latency):
+    db = FakeFirestore(write_latency=write_latency)
+    harness.seed_dataset(db, 0, n_tenants=1)
+    twilio = FakeTwilio()
+    clients.set_firestore(db)
+    clients.set_twilio(twilio)
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    return db, twilio
+
+
+def new_event():
+    assistant_id, user_id, _ = harness.tenant_ids(0)
+    call_id = f"replay-{next(_ids):05d}"
+    return call_id, user_id, harness.make_event(EVENT, call_id, '+393471234567', assistant_id)
+
+
+def side_effects(db, twilio, user_id):
+    user = db.collection('users').document(user_id).get().to_dict()
+    return user.get('monthly_calls', 0), len(twilio.sent)
+
+
+def replay(fns):
+    """Esegue le funzioni insieme (barriera), ritorna [(risposta, ms)]"""
+    barrier = threading.Barrier(len(fns))
+    results = [None] * len(fns)
+
+    def _worker(i, fn):
+        barrier.wait()
+        start = time.perf_counter()
+        response = fn()
+        results[i] = (response, (time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=_worker, args=(i, fn)) for i, fn in enumerate(fns)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def status_of(response):
+    return response[1] if isinstance(response, tuple) else 200
+
+
+def scenario_legacy(db, twilio, replays):
+    """Senza guard: ogni retry rifà tutto"""
+    call_id, user_id, payload = new_event()
+    before = side_effects(db, twilio, user_id)
+    replay([lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload))] * replays)
+    after = side_effects(db, twilio, user_id)
+    return after[0] - before[0], after[1] - before[1], {}
+
+
+def scenario_one_instance(db, twilio, replays):
+    """Stessa istanza: richieste firmate complete attraverso vapi_webhook()"""
+    call_id, user_id, payload = new_event()
+    before = side_effects(db, twilio, user_id)
+    requests = [harness.signed_request(payload) for _ in range(replays)]
+    results = replay([lambda r=r: vapi_webhook.vapi_webhook(r) for r in requests])
+    after = side_effects(db, twilio, user_id)
+    return after[0] - before[0], after[1] - before[1], _statuses(results)
+
+
+def scenario_many_instances(db, twilio, replays, instances):
+    """Istanze diverse: solo il marker durevole le coordina"""
+    call_id, user_id, payload = new_event()
+    guards = [idempotency.IdempotencyGuard(clients.get_firestore) for _ in range(instances)]
+    before = side_effects(db, twilio, user_id)
+    fns = [
+        (lambda g=guards[i % instances]: g.run(call_id, EVENT, lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload))))
+        for i in range(replays)
+    ]
+    results = replay(fns)
+    after = side_effects(db, twilio, user_id)
+    return after[0] - before[0], after[1] - before[1], _statuses(results)
+
+
+def _statuses(results):
+    counts = {}
+    for response, _ in results:
+        counts[status_of(response)] = counts.get(status_of(response), 0) + 1
+    return counts
+
+
+def scenario_latency(db, twilio, rounds):
+    """Originale vs duplicato in memoria vs duplicato da marker (istanza nuova)"""
+    original, memory, durable = [], [], []
+    for _ in range(rounds):
+        call_id, _, payload = new_event()
+        guard = idempotency.IdempotencyGuard(clients.get_firestore)
+        handler = lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload))  # noqa: E731
+        for bucket, g in ((original, guard), (memory, guard),
+                          (durable, idempotency.IdempotencyGuard(clients.get_firestore))):
+            start = time.perf_counter()
+            g.run(call_id, EVENT, handler)
+            bucket.append((time.perf_counter() - start) * 1000)
+    return statistics.median(original), statistics.median(memory), statistics.median(durable)
+
+
+def scenario_failure_and_lease(db, twilio):
+    """Handler che fallisce rilascia il marker; lease scaduta viene ripresa"""
+    ok = True
+    call_id, user_id, payload = new_event()
+    guard = idempotency.IdempotencyGuard(clients.get_firestore)
+
+    def _boom():
+        raise RuntimeError('handler failure')
+
+    try:
+        guard.run(call_id, EVENT, _boom)
+    except RuntimeError:
+        pass
+    marker = db.collection(idempotency.EVENTS_COLLECTION).document(idempotency.event_key(call_id, EVENT)).get()
+    ok &= not marker.exists
+    before = side_effects(db, twilio, user_id)
+    guard.run(call_id, EVENT, lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload)))
+    after = side_effects(db, twilio, user_id)
+    ok &= after[0] - before[0] == 1
+    print(f"  failure releases marker, retry processes once: {'ok' if ok else 'FAIL'}")
+
+    # Istanza crashata a metà: marker processing mai completato
+    call_id, user_id, payload = new_event()
+    clock = Clock()
+    crashed = idempotency.IdempotencyGuard(clients.get_firestore, clock=clock)
+    crashed._claim(idempotency.event_key(call_id, EVENT), call_id, EVENT)
+    retry = idempotency.IdempotencyGuard(clients.get_firestore, clock=clock)
+    early = retry.run(call_id, EVENT, lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload)))
+    clock.now += idempotency.LEASE_SECONDS + 1
+    before = side_effects(db, twilio, user_id)
+    late = retry.run(call_id, EVENT, lambda: vapi_webhook.handle_end_of_call(event_from_payload(payload)))
+    after = side_effects(db, twilio, user_id)
+    lease_ok = status_of(early) == 409 and status_of(late) == 200 and after[0] - before[0] == 1
+    print(f"  in-progress retry gets 409, expired lease taken over once: {'ok' if lease_ok else 'FAIL'}")
+    return ok and lease_ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay concorrente eventi duplicati')
+    parser.add_argument('--replays', type=int, default=16, help='Copie concorrenti dello stesso evento')
+    parser.add_argument('--instances', type=int, default=4, help='Istanze simulate')
+    parser.add_argument('--write-latency-ms', type=float, default=2.0, help='Latenza commit Firestore fake')
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    # Il replay legacy fa fallire transazioni per contesa: atteso, non rumoroso
+    logging.disable(logging.ERROR)
+    db, twilio = setup(args.write_latency_ms / 1000)
+    passed = True
+
+    print(f"{'scenario':<28} {'monthly_calls +':>16} {'whatsapp sent':>14}  responses")
+    rows = [
+        ('legacy (no dedup)', scenario_legacy(db, twilio, args.replays), False),
+        ('one instance', scenario_one_instance(db, twilio, args.replays), True),
+        (f"{args.instances} instances", scenario_many_instances(db, twilio, args.replays, args.instances), True),
+    ]
+    for name, (calls, sent, statuses), checked in rows:
+        print(f"{name:<28} {calls:>16} {sent:>14}  {statuses or '-'}")
+        if checked:
+            passed &= calls == 1 and sent == 1
+
+    db.write_latency = 0.0
+    original_ms, memory_ms, durable_ms = scenario_latency(db, twilio, args.rounds)
+    print(f"\nlatency p50: original {original_ms:.3f} ms, duplicate in-memory {memory_ms:.3f} ms, "
+          f"duplicate from marker {durable_ms:.3f} ms")
+    print('\nedge cases:')
+    passed &= scenario_failure_and_lease(db, twilio)
+
+    print(f"\n{'PASS' if passed else 'FAIL'}: duplicates without side effects")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+Benchmark inventario immobili (check_availability)
+
+Popola il fake Firestore con N annunci di un tenant sulle zone di Milano
+della dashboard, poi misura:
+- caricamento completo dell'indice
+- latenza delle query (zona / tipologia / budget / caratteristiche)
+- refresh incrementale dopo K modifiche
+Verifica su un inventario piccolo: esempi di vendita prima degli affitti
+da tutti i gruppi della zona, inventario vuoto e zona con tutti i gruppi
+filtrati -> "non abbiamo ... disponibili" (niente eccezioni). Esce con
+codice 1 se qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_inventory.py --listings 50000
+    python backend/benchmarks/bench_inventory.py --listings 50000 --max-query-us 1000
+"""
+import argparse
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import harness
+
+harness.setup_path()
+
+from bench_zone_resolver import load_milan_zones  # noqa: E402
+from fakes import FakeFirestore  # noqa: E402
+from inventory import InventoryIndex, format_availability, search_parameters  # noqa: E402
+
+ZONE_LABELS = {
+    'porta-romana': 'Porta Romana', 'citta-studi': 'Città Studi', 'porta-venezia': 'Porta Venezia',
+    'san-siro': 'San Siro', 'buenos-aires': 'Buenos Aires', 'stazione-centrale': 'Stazione Centrale',
+}
+
+# Parametri come arrivano da Vapi
+QUERIES = [
+    {'zona': 'Porta Romana', 'tipo_immobile': 'trilocale', 'budget_max': 500000},
+    {'zona': 'P.ta Romana', 'tipo_immobile': 'bilocale', 'budget': '300 mila euro'},
+    {'zona': 'Navigli', 'tipo_immobile': 'bilocale', 'tipo_richiesta': 'affittare', 'budget': '1.200 euro al mese'},
+    {'zona': 'Città Studi', 'tipo_immobile': 'appartamento', 'budget': 'tra 250 e 350 mila'},
+    {'zona': 'Brera', 'tipo_immobile': 'attico'},
+    {'zona': 'Darsena', 'tipo_immobile': 'casa', 'budget_max': 600000},
+    {'tipo_immobile': 'villa', 'budget': '2 milioni'},
+    {'zona': 'Isola', 'tipo_immobile': 'trilocale', 'caratteristiche': 'terrazzo,box'},
+    {'zona': 'Monza', 'tipo_immobile': 'trilocale'},
+    {'budget_max': 400000},
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+SMALL_INVENTORY = [
+    ('Brera', 'vendita', 'trilocale', 400000),
+    ('Brera', 'affitto', 'bilocale', 1200),
+    ('Brera', 'vendita', 'bilocale', 300000),
+    ('Isola', 'vendita', 'trilocale', 500000),
+]
+
+
+def small_index(listings):
+    db = FakeFirestore()
+    for n, (zona, contratto, tipo, prezzo) in enumerate(listings):
+        db.seed(f"listings/small-{n}", {
+            'user_id': 'small@example.com', 'zona': zona, 'tipo_immobile': tipo, 'prezzo': prezzo,
+            'mq': 80, 'contratto': contratto, 'caratteristiche': [], 'stato': 'disponibile',
+            'updated_at': datetime(2025, 1, 1) + timedelta(seconds=n),
+        })
+    index = InventoryIndex('small@example.com')
+    index.load(db)
+    return index
+
+
+def correctness_checks():
+    """(etichetta, ok) su inventari piccoli con risultato noto"""
+    index = small_index(SMALL_INVENTORY)
+    brera = index.search(zona='Brera')
+    empty = small_index([])
+    empty_any = empty.search()
+    empty_filtered = empty.search(tipo_immobile='trilocale', budget_max=500000)
+    isola_affitto = index.search(zona='Isola', contratto='affitto')
+    return [
+        ('all groups of the zone in the examples, vendita first',
+         brera.total == 3 and [l.contract for l in brera.examples] == ['vendita', 'vendita', 'affitto']),
+        ('empty inventory -> no listings available',
+         empty_any.total == 0 and empty_filtered.total == 0 and 'non abbiamo' in format_availability(empty_filtered)),
+        ('zone with every group filtered out -> no listings available',
+         isola_affitto.total == 0 and not isola_affitto.examples
+         and 'non abbiamo' in format_availability(isola_affitto)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inventario check_availability')
+    parser.add_argument('--listings', type=int, default=50000)
+    parser.add_argument('--iterations', type=int, default=2000, help='Ripetizioni del set di query')
+    parser.add_argument('--changes', type=int, default=200, help='Modifiche per il refresh incrementale')
+    parser.add_argument('--max-query-us', type=float, default=None, help='Soglia p99 query (exit 1 se superata)')
+    parser.add_argument('--verbose', action='store_true', help='Stampa le risposte parlate')
+    args = parser.parse_args()
+
+    zones = [ZONE_LABELS.get(z, z.replace('-', ' ').title()) for z in load_milan_zones()]
+    db = FakeFirestore()
+    harness.seed_listings(db, 'agency@example.com', args.listings, zones)
+    db.reset_counters()
+
+    index = InventoryIndex('agency@example.com')
+    start = time.perf_counter()
+    index.load(db)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    # Costo del solo indice (senza lo stream del fake)
+    docs = [(doc.id, doc.to_dict()) for doc in db.collection('listings').stream()]
+    start = time.perf_counter()
+    InventoryIndex('agency@example.com').apply(docs)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    queries = [search_parameters(q) for q in QUERIES]
+    per_query = {i: [] for i in range(len(queries))}
+    for _ in range(args.iterations):
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            index.search(**query)
+            per_query[i].append((time.perf_counter() - start) * 1e6)
+
+    all_times = [t for times in per_query.values() for t in times]
+
+    # Refresh incrementale: K annunci modificati dopo il caricamento
+    updated_at = datetime(2025, 1, 1) + timedelta(seconds=args.listings + 1)
+    for n in range(args.changes):
+        listing_id = f"agency@example.com-{n * 7 % args.listings:06d}"
+        data = db.collection('listings').document(listing_id).get().to_dict()
+        data['prezzo'] = data['prezzo'] * 0.95
+        data['stato'] = 'venduto' if n % 5 == 0 else 'disponibile'
+        data['updated_at'] = updated_at
+        db.seed(f"listings/{listing_id}", data)
+    db.reset_counters()
+    start = time.perf_counter()
+    fetched = index.refresh(db)
+    refresh_ms = (time.perf_counter() - start) * 1000
+    refresh_reads = db.counters()['reads']
+
+    print(f"listings: {args.listings}, available in index: {len(index)}")
+    print(f"full load (fake stream):     {load_ms:9.1f} ms")
+    print(f"index build only:            {build_ms:9.1f} ms")
+    print(f"incremental refresh:         {refresh_ms:9.1f} ms  ({fetched} docs, {refresh_reads} reads)")
+    print(f"query p50 / p99 (all):       {percentile(all_times, 50):9.1f} / {percentile(all_times, 99):.1f} us")
+    print()
+    print(f"{'p50 us':>8} {'p99 us':>8} {'matches':>8}  query")
+    for i, query in enumerate(QUERIES):
+        result = index.search(**queries[i])
+        print(f"{percentile(per_query[i], 50):8.1f} {percentile(per_query[i], 99):8.1f} {result.total:8d}  {query}")
+        if args.verbose:
+            print(f"{'':27} {format_availability(result)}")
+
+    checks = correctness_checks()
+    if args.max_query_us is not None:
+        checks.append((f"query p99 <= {args.max_query_us:g} us", percentile(all_times, 99) <= args.max_query_us))
+
+    passed = True
+    print('\nchecks:')
+    for label, ok in checks:
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+        passed &= ok
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
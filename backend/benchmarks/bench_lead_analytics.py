@@ -0,0 +1,224 @@
+"""
+Benchmark analytics lead: rollup giornalieri/mensili vs scansione di `calls`
+
+Storico di chiamate su più mesi per alcuni tenant. Confronta la vista
+analytics di un tenant (ultimi 30 / 90 giorni):
+- scan:   query `calls` del tenant come fa oggi la dashboard (una read
+          per chiamata, cresce con lo storico)
+- rollup: get_lead_analytics (mesi interi + giorni ai bordi, una get_all)
+Verifica che i due risultati coincidano, che i rollup incrementali
+scritti dal webhook (analytics e usage_rollups) coincidano con il rebuild
+dai documenti `calls`, anche per chiamate iniziate il mese prima e finite
+in questo, e che fine chiamata concorrenti dello stesso tenant non
+perdano incrementi.
+Esce con codice 1 se qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_lead_analytics.py
+    python backend/benchmarks/bench_lead_analytics.py --calls 50000 --tenants 10 --days 180
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import lead_analytics  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+from usage_rollup import month_key  # noqa: E402
+
+ZONES = ['Porta Romana', 'Brera', 'Navigli', 'Isola', 'Città Studi', 'Porta Venezia', 'Non specificato']
+REQUESTS = ['comprare', 'vendere', 'affittare', 'Non specificato']
+PROPERTIES = ['bilocale', 'trilocale', 'quadrilocale', 'attico', 'Non specificato']
+BUDGETS = ['300.000 €', '450.000 - 500.000 €', '250k', '1,2 milioni', 'Non specificato']
+FEATURES = ['balcone', 'terrazzo', 'piano alto', 'con ascensore', 'posto auto', 'cantina']
+
+
+def random_lead(rng):
+    client_info = {
+        'nome': rng.choice(['Giulia Bianchi', 'Marco Rossi', 'Non specificato']),
+        'telefono': '+393471234567',
+        'zona': rng.choice(ZONES),
+        'tipo_richiesta': rng.choice(REQUESTS),
+        'tipo_immobile': rng.choice(PROPERTIES),
+        'budget': rng.choice(BUDGETS),
+        'note': '',
+    }
+    lead = {'features': rng.sample(FEATURES, rng.randrange(3)), 'urgent': rng.random() < 0.2}
+    return client_info, lead
+
+
+def seed_history(db, n_calls, n_tenants, days, now):
+    """Chiamate completate distribuite negli ultimi `days` giorni"""
+    rng = random.Random(5)
+    for n in range(n_calls):
+        _, user_id, _ = harness.tenant_ids(rng.randrange(n_tenants))
+        client_info, lead = random_lead(rng)
+        db.seed(f"calls/hist-{n:07d}", {
+            'call_id': f"hist-{n:07d}",
+            'user_id': user_id,
+            'status': 'completed',
+            'started_at': now - timedelta(seconds=rng.random() * days * 86400),
+            'duration': rng.randrange(5, 900),
+            'client_info': client_info,
+            'lead_features': lead,
+        })
+
+
+def scan_analytics(db, user_id, days, today):
+    """Come la dashboard oggi: tutte le chiamate completate del tenant, filtro in memoria"""
+    first = today - timedelta(days=days - 1)
+    summary = {}
+    calls = db.collection('calls').where('status', '==', 'completed').where('user_id', '==', user_id).stream()
+    for call in calls:
+        data = call.to_dict()
+        if first <= data['started_at'].date() <= today:
+            lead_analytics.add_counts(summary, lead_analytics.call_counts(data))
+    return summary
+
+
+def comparable(summary):
+    keys = lead_analytics.COUNTERS + lead_analytics.MAPS
+    return {key: summary[key] for key in keys if summary.get(key)}
+
+
+def analytics_docs(db):
+    docs = {}
+    for snapshot in db.collection(lead_analytics.ANALYTICS_COLLECTION).stream():
+        data = snapshot.to_dict()
+        data.pop('updated_at', None)
+        docs[snapshot.id] = data
+    return docs
+
+
+def webhook_calls(db, n, threads, rng_seed=3, started_at=None):
+    """
+    n chiamate (assistant-request + end-of-call) via webhook firmato, su
+    `threads` thread. started_at: startedAt Vapi (default: adesso - durata).
+    """
+    rng = random.Random(rng_seed)
+    assistant_id, _, _ = harness.tenant_ids(0)
+    bodies = []
+    for i in range(n):
+        call_id, number = f"analytics-{rng_seed}-{i:05d}", f"+39347{rng_seed}{i:06d}"
+        start = harness.make_event('assistant-request', call_id, number, assistant_id)
+        end = harness.make_event('end-of-call-report', call_id, number, assistant_id)
+        client_info, _ = random_lead(rng)
+        end['message']['structuredData'].update({k: v for k, v in client_info.items() if k != 'telefono'})
+        end['message']['call']['duration'] = rng.randrange(5, 900)
+        if started_at is not None:
+            end['message']['startedAt'] = harness.vapi_time(started_at)
+        bodies.append((json.dumps(start).encode(), json.dumps(end).encode()))
+
+    def _run(chunk):
+        for start, end in chunk:
+            vapi_webhook.vapi_webhook(harness.signed_request(start))
+            vapi_webhook.vapi_webhook(harness.signed_request(end))
+
+    workers = [threading.Thread(target=_run, args=(bodies[i::threads],)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def usage_docs(db):
+    return {snapshot.id: (snapshot.get('call_count'), snapshot.get('total_duration'))
+            for snapshot in db.collection(usage_rollup.ROLLUP_COLLECTION).stream()}
+
+
+def check_incremental(args):
+    """
+    Rollup scritti a caldo dal webhook == rebuild dai documenti calls, con
+    un quarto delle chiamate iniziate a cavallo del cambio mese
+    """
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=1)
+    clients.set_firestore(db)
+    clients.set_twilio(FakeTwilio())
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+
+    webhook_calls(db, args.webhook_calls, threads=1)
+    webhook_calls(db, args.webhook_calls, threads=4, rng_seed=4)
+    month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    webhook_calls(db, args.webhook_calls // 4, threads=2, rng_seed=5, started_at=month_start - timedelta(seconds=30))
+    vapi_webhook.drain_deferred()  # Inizio chiamata scritto dopo la risposta ad assistant-request
+    incremental = analytics_docs(db), usage_docs(db)
+    month, previous = month_key(month_start), month_key(month_start - timedelta(days=1))
+    result = lead_analytics.rebuild_lead_analytics(db, month)
+    lead_analytics.rebuild_lead_analytics(db, previous)
+    for bucket in (month, previous):
+        usage_rollup.rebuild_monthly_rollups(db, bucket)
+    rebuilt = analytics_docs(db), usage_docs(db)
+    _, user_id, _ = harness.tenant_ids(0)
+    calls = incremental[0].get(lead_analytics.doc_id(user_id, month), {}).get('calls')
+    return incremental == rebuilt, calls == 2 * args.webhook_calls == result['calls']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rollup analytics lead')
+    parser.add_argument('--calls', type=int, default=20000, help='Chiamate storiche')
+    parser.add_argument('--tenants', type=int, default=5)
+    parser.add_argument('--days', type=int, default=120, help='Giorni di storico')
+    parser.add_argument('--webhook-calls', type=int, default=100, help='Chiamate via webhook per il check incrementale')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    now = datetime.now()
+    today = now.date()
+    db = FakeFirestore()
+    seed_history(db, args.calls, args.tenants, args.days, now)
+
+    start = time.perf_counter()
+    months = sorted({month_key(today - timedelta(days=d)) for d in range(args.days + 1)})
+    for month in months:
+        lead_analytics.rebuild_lead_analytics(db, month)
+    print(f"{args.calls} calls, {args.tenants} tenants, {args.days} days: rebuild of {len(months)} months "
+          f"in {time.perf_counter() - start:.1f}s\n")
+
+    _, user_id, _ = harness.tenant_ids(0)
+    print(f"{'view':<10} {'scan reads':>11} {'scan ms':>9} {'rollup reads':>13} {'rollup ms':>10}  same")
+    passed = True
+    for days in (30, 90):
+        db.reset_counters()
+        t0 = time.perf_counter()
+        scanned = scan_analytics(db, user_id, days, today)
+        scan_ms, scan_reads = (time.perf_counter() - t0) * 1000, db.reads
+        db.reset_counters()
+        t0 = time.perf_counter()
+        summary = lead_analytics.get_lead_analytics(db, user_id, days, today)
+        rollup_ms, rollup_reads = (time.perf_counter() - t0) * 1000, db.reads
+        same = comparable(scanned) == comparable(summary)
+        passed &= same and rollup_reads <= 40
+        print(f"{days:>3} days   {scan_reads:>11} {scan_ms:>9.1f} {rollup_reads:>13} {rollup_ms:>10.1f}  "
+              f"{'ok' if same else 'FAIL'}")
+
+    print(f"\n30-day view: {summary['calls']} calls, conversion {summary['conversion_rate']:.0%}, "
+          f"avg budget {summary['budget_average']:,.0f} EUR, top zones "
+          f"{sorted(summary['by_zona'].items(), key=lambda kv: -kv[1])[:3]}")
+
+    same, counted = check_incremental(args)
+    print('\nchecks:')
+    print(f"  webhook increments == rebuild from calls (analytics + usage, across month end): "
+          f"{'ok' if same else 'FAIL'}")
+    print(f"  concurrent end-of-call (4 threads): no lost increments: {'ok' if counted else 'FAIL'}")
+    passed &= same and counted
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
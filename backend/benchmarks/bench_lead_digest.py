@@ -0,0 +1,228 @@
+"""
+Simulazione modalità digest notifiche (lead_digest.py)
+
+Un'ora di punta per un agente con zona popolare, con clock finto e Twilio
+finto: i lead arrivano con intervalli esponenziali, una parte urgenti, e il
+worker `flush_due_digests` gira ogni minuto. Confronta richieste Twilio e
+ritardo di consegna tra invio per-lead (attuale) e digest, e verifica che
+ogni lead sia consegnato esattamente una volta, anche con un invio Twilio
+fallito e con submit concorrenti da più thread.
+
+Uso:
+    python backend/benchmarks/bench_lead_digest.py
+    python backend/benchmarks/bench_lead_digest.py --leads-per-hour 120 --window 300 --burst 5
+"""
+import argparse
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import lead_digest  # noqa: E402
+import notification  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+from lead_features import LeadFeatures  # noqa: E402
+
+USER_ID = 'agency0@example.com'
+DESTINATION = 'whatsapp:+393330000001'
+FROM_NUMBER = 'whatsapp:+390200000000'
+
+
+class Clock:
+    def __init__(self, now=1_750_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Delivery:
+    """Registra quando e come ogni lead è stato consegnato"""
+
+    def __init__(self, clock, digest_failures=0):
+        self.clock = clock
+        self.digest_failures = digest_failures
+        self.delivered = {}   # call_id -> [istanti di consegna]
+        self._lock = threading.Lock()
+        self._send_digest = notification.send_whatsapp_digest
+        notification.send_whatsapp_digest = self._digest
+
+    def _digest(self, leads, destination=None, from_number=None, twilio=None, cc=None):
+        if self.digest_failures:
+            self.digest_failures -= 1
+            raise RuntimeError('Twilio unavailable (fake)')
+        sent = self._send_digest(leads, destination, from_number, twilio=twilio, cc=cc)
+        for lead in leads:
+            self.record(lead['call_id'])
+        return sent
+
+    def record(self, call_id):
+        with self._lock:
+            self.delivered.setdefault(call_id, []).append(self.clock())
+
+    def restore(self):
+        notification.send_whatsapp_digest = self._send_digest
+
+
+def make_leads(n_per_hour, urgent_ratio, seed):
+    rng = random.Random(seed)
+    t = 0.0
+    leads = []
+    while True:
+        t += rng.expovariate(n_per_hour / 3600)
+        if t >= 3600:
+            return leads
+        call_id = f"call-{len(leads):04d}"
+        info = {'nome': f"Cliente {len(leads)}", 'telefono': f"+39347{len(leads):07d}", 'zona': 'Porta Romana',
+                'tipo_richiesta': 'comprare', 'tipo_immobile': 'trilocale', 'budget': '450.000'}
+        leads.append((t, call_id, info, LeadFeatures(['balcone'], rng.random() < urgent_ratio)))
+
+
+def notify(db, twilio, clock, delivery, config, call_id, info, features):
+    """Stessa logica di vapi_webhook._notify / _digest_lead (modalità inline)"""
+    if config is None or features.urgent:
+        notification.send_whatsapp_notification(info, info['telefono'], call_id=call_id,
+                                                 destination_override=DESTINATION, twilio=twilio,
+                                                 from_number=FROM_NUMBER, lead_features=features)
+        delivery.record(call_id)
+        return
+    entry = lead_digest.lead_entry(call_id, info, info['telefono'], features, clock())
+    action, leads = lead_digest.submit_lead(db, config, USER_ID, DESTINATION, FROM_NUMBER, entry, clock=clock)
+    if action == lead_digest.IMMEDIATE:
+        notification.send_whatsapp_notification(info, info['telefono'], call_id=call_id,
+                                                 destination_override=DESTINATION, twilio=twilio,
+                                                 from_number=FROM_NUMBER, lead_features=features)
+        delivery.record(call_id)
+    elif action == lead_digest.DIGEST:
+        try:
+            notification.send_whatsapp_digest(leads, DESTINATION, FROM_NUMBER, twilio=twilio)
+        except Exception:
+            lead_digest.requeue(db, USER_ID, DESTINATION, leads, clock=clock)
+
+
+def simulate(leads, config, flush_every, digest_failures=0):
+    db = FakeFirestore()
+    clients.set_firestore(db)
+    twilio = FakeTwilio()
+    clock = Clock()
+    start = clock.now
+    delivery = Delivery(clock, digest_failures)
+    try:
+        next_flush = start + flush_every
+        for offset, call_id, info, features in leads:
+            while next_flush <= start + offset:
+                clock.now = next_flush
+                lead_digest.flush_due_digests(db, twilio=twilio, clock=clock)
+                next_flush += flush_every
+            clock.now = start + offset
+            notify(db, twilio, clock, delivery, config, call_id, info, features)
+        # Coda finale: il worker continua finché i buffer sono vuoti
+        for _ in range(120):
+            clock.now = next_flush
+            lead_digest.flush_due_digests(db, twilio=twilio, clock=clock)
+            next_flush += flush_every
+    finally:
+        delivery.restore()
+
+    arrivals = {call_id: start + offset for offset, call_id, _, _ in leads}
+    delays = [delivery.delivered[c][0] - arrivals[c] for c in arrivals if c in delivery.delivered]
+    urgent_delays = [delivery.delivered[c][0] - arrivals[c] for _, c, _, f in leads
+                     if f.urgent and c in delivery.delivered]
+    return {
+        'twilio_requests': len(twilio.sent),
+        'missing': [c for c in arrivals if c not in delivery.delivered],
+        'duplicated': [c for c, times in delivery.delivered.items() if len(times) > 1],
+        'p50_delay': statistics.median(delays) if delays else 0,
+        'max_delay': max(delays) if delays else 0,
+        'max_urgent_delay': max(urgent_delays) if urgent_delays else 0,
+    }
+
+
+def concurrent_submits(config, n_threads, per_thread):
+    """Submit concorrenti sulla stessa destinazione: nessun lead perso o duplicato"""
+    db = FakeFirestore(write_latency=0.001)
+    clients.set_firestore(db)
+    clock = Clock()
+    handed_out = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(n_threads)
+
+    fallbacks = []
+
+    def _worker(t):
+        rng = random.Random(t)
+        barrier.wait()
+        for i in range(per_thread):
+            call_id = f"t{t}-{i}"
+            entry = lead_digest.lead_entry(call_id, {'nome': call_id}, '', None, clock())
+            try:
+                action, leads = lead_digest.submit_lead(db, config, USER_ID, DESTINATION, FROM_NUMBER, entry,
+                                                        clock=clock)
+            except Exception:
+                # Come _digest_lead: contesa esaurita -> messaggio singolo
+                action, leads = 'fallback', [entry]
+                fallbacks.append(call_id)
+            with lock:
+                handed_out.extend(lead['call_id'] for lead in leads)
+            time.sleep(rng.uniform(0, 0.005))
+
+    threads = [threading.Thread(target=_worker, args=(t,)) for t in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    state = db.collection(lead_digest.DIGEST_COLLECTION).document(lead_digest.digest_key(USER_ID, DESTINATION)).get()
+    handed_out.extend(lead['call_id'] for lead in state.to_dict()['leads'])
+    expected = n_threads * per_thread
+    return len(handed_out) == expected and len(set(handed_out)) == expected, len(fallbacks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulazione digest notifiche lead')
+    parser.add_argument('--leads-per-hour', type=float, default=60)
+    parser.add_argument('--urgent-ratio', type=float, default=0.1)
+    parser.add_argument('--window', type=int, default=600, help='Finestra digest (secondi)')
+    parser.add_argument('--burst', type=int, default=5, help='Soglia burst')
+    parser.add_argument('--flush-every', type=int, default=60, help='Periodo worker flush (secondi)')
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    leads = make_leads(args.leads_per_hour, args.urgent_ratio, args.seed)
+    config = lead_digest.DigestConfig(True, args.window, args.burst)
+    urgent = sum(1 for lead in leads if lead[3].urgent)
+    print(f"{len(leads)} leads in 1h ({urgent} urgent), window {args.window}s, burst {args.burst}, "
+          f"flush every {args.flush_every}s\n")
+
+    header = (f"{'mode':<26} {'twilio req':>10} {'p50 delay':>10} {'max delay':>10} "
+              f"{'urgent max':>11} {'lost':>5} {'dup':>5}")
+    print(header)
+    print('-' * len(header))
+    passed = True
+    for name, cfg, failures in (('per-lead (current)', None, 0),
+                                ('digest', config, 0),
+                                ('digest, 1 failed digest', config, 1)):
+        r = simulate(leads, cfg, args.flush_every, failures)
+        print(f"{name:<26} {r['twilio_requests']:>10} {r['p50_delay']:>9.0f}s {r['max_delay']:>9.0f}s "
+              f"{r['max_urgent_delay']:>10.0f}s {len(r['missing']):>5} {len(r['duplicated']):>5}")
+        if cfg is not None:
+            passed &= not r['missing'] and not r['duplicated'] and r['max_urgent_delay'] == 0
+            passed &= r['max_delay'] <= args.window + args.flush_every + (lead_digest.RETRY_SECONDS if failures else 0)
+
+    concurrent_ok, fallbacks = concurrent_submits(config, 8, 25)
+    print(f"\nconcurrent submits (8 threads x 25): "
+          f"{'no lost/duplicated leads' if concurrent_ok else 'FAIL'}, {fallbacks} single-message fallbacks")
+    passed &= concurrent_ok
+    print(f"{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Benchmark estrazione caratteristiche/urgenza del lead
+
+Confronta i vecchi controlli a sottostringa (generate_recommendation +
+urgency_words) con il matcher compilato di lead_features:
+- falsi positivi/negativi su frasi tipiche
+- latenza su note brevi e transcript lunghi (una scansione sola)
+
+Uso:
+    python backend/benchmarks/bench_lead_features.py
+    python backend/benchmarks/bench_lead_features.py --sizes 2000,20000,200000 --verbose
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import harness
+
+harness.setup_path()
+
+from lead_features import extract_lead_features, get_extractor  # noqa: E402
+
+# (note, transcript, caratteristiche attese, urgente atteso)
+CASES = [
+    ('Vuole terrazzo e box auto, urgente', '', {'terrazzo', 'posto auto'}, True),
+    ('Ha già chiesto un prestito in banca', '', set(), False),
+    ('Bagno con box doccia, niente garage', '', {'posto auto'}, False),
+    ('Cerca casa luminosa al più presto', '', {'luminoso'}, True),
+    ('Cerca casa luminosa al piu presto', '', {'luminoso'}, True),
+    ('Richiamerà di nuovo domani', '', set(), False),
+    ('Non è urgente, sta solo guardando', '', set(), False),
+    ('Vuole sole e aria, ultimo piano', '', {'piano alto'}, False),
+    ('Nessuna', 'AI: Le serve un box?\nUser: No, però vorrei il balcone e una cantina.', {'balcone', 'cantina'}, False),
+    ('', 'AI: Quando vorrebbe trasferirsi?\nUser: Subito, ho già venduto casa.', set(), True),
+    ('Appartamento arredato con ascensore', '', {'arredato', 'con ascensore'}, False),
+    ('Paga già luce e gas a parte', '', set(), False),
+]
+
+
+def legacy_extract(note, transcript=''):
+    """Logica pre-lead_features (solo note, sottostringhe)"""
+    features = []
+    if note and note != 'Nessuna':
+        n = note.lower()
+        if 'balcon' in n:
+            features.append('balcone')
+        if 'terrazzo' in n or 'terrazza' in n:
+            features.append('terrazzo')
+        if 'luce' in n or 'luminoso' in n or 'sole' in n:
+            features.append('luminoso')
+        if 'piano alto' in n or 'ultimo piano' in n:
+            features.append('piano alto')
+        if 'ascensore' in n:
+            features.append('con ascensore')
+        if 'garage' in n or 'box' in n or 'posto auto' in n:
+            features.append('posto auto')
+        if 'cantina' in n:
+            features.append('cantina')
+        if 'ristrutturato' in n or 'nuovo' in n:
+            features.append('ristrutturato')
+        if 'arredato' in n:
+            features.append('arredato')
+    urgency_words = ['urgente', 'subito', 'immediato', 'veloce', 'presto', 'asap', 'urgenza']
+    urgent = any(w in str(note).lower() for w in urgency_words) if note != 'Nessuna' else False
+    return set(features), urgent
+
+
+def legacy_extract_transcript(note, transcript):
+    """Vecchia logica estesa al transcript: note + transcript lowercased e scansionati per ogni parola"""
+    return legacy_extract(f"{note}\n{transcript}")
+
+
+def make_transcript(size):
+    turns = [
+        "AI: Buongiorno, sono l'assistente dell'agenzia. Come posso aiutarla?",
+        "User: Buongiorno, cerco un trilocale in zona Porta Romana, possibilmente con balcone.",
+        "AI: Perfetto. Ha un budget indicativo?",
+        "User: Intorno ai 400 mila euro, e mi servirebbe anche una cantina.",
+        "AI: Preferisce un piano alto?",
+        "User: Sì, se possibile con ascensore. Devo trasferirmi abbastanza presto per lavoro.",
+    ]
+    text = []
+    length = 0
+    i = 0
+    while length < size:
+        turn = turns[i % len(turns)]
+        text.append(turn)
+        length += len(turn) + 1
+        i += 1
+    return '\n'.join(text)[:size]
+
+
+def timed(fn, note, transcript, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(note, transcript)
+        times.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lead_features')
+    parser.add_argument('--sizes', default='500,5000,50000,200000', help='Lunghezze transcript (caratteri)')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    for name, fn in (('legacy substring', lambda n, t: legacy_extract(n, t)),
+                     ('lead_features', lambda n, t: (lambda r: (set(r.features), r.urgent))(
+                         extract_lead_features(n, t)))):
+        wrong = []
+        for note, transcript, features, urgent in CASES:
+            got = fn(note, transcript)
+            if got != (features, urgent):
+                wrong.append((note, transcript, (features, urgent), got))
+        print(f"{name:<18} correct: {len(CASES) - len(wrong)}/{len(CASES)}")
+        if args.verbose:
+            for note, transcript, expected, got in wrong:
+                print(f"    {note or transcript!r}: atteso {expected}, ottenuto {got}")
+
+    start = time.perf_counter()
+    get_extractor({'features': {'giardino': ['giardino']}, 'urgency': ['rogito a breve']})
+    compile_us = (time.perf_counter() - start) * 1e6
+    print(f"\ncompile tenant vocabulary:   {compile_us:8.1f} us (poi in cache)")
+
+    note = 'Cerca trilocale luminoso con terrazzo, box auto, urgente'
+    print(f"\n{'transcript chars':>16} {'legacy us':>12} {'lead_features us':>17}")
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        transcript = make_transcript(size)
+        legacy_us = timed(legacy_extract_transcript, note, transcript, args.repeat)
+        new_us = timed(extract_lead_features, note, transcript, args.repeat)
+        print(f"{size:>16} {legacy_us:12.1f} {new_us:17.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
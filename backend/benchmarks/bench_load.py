@@ -0,0 +1,248 @@
+"""
+Load test del webhook Vapi su un'istanza locale (functions_framework)
+
+Avvia `vapi_webhook` come in Cloud Functions (functions_framework.create_app
+su main.py) su un server HTTP locale, con Firestore e Twilio finti con
+latenza configurabile. Il generatore invia richieste firmate con lo
+stesso schema HMAC di verify_vapi_signature e riproduce il ciclo di vita
+di una chiamata per N tenant:
+    assistant-request -> function-call -> end-of-call-report
+Arrivi di Poisson a ritmo crescente (--rates), open loop: le richieste
+partono all'orario previsto anche se il server rallenta, e la latenza è
+misurata dall'orario previsto (la coda lato client conta).
+
+Per ogni ritmo: throughput, p50/p95/p99 ed errori per tipo evento. Alla
+fine il ritmo massimo a cui assistant-request resta nel budget di latenza
+(il primo saluto aspetta la risposta) e le chiamate contemporanee
+equivalenti con la durata media reale (legge di Little).
+
+Il server limita le richieste in parallelo a --threads come il worker
+gunicorn di functions_framework (default 4 x CPU, variabile THREADS).
+Esce con codice 1 se le chiamate salvate non tornano con gli
+end-of-call-report accettati/inviati (o con i WhatsApp inviati).
+
+Uso:
+    python backend/benchmarks/bench_load.py
+    python backend/benchmarks/bench_load.py --rates 5,10,20,40 --duration 20 --tenants 100 --read-latency-ms 15
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import requests  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+
+EVENTS = ('assistant-request', 'function-call', 'end-of-call-report')
+ZONES = ['porta-romana', 'brera', 'navigli', 'isola', 'citta-studi', 'porta-venezia']
+
+
+class LocalInstance:
+    """Istanza locale della function: app functions_framework su un server werkzeug"""
+
+    def __init__(self, threads):
+        import functions_framework
+        from werkzeug.serving import make_server
+
+        app = functions_framework.create_app(
+            target='vapi_webhook', source=os.path.join(harness.FUNCTIONS_DIR, 'main.py'))
+        slots = self._slots = threading.BoundedSemaphore(threads)
+        self._threads = threads
+
+        def limited(environ, start_response):
+            # Come gunicorn gthread: al massimo `threads` richieste servite insieme
+            with slots:
+                return list(app(environ, start_response))
+
+        self._server = make_server('127.0.0.1', 0, limited, threaded=True)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def drain(self):
+        """Attende le richieste ancora in corso (anche quelle scadute lato client)"""
+        for _ in range(self._threads):
+            self._slots.acquire()
+        for _ in range(self._threads):
+            self._slots.release()
+
+    def close(self):
+        self._server.shutdown()
+        self._thread.join()
+
+
+def setup_backends(args):
+    """Fake con latenza iniettata, tenant e listing; cache di processo vuote"""
+    db = FakeFirestore(read_latency=args.read_latency_ms / 1000, write_latency=args.write_latency_ms / 1000)
+    harness.seed_dataset(db, 0, n_tenants=args.tenants)
+    for i in range(args.tenants):
+        harness.seed_listings(db, harness.tenant_ids(i)[1], args.listings, ZONES, seed=i)
+    db.reset_counters()
+    twilio = FakeTwilio(latency=args.twilio_latency_ms / 1000)
+    clients.set_firestore(db)
+    clients.set_twilio(twilio)
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+    return db, twilio
+
+
+def schedule(rate, duration, args, rng, prefix):
+    """Eventi (istante, tipo, body) di tutte le chiamate che arrivano in `duration` secondi"""
+    events = []
+    t = rng.expovariate(rate)
+    n = 0
+    while t < duration:
+        assistant_id, _, _ = harness.tenant_ids(rng.randrange(args.tenants))
+        call_id, number = f"{prefix}-{n:06d}", f"+39348{rng.randrange(10 ** 7):07d}"
+        length = args.call_seconds * rng.uniform(0.5, 1.5)
+        for event, offset in zip(EVENTS, (0.0, length * rng.uniform(0.2, 0.8), length)):
+            body = json.dumps(harness.make_event(event, call_id, number, assistant_id)).encode()
+            events.append((t + offset, event, body))
+        n += 1
+        t += rng.expovariate(rate)
+    events.sort(key=lambda e: e[0])
+    return events, n
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {event: [] for event in EVENTS}
+        self.errors = {event: 0 for event in EVENTS}
+        self.accepted_end_of_call = 0
+        self.sent_end_of_call = 0
+        self._lock = threading.Lock()
+
+    def record(self, event, ms, ok):
+        with self._lock:
+            self.latencies[event].append(ms)
+            if event == 'end-of-call-report':
+                self.sent_end_of_call += 1
+            if not ok:
+                self.errors[event] += 1
+            elif event == 'end-of-call-report':
+                self.accepted_end_of_call += 1
+
+
+def run_rate(url, rate, args, rng, prefix):
+    """Open loop a `rate` chiamate/s: ritorna (Recorder, chiamate, secondi, richieste)"""
+    events, n_calls = schedule(rate, args.duration, args, rng, prefix)
+    recorder = Recorder()
+    local = threading.local()
+
+    def send(due, event, body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        try:
+            response = session.post(url, data=body, timeout=args.timeout, headers={
+                'content-type': 'application/json', 'x-vapi-signature': harness.sign(body)})
+            ok = response.status_code == 200 and 'error' not in response.json()
+        except (requests.RequestException, ValueError):
+            ok = False
+        recorder.record(event, (time.perf_counter() - due) * 1000, ok)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for offset, event, body in events:
+            due = start + offset
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(send, due, event, body)
+    return recorder, n_calls, time.perf_counter() - start, len(events)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test del webhook Vapi su istanza locale')
+    parser.add_argument('--rates', default='2,5,10,20', help='Chiamate nuove al secondo, un giro per valore')
+    parser.add_argument('--duration', type=float, default=10.0, help='Secondi di arrivi per giro')
+    parser.add_argument('--tenants', type=int, default=50)
+    parser.add_argument('--listings', type=int, default=200, help='Immobili per tenant (function-call)')
+    parser.add_argument('--call-seconds', type=float, default=4.0,
+                        help='Durata simulata di una chiamata (compressa rispetto a quella reale)')
+    parser.add_argument('--avg-call-seconds', type=float, default=180.0,
+                        help='Durata media reale di una chiamata, per le chiamate contemporanee equivalenti')
+    parser.add_argument('--budget-ms', type=float, default=1000.0, help='Budget p99 di assistant-request')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('THREADS', (os.cpu_count() or 1) * 4)),
+                        help='Richieste servite in parallelo dall\'istanza (gunicorn THREADS)')
+    parser.add_argument('--clients', type=int, default=256, help='Connessioni massime del generatore')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout HTTP del generatore (s)')
+    parser.add_argument('--read-latency-ms', type=float, default=10.0)
+    parser.add_argument('--write-latency-ms', type=float, default=15.0)
+    parser.add_argument('--twilio-latency-ms', type=float, default=80.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    db, twilio = setup_backends(args)
+    instance = LocalInstance(args.threads)
+    rng = random.Random(args.seed)
+    print(f"instance {instance.url} ({args.threads} threads), {args.tenants} tenants, "
+          f"RPC read {args.read_latency_ms}ms / commit {args.write_latency_ms}ms, Twilio {args.twilio_latency_ms}ms\n")
+    print(f"{'calls/s':>7} {'event':<20} {'requests':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>7}")
+
+    sustained = None
+    accepted = sent = 0
+    try:
+        for n, rate in enumerate(float(r) for r in args.rates.split(',')):
+            recorder, n_calls, seconds, n_requests = run_rate(instance.url, rate, args, rng, f"load-{n:02d}")
+            accepted += recorder.accepted_end_of_call
+            sent += recorder.sent_end_of_call
+            for event in EVENTS:
+                values = recorder.latencies[event]
+                errors = recorder.errors[event]
+                print(f"{rate:>7g} {event:<20} {len(values):>8} {len(values) / seconds:>7.1f} "
+                      f"{percentile(values, 50):>8.1f} {percentile(values, 95):>8.1f} "
+                      f"{percentile(values, 99):>8.1f} {errors / max(len(values), 1):>6.1%}")
+            p99 = percentile(recorder.latencies['assistant-request'], 99)
+            within = p99 <= args.budget_ms and not recorder.errors['assistant-request']
+            print(f"{'':>7} {n_calls} calls, {n_requests / seconds:.1f} req/s overall, assistant-request "
+                  f"p99 {'within' if within else 'OVER'} {args.budget_ms:g} ms budget\n")
+            if within:
+                sustained = rate
+            instance.drain()  # Il giro successivo parte con l'istanza scarica
+    finally:
+        instance.close()
+
+    if sustained is None:
+        print(f"no tested rate keeps assistant-request p99 within {args.budget_ms:g} ms")
+    else:
+        print(f"sustained: {sustained:g} new calls/s with assistant-request p99 <= {args.budget_ms:g} ms "
+              f"= ~{sustained * args.avg_call_seconds:.0f} concurrent calls of {args.avg_call_seconds:g}s")
+
+    completed = sum(1 for c in db.collection('calls').stream() if c.to_dict().get('status') == 'completed')
+    # Una richiesta scaduta lato client può essere completata dal server comunque
+    consistent = accepted <= completed <= sent and len(twilio.sent) == completed
+    print(f"\nend-of-call-report sent {sent}, accepted {accepted}, calls saved {completed}, "
+          f"WhatsApp sent {len(twilio.sent)}: {'ok' if consistent else 'FAIL'}")
+    print(f"\n{'PASS' if consistent else 'FAIL'}")
+    return 0 if consistent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
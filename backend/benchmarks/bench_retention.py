@@ -0,0 +1,252 @@
+"""
+Benchmark retention delle chiamate (retention.py)
+
+Storico di chiamate su tre anni per alcuni tenant con retention diverse
+(default, 30 giorni, 2 anni), transcript inline o a chunk compressi; una
+parte delle chiamate senza started_at (solo ended_at o created_at).
+Esegue la retention con interruzioni simulate e verifica:
+- in `calls` restano esattamente le chiamate dentro la retention del
+  proprio tenant, anche quelle senza started_at, nessun chunk transcript
+  orfano
+- ogni chiamata eliminata è nell'archivio una e una sola volta, anche
+  con crash durante le eliminazioni e dopo un append non confermato
+- lettura puntuale dall'indice: stesso documento e transcript completo
+- memoria di picco indipendente dal numero di chiamate (pagina per pagina)
+Riporta chiamate archiviate al secondo, compressione e documenti letti.
+Esce con codice 1 se qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_retention.py
+    python backend/benchmarks/bench_retention.py --calls 20000 --page-size 500
+"""
+import argparse
+import gzip
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import harness
+
+harness.setup_path()
+
+import retention  # noqa: E402
+from fakes import FakeFirestore  # noqa: E402
+from transcript_store import write_transcript  # noqa: E402
+
+TENANTS = 6
+RETENTION_DAYS = {1: 30, 2: 730}  # indice tenant -> retention_days (gli altri: default)
+DEFAULT_DAYS = 365
+NOW = datetime(2025, 6, 1, 12, tzinfo=timezone.utc)
+
+
+class Crash(Exception):
+    pass
+
+
+def seed(n_calls, seed=9):
+    """Fake con tenant e chiamate; ritorna (db, {call_id: scade?}, {call_id: transcript})"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=TENANTS)
+    for i, days in RETENTION_DAYS.items():
+        db.seed(f"users/{harness.tenant_ids(i)[1]}", {
+            **db.collection('users').document(harness.tenant_ids(i)[1]).get().to_dict(), 'retention_days': days})
+    rng = random.Random(seed)
+    expected = {}
+    transcripts = {}
+    for n in range(n_calls):
+        call_id = f"call-{n:07d}"
+        tenant = rng.randrange(TENANTS + 1)  # TENANTS = chiamata senza tenant
+        user_id = harness.tenant_ids(tenant)[1] if tenant < TENANTS else None
+        age_days = rng.random() * 3 * 365
+        transcript = f"AI: Buongiorno, chiamata {call_id}. " + 'User: Cerco un trilocale con terrazzo. ' * rng.randrange(5, 60)
+        data = {
+            'call_id': call_id,
+            'customer_number': f"+39347{rng.randrange(10 ** 7):07d}",
+            'duration': rng.randrange(20, 600),
+            'status': 'completed',
+            'client_info': {'nome': 'Cliente', 'zona': 'Brera', 'tipo_richiesta': 'comprare'},
+        }
+        # Inizio chiamata mai salvato: datata da ended_at, o solo da created_at
+        dated = rng.random()
+        if dated < 0.9:
+            data['started_at'] = NOW - timedelta(days=age_days)
+        elif dated < 0.96:
+            data['ended_at'] = NOW - timedelta(days=age_days)
+        else:
+            data['created_at'] = NOW - timedelta(days=age_days)
+        if user_id:
+            data['user_id'] = user_id
+        if rng.random() < 0.5:
+            data['transcript'] = transcript
+        else:
+            batch = db.batch()
+            data.update(write_transcript(db, batch, call_id, transcript))
+            batch.commit()
+        db.seed(f"calls/{call_id}", data)
+        transcripts[call_id] = transcript
+        expected[call_id] = age_days > RETENTION_DAYS.get(tenant, DEFAULT_DAYS)
+    db.reset_counters()
+    return db, expected, transcripts
+
+
+def new_run(db, archive_dir, args, checkpoint='bench'):
+    return retention.Retention(db, archive_dir, DEFAULT_DAYS, args.page_size, checkpoint=checkpoint, now=NOW)
+
+
+def crash_after_commits(db, commits):
+    """Il batch numero `commits` fallisce (processo interrotto a metà eliminazioni)"""
+    original = db.batch
+    count = [0]
+
+    def batch():
+        real = original()
+        commit = real.commit
+
+        def failing_commit():
+            count[0] += 1
+            if count[0] == commits:
+                raise Crash()
+            return commit()
+
+        real.commit = failing_commit
+        return real
+
+    db.batch = batch
+    return lambda: setattr(db, 'batch', original)
+
+
+def crash_after_append(appends):
+    """L'append numero `appends` arriva su disco ma il checkpoint no"""
+    original = retention.ArchiveWriter.append
+    count = [0]
+
+    def append(self, records):
+        result = original(self, records)
+        count[0] += 1
+        if count[0] == appends:
+            raise Crash()
+        return result
+
+    retention.ArchiveWriter.append = append
+    return lambda: setattr(retention.ArchiveWriter, 'append', original)
+
+
+def run_with_crashes(db, archive_dir, args):
+    """Run interrotto due volte, ripreso ogni volta dal checkpoint"""
+    crashes = 0
+    for inject in (lambda: crash_after_commits(db, 3), lambda: crash_after_append(5), lambda: (lambda: None)):
+        restore = inject()
+        run = new_run(db, archive_dir, args)
+        run.resume()
+        try:
+            report = run.run()
+        except Crash:
+            crashes += 1
+            continue
+        finally:
+            restore()
+        return report, crashes
+    raise RuntimeError('run not completed')
+
+
+def archived_ids(archive_dir, name='bench'):
+    ids = []
+    with gzip.open(f"{archive_dir}/{name}{retention.ARCHIVE_SUFFIX}", 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            ids.append(json.loads(line)['_id'])
+    return ids
+
+
+def peak_memory_kb(n_calls, args):
+    """Picco tracemalloc del solo run di retention"""
+    db, _, _ = seed(n_calls)
+    archive_dir = tempfile.mkdtemp(prefix='retention-')
+    try:
+        tracemalloc.start()
+        new_run(db, archive_dir, args, checkpoint=None).run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / 1024
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark retention chiamate')
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    db, expected, transcripts = seed(args.calls)
+    no_started_at = {snapshot.id for snapshot in db.collection('calls').stream()
+                     if 'started_at' not in snapshot.to_dict()}
+    db.reset_counters()
+    expired = {call_id for call_id, old in expected.items() if old}
+    archive_dir = tempfile.mkdtemp(prefix='retention-')
+    passed = True
+    try:
+        start = time.perf_counter()
+        report, crashes = run_with_crashes(db, archive_dir, args)
+        seconds = time.perf_counter() - start
+        stats = report['stats']
+        raw_bytes = sum(len(retention.archive_record(call_id, {'transcript': transcripts[call_id]}))
+                        for call_id in expired)
+        print(f"{args.calls} calls over 3 years, {TENANTS} tenants (+ no tenant), retention "
+              f"{DEFAULT_DAYS}d default / {sorted(RETENTION_DAYS.values())} custom\n")
+        print(f"expired {len(expired)}, archived {stats['archived']} in {seconds:.1f}s "
+              f"({stats['archived'] / seconds:.0f} calls/s) with {crashes} simulated crashes")
+        print(f"scanned {stats['scanned']} (calls older than the shortest retention), "
+              f"retained {stats['retained']}, {stats['deleted_docs']} docs deleted in {stats['commits']} commits")
+        print(f"archive {stats['archive_bytes']:,} bytes vs ~{raw_bytes:,} bytes of transcripts as JSON")
+
+        remaining = {snapshot.id for snapshot in db.collection('calls').stream()}
+        orphan_chunks = sum(1 for path in db._docs if path.startswith('calls/')
+                            and path.count('/') == 3 and path.split('/')[1] in expired)
+        ids = archived_ids(archive_dir)
+        undated = expired & no_started_at
+        rng = random.Random(1)
+        sample = rng.sample(sorted(expired), min(50, len(expired)))
+        lookups_ok = True
+        start = time.perf_counter()
+        for call_id in sample:
+            record = retention.find_archived_call(archive_dir, call_id)
+            lookups_ok &= record is not None and record['transcript'] == transcripts[call_id] \
+                and record['call_id'] == call_id
+        lookup_ms = (time.perf_counter() - start) / max(len(sample), 1) * 1000
+        missing_lookup = retention.find_archived_call(archive_dir, 'not-a-call') is None
+
+        small = peak_memory_kb(args.calls // 4, args)
+        large = peak_memory_kb(args.calls, args)
+        print(f"point lookup: {lookup_ms:.1f} ms; peak memory {small:,.0f} KB ({args.calls // 4} calls) "
+              f"vs {large:,.0f} KB ({args.calls} calls)")
+
+        checks = [
+            ('calls left == calls within their tenant retention', remaining == set(expected) - expired),
+            ('calls without started_at archived by ended_at / created_at',
+             undated <= set(ids) and not undated & remaining),
+            ('no transcript chunks left for deleted calls', orphan_chunks == 0),
+            ('every expired call archived exactly once despite crashes',
+             crashes == 2 and len(ids) == len(set(ids)) and set(ids) == expired),
+            ('point lookup returns the full document and transcript', lookups_ok and missing_lookup),
+            ('peak memory bounded by the page, not the collection', large < 2 * small),
+        ]
+    finally:
+        shutil.rmtree(archive_dir)
+
+    print('\nchecks:')
+    for label, ok in checks:
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+        passed &= ok
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
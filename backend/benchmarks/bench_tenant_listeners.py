@@ -0,0 +1,277 @@
+"""
+Benchmark cache tenant con listener on_snapshot (tenant_cache.TenantListeners)
+
+Simula ore di traffico su un'istanza calda con tempo finto: lookup del
+contesto tenant a ritmo costante mentre i clienti modificano zone
+(users) e numero Twilio (orders). Confronta:
+- ttl:    solo scadenza (15 minuti) -> lookup su dati vecchi, letture al miss
+- listen: listener su orders/users  -> aggiornamento alla modifica
+Per ogni modalità: lookup serviti con dati non aggiornati, ritardo massimo,
+letture Firestore sull'hot path.
+
+Il fake consegna gli snapshot in modo sincrono (come l'emulatore in
+locale); in produzione arrivano in genere entro un secondo.
+
+Controlli: order riassegnato -> entry invalidata, cap dei listener,
+webhook end-to-end (routing al nuovo agente senza letture), thread
+concorrenti di lettura e scrittura senza deadlock, caricamento bloccato
+che non blocca gli altri thread oltre wait_timeout. Esce con codice 1 se
+qualcosa non torna.
+
+Uso:
+    python backend/benchmarks/bench_tenant_listeners.py
+    python backend/benchmarks/bench_tenant_listeners.py --hours 4 --tenants 50 --edit-every 60
+"""
+import argparse
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import vapi_webhook  # noqa: E402
+from events import event_from_payload  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+from notification import format_whatsapp_number  # noqa: E402
+from tenant_cache import TenantCache, TenantListeners, load_tenant_context  # noqa: E402
+
+ZONE = 'porta-romana'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def new_cache(db, clock, mode, max_tenants=100):
+    cache = TenantCache(lambda assistant_id: load_tenant_context(db, assistant_id), clock=clock)
+    listeners = TenantListeners(cache, lambda: db, max_tenants=max_tenants) if mode == 'listen' else None
+    return cache, listeners
+
+
+def is_current(db, context):
+    """Il contesto in cache corrisponde ai documenti attuali?"""
+    order = db.collection('orders').document(context.order_id).get().to_dict()
+    user = db.collection('users').document(context.user_id).get().to_dict()
+    return context.zone_assignments == user.get('zone_assignments') and \
+        context.from_number == format_whatsapp_number(order['twilio_phone_number'])
+
+
+def simulate(args, mode):
+    """Ore di traffico con modifiche: (lookup stale, ritardo max s, letture hot path, stats listener)"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=args.tenants)
+    clock = Clock()
+    cache, listeners = new_cache(db, clock, mode)
+    rng = random.Random(11)
+
+    stale = 0
+    max_delay = 0.0
+    edited_at = {}  # indice tenant -> tempo della modifica non ancora vista
+    hot_reads = 0
+    step = 1.0 / args.lookups_per_second
+    next_edit = args.edit_every
+    for n in range(int(args.hours * 3600 * args.lookups_per_second)):
+        clock.now = n * step
+        if clock.now >= next_edit:
+            next_edit += args.edit_every
+            i = rng.randrange(args.tenants)
+            _, user_id, order_id = harness.tenant_ids(i)
+            if rng.random() < 0.7:
+                db.collection('users').document(user_id).set(
+                    {'zone_assignments': {ZONE: {'whatsapp': f"+39340{n:07d}"}}}, merge=True)
+            else:
+                db.collection('orders').document(order_id).update({'twilio_phone_number': f"+3906{n:07d}"})
+            edited_at.setdefault(i, clock.now)
+
+        i = rng.randrange(args.tenants)
+        assistant_id, _, _ = harness.tenant_ids(i)
+        reads = db.reads
+        context = cache.get(assistant_id)
+        hot_reads += db.reads - reads
+
+        reads = db.reads
+        current = is_current(db, context)
+        db.reads = reads  # Verifica fuori conteggio
+        if current:
+            edited_at.pop(i, None)
+        else:
+            stale += 1
+            max_delay = max(max_delay, clock.now - edited_at.get(i, clock.now))
+    return stale, max_delay, hot_reads, listeners.stats() if listeners else {}
+
+
+def check_detach():
+    """Order riassegnato a un altro assistant: l'entry non deve più servirlo"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=2)
+    cache, listeners = new_cache(db, Clock(), 'listen')
+    assistant_id, _, order_id = harness.tenant_ids(0)
+    cache.get(assistant_id)
+    db.collection('orders').document(order_id).update({'vapi_assistant_id': 'asst-moved'})
+    return cache.get(assistant_id) is None and listeners.stats()['invalidations'] == 1
+
+
+def check_cap():
+    """Oltre max_tenants i più vecchi escono dai listener ma restano in cache"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=10)
+    cache, listeners = new_cache(db, Clock(), 'listen', max_tenants=4)
+    for i in range(10):
+        cache.get(harness.tenant_ids(i)[0])
+    stats = listeners.stats()
+    reads = db.reads
+    for i in range(10):
+        cache.get(harness.tenant_ids(i)[0])
+    return stats['tenants'] == 4 and stats['listeners'] == 8 and db.reads == reads
+
+
+def check_webhook():
+    """Zona riassegnata dal cliente: la chiamata successiva va al nuovo agente, zero letture tenant"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=1)
+    clients.set_firestore(db)
+    clients.set_twilio(FakeTwilio())
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    listeners = TenantListeners(vapi_webhook._tenant_cache, clients.get_firestore)
+    assistant_id, user_id, _ = harness.tenant_ids(0)
+    try:
+        def end_of_call(call_id):
+            payload = harness.make_event('end-of-call-report', call_id, '+393471234567', assistant_id)
+            vapi_webhook.handle_end_of_call(event_from_payload(payload))
+            return db.collection('calls').document(call_id).get().to_dict()['assigned_agent']
+
+        before = end_of_call('listen-1')
+        db.collection('users').document(user_id).set(
+            {'zone_assignments': {ZONE: {'whatsapp': '+393409999999'}}}, merge=True)
+        reads = vapi_webhook._tenant_cache.stats()['loads']
+        after = end_of_call('listen-2')
+        loads = vapi_webhook._tenant_cache.stats()['loads'] - reads
+        return before != after and after.endswith('+393409999999') and loads == 0
+    finally:
+        listeners.close()
+        vapi_webhook._tenant_cache.on_load = None
+        vapi_webhook._tenant_cache.invalidate()
+
+
+def check_concurrency(seconds=2.0):
+    """Lettori e scrittori concorrenti: nessun deadlock, cache allineata alla fine"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=8)
+    cache, listeners = new_cache(db, Clock(), 'listen')
+    stop = threading.Event()
+    errors = []
+
+    def reader(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            try:
+                cache.get(harness.tenant_ids(rng.randrange(8))[0])
+            except Exception as e:
+                errors.append(e)
+
+    def writer(seed):
+        rng = random.Random(seed)
+        n = 0
+        while not stop.is_set():
+            n += 1
+            _, user_id, order_id = harness.tenant_ids(rng.randrange(8))
+            db.collection('users').document(user_id).set(
+                {'zone_assignments': {ZONE: {'whatsapp': f"+39341{seed}{n:06d}"}}}, merge=True)
+            db.collection('orders').document(order_id).update({'twilio_phone_number': f"+3907{seed}{n:06d}"})
+
+    threads = [threading.Thread(target=reader, args=(i,), daemon=True) for i in range(6)]
+    threads += [threading.Thread(target=writer, args=(i,), daemon=True) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    stop.wait(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join(5)
+    alive = any(thread.is_alive() for thread in threads)
+    aligned = all(is_current(db, cache.get(harness.tenant_ids(i)[0])) for i in range(8))
+    return not alive and not errors and aligned
+
+
+def check_stuck_load(wait_timeout=0.05):
+    """Primo caricamento bloccato: gli altri thread caricano da sé dopo wait_timeout"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=1)
+    assistant_id = harness.tenant_ids(0)[0]
+    release = threading.Event()
+    first = [True]
+
+    def loader(assistant_id):
+        if first[0]:
+            first[0] = False
+            release.wait(5)  # RPC bloccata
+        return load_tenant_context(db, assistant_id)
+
+    cache = TenantCache(loader, wait_timeout=wait_timeout)
+    leader = threading.Thread(target=cache.get, args=(assistant_id,), daemon=True)
+    leader.start()
+    while not cache._inflight:
+        time.sleep(0.001)
+    results = []
+    followers = [threading.Thread(target=lambda: results.append(cache.get(assistant_id)), daemon=True)
+                 for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    for thread in followers:
+        thread.join(1)
+    served = len(results) == 4 and all(is_current(db, context) for context in results)
+    release.set()
+    leader.join(5)
+    return served and not leader.is_alive() and cache.stats()['wait_timeouts'] >= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cache tenant con listener on_snapshot')
+    parser.add_argument('--hours', type=float, default=2.0, help='Ore di traffico simulate')
+    parser.add_argument('--tenants', type=int, default=20)
+    parser.add_argument('--lookups-per-second', type=float, default=2.0)
+    parser.add_argument('--edit-every', type=float, default=120.0, help='Secondi tra due modifiche di un cliente')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    lookups = int(args.hours * 3600 * args.lookups_per_second)
+    print(f"{args.hours:g}h simulated, {args.tenants} tenants, {lookups} lookups, "
+          f"one edit every {args.edit_every:g}s\n")
+    print(f"{'mode':<8} {'stale lookups':>14} {'max delay':>10} {'hot-path reads':>15} {'listener updates':>17}")
+    results = {}
+    for mode in ('ttl', 'listen'):
+        stale, delay, reads, stats = results[mode] = simulate(args, mode)
+        print(f"{mode:<8} {stale:>14} {delay:>9.0f}s {reads:>15} {stats.get('updates', '-'):>17}")
+
+    checks = [
+        ('listen: no stale lookups', results['listen'][0] == 0),
+        # 2 letture per load (order + user): primo load + uno per ora di TTL di sicurezza
+        ('listen: hot-path reads only for loads and safety-net TTL reloads',
+         results['listen'][2] <= 2 * args.tenants * math.ceil(args.hours) < results['ttl'][2]),
+        ('order reassigned to another assistant -> entry invalidated', check_detach()),
+        ('listener cap: oldest tenants fall back to TTL, still cached', check_cap()),
+        ('webhook routes to the new agent right after the edit, no tenant reload', check_webhook()),
+        ('concurrent readers and writers: no deadlock, cache aligned', check_concurrency()),
+        ('stuck tenant load: other requests load directly after wait_timeout', check_stuck_load()),
+    ]
+    print('\nchecks:')
+    for label, ok in checks:
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+    passed = all(ok for _, ok in checks)
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Benchmark sender Twilio contro un server HTTP locale (twilio_sender.py)
+
+Un server locale imita l'endpoint Messages.json di Twilio, con latenza,
+percentuale di errori 503 e risposte lente configurabili. Confronta il
+client SDK senza retry (twilio.rest, pool HTTP), lo stesso dentro
+RetryingClient (default di clients.py) e TwilioSender in quattro scenari:
+- sano: latenza per messaggio e connessioni aperte
+- instabile: % di 503 -> messaggi consegnati
+- degradato: Twilio risponde 500 lentamente -> tempo perso dalle notifiche,
+  poi ripresa del servizio (circuit breaker half-open -> closed)
+- fan-out: stesso lead a più agenti, sequenziale vs concorrente
+Verifica anche che un timeout di lettura NON venga ritentato (niente
+messaggi doppi, con entrambi i client resilienti) e che il retry outbox di una notifica fallita verso il
+principale non rimandi il messaggio ai CC già raggiunti. Esce con codice 1 se un controllo fallisce.
+
+Uso:
+    python backend/benchmarks/bench_twilio_sender.py
+    python backend/benchmarks/bench_twilio_sender.py --messages 200 --latency-ms 50 --flaky 0.3
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import harness
+
+harness.setup_path()
+
+import notification  # noqa: E402
+import notification_outbox  # noqa: E402
+import twilio_sender  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+
+ACCOUNT_SID = 'AC' + '0' * 32
+AUTH_TOKEN = 'bench-token'
+FROM_NUMBER = 'whatsapp:+390200000000'
+
+
+class TwilioStandIn:
+    """Server HTTP locale con la stessa API di POST Messages.json"""
+
+    def __init__(self, seed=7):
+        self.latency = 0.0
+        self.fail_ratio = 0.0
+        self.fail_status = 503
+        self.requests = 0
+        self.connections = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive come api.twilio.com
+
+            def setup(self):
+                super().setup()
+                with stand_in._lock:
+                    stand_in.connections += 1
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    sid = f"SM{stand_in.requests:032d}"
+                    fail = stand_in._rng.random() < stand_in.fail_ratio
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                if fail:
+                    status = stand_in.fail_status
+                    payload = {'code': 20000 + status, 'message': 'Service unavailable (stand-in)', 'status': status}
+                else:
+                    status = 201
+                    payload = {'sid': sid, 'status': 'queued', 'to': form.get('To', [''])[0],
+                               'from': form.get('From', [''])[0], 'body': form.get('Body', [''])[0]}
+                body = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # Client andato in timeout
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def configure(self, latency=0.0, fail_ratio=0.0, fail_status=503):
+        self.latency, self.fail_ratio, self.fail_status = latency, fail_ratio, fail_status
+        self.requests = 0
+        self.connections = 0
+
+    def close(self):
+        self.server.shutdown()
+
+
+def sdk_client(base_url, timeout):
+    """Client twilio.rest senza retry, puntato al server locale"""
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=0)
+    http_client.session.mount('http://', adapter)
+    client = Client(ACCOUNT_SID, AUTH_TOKEN, http_client=http_client)
+    client.api.base_url = base_url
+    return client
+
+
+def retrying_sdk(base_url, args, timeout=None):
+    """Come clients._build_twilio con TWILIO_CLIENT=sdk (default): SDK dentro RetryingClient"""
+    return twilio_sender.RetryingClient(
+        sdk_client(base_url, timeout or args.timeout), max_attempts=args.max_attempts,
+        backoff_base=args.backoff_base, breaker=twilio_sender.CircuitBreaker(args.breaker_threshold, args.breaker_reset))
+
+
+def new_sender(base_url, args, **overrides):
+    options = dict(read_timeout=args.timeout, max_attempts=args.max_attempts, backoff_base=args.backoff_base,
+                   breaker=twilio_sender.CircuitBreaker(args.breaker_threshold, args.breaker_reset))
+    options.update(overrides)
+    return twilio_sender.TwilioSender(ACCOUNT_SID, AUTH_TOKEN, base_url=base_url, **options)
+
+
+def run_sends(client, n, destination='whatsapp:+393330000001'):
+    """n invii sequenziali: (consegnati, latenze ms, secondi totali)"""
+    delivered, latencies = 0, []
+    start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        try:
+            client.messages.create(body=f"Nuovo lead {i}", from_=FROM_NUMBER, to=destination)
+            delivered += 1
+        except Exception:
+            pass
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return delivered, latencies, time.perf_counter() - start
+
+
+class PrimaryDownTwilio(FakeTwilio):
+    """Fallisce le prime `times` volte verso `down`; gli altri destinatari ricevono"""
+
+    def __init__(self, down, times):
+        super().__init__()
+        self.down = down
+        self.times = times
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        with self._lock:
+            if to == self.down and self.times > 0:
+                self.times -= 1
+                raise RuntimeError('Twilio unavailable (fake)')
+        return super().create(body=body, from_=from_, to=to, **kwargs)
+
+
+def outbox_cc_retry(destinations):
+    """Job outbox con CC, principale giù al primo tentativo: (esiti, messaggi per destinatario)"""
+    db = FakeFirestore()
+    twilio = PrimaryDownTwilio(destinations[0], times=1)
+    notification_outbox.enqueue_notification(
+        db, 'bench-cc', {'nome': 'Giulia Bianchi', 'zona': 'Porta Romana'}, '+393471234567',
+        destination=destinations[0], from_number=FROM_NUMBER, cc=destinations[1:])
+    ref = db.collection(notification_outbox.OUTBOX_COLLECTION).document('bench-cc')
+    outcomes = [notification_outbox.process_job(db, ref, twilio=twilio),
+                notification_outbox.process_job(db, ref, twilio=twilio, clock=lambda: time.time() + 3600)]
+    return outcomes, [sum(m['to'] == d for m in twilio.sent) for d in destinations]
+
+
+def _p(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sender Twilio su server locale')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Latenza del server locale')
+    parser.add_argument('--flaky', type=float, default=0.25, help='Quota di 503 nello scenario instabile')
+    parser.add_argument('--degraded-latency-ms', type=float, default=300.0, help='Latenza dei 500 in degrado')
+    parser.add_argument('--fanout', type=int, default=4, help='Destinatari per il fan-out')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout lettura (s)')
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--backoff-base', type=float, default=0.05, help='Base backoff con jitter (s)')
+    parser.add_argument('--breaker-threshold', type=int, default=5)
+    parser.add_argument('--breaker-reset', type=float, default=1.0, help='Secondi circuito aperto')
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    stand_in = TwilioStandIn()
+    latency = args.latency_ms / 1000
+    n = args.messages
+    passed = True
+
+    def _check(ok, label):
+        nonlocal passed
+        passed &= ok
+        print(f"  {label}: {'ok' if ok else 'FAIL'}")
+
+    print(f"local Twilio stand-in {stand_in.base_url}, {n} messages, latency {args.latency_ms:.0f}ms\n")
+    print(f"{'scenario':<30} {'delivered':>10} {'p50 ms':>8} {'p95 ms':>8} {'total s':>8} {'requests':>9} {'conns':>6}")
+
+    def _row(name, result):
+        delivered, latencies, seconds = result
+        print(f"{name:<30} {delivered:>6}/{n:<3} {statistics.median(latencies):>8.1f} {_p(latencies, 0.95):>8.1f} "
+              f"{seconds:>8.2f} {stand_in.requests:>9} {stand_in.connections:>6}")
+        return delivered, seconds
+
+    results = {}
+    degraded = {}
+    for scenario, kwargs in (('healthy', {'latency': latency}),
+                             ('flaky', {'latency': latency, 'fail_ratio': args.flaky}),
+                             ('degraded', {'latency': args.degraded_latency_ms / 1000, 'fail_ratio': 1.0,
+                                           'fail_status': 500})):
+        for name, factory in (('sdk', lambda: sdk_client(stand_in.base_url, args.timeout)),
+                              ('sdk+retry', lambda: retrying_sdk(stand_in.base_url, args)),
+                              ('sender', lambda: new_sender(stand_in.base_url, args))):
+            client = factory()
+            stand_in.configure(**kwargs)
+            results[scenario, name] = _row(f"{scenario} / {name}", run_sends(client, n))
+            if scenario == 'degraded':
+                degraded[name] = client
+
+    # Fan-out: stesso messaggio a più agenti (zona con più agenti / CC)
+    stand_in.configure(latency=0.2)
+    destinations = [f"whatsapp:+39333000{i:04d}" for i in range(args.fanout)]
+    sender = new_sender(stand_in.base_url, args)
+    start = time.perf_counter()
+    for destination in destinations:
+        sender.messages.create(body='Nuovo lead', from_=FROM_NUMBER, to=destination)
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    fanned = twilio_sender.send_many(sender, 'Nuovo lead', FROM_NUMBER, destinations)
+    concurrent = time.perf_counter() - start
+    print(f"\nfan-out to {args.fanout} recipients (200ms each): sequential {sequential * 1000:.0f} ms, "
+          f"concurrent {concurrent * 1000:.0f} ms")
+
+    # Notifica completa con CC: il principale riceve, un CC fallito non fa rilanciare
+    stand_in.configure(latency=0.02)
+    sent = notification.send_whatsapp_notification(
+        {'nome': 'Giulia Bianchi', 'zona': 'Porta Romana', 'tipo_richiesta': 'comprare'}, '+393471234567',
+        call_id='bench', destination_override=destinations[0], twilio=sender, from_number=FROM_NUMBER,
+        cc=destinations[1:])
+    notification_requests = stand_in.requests
+
+    print('\nchecks:')
+    for name in ('sdk+retry', 'sender'):
+        _check(results['flaky', name][0] >= n * 0.97 > results['flaky', 'sdk'][0],
+               f"flaky: {name} delivers {results['flaky', name][0]}/{n}, sdk {results['flaky', 'sdk'][0]}/{n}")
+        _check(results['degraded', name][1] < results['degraded', 'sdk'][1] / 3,
+               f"degraded: {name} fails fast ({results['degraded', name][1]:.1f}s vs "
+               f"{results['degraded', 'sdk'][1]:.1f}s), circuit {degraded[name].breaker.state}")
+
+    # Ripresa: dopo reset_seconds una richiesta di prova richiude il circuito
+    stand_in.configure(latency=latency)
+    time.sleep(args.breaker_reset)
+    for name in ('sdk+retry', 'sender'):
+        try:
+            degraded[name].messages.create(body='probe', from_=FROM_NUMBER, to=destinations[0])
+        except twilio_sender.TwilioError:
+            pass
+        _check(degraded[name].breaker.state == twilio_sender.CLOSED,
+               f"recovery: half-open probe closes the {name} circuit")
+    _check(all(not isinstance(r, Exception) for _, r in fanned) and concurrent < sequential / 2,
+           'fan-out: all recipients delivered, concurrent < half of sequential')
+    _check(sent is True and notification_requests == args.fanout,
+           f"send_whatsapp_notification with {args.fanout - 1} CC: {notification_requests} requests")
+
+    # Timeout di lettura: Twilio potrebbe aver accettato il messaggio -> nessun retry
+    for name, slow in (('sdk+retry', retrying_sdk(stand_in.base_url, args, timeout=0.1)),
+                       ('sender', new_sender(stand_in.base_url, args, read_timeout=0.1))):
+        stand_in.configure(latency=0.5)
+        try:
+            slow.messages.create(body='slow', from_=FROM_NUMBER, to=destinations[0])
+        except twilio_sender.TwilioError:
+            pass
+        _check(stand_in.requests == 1, f"{name}: read timeout not retried ({stand_in.requests} request)")
+
+    # Outbox: il retry dopo un principale fallito salta i CC già raggiunti
+    outcomes, per_recipient = outbox_cc_retry(destinations)
+    _check(outcomes == ['retry', 'sent'] and per_recipient == [1] * len(destinations),
+           f"outbox retry after primary failure: {'/'.join(outcomes)}, messages per recipient {per_recipient}")
+
+    stand_in.close()
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
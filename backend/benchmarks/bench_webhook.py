@@ -0,0 +1,149 @@
+"""
+Benchmark offline del webhook Vapi
+
+Guida vapi_webhook() con payload registrati (assistant-request,
+function-call, end-of-call-report) contro fake in memoria di Firestore e
+Twilio. Per ogni tipo evento riporta percentili di latenza, read/write
+Firestore per evento e picco di allocazioni, al crescere di `calls`.
+
+Uso:
+    python backend/benchmarks/bench_webhook.py
+    python backend/benchmarks/bench_webhook.py --sizes 1000,10000,100000 --iterations 300
+    python backend/benchmarks/bench_webhook.py --json results.json
+"""
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+import harness
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+from fakes import FakeFirestore, FakeTwilio  # noqa: E402
+
+EVENT_ORDER = ('assistant-request', 'function-call', 'end-of-call-report')
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def reset_process_state():
+    """Simula un'istanza nuova: svuota le cache in-process del webhook"""
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+
+
+def build_requests(event_type, iterations, n_tenants, offset=0):
+    requests = []
+    for i in range(iterations):
+        n = offset + i
+        assistant_id, _, _ = harness.tenant_ids(n % n_tenants)
+        payload = harness.make_event(event_type, f"bench-{n:07d}", f"+39348{n:07d}", assistant_id)
+        requests.append(harness.signed_request(payload))
+    return requests
+
+
+def run_event(db, event_type, iterations, n_tenants, track_allocations):
+    latencies = []
+    reads = []
+    writes = []
+    peaks = []
+
+    requests = build_requests(event_type, iterations, n_tenants)
+    for request in requests:
+        before = db.counters()
+        if track_allocations:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        vapi_webhook.vapi_webhook(request)
+        latencies.append((time.perf_counter() - start) * 1000)
+        vapi_webhook.drain_deferred()  # RPC differite dopo la risposta contate sull'evento
+        if track_allocations:
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        after = db.counters()
+        reads.append(after['reads'] - before['reads'])
+        writes.append(after['writes'] - before['writes'])
+
+    result = {
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'reads_per_event': statistics.mean(reads),
+        'writes_per_event': statistics.mean(writes),
+    }
+    if track_allocations:
+        result['peak_alloc_kib'] = statistics.median(peaks) / 1024
+    return result
+
+
+def run(sizes, iterations, n_tenants, track_allocations):
+    results = {}
+    for size in sizes:
+        db = FakeFirestore()
+        harness.seed_dataset(db, size, n_tenants=n_tenants)
+        clients.set_firestore(db)
+        clients.set_twilio(FakeTwilio())
+        reset_process_state()
+
+        # tracemalloc solo durante gli eventi (il seed di 100k doc è lento se tracciato)
+        if track_allocations:
+            tracemalloc.start()
+        results[size] = {}
+        for event_type in EVENT_ORDER:
+            results[size][event_type] = run_event(db, event_type, iterations, n_tenants, track_allocations)
+        if track_allocations:
+            tracemalloc.stop()
+    return results
+
+
+def print_table(results):
+    header = f"{'calls':>8}  {'event':<20} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'reads/ev':>9} {'writes/ev':>9} {'peak KiB':>9}"
+    print(header)
+    print('-' * len(header))
+    for size, events in results.items():
+        for event_type, r in events.items():
+            peak = f"{r['peak_alloc_kib']:9.1f}" if 'peak_alloc_kib' in r else f"{'-':>9}"
+            print(
+                f"{size:>8}  {event_type:<20} {r['p50_ms']:8.3f} {r['p95_ms']:8.3f} {r['p99_ms']:8.3f} "
+                f"{r['reads_per_event']:9.2f} {r['writes_per_event']:9.2f} {peak}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark offline vapi_webhook')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Dimensioni collezione calls')
+    parser.add_argument('--iterations', type=int, default=200, help='Eventi per tipo e dimensione')
+    parser.add_argument('--tenants', type=int, default=20)
+    parser.add_argument('--no-alloc', action='store_true', help='Disattiva tracemalloc (latenze più pulite)')
+    parser.add_argument('--json', default=None, help='Salva i risultati in JSON')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    track_allocations = not args.no_alloc
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    results = run(sizes, args.iterations, args.tenants, track_allocations)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
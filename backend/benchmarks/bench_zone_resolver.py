@@ -0,0 +1,165 @@
+"""
+Benchmark risoluzione zona -> agente
+
+Usa la lista zone di Milano della dashboard (dashboard/lib/milanZones.ts)
+come zone_assignments di un tenant e un set di varianti realistiche
+(abbreviazioni, prefissi/suffissi, accenti, refusi, alias, zone sconosciute).
+
+Confronta il vecchio match esatto (lower + spazi -> trattini) con ZoneIndex:
+- accuratezza (risposta attesa, incluso None per zone non assegnate)
+- costo di compilazione dell'indice
+- latenza per lookup a freddo (memo vuota) e a caldo (memo piena)
+
+Uso:
+    python backend/benchmarks/bench_zone_resolver.py
+    python backend/benchmarks/bench_zone_resolver.py --iterations 20000 --verbose
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+import harness
+
+harness.setup_path()
+
+from zone_resolver import ZoneIndex  # noqa: E402
+
+MILAN_ZONES_TS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'dashboard', 'lib', 'milanZones.ts'
+)
+
+# (testo estratto dall'AI, id zona atteso o None)
+CASES = [
+    ('Porta Romana', 'porta-romana'),
+    ('porta romana', 'porta-romana'),
+    ('P.ta Romana', 'porta-romana'),
+    ('p.ta romana', 'porta-romana'),
+    ('Pta Romana', 'porta-romana'),
+    ('zona Porta Romana', 'porta-romana'),
+    ('porta romana milano', 'porta-romana'),
+    ('Porta Romana, Milano (MI)', 'porta-romana'),
+    ('quartiere di porta romana', 'porta-romana'),
+    ('viale Sabotino, porta romana', 'porta-romana'),
+    ('portaromana', 'porta-romana'),
+    ('Città Studi', 'citta-studi'),
+    ("Citta' Studi", 'citta-studi'),
+    ('citta studi', 'citta-studi'),
+    ('zona Politecnico', 'citta-studi'),
+    ('Navigli', 'navigli'),
+    ('navilgi', 'navigli'),
+    ('Naviglio Grande', 'navigli'),
+    ('Darsena', 'navigli'),
+    ('Porta Ticinese', 'ticinese'),
+    ('C.so Buenos Aires', 'buenos-aires'),
+    ('corso buenos aires', 'buenos-aires'),
+    ('Buenos Aires', 'buenos-aires'),
+    ('buenos aries', 'buenos-aires'),
+    ('Stazione Centrale', 'stazione-centrale'),
+    ('Centrale', 'stazione-centrale'),
+    ('p.za Duca d\'Aosta', 'stazione-centrale'),
+    ('Isola', 'isola'),
+    ('quartiere Isola', 'isola'),
+    ('Garibaldi', 'garibaldi'),
+    ('Porta Garibaldi', 'garibaldi'),
+    ('Porta Nuova', 'garibaldi'),
+    ('Corso Como', 'garibaldi'),
+    ('Brera', 'brera'),
+    ('brera milano', 'brera'),
+    ('Breraa', 'brera'),
+    ('Duomo', 'duomo'),
+    ('piazza Duomo', 'duomo'),
+    ('P.za Duomo', 'duomo'),
+    ('Centro', 'centro'),
+    ('centro Milano', 'centro'),
+    ('San Babila', 'centro'),
+    ('San Siro', 'san-siro'),
+    ('S. Siro', 'san-siro'),
+    ('zona stadio', 'san-siro'),
+    ('Fiera', 'fiera'),
+    ('CityLife', 'fiera'),
+    ('Portello', 'portello'),
+    ('Loreto', 'loreto'),
+    ('P.le Loreto', 'loreto'),
+    ('NoLo', 'loreto'),
+    ('Lambrate', 'lambrate'),
+    ('Bicocca', 'bicocca'),
+    ('Porta Venezia', 'porta-venezia'),
+    ('P.ta Venezia', 'porta-venezia'),
+    ('V.le Tunisia, Porta Venezia', 'porta-venezia'),
+    # Non assegnate: devono cadere sul default
+    ('Sesto San Giovanni', None),
+    ('Monza', None),
+    ('Bovisa', None),
+    ('Non so', None),
+    ('Lorenteggio', None),
+    ('Milano', None),
+]
+
+
+def load_milan_zones(path=MILAN_ZONES_TS):
+    """Estrae gli id zona da milanZones.ts (fonte unica con la dashboard)"""
+    with open(path, encoding='utf-8') as f:
+        return re.findall(r"\{\s*id:\s*'([^']+)'", f.read())
+
+
+def legacy_resolve(zone_assignments, text):
+    """Match pre-ZoneIndex: lower + strip + spazi -> trattini, lookup esatto"""
+    key = text.lower().strip().replace(' ', '-')
+    return key if key in zone_assignments else None
+
+
+def time_lookups(resolve, texts, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        resolve(texts[i % len(texts)])
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark risoluzione zone')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--verbose', action='store_true', help='Stampa i casi sbagliati')
+    args = parser.parse_args()
+
+    zone_ids = load_milan_zones()
+    assignments = {z: {'whatsapp': f"+3933300{n:05d}", 'name': f"Agente {n}"} for n, z in enumerate(zone_ids)}
+    texts = [text for text, _ in CASES]
+
+    compile_times = []
+    for _ in range(200):
+        start = time.perf_counter()
+        ZoneIndex(assignments)
+        compile_times.append((time.perf_counter() - start) * 1e6)
+    index = ZoneIndex(assignments)
+
+    results = {}
+    for name, resolve in (('legacy exact', lambda t: legacy_resolve(assignments, t)), ('ZoneIndex', index.resolve)):
+        wrong = [(t, expected, resolve(t)) for t, expected in CASES if resolve(t) != expected]
+        results[name] = wrong
+        print(f"{name:<14} accuracy: {len(CASES) - len(wrong)}/{len(CASES)}")
+        if args.verbose:
+            for text, expected, got in wrong:
+                print(f"    {text!r}: atteso {expected!r}, ottenuto {got!r}")
+
+    cold = []
+    for text in texts:
+        fresh = ZoneIndex(assignments)
+        start = time.perf_counter()
+        fresh.resolve(text)
+        cold.append((time.perf_counter() - start) * 1e6)
+
+    print()
+    print(f"zones: {len(zone_ids)}, index keys: {len(index)}")
+    print(f"compile index (median):        {statistics.median(compile_times):8.1f} us")
+    print(f"lookup cold (median / max):    {statistics.median(cold):8.1f} / {max(cold):.1f} us")
+    print(f"lookup warm (mean):            {time_lookups(index.resolve, texts, args.iterations):8.2f} us")
+    print(f"legacy lookup (mean):          "
+          f"{time_lookups(lambda t: legacy_resolve(assignments, t), texts, args.iterations):8.2f} us")
+    return 1 if results['ZoneIndex'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,673 @@
+"""
+Fake in-memory di Firestore e Twilio per benchmark offline
+
+Implementano solo il sottoinsieme di API usato dal backend
+(collection/document/get/set/update/where/stream/batch/transaction)
+e contano RPC di lettura/scrittura per evento. FakeAsyncFirestore espone
+le stesse API con RPC awaitable (AsyncClient, percorso asyncio).
+"""
+import copy
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+
+_ids = itertools.count(1)
+
+
+# google.cloud.firestore viene importato solo alla prima write, così il
+# benchmark di cold start misura l'import fatto dal codice applicativo
+def _transforms():
+    from google.cloud.firestore_v1 import transforms
+    return transforms
+
+
+def _exceptions():
+    from google.api_core import exceptions
+    return exceptions
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _normalize(value):
+    """Datetime naive -> UTC aware (come fa Firestore)"""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _get_path(data, path):
+    current = data
+    for part in path.split('.'):
+        if not isinstance(current, dict) or part not in current:
+            return None, False
+        current = current[part]
+    return current, True
+
+
+def _apply_value(target, key, value):
+    transforms = _transforms()
+    if value is transforms.SERVER_TIMESTAMP:
+        target[key] = _now()
+    elif value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, transforms.Increment):
+        current = target.get(key)
+        target[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key) or [])
+        current.extend(v for v in value.values if v not in current)
+        target[key] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [v for v in (target.get(key) or []) if v not in value.values]
+    else:
+        target[key] = copy.deepcopy(_normalize(value))
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and value and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = {}
+            _merge(target[key], value)
+        else:
+            _apply_value(target, key, value)
+
+
+def _update_path(target, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    if isinstance(value, dict):
+        target[parts[-1]] = {}
+        _merge(target[parts[-1]], value)
+    else:
+        _apply_value(target, parts[-1], value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value, _ = _get_path(self._data or {}, field_path)
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        self._client._latency('read')
+        self._client.reads += 1
+        with self._client._lock:
+            if transaction is not None:
+                transaction._read_versions[self.path] = self._client._versions.get(self.path, 0)
+            data = self._client._docs.get(self.path)
+            return FakeSnapshot(self, copy.deepcopy(data) if data is not None else None)
+
+    def set(self, data, merge=False):
+        self._client._latency('write')
+        self._client.writes += 1
+        self._client._apply([('set', self, data, merge)])
+
+    def update(self, data):
+        self._client._latency('write')
+        self._client.writes += 1
+        self._client._apply([('update', self, data, None)])
+
+    def create(self, data):
+        self._client._latency('write')
+        self._client.writes += 1
+        self._client._apply([('create', self, data, None)])
+
+    def delete(self):
+        self._client._latency('write')
+        self._client.writes += 1
+        self._client._apply([('delete', self, None, None)])
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+class FakeQuery:
+    def __init__(self, client, path, filters=(), orders=(), limit=None, cursor=None):
+        self._client = client
+        self._path = path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        values = dict(filters=self._filters, orders=self._orders, limit=self._limit, cursor=self._cursor)
+        values.update(changes)
+        return FakeQuery(self._client, self._path, **values)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, _normalize(value))])
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def _matches(self):
+        docs = self._client._docs
+        results = []
+        with self._client._lock:
+            for path in self._client._collections.get(self._path, ()):
+                data = docs[path]
+                ok = True
+                for field, op, value in self._filters:
+                    current, present = _get_path(data, field)
+                    if not present or not _OPS[op](current, value):
+                        ok = False
+                        break
+                if ok:
+                    results.append((path, data))
+
+        # Ordinamento: campi richiesti (o filtri di range), poi id documento
+        orders = list(self._orders)
+        for field, op, _ in self._filters:
+            if op in ('<', '<=', '>', '>=') and not any(o[0] == field for o in orders):
+                orders.insert(0, (field, 'ASCENDING'))
+        results.sort(key=lambda item: item[0])
+        for field, direction in reversed(orders):
+            results.sort(
+                key=lambda item: _sort_key(_get_path(item[1], field)[0]),
+                reverse=(direction == 'DESCENDING')
+            )
+
+        if self._cursor is not None:
+            # Come Firestore: posizione dai valori dello snapshot, anche se
+            # il documento nel frattempo è stato eliminato
+            cursor_path = self._cursor.reference.path
+            cursor_data = self._cursor._data or {}
+            results = [item for item in results if _after(item, cursor_path, cursor_data, orders)]
+        if self._limit is not None:
+            results = results[:self._limit]
+        with self._client._lock:
+            return [(path, copy.deepcopy(data)) for path, data in results]
+
+    def stream(self, transaction=None, **kwargs):
+        self._client._latency('read')
+        results = self._matches()
+        # Firestore addebita una read anche per query vuote
+        self._client.reads += max(1, len(results))
+        for path, data in results:
+            yield FakeSnapshot(FakeDocumentReference(self._client, path), data)
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+
+def _after(item, cursor_path, cursor_data, orders):
+    """Il risultato viene dopo il cursore nell'ordinamento della query?"""
+    path, data = item
+    for field, direction in orders:
+        if field == '__name__':
+            continue
+        a, b = _sort_key(_get_path(data, field)[0]), _sort_key(_get_path(cursor_data, field)[0])
+        if a != b:
+            return (a > b) != (direction == 'DESCENDING')
+    return path > cursor_path
+
+
+def _sort_key(value):
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.timestamp())
+    return (4, str(value))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or f'auto{next(_ids)}'}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(('update', reference, data, None))
+
+    def create(self, reference, data):
+        self._writes.append(('create', reference, data, None))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, None))
+
+    def commit(self):
+        if len(self._writes) > 500:
+            raise _exceptions().InvalidArgument('maximum 500 writes allowed per request')
+        self._client._latency('write')
+        self._client.writes += len(self._writes)
+        self._client.commits += 1
+        self._client._apply(self._writes)
+        self._writes = []
+        return []
+
+    def __len__(self):
+        return len(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Compatibile con `firestore.transactional`: le letture registrano la
+    versione dei documenti e il commit fallisce (Aborted) se sono cambiati.
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._read_versions = {}
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = f"tx{next(_ids)}".encode()
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        client = self._client
+        client._latency('write')
+        with client._lock:
+            for path, version in self._read_versions.items():
+                if client._versions.get(path, 0) != version:
+                    self._clean_up()
+                    raise _exceptions().Aborted('Transaction contention')
+            client.writes += len(self._writes)
+            client.commits += 1
+            client._apply(self._writes, locked=True)
+        self._clean_up()
+        return []
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get(transaction=self)])
+        return ref_or_query.stream()
+
+
+class FakeFirestore:
+    """
+    Client Firestore in memoria.
+
+    Args:
+        read_latency: Secondi di latenza simulata per ogni RPC di lettura
+        write_latency: Secondi di latenza simulata per ogni commit
+    """
+
+    def __init__(self, read_latency=0.0, write_latency=0.0):
+        self._docs = {}
+        self._collections = {}  # path collezione -> {path documento: None}
+        self._versions = {}
+        self._watchers = {}
+        self._lock = threading.RLock()
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+
+    def _latency(self, kind):
+        delay = self.read_latency if kind == 'read' else self.write_latency
+        if delay:
+            time.sleep(delay)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return FakeTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def get_all(self, references, **kwargs):
+        self._latency('read')
+        for ref in references:
+            with self._lock:
+                data = self._docs.get(ref.path)
+            self.reads += 1
+            yield FakeSnapshot(ref, copy.deepcopy(data) if data is not None else None)
+
+    def reset_counters(self):
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+
+    def counters(self):
+        return {'reads': self.reads, 'writes': self.writes, 'commits': self.commits}
+
+    def seed(self, path, data):
+        """Inserisce un documento senza contare RPC"""
+        with self._lock:
+            self._put(path, _normalize(copy.deepcopy(data)))
+            self._versions[path] = self._versions.get(path, 0) + 1
+
+    def _apply(self, writes, locked=False):
+        if not locked:
+            with self._lock:
+                return self._apply(writes, locked=True)
+        changed = []
+        # Valida prima tutte le write (commit atomico)
+        for kind, ref, data, merge in writes:
+            if kind == 'create' and ref.path in self._docs:
+                raise _exceptions().AlreadyExists(f"Document already exists: {ref.path}")
+            if kind == 'update' and ref.path not in self._docs:
+                raise _exceptions().NotFound(f"No document to update: {ref.path}")
+        for kind, ref, data, merge in writes:
+            if kind == 'delete':
+                self._remove(ref.path)
+            elif kind == 'update':
+                doc = self._docs[ref.path]
+                for path, value in data.items():
+                    _update_path(doc, path, value)
+            else:
+                doc = self._docs.get(ref.path) if (kind == 'set' and merge) else None
+                doc = doc if doc is not None else {}
+                _merge(doc, data)
+                self._put(ref.path, doc)
+            self._versions[ref.path] = self._versions.get(ref.path, 0) + 1
+            changed.append(ref)
+        for ref in changed:
+            self._notify(ref)
+
+    def _put(self, path, data):
+        if path not in self._docs:
+            self._collections.setdefault(path.rsplit('/', 1)[0], {})[path] = None
+        self._docs[path] = data
+
+    def _remove(self, path):
+        if self._docs.pop(path, None) is not None:
+            self._collections.get(path.rsplit('/', 1)[0], {}).pop(path, None)
+
+    def _watch(self, ref, callback):
+        watch = FakeWatch(self, ref, callback)
+        with self._lock:
+            self._watchers.setdefault(ref.path, []).append(watch)
+        self._notify(ref, only=watch)
+        return watch
+
+    def _notify(self, ref, only=None):
+        watchers = [only] if only else list(self._watchers.get(ref.path, ()))
+        if not watchers:
+            return
+        data = self._docs.get(ref.path)
+        snapshot = FakeSnapshot(ref, copy.deepcopy(data) if data is not None else None)
+        for watch in watchers:
+            watch.callback([snapshot], [], _now())
+
+
+class FakeWatch:
+    def __init__(self, client, ref, callback):
+        self._client = client
+        self._ref = ref
+        self.callback = callback
+
+    def unsubscribe(self):
+        with self._client._lock:
+            watchers = self._client._watchers.get(self._ref.path, [])
+            if self in watchers:
+                watchers.remove(self)
+
+
+class FakeAsyncDocumentReference:
+    """Riferimento di FakeAsyncFirestore: stessi documenti, RPC awaitable"""
+
+    def __init__(self, client, ref):
+        self._client = client
+        self._ref = ref
+        self.path = ref.path
+        self.id = ref.id
+
+    def collection(self, name):
+        return FakeAsyncCollection(self._client, self._ref.collection(name))
+
+    async def get(self, field_paths=None, transaction=None, **kwargs):
+        await self._client._latency('read')
+        return self._ref.get(transaction=transaction)
+
+    async def set(self, data, merge=False):
+        await self._client._latency('write')
+        self._ref.set(data, merge=merge)
+
+    async def update(self, data):
+        await self._client._latency('write')
+        self._ref.update(data)
+
+    async def create(self, data):
+        await self._client._latency('write')
+        self._ref.create(data)
+
+    async def delete(self):
+        await self._client._latency('write')
+        self._ref.delete()
+
+    def __eq__(self, other):
+        return isinstance(other, FakeAsyncDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeAsyncQuery:
+    def __init__(self, client, query):
+        self._client = client
+        self._query = query
+
+    def where(self, *args, **kwargs):
+        return FakeAsyncQuery(self._client, self._query.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return FakeAsyncQuery(self._client, self._query.order_by(*args, **kwargs))
+
+    def limit(self, count):
+        return FakeAsyncQuery(self._client, self._query.limit(count))
+
+    async def stream(self, transaction=None, **kwargs):
+        await self._client._latency('read')
+        for snapshot in list(self._query.stream()):
+            snapshot.reference = FakeAsyncDocumentReference(self._client, snapshot.reference)
+            yield snapshot
+
+    async def get(self, transaction=None, **kwargs):
+        return [snapshot async for snapshot in self.stream()]
+
+
+class FakeAsyncCollection(FakeAsyncQuery):
+    def __init__(self, client, collection):
+        super().__init__(client, collection)
+        self.id = collection.id
+
+    def document(self, document_id=None):
+        return FakeAsyncDocumentReference(self._client, self._query.document(document_id))
+
+
+class FakeAsyncWriteBatch(FakeWriteBatch):
+    def __init__(self, client):
+        super().__init__(client.sync)
+        self._async_client = client
+
+    async def commit(self):
+        await self._async_client._latency('write')
+        return FakeWriteBatch.commit(self)
+
+
+class FakeAsyncTransaction(FakeTransaction):
+    """Compatibile con `firestore.async_transactional` (Aborted su contesa)"""
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client.sync, max_attempts=max_attempts, read_only=read_only)
+        self._async_client = client
+
+    async def _begin(self, retry_id=None):
+        FakeTransaction._begin(self, retry_id)
+
+    async def _rollback(self):
+        FakeTransaction._rollback(self)
+
+    async def _commit(self):
+        await self._async_client._latency('write')
+        return FakeTransaction._commit(self)
+
+
+class FakeAsyncFirestore:
+    """
+    Firestore AsyncClient in memoria: le RPC aspettano con asyncio.sleep,
+    quindi molte richieste in volo si sovrappongono su un solo thread.
+
+    Args:
+        read_latency / write_latency: come FakeFirestore
+        sync: FakeFirestore con cui condividere documenti e contatori
+            (senza latenza propria: la simula questo client)
+    """
+
+    def __init__(self, read_latency=0.0, write_latency=0.0, sync=None):
+        self.sync = sync if sync is not None else FakeFirestore()
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+
+    async def _latency(self, kind):
+        import asyncio
+
+        delay = self.read_latency if kind == 'read' else self.write_latency
+        if delay:
+            await asyncio.sleep(delay)
+
+    def collection(self, name):
+        return FakeAsyncCollection(self, self.sync.collection(name))
+
+    def document(self, path):
+        return FakeAsyncDocumentReference(self, self.sync.document(path))
+
+    def batch(self):
+        return FakeAsyncWriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return FakeAsyncTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def seed(self, path, data):
+        self.sync.seed(path, data)
+
+    def reset_counters(self):
+        self.sync.reset_counters()
+
+    def counters(self):
+        return self.sync.counters()
+
+
+class FakeMessage:
+    def __init__(self, sid, status='queued'):
+        self.sid = sid
+        self.status = status
+
+
+class FakeTwilio:
+    """
+    Client Twilio finto: registra i messaggi inviati.
+
+    Args:
+        latency: Secondi di latenza simulata per messages.create
+        fail_times: Numero di invii iniziali che falliscono (test retry)
+    """
+
+    def __init__(self, latency=0.0, fail_times=0):
+        self.latency = latency
+        self.fail_times = fail_times
+        self.sent = []
+        self._lock = threading.Lock()
+        self.messages = self
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise RuntimeError('Twilio unavailable (fake)')
+            self.sent.append({'body': body, 'from_': from_, 'to': to})
+            return FakeMessage(f"SM{len(self.sent):032d}")
@@ -0,0 +1,162 @@
+"""
+Utility comuni ai benchmark: path del codice functions, richieste firmate
+con lo stesso schema HMAC di verify_vapi_signature.
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+
+# Chiave usata per firmare i payload dei benchmark
+BENCH_VAPI_API_KEY = 'bench-vapi-key'
+
+
+def setup_path():
+    """Rende importabili i moduli in backend/functions e fissa la chiave Vapi"""
+    os.environ.setdefault('VAPI_API_KEY', BENCH_VAPI_API_KEY)
+    if FUNCTIONS_DIR not in sys.path:
+        sys.path.insert(0, FUNCTIONS_DIR)
+
+
+def sign(body, key=BENCH_VAPI_API_KEY):
+    """Firma HMAC-SHA256 esadecimale (header x-vapi-signature)"""
+    return hmac.new(key.encode(), body, hashlib.sha256).hexdigest()
+
+
+def signed_request(payload, key=BENCH_VAPI_API_KEY):
+    """Costruisce una flask.Request firmata come quelle inviate da Vapi"""
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    builder = EnvironBuilder(
+        method='POST',
+        data=body,
+        headers={'x-vapi-signature': sign(body, key), 'content-type': 'application/json'}
+    )
+    return Request(builder.get_environ())
+
+
+PAYLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+EVENT_PAYLOADS = {
+    'assistant-request': 'assistant_request.json',
+    'function-call': 'function_call.json',
+    'end-of-call-report': 'end_of_call_report.json',
+}
+
+
+def load_payload(event_type):
+    """Payload registrato per tipo evento (dict nuovo a ogni chiamata)"""
+    with open(os.path.join(PAYLOADS_DIR, EVENT_PAYLOADS[event_type]), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def vapi_time(when):
+    """datetime UTC -> timestamp ISO 8601 come nei payload Vapi"""
+    return when.strftime('%Y-%m-%dT%H:%M:%S.') + f"{when.microsecond // 1000:03d}Z"
+
+
+def make_event(event_type, call_id, customer_number, assistant_id):
+    """Payload registrato con id chiamata/numero/assistant sostituiti, orari spostati ad adesso"""
+    from datetime import datetime, timedelta, timezone
+
+    payload = load_payload(event_type)
+    message = payload['message']
+    call = message['call']
+    call['id'] = call_id
+    call['assistantId'] = assistant_id
+    call['customer']['number'] = customer_number
+    if 'startedAt' in message:
+        ended = datetime.now(timezone.utc)
+        message['startedAt'] = vapi_time(ended - timedelta(seconds=call.get('duration') or 0))
+        message['endedAt'] = call['endedAt'] = vapi_time(ended)
+    return payload
+
+
+def tenant_ids(index):
+    return f"asst-{index:04d}", f"agency{index}@example.com", f"ord-{index:04d}"
+
+
+def seed_dataset(db, n_calls, n_tenants=20, n_numbers=5000, transcript_size=2000, seed=42):
+    """
+    Popola il fake con tenant (orders/users) e `n_calls` chiamate del mese
+    corrente, poi ricostruisce i rollup. I contatori RPC vengono azzerati.
+    """
+    import random
+    from datetime import datetime, timedelta
+
+    rng = random.Random(seed)
+    zones = ['porta-romana', 'brera', 'navigli', 'isola', 'citta-studi', 'porta-venezia']
+
+    for i in range(n_tenants):
+        assistant_id, user_id, order_id = tenant_ids(i)
+        db.seed(f"orders/{order_id}", {
+            'vapi_assistant_id': assistant_id,
+            'user_id': user_id,
+            'twilio_phone_number': f"+3902{i:07d}",
+        })
+        db.seed(f"users/{user_id}", {
+            'monthly_calls': 0,
+            'monthly_calls_limit': 500,
+            'subscription_plan': 'professional',
+            'current_month_start': datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+            'zone_assignments': {
+                zone: {'whatsapp': f"+39333{i:03d}{z:04d}", 'name': f"Agente {z}"}
+                for z, zone in enumerate(zones)
+            },
+        })
+
+    month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    span = max((datetime.now() - month_start).total_seconds(), 1)
+    filler = ('AI: Buongiorno! User: Cerco casa in zona ' * (transcript_size // 40 + 1))[:transcript_size]
+    for n in range(n_calls):
+        _, user_id, order_id = tenant_ids(rng.randrange(n_tenants))
+        db.seed(f"calls/hist-{n:07d}", {
+            'call_id': f"hist-{n:07d}",
+            'customer_number': f"+39347{rng.randrange(n_numbers):07d}",
+            'started_at': month_start + timedelta(seconds=rng.random() * span),
+            'duration': rng.randrange(20, 600),
+            'status': 'completed',
+            'user_id': user_id,
+            'order_id': order_id,
+            'client_info': {'nome': 'Cliente', 'zona': rng.choice(zones), 'tipo_richiesta': 'comprare'},
+            'transcript': filler,
+        })
+
+    import usage_rollup
+    usage_rollup.rebuild_monthly_rollups(db, usage_rollup.month_key())
+    db.reset_counters()
+
+
+LISTING_TYPES = ('monolocale', 'bilocale', 'trilocale', 'quadrilocale', 'attico', 'villa', 'loft', 'box')
+LISTING_FEATURES = ('terrazzo', 'balcone', 'box', 'ascensore', 'giardino', 'portineria', 'cantina')
+
+
+def seed_listings(db, user_id, n_listings, zones, seed=7):
+    """Popola `listings` per un tenant con prezzi plausibili per tipologia"""
+    import random
+    from datetime import datetime, timedelta
+
+    rng = random.Random(seed)
+    base = {'monolocale': 180000, 'bilocale': 280000, 'trilocale': 420000, 'quadrilocale': 600000,
+            'attico': 1100000, 'villa': 1500000, 'loft': 500000, 'box': 40000}
+    updated_at = datetime(2025, 1, 1)
+    for n in range(n_listings):
+        tipo = rng.choice(LISTING_TYPES)
+        affitto = tipo != 'box' and rng.random() < 0.25
+        price = base[tipo] * rng.uniform(0.6, 1.6)
+        db.seed(f"listings/{user_id}-{n:06d}", {
+            'user_id': user_id,
+            'zona': rng.choice(zones),
+            'tipo_immobile': tipo,
+            'prezzo': round(price / 300 if affitto else price, -1),
+            'mq': rng.randrange(25, 250),
+            'contratto': 'affitto' if affitto else 'vendita',
+            'caratteristiche': rng.sample(LISTING_FEATURES, rng.randrange(0, 4)),
+            'stato': 'disponibile' if rng.random() < 0.9 else 'venduto',
+            'updated_at': updated_at + timedelta(seconds=n),
+        })
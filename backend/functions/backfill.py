@@ -0,0 +1,440 @@
+"""
+Backfill / rielaborazione delle chiamate storiche
+
+Quando cambia l'estrazione di client_info, il routing per zona o la
+contabilità di utilizzo, riapplica la logica del webhook alle `calls`
+esistenti con le STESSE funzioni:
+- client_info      <- vapi_webhook.build_client_info(structured_data)
+- lead_features    <- estrattore del tenant (note + transcript)
+- assigned_agent   <- vapi_webhook.get_agent_for_zone(zona, tenant)
+- usage (--usage)  <- rollup mensili riscritti dai totali accumulati
+
+Pipeline:
+- lettura a pagine per document id (cursore start_after), la pagina
+  successiva si legge mentre i worker elaborano la precedente
+- ricalcolo (decompressione transcript, regex lead, zone) in un
+  ProcessPoolExecutor; --workers 0 elabora nel processo principale
+- scrittura solo dei campi cambiati, in batch da max 500 write
+- checkpoint in `backfill_runs/{nome}` dopo ogni pagina scritta:
+  --resume riparte dall'ultimo documento confermato
+- --max-writes-per-second per non saturare Firestore in produzione
+
+Uso:
+    python backfill.py --dry-run --limit 1000
+    python backfill.py --checkpoint zone-fix-2025-03 --workers 8 --usage
+    python backfill.py --checkpoint zone-fix-2025-03 --resume
+    python backfill.py --fields assigned_agent --max-writes-per-second 200
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from lead_features import get_extractor
+from pacing import Pacer
+from tenant_cache import TenantContext, load_tenant_context
+from transcript_store import decompress_transcript, read_transcript_chunks
+
+CHECKPOINT_COLLECTION = 'backfill_runs'
+FIELDS = ('client_info', 'lead_features', 'assigned_agent')
+MAX_BATCH_WRITES = 500
+DEFAULT_PAGE_SIZE = 500
+
+# Valore None in un update = campo da eliminare
+_DELETE = None
+
+# Campi del documento usati da recompute_call
+_WORKER_KEYS = ('assistant_id', 'order_id', 'customer_number', 'structured_data', 'client_info',
+                'lead_features', 'assigned_agent', 'transcript')
+
+
+# --- Ricalcolo (gira nei worker: niente Firestore, solo dati picklabili) ---
+
+_worker_tenants = {}
+
+
+def _tenant(spec):
+    """TenantContext ricostruito dal worker (indici zone/lead compilati una volta)"""
+    if spec is None:
+        return None
+    tenant = _worker_tenants.get(spec[0])
+    if tenant is None:
+        tenant = _worker_tenants[spec[0]] = TenantContext(*spec)
+    return tenant
+
+
+def recompute_call(item, tenant, fields):
+    """
+    Campi derivati da aggiornare per una chiamata (solo quelli cambiati).
+
+    Args:
+        item: (call_id, call_data, transcript_chunks | None)
+        tenant: TenantContext | None
+        fields: Campi da ricalcolare (sottoinsieme di FIELDS)
+    """
+    from vapi_webhook import build_client_info, get_agent_for_zone
+
+    call_id, data, chunks = item
+    updates = {}
+
+    client_info = data.get('client_info') or {}
+    structured_data = data.get('structured_data')
+    if 'client_info' in fields and structured_data:
+        # Chiamate senza structured output: client_info originale, non ricostruibile
+        client_info = build_client_info(structured_data, data.get('customer_number', ''))
+        if client_info != data.get('client_info'):
+            updates['client_info'] = client_info
+
+    if 'lead_features' in fields:
+        transcript = data.get('transcript') or ''
+        if not transcript and chunks:
+            transcript = decompress_transcript(chunks)
+        extractor = tenant.lead_extractor if tenant is not None else get_extractor()
+        lead = extractor.extract(client_info.get('note', ''), transcript).to_dict()
+        if lead != data.get('lead_features'):
+            updates['lead_features'] = lead
+
+    if 'assigned_agent' in fields and tenant is not None:
+        agent = get_agent_for_zone(client_info.get('zona'), tenant)
+        if agent != data.get('assigned_agent'):
+            updates['assigned_agent'] = agent if agent else _DELETE
+
+    return updates
+
+
+def _init_worker():
+    logging.disable(logging.INFO)  # get_agent_for_zone logga ogni risoluzione
+
+
+def recompute_page(items, tenant_specs, fields):
+    """Unità di lavoro di un worker: [(call_id, updates)] per i documenti cambiati"""
+    results = []
+    for item in items:
+        spec = tenant_specs.get(item[1].get('assistant_id') or item[1].get('order_id'))
+        updates = recompute_call(item, _tenant(spec), fields)
+        if updates:
+            results.append((item[0], updates))
+    return results
+
+
+# --- Processo principale: I/O Firestore, checkpoint, scritture ---
+
+def _tenant_spec(context):
+    if context is None:
+        return None
+    return (context.assistant_id, context.user_id, context.order_id, context.from_number,
+            context.zone_assignments, context.zone_aliases, context.lead_vocabulary)
+
+
+class _Tenants:
+    """Contesti tenant per assistant_id/order_id, letti una volta per run"""
+
+    def __init__(self, db):
+        self._db = db
+        self._specs = {}
+
+    def spec(self, call_data):
+        assistant_id = call_data.get('assistant_id')
+        order_id = call_data.get('order_id')
+        key = assistant_id or order_id
+        if not key:
+            return None, None
+        if key not in self._specs:
+            if not assistant_id:
+                # Chiamate storiche senza assistant_id: risale dall'order
+                order = self._db.collection('orders').document(order_id).get()
+                assistant_id = order.to_dict().get('vapi_assistant_id') if order.exists else None
+            context = load_tenant_context(self._db, assistant_id) if assistant_id else None
+            self._specs[key] = _tenant_spec(context)
+        return key, self._specs[key]
+
+
+def _usage_add(usage, call_data):
+    """
+    Accumula durata e conteggio per mese (started_at), globale e per
+    tenant; solo chiamate concluse, come rebuild_monthly_rollups
+    """
+    from usage_rollup import month_key
+
+    started_at = call_data.get('started_at')
+    if call_data.get('status') != 'completed' or not started_at or not hasattr(started_at, 'strftime'):
+        return
+    duration = call_data.get('duration', 0) or 0
+    month = usage.setdefault(month_key(started_at), {'global': {'call_count': 0, 'total_duration': 0},
+                                                     'tenants': {}})
+    targets = [month['global']]
+    if call_data.get('user_id'):
+        targets.append(month['tenants'].setdefault(call_data['user_id'],
+                                                   {'call_count': 0, 'total_duration': 0}))
+    for target in targets:
+        target['call_count'] += 1
+        target['total_duration'] += duration
+
+
+def _usage_merge(usage, page_usage):
+    """Somma in `usage` i totali di una pagina (stessa forma di _usage_add)"""
+    for month, values in page_usage.items():
+        target = usage.setdefault(month, {'global': {'call_count': 0, 'total_duration': 0}, 'tenants': {}})
+        totals = [(target['global'], values['global'])]
+        totals.extend((target['tenants'].setdefault(user_id, {'call_count': 0, 'total_duration': 0}), counts)
+                      for user_id, counts in values['tenants'].items())
+        for into, counts in totals:
+            into['call_count'] += counts['call_count']
+            into['total_duration'] += counts['total_duration']
+
+
+class Backfill:
+    """
+    Rielaborazione a pagine di `calls`.
+
+    Args:
+        db: Firestore client
+        fields: Campi derivati da ricalcolare
+        page_size: Documenti per pagina (e per unità di lavoro dei worker)
+        workers: Processi worker (0 = elaborazione nel processo principale)
+        dry_run: Calcola e conta le modifiche senza scrivere
+        usage: Riscrive i rollup mensili dai totali accumulati
+        max_writes_per_second: Limite di scrittura (None = nessuno)
+        checkpoint: Nome del run per checkpoint/resume (None = niente checkpoint)
+        limit: Massimo documenti da scansionare
+    """
+
+    def __init__(self, db, fields=FIELDS, page_size=DEFAULT_PAGE_SIZE, workers=None, dry_run=False,
+                 usage=False, max_writes_per_second=None, checkpoint=None, limit=None):
+        self.db = db
+        self.fields = tuple(fields)
+        self.page_size = page_size
+        if workers is None:
+            # Con una sola CPU un pool aggiunge solo pickling
+            workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+        self.workers = workers
+        self.dry_run = dry_run
+        self.usage = usage
+        self.checkpoint = checkpoint
+        self.limit = limit
+        self._pacer = Pacer(max_writes_per_second)
+        self._tenants = _Tenants(db)
+        self.stats = {'scanned': 0, 'changed': 0, 'writes': 0, 'commits': 0}
+        self.changes = {field: 0 for field in self.fields}
+        self._usage = {}
+        self._last_id = None
+
+    def _checkpoint_ref(self):
+        return self.db.collection(CHECKPOINT_COLLECTION).document(self.checkpoint)
+
+    def resume(self):
+        """Riprende stato e cursore dall'ultimo checkpoint. Ritorna False se assente."""
+        snapshot = self._checkpoint_ref().get()
+        if not snapshot.exists:
+            return False
+        state = snapshot.to_dict()
+        self._last_id = state.get('last_id')
+        self.stats.update(state.get('stats') or {})
+        self.changes.update(state.get('changes') or {})
+        self._usage = state.get('usage') or {}
+        logging.info(f"Resuming backfill '{self.checkpoint}' after {self._last_id} ({self.stats['scanned']} scanned)")
+        return True
+
+    def _save_checkpoint(self, done=False):
+        if not self.checkpoint or self.dry_run:
+            return
+        from google.cloud import firestore
+
+        self._checkpoint_ref().set({
+            'last_id': self._last_id,
+            'fields': list(self.fields),
+            'stats': self.stats,
+            'changes': self.changes,
+            'usage': self._usage if self.usage else {},
+            'done': done,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+
+    def _pages(self):
+        collection = self.db.collection('calls')
+        cursor = None
+        if self._last_id:
+            cursor = collection.document(self._last_id).get()
+        scanned = self.stats['scanned']
+        while self.limit is None or scanned < self.limit:
+            size = self.page_size if self.limit is None else min(self.page_size, self.limit - scanned)
+            query = collection.order_by('__name__').limit(size)
+            if cursor is not None:
+                query = query.start_after(cursor)
+            page = list(query.stream())
+            if not page:
+                return
+            cursor = page[-1]
+            scanned += len(page)
+            yield page
+
+    def _prepare(self, page):
+        """
+        Pagina -> (items per i worker, tenant spec usati, utilizzo della
+        pagina). L'utilizzo entra nei totali solo in _finish_page, insieme
+        al cursore: il checkpoint non conta pagine ancora in volo.
+        """
+        chunks = read_transcript_chunks(self.db, page) if 'lead_features' in self.fields else {}
+        items = []
+        specs = {}
+        page_usage = {}
+        for snapshot in page:
+            data = snapshot.to_dict() or {}
+            key, spec = self._tenants.spec(data)
+            if key is not None:
+                specs[key] = spec
+            if self.usage:
+                _usage_add(page_usage, data)
+            # Ai worker solo i campi letti dal ricalcolo (meno pickling)
+            items.append((snapshot.id, {key: data[key] for key in _WORKER_KEYS if key in data}, chunks.get(snapshot.id)))
+        return items, specs, page_usage
+
+    def _write(self, results):
+        from google.cloud import firestore
+
+        if self.dry_run:
+            return
+        batch = self.db.batch()
+        pending = 0
+        for call_id, updates in results:
+            if pending >= MAX_BATCH_WRITES:
+                self._commit(batch, pending)
+                batch = self.db.batch()
+                pending = 0
+            batch.update(self.db.collection('calls').document(call_id), {
+                field: firestore.DELETE_FIELD if value is _DELETE else value
+                for field, value in updates.items()
+            })
+            pending += 1
+        if pending:
+            self._commit(batch, pending)
+
+    def _commit(self, batch, pending):
+        self._pacer.wait(pending)
+        batch.commit()
+        self.stats['writes'] += pending
+        self.stats['commits'] += 1
+
+    def _finish_page(self, page_size, last_id, results, page_usage):
+        self._write(results)
+        _usage_merge(self._usage, page_usage)
+        self.stats['scanned'] += page_size
+        self.stats['changed'] += len(results)
+        for _, updates in results:
+            for field in updates:
+                self.changes[field] += 1
+        self._last_id = last_id
+        self._save_checkpoint()
+
+    def run(self):
+        """
+        Esegue il backfill. Returns dict con stats, modifiche per campo,
+        secondi e throughput (documenti/s, write/s).
+        """
+        start = time.perf_counter()
+        scanned_before = self.stats['scanned']
+        pool = None
+        if self.workers:
+            # spawn: i worker non ereditano il canale gRPC del client Firestore
+            pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'), _init_worker)
+        inflight = deque()
+        try:
+            for page in self._pages():
+                items, specs, page_usage = self._prepare(page)
+                if pool is not None:
+                    result = pool.submit(recompute_page, items, specs, self.fields)
+                else:
+                    previous = logging.root.manager.disable
+                    _init_worker()
+                    try:
+                        result = recompute_page(items, specs, self.fields)
+                    finally:
+                        logging.disable(previous)
+                inflight.append((len(page), page[-1].id, result, page_usage))
+                # Pipeline: al massimo `workers` pagine in volo, scritte in ordine
+                while len(inflight) > max(self.workers, 0):
+                    self._drain(inflight.popleft(), start, scanned_before)
+            while inflight:
+                self._drain(inflight.popleft(), start, scanned_before)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        if self.usage and not self.dry_run:
+            from usage_rollup import write_monthly_rollups
+            for month, values in sorted(self._usage.items()):
+                write_monthly_rollups(self.db, month, values['global'], values['tenants'])
+        self._save_checkpoint(done=True)
+
+        elapsed = time.perf_counter() - start
+        scanned = self.stats['scanned'] - scanned_before
+        return {
+            'stats': dict(self.stats),
+            'changes': dict(self.changes),
+            'usage_months': sorted(self._usage),
+            'seconds': elapsed,
+            'docs_per_second': scanned / elapsed if elapsed else 0.0,
+            'writes_per_second': self.stats['writes'] / elapsed if elapsed else 0.0,
+        }
+
+    def _drain(self, entry, start, scanned_before):
+        page_size, last_id, result, page_usage = entry
+        results = result.result() if hasattr(result, 'result') else result
+        self._finish_page(page_size, last_id, results, page_usage)
+        elapsed = time.perf_counter() - start
+        rate = (self.stats['scanned'] - scanned_before) / elapsed if elapsed else 0
+        logging.info(
+            f"Backfill: {self.stats['scanned']} scanned, {self.stats['changed']} changed, "
+            f"{self.stats['writes']} writes, {rate:.0f} docs/s"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rielabora le chiamate storiche con la logica attuale del webhook')
+    parser.add_argument('--fields', default=','.join(FIELDS), help=f"Campi da ricalcolare ({','.join(FIELDS)})")
+    parser.add_argument('--usage', action='store_true', help='Riscrive i rollup mensili di utilizzo')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--workers', type=int, default=None, help='Processi worker (default: CPU, 0 = nessuno)')
+    parser.add_argument('--limit', type=int, default=None, help='Massimo documenti da scansionare')
+    parser.add_argument('--dry-run', action='store_true', help='Solo conteggi, nessuna scrittura')
+    parser.add_argument('--max-writes-per-second', type=float, default=None)
+    parser.add_argument('--checkpoint', default=None, help='Nome del run (salva il cursore in backfill_runs)')
+    parser.add_argument('--resume', action='store_true', help="Riprende dall'ultimo checkpoint")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    fields = [field for field in args.fields.split(',') if field]
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        parser.error(f"Campi sconosciuti: {', '.join(sorted(unknown))}")
+    if args.resume and not args.checkpoint:
+        parser.error('--resume richiede --checkpoint')
+    if args.usage and args.limit is not None:
+        parser.error('--usage richiede una scansione completa (senza --limit)')
+
+    from clients import get_firestore
+    backfill = Backfill(
+        get_firestore(), fields, args.page_size, args.workers, args.dry_run, args.usage,
+        args.max_writes_per_second, args.checkpoint, args.limit
+    )
+    if args.resume and not backfill.resume():
+        parser.error(f"Checkpoint '{args.checkpoint}' non trovato")
+
+    report = backfill.run()
+    stats = report['stats']
+    print(f"scanned {stats['scanned']}, changed {stats['changed']}{' (dry run)' if args.dry_run else ''}, "
+          f"{stats['writes']} writes in {stats['commits']} commits")
+    print('changes: ' + ', '.join(f"{field} {count}" for field, count in report['changes'].items()))
+    if report['usage_months']:
+        print(f"usage rollups: {', '.join(report['usage_months'])}")
+    print(f"{report['seconds']:.1f}s, {report['docs_per_second']:.0f} docs/s, "
+          f"{report['writes_per_second']:.0f} writes/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""
+Profili chiamante per tenant: storico di un numero senza scansionare `calls`
+
+Ogni fine chiamata trattava il chiamante come nuovo: l'agente riceveva un
+"Nuovo Lead" completo anche alla terza telefonata della stessa persona, e
+per sapere se aveva già chiamato bisognava cercare in `calls` per
+customer_number.
+
+Documento `caller_profiles/{user_id}_{numero}`:
+- call_count (Increment), first_seen, last_seen, last_call_id
+- client_info: unione dei campi noti dalle chiamate precedenti (merge a
+  livello di campo: un 'Non specificato' non cancella un dato già noto)
+- last_notified_at: ultimo lead notificato all'agente
+
+Aggiornato a fine chiamata nella stessa transazione che salva la chiamata.
+Lettura: una get per (tenant, numero), poi cache in-process (LRU + TTL)
+aggiornata dopo ogni commit. Con più istanze il conteggio mostrato può
+restare indietro di qualche chiamata fino alla scadenza del TTL; il
+contatore sul documento resta esatto (Increment).
+
+Lead quasi duplicati: se il tenant imposta `duplicate_lead_window`
+(secondi) su users/{user_id}, una richiamata entro la finestra che non
+aggiunge informazioni rispetto al profilo non genera un nuovo WhatsApp
+(mai per i lead urgenti). Disattivato di default.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import telemetry
+
+PROFILE_COLLECTION = 'caller_profiles'
+NOT_SPECIFIED = 'Non specificato'
+
+# Campi del lead confrontati per riconoscere una richiamata senza novità
+LEAD_FIELDS = ('nome', 'tipo_richiesta', 'zona', 'tipo_immobile', 'budget')
+
+_NUMBER_CHARS = re.compile(r'[^\d+]')
+
+
+def normalize_number(customer_number):
+    """'whatsapp:+39 347 123 4567' -> '+393471234567'"""
+    return _NUMBER_CHARS.sub('', (customer_number or '').replace('whatsapp:', ''))
+
+
+def profile_id(user_id, customer_number):
+    return f"{user_id}_{normalize_number(customer_number)}"
+
+
+def _known(value):
+    return bool(value) and value != NOT_SPECIFIED
+
+
+def known_fields(client_info):
+    """Solo i campi con un valore (niente vuoti / 'Non specificato')"""
+    return {key: value for key, value in (client_info or {}).items() if _known(value)}
+
+
+class CallerProfile:
+    """Storico di un numero presso un tenant (call_count 0 = mai visto)"""
+    __slots__ = ('user_id', 'customer_number', 'call_count', 'first_seen', 'last_seen',
+                 'last_call_id', 'client_info', 'last_notified_at')
+
+    def __init__(self, user_id, customer_number, call_count=0, first_seen=None, last_seen=None,
+                 last_call_id=None, client_info=None, last_notified_at=None):
+        self.user_id = user_id
+        self.customer_number = customer_number
+        self.call_count = call_count
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.last_call_id = last_call_id
+        self.client_info = client_info or {}
+        self.last_notified_at = last_notified_at
+
+    @classmethod
+    def from_dict(cls, user_id, customer_number, data):
+        data = data or {}
+        return cls(user_id, customer_number, data.get('call_count', 0) or 0, data.get('first_seen'),
+                   data.get('last_seen'), data.get('last_call_id'), data.get('client_info'),
+                   data.get('last_notified_at'))
+
+    @property
+    def returning(self):
+        return self.call_count > 0
+
+    def enrich(self, client_info):
+        """client_info della chiamata completato con i dati già noti del chiamante"""
+        merged = dict(client_info)
+        for key, value in self.client_info.items():
+            if not _known(merged.get(key)):
+                merged[key] = value
+        return merged
+
+    def is_near_duplicate(self, client_info, window, now=None):
+        """
+        Richiamata entro `window` secondi dall'ultimo lead notificato che
+        non aggiunge né cambia nessun campo del lead.
+        """
+        if not window or not self.last_notified_at:
+            return False
+        now = now or datetime.now(timezone.utc)
+        if (now - _aware(self.last_notified_at)).total_seconds() > window:
+            return False
+        for key in LEAD_FIELDS:
+            value = client_info.get(key)
+            if _known(value) and _fold(value) != _fold(self.client_info.get(key)):
+                return False
+        return True
+
+    def notification_info(self):
+        """Dati per la notifica ('returning caller'): None al primo contatto"""
+        if not self.returning:
+            return None
+        return {'call_count': self.call_count + 1, 'first_seen': self.first_seen}
+
+    def after_call(self, call_id, client_info, notified, now=None):
+        """Copia aggiornata come dopo record_caller_profile (per la cache)"""
+        now = now or datetime.now(timezone.utc)
+        merged = dict(self.client_info)
+        merged.update(known_fields(client_info))
+        return CallerProfile(self.user_id, self.customer_number, self.call_count + 1,
+                             self.first_seen or now, now, call_id, merged,
+                             now if notified else self.last_notified_at)
+
+
+def _aware(value):
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _fold(value):
+    return ' '.join(str(value).lower().split()) if value else ''
+
+
+def record_caller_profile(db, writer, profile, call_id, client_info, notified):
+    """
+    Accoda su `writer` (transaction/batch) l'aggiornamento del profilo a
+    fine chiamata: merge, nessuna lettura. first_seen solo se il profilo
+    letto non esisteva.
+    """
+    from google.cloud import firestore
+
+    data = {
+        'user_id': profile.user_id,
+        'customer_number': profile.customer_number,
+        'call_count': firestore.Increment(1),
+        'last_seen': firestore.SERVER_TIMESTAMP,
+        'last_call_id': call_id,
+    }
+    if not profile.returning:
+        data['first_seen'] = firestore.SERVER_TIMESTAMP
+    info = known_fields(client_info)
+    if info:
+        data['client_info'] = info
+    if notified:
+        data['last_notified_at'] = firestore.SERVER_TIMESTAMP
+    ref = db.collection(PROFILE_COLLECTION).document(profile_id(profile.user_id, profile.customer_number))
+    writer.set(ref, data, merge=True)
+
+
+class CallerProfiles:
+    """
+    Cache LRU + TTL dei profili per (user_id, numero).
+
+    Args:
+        db_factory: Funzione che ritorna il client Firestore
+        max_size: Profili massimi in memoria
+        ttl: Secondi dopo cui un profilo viene riletto (aggiornamenti di altre istanze)
+        clock: Funzione tempo monotono (iniettabile nei test)
+    """
+
+    def __init__(self, db_factory, max_size=5000, ttl=300, clock=time.monotonic):
+        self._db_factory = db_factory
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # profile_id -> (CallerProfile, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, user_id, customer_number):
+        """Profilo del chiamante (call_count 0 se nuovo): una get al primo accesso"""
+        profile = self.peek(user_id, customer_number)
+        if profile is not None:
+            return profile
+        key = profile_id(user_id, customer_number)
+        snapshot = self._db_factory().collection(PROFILE_COLLECTION).document(key).get()
+        telemetry.count('firestore_rpc', op='read')
+        return self.loaded(user_id, customer_number, snapshot.to_dict() if snapshot.exists else None)
+
+    def peek(self, user_id, customer_number):
+        """
+        Profilo in cache senza leggerlo (None se da caricare). Usata dal
+        percorso asyncio, che legge il documento da sé e chiama loaded().
+        """
+        key = profile_id(user_id, customer_number)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                telemetry.count('cache', cache='caller_profile', result='hit')
+                return entry[0]
+        telemetry.count('cache', cache='caller_profile', result='miss')
+        return None
+
+    def loaded(self, user_id, customer_number, data):
+        """Profilo dal documento letto (None = mai visto), messo in cache"""
+        profile = CallerProfile.from_dict(user_id, normalize_number(customer_number), data)
+        with self._lock:
+            self.loads += 1
+        self.remember(profile)
+        return profile
+
+    def remember(self, profile):
+        """Inserisce/aggiorna il profilo in cache (es. dopo il commit di fine chiamata)"""
+        key = profile_id(profile.user_id, profile.customer_number)
+        with self._lock:
+            self._entries[key] = (profile, self._clock() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def forget(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.loads = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'loads': self.loads}
+
+
+def lookup_profile(profiles, tenant, customer_number):
+    """Profilo per la chiamata, None se senza tenant/numero o in errore (fail-open)"""
+    if tenant is None or not tenant.user_id or not normalize_number(customer_number):
+        return None
+    try:
+        with telemetry.span('caller_profile'):
+            return profiles.get(tenant.user_id, customer_number)
+    except Exception as e:
+        logging.error(f"Error loading caller profile for {customer_number}: {e}")
+        return None
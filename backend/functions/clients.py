@@ -0,0 +1,136 @@
+"""
+Registry dei client condivisi (Firestore, Twilio)
+
+Un solo client per tipo e per processo, creato alla prima richiesta e poi
+riusato da tutti i moduli: niente setup credenziali/canale gRPC per ogni
+notifica. Nei test si possono iniettare fake con set_firestore/set_twilio.
+
+Client Twilio: twilio.rest (default) dentro twilio_sender.RetryingClient
+(retry con jitter su 429/5xx e circuit breaker). TWILIO_CLIENT=sender
+attiva twilio_sender.TwilioSender (stessa politica, API REST senza SDK).
+Configurabile via env:
+- TWILIO_HTTP_TIMEOUT     timeout lettura in secondi (default 10)
+- TWILIO_CONNECT_TIMEOUT  timeout connessione in secondi (default 3.05)
+- TWILIO_POOL_MAXSIZE     connessioni keep-alive per host (default 10)
+- TWILIO_MAX_RETRIES      retry su 429/5xx/errori di connessione (default 2)
+- TWILIO_API_BASE_URL     endpoint API con sender (default https://api.twilio.com)
+
+Firestore usa un singolo canale gRPC multiplexato per client: condividere
+il client è già il pooling corretto. Il percorso asyncio del webhook
+(vapi_webhook_async.py) usa un AsyncClient separato (get_async_firestore).
+"""
+import os
+import threading
+
+TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+
+TWILIO_HTTP_TIMEOUT = float(os.environ.get('TWILIO_HTTP_TIMEOUT', '10'))
+TWILIO_POOL_MAXSIZE = int(os.environ.get('TWILIO_POOL_MAXSIZE', '10'))
+TWILIO_CONNECT_TIMEOUT = float(os.environ.get('TWILIO_CONNECT_TIMEOUT', '3.05'))
+TWILIO_MAX_RETRIES = int(os.environ.get('TWILIO_MAX_RETRIES', '2'))
+TWILIO_API_BASE_URL = os.environ.get('TWILIO_API_BASE_URL', 'https://api.twilio.com')
+TWILIO_CLIENT = os.environ.get('TWILIO_CLIENT', 'sdk').lower()
+
+_lock = threading.Lock()
+_firestore_client = None
+_async_firestore_client = None
+_twilio_client = None
+_twilio_resolved = False
+
+
+def get_firestore():
+    """Firestore client condiviso (creato alla prima chiamata)"""
+    global _firestore_client
+    if _firestore_client is None:
+        with _lock:
+            if _firestore_client is None:
+                from google.cloud import firestore
+                _firestore_client = firestore.Client()
+    return _firestore_client
+
+
+def get_async_firestore():
+    """Firestore AsyncClient condiviso (da usare sull'event loop del processo)"""
+    global _async_firestore_client
+    if _async_firestore_client is None:
+        with _lock:
+            if _async_firestore_client is None:
+                from google.cloud import firestore
+                _async_firestore_client = firestore.AsyncClient()
+    return _async_firestore_client
+
+
+def _build_twilio():
+    if TWILIO_CLIENT == 'sender':
+        from twilio_sender import TwilioSender
+
+        return TwilioSender(
+            TWILIO_ACCOUNT_SID,
+            TWILIO_AUTH_TOKEN,
+            base_url=TWILIO_API_BASE_URL,
+            connect_timeout=TWILIO_CONNECT_TIMEOUT,
+            read_timeout=TWILIO_HTTP_TIMEOUT,
+            max_attempts=TWILIO_MAX_RETRIES + 1,
+            pool_maxsize=TWILIO_POOL_MAXSIZE
+        )
+
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+    from twilio_sender import RetryingClient
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+    # Retry fatti da RetryingClient (con jitter e breaker), non dall'adapter
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=TWILIO_POOL_MAXSIZE,
+        max_retries=0
+    )
+    http_client.session.mount('https://', adapter)
+    client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+    return RetryingClient(client, max_attempts=TWILIO_MAX_RETRIES + 1)
+
+
+def get_twilio():
+    """Twilio client condiviso, o None se le credenziali non sono configurate"""
+    global _twilio_client, _twilio_resolved
+    if not _twilio_resolved:
+        with _lock:
+            if not _twilio_resolved:
+                if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+                    _twilio_client = _build_twilio()
+                _twilio_resolved = True
+    return _twilio_client
+
+
+def set_firestore(client):
+    """Inietta un client Firestore (fake nei test/benchmark)"""
+    global _firestore_client
+    with _lock:
+        _firestore_client = client
+
+
+def set_async_firestore(client):
+    """Inietta un client Firestore asincrono (fake nei test/benchmark)"""
+    global _async_firestore_client
+    with _lock:
+        _async_firestore_client = client
+
+
+def set_twilio(client):
+    """Inietta un client Twilio (fake nei test/benchmark)"""
+    global _twilio_client, _twilio_resolved
+    with _lock:
+        _twilio_client = client
+        _twilio_resolved = True
+
+
+def reset():
+    """Dimentica i client: verranno ricreati alla prossima richiesta"""
+    global _firestore_client, _async_firestore_client, _twilio_client, _twilio_resolved
+    with _lock:
+        _firestore_client = None
+        _async_firestore_client = None
+        _twilio_client = None
+        _twilio_resolved = False
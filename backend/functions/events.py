@@ -0,0 +1,172 @@
+"""
+Eventi Vapi tipizzati: un solo parse del body, oggetti compatti per tipo
+
+Il webhook legge i bytes una volta (firma HMAC + decode) e i handler
+ricevono un oggetto con i campi già estratti, invece di ripetere le
+catene .get('message', {}).get('call', {})... in ogni funzione.
+
+Eventi non gestiti (status-update, conversation-update, transcript...)
+vengono riconosciuti dal campo message.type senza decodificare il body:
+conversation-update porta l'intera conversazione a ogni turno. La
+lettura si ferma dopo PEEK_MAX_TOKENS token (type dopo array lunghi):
+oltre, costerebbe più del parse completo, che viene fatto comunque.
+
+Decoder JSON: orjson se installato, altrimenti json della stdlib
+(stesso risultato, più lento sui payload end-of-call da 50-200 KB).
+Regressioni: benchmarks/bench_events.py
+"""
+import json
+import re
+from datetime import datetime
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+ASSISTANT_REQUEST = 'assistant-request'
+END_OF_CALL_REPORT = 'end-of-call-report'
+FUNCTION_CALL = 'function-call'
+
+# Stringhe JSON (con escape) e punteggiatura strutturale: le stringhe lunghe
+# (transcript) vengono saltate in un solo passo della regex
+_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]:,]')
+_MESSAGE_KEY = b'"message"'
+_TYPE_KEY = b'"type"'
+
+# Token letti al massimo da peek_event_type prima del ripiego sul parse completo
+PEEK_MAX_TOKENS = 512
+
+
+class VapiEvent:
+    """Campi comuni degli eventi di una chiamata"""
+    __slots__ = ('type', 'call_id', 'customer_number', 'assistant_id')
+
+    def __init__(self, message, payload):
+        call = message.get('call') or {}
+        self.type = message.get('type', '')
+        self.call_id = call.get('id', '')
+        self.customer_number = (call.get('customer') or {}).get('number', '')
+        # assistantId: sulla call, sul message o alla radice del payload
+        self.assistant_id = call.get('assistantId') or message.get('assistantId') or payload.get('assistantId', '')
+
+
+class AssistantRequest(VapiEvent):
+    __slots__ = ()
+
+
+def _parse_time(value):
+    """Timestamp ISO 8601 di Vapi ('2025-03-14T10:21:07.412Z') -> datetime, None se assente/non valido"""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+class EndOfCallReport(VapiEvent):
+    __slots__ = ('duration', 'ended_reason', 'started_at', 'structured_data', 'transcript')
+
+    def __init__(self, message, payload):
+        super().__init__(message, payload)
+        call = message.get('call') or {}
+        self.duration = call.get('duration', 0)
+        self.ended_reason = call.get('endedReason', 'unknown')
+        # Inizio chiamata secondo Vapi (startedAt sul message o sulla call)
+        self.started_at = _parse_time(message.get('startedAt') or call.get('startedAt'))
+        self.structured_data = message.get('structuredData') or {}
+        self.transcript = message.get('transcript', '')
+
+
+class FunctionCall(VapiEvent):
+    __slots__ = ('name', 'parameters')
+
+    def __init__(self, message, payload):
+        super().__init__(message, payload)
+        function_call = message.get('functionCall') or {}
+        self.name = function_call.get('name', '')
+        self.parameters = function_call.get('parameters', {})
+
+
+class UnhandledEvent:
+    """Tipo non gestito dal webhook: solo il tipo, il body non viene decodificato"""
+    __slots__ = ('type',)
+
+    call_id = ''
+
+    def __init__(self, event_type):
+        self.type = event_type
+
+
+EVENT_TYPES = {
+    ASSISTANT_REQUEST: AssistantRequest,
+    END_OF_CALL_REPORT: EndOfCallReport,
+    FUNCTION_CALL: FunctionCall,
+}
+
+
+def peek_event_type(body, max_tokens=PEEK_MAX_TOKENS):
+    """
+    message.type letto dai bytes senza decodificare il resto del payload.
+    Conta la profondità di {}/[] così un "type" annidato (messages,
+    toolCalls...) non viene scambiato per quello dell'evento. Si ferma
+    dopo `max_tokens` token.
+
+    Returns:
+        str, o None se non trovato (il chiamante fa il parse completo)
+    """
+    depth = 0
+    key = None
+    candidate = None
+    in_message = False
+    for count, match in enumerate(_TOKEN.finditer(body)):
+        if count >= max_tokens:
+            return None
+        token = match.group()
+        first = token[0]
+        if first == 0x22:  # '"'
+            if key is None:
+                candidate = token
+                continue
+            if in_message and depth == 2 and key == _TYPE_KEY:
+                return json.loads(token)
+            key = None
+        elif token == b':':
+            key, candidate = candidate, None
+        elif token == b',':
+            key = candidate = None
+        elif token in (b'{', b'['):
+            if depth == 1 and key == _MESSAGE_KEY and token == b'{':
+                in_message = True
+            depth += 1
+            key = candidate = None
+        else:
+            depth -= 1
+            if in_message and depth == 1:
+                return None  # Fine di message senza type
+            key = candidate = None
+    return None
+
+
+def event_from_payload(payload):
+    """Evento tipizzato da un payload già decodificato (dict)"""
+    message = payload.get('message') or {}
+    event_class = EVENT_TYPES.get(message.get('type', ''))
+    if event_class is None:
+        return UnhandledEvent(message.get('type', ''))
+    return event_class(message, payload)
+
+
+def decode_event(body):
+    """
+    Bytes del webhook -> evento tipizzato (un solo parse).
+
+    Raises:
+        ValueError: body non JSON
+    """
+    event_type = peek_event_type(body)
+    if event_type is not None and event_type not in EVENT_TYPES:
+        return UnhandledEvent(event_type)
+    return event_from_payload(loads(body))
@@ -0,0 +1,383 @@
+"""
+Idempotenza degli eventi webhook (call_id + tipo evento)
+
+Vapi ritenta i webhook in timeout: senza dedup un end-of-call-report
+ripetuto incrementa due volte l'utilizzo del tenant e rimanda il lead su
+WhatsApp. Ogni evento viene eseguito UNA volta; i duplicati ricevono la
+risposta originale senza side effect.
+
+Due livelli:
+- in-process: LRU delle risposte recenti + single-flight (un duplicato
+  concorrente sulla stessa istanza aspetta il primo e ne riusa la risposta)
+- durevole: marker `webhook_events/{call_id}:{event_type}` creato con
+  `create()` (atomico tra istanze) prima dei side effect:
+    processing (lease_until) -> done (response, status_code)
+  Se l'handler solleva il marker viene rimosso e il retry rielabora.
+  Un marker `processing` con lease scaduta (istanza crashata) viene
+  ripreso dal primo retry successivo.
+
+Un duplicato che arriva mentre l'originale è ancora in corso su un'altra
+istanza riceve 409: il retry successivo di Vapi troverà la risposta.
+
+I marker hanno `expires_at`: configurare una TTL policy Firestore su quel
+campo per eliminarli automaticamente.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import telemetry
+
+EVENTS_COLLECTION = 'webhook_events'
+
+LEASE_SECONDS = 120
+RETENTION_SECONDS = 7 * 86400
+FLIGHT_TIMEOUT_SECONDS = 60
+
+IN_PROGRESS_RESPONSE = ({'status': 'in_progress'}, 409)
+
+
+def _utc(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc)
+
+
+def event_key(call_id, event_type):
+    return f"{call_id}:{event_type}"
+
+
+def _split_response(response):
+    """Risposta Flask (body | (body, status)) -> (body, status_code)"""
+    if isinstance(response, tuple):
+        return response[0], response[1]
+    return response, 200
+
+
+def _join_response(body, status_code):
+    return body if status_code == 200 else (body, status_code)
+
+
+class _Flight:
+    """Evento in elaborazione: i duplicati sulla stessa istanza aspettano"""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class IdempotencyGuard:
+    """
+    Esegue un handler al massimo una volta per (call_id, tipo evento).
+
+    Args:
+        db_factory: Funzione che ritorna il client Firestore
+        durable_events: Tipi evento con marker durevole (gli altri solo in-process)
+        max_size: Numero massimo di risposte ricordate in-process
+        ttl: Secondi di validità di una risposta in-process
+        lease_seconds: Durata della presa in carico prima che un retry possa riprenderla
+        clock: Funzione che ritorna epoch seconds (iniettabile nei test)
+    """
+
+    def __init__(self, db_factory, durable_events=('end-of-call-report',), max_size=2048, ttl=900,
+                 lease_seconds=LEASE_SECONDS, clock=time.time):
+        self._db_factory = db_factory
+        self._durable_events = frozenset(durable_events)
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lease_seconds = lease_seconds
+        self._clock = clock
+        self._responses = OrderedDict()  # key -> (response, expires_at)
+        self._inflight = {}
+        self._async_inflight = {}  # key -> asyncio.Future (percorso asyncio)
+        self._lock = threading.Lock()
+
+    def run(self, call_id, event_type, handler):
+        """
+        Esegue handler() se l'evento è nuovo, altrimenti ritorna la risposta
+        originale. Senza call_id l'handler viene eseguito sempre.
+        """
+        if not call_id:
+            return handler()
+        key = event_key(call_id, event_type)
+
+        with self._lock:
+            remembered = self._remembered(key, event_type)
+            if remembered is not None:
+                return remembered
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            telemetry.count('idempotency', event=event_type, result='duplicate_inflight')
+            if not flight.done.wait(FLIGHT_TIMEOUT_SECONDS):
+                return IN_PROGRESS_RESPONSE
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            response = self._run_leader(key, call_id, event_type, handler)
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+            raise
+
+        flight.value = response
+        with self._lock:
+            if response is not IN_PROGRESS_RESPONSE:
+                self._store(key, response)
+            del self._inflight[key]
+        flight.done.set()
+        return response
+
+    async def run_async(self, db, call_id, event_type, handler):
+        """
+        Come run() per il percorso asyncio: `handler` è una coroutine
+        function e il marker durevole usa il Firestore AsyncClient `db`.
+        Memoria delle risposte condivisa con run(); i duplicati concorrenti
+        sullo stesso event loop aspettano il primo senza occupare thread.
+        """
+        import asyncio
+
+        if not call_id:
+            return await handler()
+        key = event_key(call_id, event_type)
+
+        with self._lock:
+            remembered = self._remembered(key, event_type)
+        if remembered is not None:
+            return remembered
+
+        flight = self._async_inflight.get(key)
+        if flight is not None:
+            telemetry.count('idempotency', event=event_type, result='duplicate_inflight')
+            return await asyncio.shield(flight)
+
+        flight = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._run_leader_async(db, key, call_id, event_type, handler)
+        except Exception as e:
+            del self._async_inflight[key]
+            flight.set_exception(e)
+            flight.exception()  # Nessun warning se non ci sono duplicati in attesa
+            raise
+
+        del self._async_inflight[key]
+        if response is not IN_PROGRESS_RESPONSE:
+            with self._lock:
+                self._store(key, response)
+        flight.set_result(response)
+        return response
+
+    def _remembered(self, key, event_type):
+        """Risposta recente in-process o None. Da chiamare con il lock."""
+        entry = self._responses.get(key)
+        if entry is not None and entry[1] > self._clock():
+            self._responses.move_to_end(key)
+            telemetry.count('idempotency', event=event_type, result='duplicate_memory')
+            return entry[0]
+        return None
+
+    def _run_leader(self, key, call_id, event_type, handler):
+        if event_type not in self._durable_events:
+            telemetry.count('idempotency', event=event_type, result='first')
+            return handler()
+
+        try:
+            claimed, response = self._claim(key, call_id, event_type)
+        except Exception as e:
+            # Fail-open: meglio un possibile duplicato che perdere l'evento
+            logging.error(f"Idempotency claim failed for {key}: {e}")
+            telemetry.count('idempotency', event=event_type, result='error')
+            return handler()
+
+        if not claimed:
+            return self._not_claimed(key, event_type, response)
+
+        telemetry.count('idempotency', event=event_type, result='first')
+        try:
+            response = handler()
+        except Exception:
+            self._release(key)
+            raise
+        self._complete(key, response)
+        return response
+
+    async def _run_leader_async(self, db, key, call_id, event_type, handler):
+        if event_type not in self._durable_events:
+            telemetry.count('idempotency', event=event_type, result='first')
+            return await handler()
+
+        try:
+            claimed, response = await self._claim_async(db, key, call_id, event_type)
+        except Exception as e:
+            logging.error(f"Idempotency claim failed for {key}: {e}")
+            telemetry.count('idempotency', event=event_type, result='error')
+            return await handler()
+
+        if not claimed:
+            return self._not_claimed(key, event_type, response)
+
+        telemetry.count('idempotency', event=event_type, result='first')
+        ref = db.collection(EVENTS_COLLECTION).document(key)
+        try:
+            response = await handler()
+        except Exception:
+            try:
+                await ref.delete()
+                telemetry.count('firestore_rpc', op='write')
+            except Exception as e:
+                logging.error(f"Error releasing event marker {key}: {e}")
+            raise
+        try:
+            await ref.update(self._done_update(response))
+            telemetry.count('firestore_rpc', op='write')
+        except Exception as e:
+            logging.error(f"Error completing event marker {key}: {e}")
+        return response
+
+    @staticmethod
+    def _not_claimed(key, event_type, response):
+        if response is None:
+            logging.info(f"Event {key} already in progress on another instance")
+            telemetry.count('idempotency', event=event_type, result='in_progress')
+            return IN_PROGRESS_RESPONSE
+        logging.info(f"Duplicate event {key}: returning original response")
+        telemetry.count('idempotency', event=event_type, result='duplicate_durable')
+        return response
+
+    def _ref(self, key):
+        return self._db_factory().collection(EVENTS_COLLECTION).document(key)
+
+    def _claim(self, key, call_id, event_type):
+        """
+        Prende in carico l'evento.
+        Returns (True, None) se va elaborato, (False, risposta) se già fatto,
+        (False, None) se in corso altrove.
+        """
+        from google.api_core import exceptions
+        from google.cloud import firestore
+
+        ref = self._ref(key)
+        now = self._clock()
+        try:
+            ref.create(self._processing_marker(call_id, event_type, now))
+            telemetry.count('firestore_rpc', op='write')
+            return True, None
+        except exceptions.AlreadyExists:
+            pass
+
+        transaction = self._db_factory().transaction()
+
+        @firestore.transactional
+        def _run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            telemetry.count('firestore_rpc', op='read')
+            return self._resolve_marker(transaction, ref, snapshot, key, call_id, event_type, now)
+
+        result = _run(transaction)
+        telemetry.count('firestore_rpc', op='commit')
+        return result
+
+    async def _claim_async(self, db, key, call_id, event_type):
+        """Come _claim, con Firestore AsyncClient"""
+        from google.api_core import exceptions
+        from google.cloud import firestore
+
+        ref = db.collection(EVENTS_COLLECTION).document(key)
+        now = self._clock()
+        try:
+            await ref.create(self._processing_marker(call_id, event_type, now))
+            telemetry.count('firestore_rpc', op='write')
+            return True, None
+        except exceptions.AlreadyExists:
+            pass
+
+        @firestore.async_transactional
+        async def _run(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            telemetry.count('firestore_rpc', op='read')
+            return self._resolve_marker(transaction, ref, snapshot, key, call_id, event_type, now)
+
+        result = await _run(db.transaction())
+        telemetry.count('firestore_rpc', op='commit')
+        return result
+
+    def _processing_marker(self, call_id, event_type, now):
+        from google.cloud import firestore
+
+        return {
+            'call_id': call_id,
+            'event_type': event_type,
+            'status': 'processing',
+            'lease_until': _utc(now + self._lease_seconds),
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'expires_at': _utc(now + RETENTION_SECONDS),
+        }
+
+    def _resolve_marker(self, transaction, ref, snapshot, key, call_id, event_type, now):
+        """Decide sul marker esistente, letto in transazione (vedi _claim)"""
+        if not snapshot.exists:
+            # Rilasciato nel frattempo (handler fallito): lo rielaboriamo noi
+            transaction.set(ref, self._processing_marker(call_id, event_type, now))
+            return True, None
+        marker = snapshot.to_dict()
+        if marker.get('status') == 'done':
+            body = json.loads(marker.get('response') or 'null')
+            return False, _join_response(body, marker.get('status_code', 200))
+        lease_until = marker.get('lease_until')
+        if lease_until and lease_until > _utc(now):
+            return False, None
+        # Lease scaduta: l'istanza che lo elaborava è morta
+        logging.warning(f"Taking over expired event {key}")
+        transaction.update(ref, {'lease_until': _utc(now + self._lease_seconds)})
+        return True, None
+
+    @staticmethod
+    def _done_update(response):
+        from google.cloud import firestore
+
+        body, status_code = _split_response(response)
+        return {
+            'status': 'done',
+            'response': json.dumps(body),
+            'status_code': status_code,
+            'completed_at': firestore.SERVER_TIMESTAMP,
+        }
+
+    def _complete(self, key, response):
+        try:
+            self._ref(key).update(self._done_update(response))
+            telemetry.count('firestore_rpc', op='write')
+        except Exception as e:
+            # L'evento è elaborato: al peggio un retry dopo la lease lo ripete
+            logging.error(f"Error completing event marker {key}: {e}")
+
+    def _release(self, key):
+        try:
+            self._ref(key).delete()
+            telemetry.count('firestore_rpc', op='write')
+        except Exception as e:
+            logging.error(f"Error releasing event marker {key}: {e}")
+
+    def _store(self, key, response):
+        self._responses[key] = (response, self._clock() + self._ttl)
+        self._responses.move_to_end(key)
+        while len(self._responses) > self._max_size:
+            self._responses.popitem(last=False)
+
+    def forget(self, key=None):
+        """Svuota la memoria in-process (tutta o una chiave); i marker restano"""
+        with self._lock:
+            if key is None:
+                self._responses.clear()
+            else:
+                self._responses.pop(key, None)
@@ -0,0 +1,671 @@
+"""
+Inventario immobili in memoria per check_availability
+
+check_availability arriva a metà conversazione: ogni 100ms si sentono.
+Gli annunci del tenant (collezione `listings`) vengono caricati una volta in
+un indice colonnare e poi aggiornati in modo incrementale su `updated_at`.
+
+Struttura dell'indice:
+- gruppi (zona, contratto, categoria, locali) -> colonne `array` ordinate per
+  prezzo (prezzo, id, bitmask caratteristiche)
+- filtro budget = due bisect sulla colonna prezzi del gruppo, quindi il
+  conteggio non scansiona gli annunci (solo le caratteristiche richiedono
+  un passaggio sul range)
+- zona in testo libero risolta con zone_resolver sulle zone presenti
+
+Documento `listings/{id}`:
+    user_id, zona, tipo_immobile ('trilocale', 'villa', ...), prezzo,
+    locali, mq, contratto ('vendita' | 'affitto'), caratteristiche (lista),
+    stato ('disponibile' | 'venduto' | ...), updated_at
+
+Gli annunci non disponibili vanno marcati con `stato` (non cancellati):
+le cancellazioni fisiche vengono recepite solo al reload completo.
+"""
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+
+import telemetry
+from zone_resolver import ZoneIndex, normalize_zone
+
+LISTINGS_COLLECTION = 'listings'
+AVAILABLE_STATUS = 'disponibile'
+
+REFRESH_SECONDS = 60         # refresh incrementale al massimo una volta al minuto
+FULL_RELOAD_SECONDS = 3600   # reload completo (recepisce cancellazioni fisiche)
+MAX_TENANTS = 200
+BUDGET_TOLERANCE = 0.10      # "entro 300 mila" include fino a 330 mila
+MAX_FEATURES = 64
+
+# Tipologie con numero locali implicito
+ROOM_TYPES = {
+    'monolocale': 1,
+    'bilocale': 2,
+    'trilocale': 3,
+    'quadrilocale': 4,
+    'pentalocale': 5,
+}
+
+# Parola (annuncio o richiesta) -> categoria
+CATEGORIES = {
+    'appartamento': 'appartamento',
+    'appartamenti': 'appartamento',
+    'attico': 'attico',
+    'attici': 'attico',
+    'villa': 'villa',
+    'ville': 'villa',
+    'villetta': 'villa',
+    'villino': 'villa',
+    'loft': 'loft',
+    'ufficio': 'ufficio',
+    'uffici': 'ufficio',
+    'negozio': 'negozio',
+    'negozi': 'negozio',
+    'box': 'box',
+    'garage': 'box',
+    'posto auto': 'box',
+}
+
+# Richieste generiche che coprono più categorie
+CATEGORY_GROUPS = {
+    'casa': ('appartamento', 'attico', 'villa', 'loft'),
+    'abitazione': ('appartamento', 'attico', 'villa', 'loft'),
+    'immobile': None,
+    'immobili': None,
+}
+
+CONTRACTS = {
+    'vendita': 'vendita',
+    'comprare': 'vendita',
+    'acquisto': 'vendita',
+    'acquistare': 'vendita',
+    'affitto': 'affitto',
+    'affittare': 'affitto',
+    'locazione': 'affitto',
+}
+
+# Nome parlato: (singolare, plurale, femminile)
+NOUNS = {
+    'monolocale': ('monolocale', 'monolocali', False),
+    'bilocale': ('bilocale', 'bilocali', False),
+    'trilocale': ('trilocale', 'trilocali', False),
+    'quadrilocale': ('quadrilocale', 'quadrilocali', False),
+    'pentalocale': ('pentalocale', 'pentalocali', False),
+    'appartamento': ('appartamento', 'appartamenti', False),
+    'attico': ('attico', 'attici', False),
+    'villa': ('villa', 'ville', True),
+    'loft': ('loft', 'loft', False),
+    'ufficio': ('ufficio', 'uffici', False),
+    'negozio': ('negozio', 'negozi', False),
+    'box': ('box', 'box', False),
+    'casa': ('casa', 'case', True),
+}
+_DEFAULT_NOUN = ('immobile', 'immobili', False)
+
+_zone_key = lru_cache(maxsize=4096)(normalize_zone)
+
+_NUMBER = re.compile(r'(\d+(?:[.,]\d+)*)\s*(k|mila|mln|milion[ei]|m)?\b')
+
+
+# Valori ripetuti su migliaia di annunci (zone, tipologie, caratteristiche):
+# normalizzazioni memoizzate per tenere basso il costo del caricamento
+@lru_cache(maxsize=4096)
+def _norm(text):
+    text = unicodedata.normalize('NFKD', str(text))
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+@lru_cache(maxsize=1024)
+def parse_type(value):
+    """
+    'Trilocale' -> ('appartamento',), 3
+    'casa' -> ('appartamento', 'attico', 'villa', 'loft'), 0
+    None / sconosciuto -> None, 0 (nessun filtro)
+    """
+    if not value:
+        return None, 0
+    text = _norm(value)
+    for word, rooms in ROOM_TYPES.items():
+        if word in text:
+            return ('appartamento',), rooms
+    for word, group in CATEGORY_GROUPS.items():
+        if word in text:
+            return group, 0
+    for word, category in CATEGORIES.items():
+        if word in text:
+            return (category,), 0
+    return None, 0
+
+
+@lru_cache(maxsize=256)
+def parse_contract(value):
+    if not value:
+        return None
+    text = _norm(value)
+    for word, contract in CONTRACTS.items():
+        if word in text:
+            return contract
+    return None
+
+
+def _to_number(raw, unit):
+    if ',' in raw and '.' in raw:
+        raw = raw.replace('.', '').replace(',', '.')
+    elif ',' in raw:
+        raw = raw.replace(',', '.') if len(raw.rsplit(',', 1)[1]) != 3 else raw.replace(',', '')
+    elif raw.count('.') > 1 or (raw.count('.') == 1 and len(raw.rsplit('.', 1)[1]) == 3):
+        raw = raw.replace('.', '')
+    number = float(raw)
+    if unit in ('k', 'mila'):
+        number *= 1000
+    elif unit in ('mln', 'milione', 'milioni', 'm'):
+        number *= 1000000
+    return number
+
+
+def parse_budget(value, contract=None):
+    """
+    Budget parlato -> (min, max). Numeri passati da Vapi restano tali.
+    '300.000 euro' -> (None, 300000); 'tra 250 e 300 mila' -> (250000, 300000)
+    '1,2 milioni' -> (None, 1200000); '300' per una vendita -> 300 mila
+    """
+    if value is None or value == '':
+        return None, None
+    if isinstance(value, (int, float)):
+        return None, float(value)
+
+    text = _norm(value)
+    if 'mese' in text or 'mensil' in text:
+        contract = 'affitto'
+    matches = _NUMBER.findall(text)
+    if not matches:
+        return None, None
+
+    last_unit = matches[-1][1]
+    numbers = []
+    for raw, unit in matches[:2]:
+        number = _to_number(raw, unit or last_unit)
+        # "budget 300" in vendita = 300 mila
+        if contract != 'affitto' and not (unit or last_unit) and number < 10000:
+            number *= 1000
+        numbers.append(number)
+
+    if len(numbers) == 2:
+        return min(numbers), max(numbers)
+    return None, numbers[0]
+
+
+def _price_param(value, contract=None):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return parse_budget(value, contract)[1]
+
+
+def search_parameters(parameters):
+    """
+    Parametri della function call Vapi -> kwargs di InventoryIndex.search.
+    Accetta budget_min/budget_max numerici o un `budget` parlato, contratto
+    esplicito o dedotto da tipo_richiesta ('comprare' / 'affittare').
+    """
+    contract = parse_contract(parameters.get('contratto') or parameters.get('tipo_richiesta'))
+    budget_min = _price_param(parameters.get('budget_min'), contract)
+    budget_max = _price_param(parameters.get('budget_max'), contract)
+    if budget_min is None and budget_max is None:
+        budget_min, budget_max = parse_budget(parameters.get('budget'), contract)
+
+    # Senza contratto esplicito il budget lo rivela: 1.200 è un affitto, 300.000 no
+    if contract is None and (budget_max or budget_min):
+        contract = 'affitto' if (budget_max or budget_min) < 10000 else 'vendita'
+
+    def _text(name):
+        value = parameters.get(name)
+        return value if value and value != 'Non specificato' else None
+
+    return {
+        'zona': _text('zona'),
+        'tipo_immobile': _text('tipo_immobile'),
+        'budget_min': budget_min,
+        'budget_max': budget_max,
+        'contratto': contract,
+        'caratteristiche': parameters.get('caratteristiche') or None,
+    }
+
+
+class Listing:
+    __slots__ = ('id', 'zone_key', 'zone_label', 'contract', 'category', 'rooms', 'price', 'mq', 'features',
+                 'title')
+
+    def __init__(self, listing_id, zone_key, zone_label, contract, category, rooms, price, mq, features, title):
+        self.id = listing_id
+        self.zone_key = zone_key
+        self.zone_label = zone_label
+        self.contract = contract
+        self.category = category
+        self.rooms = rooms
+        self.price = price
+        self.mq = mq
+        self.features = features
+        self.title = title
+
+    @property
+    def group(self):
+        return self.zone_key, self.contract, self.category, self.rooms
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'zona': self.zone_label,
+            'categoria': self.category,
+            'locali': self.rooms,
+            'prezzo': self.price,
+            'mq': self.mq,
+            'contratto': self.contract,
+            'titolo': self.title,
+        }
+
+
+class _Group:
+    """Colonne di un gruppo ordinate per prezzo"""
+    __slots__ = ('prices', 'ids', 'features')
+
+    def __init__(self, listings):
+        listings = sorted(listings, key=lambda item: item.price)
+        self.prices = array('d', (item.price for item in listings))
+        self.ids = [item.id for item in listings]
+        self.features = array('Q', (item.features for item in listings))
+
+
+class SearchResult:
+    __slots__ = ('total', 'examples', 'zone_label', 'zone_unknown', 'nouns', 'budget_min', 'budget_max', 'contract')
+
+    def __init__(self, total, examples, zone_label=None, zone_unknown=False, nouns=_DEFAULT_NOUN,
+                 budget_min=None, budget_max=None, contract=None):
+        self.total = total
+        self.examples = examples
+        self.zone_label = zone_label
+        self.zone_unknown = zone_unknown
+        self.nouns = nouns
+        self.budget_min = budget_min
+        self.budget_max = budget_max
+        self.contract = contract
+
+
+class InventoryIndex:
+    """
+    Indice degli annunci disponibili di un tenant.
+
+    Args:
+        user_id: Tenant proprietario degli annunci
+        clock: Funzione tempo monotono (iniettabile nei test)
+    """
+
+    def __init__(self, user_id, clock=time.monotonic):
+        self.user_id = user_id
+        self._clock = clock
+        self._rows = {}             # id -> Listing
+        self._members = {}          # gruppo -> set(id)
+        self._groups = {}           # gruppo -> _Group
+        self._zone_groups = {}      # zone_key -> [gruppi]
+        self._zone_labels = {}      # zone_key -> etichetta parlata
+        self._zone_index = None
+        self._feature_bits = {}
+        self._watermark = None      # max updated_at visto
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.loaded_at = None
+        self.refreshed_at = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    # --- aggiornamento -------------------------------------------------
+
+    def _feature_mask(self, features):
+        mask = 0
+        for feature in features or ():
+            key = _norm(feature)
+            bit = self._feature_bits.get(key)
+            if bit is None:
+                if len(self._feature_bits) >= MAX_FEATURES:
+                    continue
+                bit = self._feature_bits[key] = len(self._feature_bits)
+            mask |= 1 << bit
+        return mask
+
+    def _to_listing(self, listing_id, data):
+        if data.get('stato', AVAILABLE_STATUS) != AVAILABLE_STATUS:
+            return None
+        try:
+            price = float(data.get('prezzo') or 0)
+        except (TypeError, ValueError):
+            return None
+        zone_label = (data.get('zona') or '').strip()
+        zone_key = _zone_key(zone_label)
+        if price <= 0 or not zone_key:
+            return None
+
+        categories, rooms = parse_type(data.get('tipo_immobile'))
+        category = categories[0] if categories and len(categories) == 1 else 'appartamento'
+        try:
+            rooms = int(data.get('locali') or rooms or 0)
+            mq = int(data.get('mq') or 0)
+        except (TypeError, ValueError):
+            mq = 0
+        return Listing(
+            listing_id,
+            zone_key,
+            zone_label,
+            parse_contract(data.get('contratto')) or 'vendita',
+            category,
+            rooms,
+            price,
+            mq,
+            self._feature_mask(data.get('caratteristiche')),
+            data.get('titolo') or ''
+        )
+
+    def apply(self, changes):
+        """
+        Applica upsert/rimozioni: iterable di (listing_id, data | None).
+        Ricostruisce solo i gruppi toccati. Ritorna il numero di modifiche.
+        """
+        dirty = set()
+        applied = 0
+        with self._lock:
+            for listing_id, data in changes:
+                previous = self._rows.pop(listing_id, None)
+                if previous is not None:
+                    self._members[previous.group].discard(listing_id)
+                    dirty.add(previous.group)
+
+                listing = self._to_listing(listing_id, data) if data is not None else None
+                if listing is not None:
+                    self._rows[listing_id] = listing
+                    self._members.setdefault(listing.group, set()).add(listing_id)
+                    self._zone_labels.setdefault(listing.zone_key, listing.zone_label)
+                    dirty.add(listing.group)
+
+                updated_at = (data or {}).get('updated_at')
+                if updated_at is not None and (self._watermark is None or updated_at > self._watermark):
+                    self._watermark = updated_at
+                applied += 1
+
+            self._rebuild(dirty)
+        return applied
+
+    def _rebuild(self, dirty):
+        zones_changed = False
+        for group in dirty:
+            members = self._members.get(group)
+            if members:
+                if group not in self._groups:
+                    self._zone_groups.setdefault(group[0], []).append(group)
+                    zones_changed = True
+                self._groups[group] = _Group(self._rows[i] for i in members)
+            elif group in self._groups:
+                del self._groups[group]
+                self._members.pop(group, None)
+                self._zone_groups[group[0]].remove(group)
+                if not self._zone_groups[group[0]]:
+                    del self._zone_groups[group[0]]
+                    self._zone_labels.pop(group[0], None)
+                zones_changed = True
+        if zones_changed or self._zone_index is None:
+            self._zone_index = ZoneIndex(dict.fromkeys(self._zone_groups))
+
+    def _reset(self):
+        with self._lock:
+            self._rows.clear()
+            self._members.clear()
+            self._groups.clear()
+            self._zone_groups.clear()
+            self._zone_labels.clear()
+            self._feature_bits.clear()
+            self._zone_index = None
+            self._watermark = None
+
+    def load(self, db):
+        """Caricamento completo degli annunci del tenant"""
+        docs = db.collection(LISTINGS_COLLECTION).where('user_id', '==', self.user_id).stream()
+        changes = [(doc.id, doc.to_dict()) for doc in docs]
+        telemetry.count('firestore_rpc', op='read')
+        self._reset()
+        self.apply(changes)
+        self.loaded_at = self.refreshed_at = self._clock()
+        logging.info(f"Inventory loaded for {self.user_id}: {len(self._rows)} available listings")
+        return len(changes)
+
+    def refresh(self, db):
+        """Solo annunci con updated_at >= ultimo visto (upsert idempotenti)"""
+        if self._watermark is None:
+            return self.load(db)
+        docs = db.collection(LISTINGS_COLLECTION)\
+            .where('user_id', '==', self.user_id)\
+            .where('updated_at', '>=', self._watermark)\
+            .order_by('updated_at')\
+            .stream()
+        changes = [(doc.id, doc.to_dict()) for doc in docs]
+        telemetry.count('firestore_rpc', op='read')
+        self.apply(changes)
+        self.refreshed_at = self._clock()
+        return len(changes)
+
+    def ensure_fresh(self, db, refresh_interval=REFRESH_SECONDS, full_reload_interval=FULL_RELOAD_SECONDS):
+        """
+        Ricarica se scaduto. Con indice già caricato e refresh in corso su
+        un altro thread risponde subito con i dati attuali.
+        """
+        now = self._clock()
+        if self.refreshed_at is not None and now - self.refreshed_at < refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            now = self._clock()
+            if self.loaded_at is None or now - self.loaded_at >= full_reload_interval:
+                self.load(db)
+            elif self.refreshed_at is None or now - self.refreshed_at >= refresh_interval:
+                try:
+                    self.refresh(db)
+                except Exception as e:
+                    # Meglio dati di un minuto fa che nessuna risposta
+                    logging.error(f"Inventory refresh failed for {self.user_id}: {e}")
+                    self.refreshed_at = now
+        finally:
+            self._refresh_lock.release()
+
+    # --- ricerca -------------------------------------------------------
+
+    def search(self, zona=None, tipo_immobile=None, budget_min=None, budget_max=None, contratto=None,
+               caratteristiche=None, limit=3):
+        """
+        Filtra per zona (testo libero), tipologia, budget, contratto e
+        caratteristiche. Ritorna SearchResult con totale ed esempi più economici.
+        """
+        categories, rooms = parse_type(tipo_immobile)
+        contract = parse_contract(contratto)
+        nouns = NOUNS.get(_type_word(tipo_immobile), _DEFAULT_NOUN)
+        low = budget_min if budget_min is not None else -math.inf
+        high = budget_max * (1 + BUDGET_TOLERANCE) if budget_max is not None else math.inf
+
+        if isinstance(caratteristiche, str):
+            caratteristiche = [c for c in caratteristiche.split(',') if c.strip()]
+
+        with self._lock:
+            zone_key = None
+            if zona:
+                zone_key = self._zone_index.resolve(zona) if self._zone_index is not None else None
+                if zone_key is None:
+                    return SearchResult(0, [], zona, True, nouns, budget_min, budget_max, contract)
+                candidates = self._zone_groups.get(zone_key, ())
+            else:
+                candidates = self._groups.keys()
+
+            required = 0
+            for feature in caratteristiche or ():
+                bit = self._feature_bits.get(_norm(feature))
+                if bit is None:
+                    candidates = ()
+                    break
+                required |= 1 << bit
+
+            total = 0
+            examples = []
+            for group in candidates:
+                _, group_contract, group_category, group_rooms = group
+                if contract is not None and group_contract != contract:
+                    continue
+                if categories is not None and group_category not in categories:
+                    continue
+                if rooms and group_rooms != rooms:
+                    continue
+
+                columns = self._groups[group]
+                start = bisect_left(columns.prices, low)
+                end = bisect_right(columns.prices, high)
+                if start >= end:
+                    continue
+
+                if not required:
+                    total += end - start
+                    picked = range(start, min(end, start + limit))
+                else:
+                    features = columns.features
+                    picked = [i for i in range(start, end) if features[i] & required == required]
+                    total += len(picked)
+                    picked = picked[:limit]
+                # Esempi di vendita prima degli affitti se il contratto non è noto
+                rank = 0 if group_contract == 'vendita' else 1
+                examples.extend((rank, columns.prices[i], columns.ids[i]) for i in picked)
+
+            examples.sort()
+            listings = [self._rows[listing_id] for _, _, listing_id in examples[:limit]]
+            zone_label = self._zone_labels.get(zone_key) if zone_key else None
+
+        return SearchResult(total, listings, zone_label, False, nouns, budget_min, budget_max, contract)
+
+
+def _type_word(tipo_immobile):
+    """Parola da usare nella risposta ('trilocali', 'ville', ...)"""
+    if not tipo_immobile:
+        return None
+    text = _norm(tipo_immobile)
+    for word in ROOM_TYPES:
+        if word in text:
+            return word
+    for word in ('casa', 'abitazione'):
+        if word in text:
+            return 'casa'
+    for word, category in CATEGORIES.items():
+        if word in text:
+            return category
+    return None
+
+
+def format_price(value, contract=None):
+    """Prezzo leggibile dal TTS: '420 mila euro', '1,2 milioni di euro', '1.200 euro al mese'"""
+    if contract == 'affitto':
+        return f"{int(round(value)):,} euro al mese".replace(',', '.')
+    if value >= 1000000:
+        millions = round(value / 1000000, 1)
+        if millions == 1:
+            return "1 milione di euro"
+        return f"{millions:g} milioni di euro".replace('.', ',')
+    if value >= 1000:
+        return f"{int(round(value / 1000))} mila euro"
+    return f"{int(round(value))} euro"
+
+
+def _example_phrase(listing, nouns, with_zone):
+    singular, _, feminine = NOUNS.get(_listing_noun(listing), nouns)
+    phrase = f"{'una' if feminine else 'un'} {singular}"
+    if listing.mq:
+        phrase += f" di {listing.mq} metri quadri"
+    if with_zone:
+        phrase += f" in zona {listing.zone_label}"
+    return f"{phrase} a {format_price(listing.price, listing.contract)}"
+
+
+def _listing_noun(listing):
+    if listing.category == 'appartamento':
+        for word, rooms in ROOM_TYPES.items():
+            if rooms == listing.rooms:
+                return word
+    return listing.category
+
+
+def format_availability(result):
+    """Risposta breve e parlabile per l'assistente vocale"""
+    singular, plural, feminine = result.nouns
+
+    if result.zone_unknown:
+        return (f"Al momento non abbiamo immobili in zona {result.zone_label}. "
+                f"Se vuole, faccio ricontattare da un agente con proposte nelle zone vicine.")
+
+    where = f" in zona {result.zone_label}" if result.zone_label else ""
+    budget = ""
+    if result.budget_max is not None:
+        budget = f" entro {format_price(result.budget_max, result.contract)}"
+    elif result.budget_min is not None:
+        budget = f" da {format_price(result.budget_min, result.contract)} in su"
+
+    if result.total == 0:
+        return (f"Al momento non abbiamo {plural} disponibili{where}{budget}. "
+                f"Posso far ricontattare da un agente appena ne entra uno adatto.")
+
+    examples = [_example_phrase(listing, result.nouns, not where) for listing in result.examples[:2]]
+    if result.total == 1:
+        return f"Abbiamo {examples[0]}{where}."
+
+    message = f"Abbiamo {result.total} {plural} disponibili{where}{budget}. Per esempio {examples[0]}"
+    if len(examples) > 1:
+        message += f", oppure {examples[1]}"
+    return message + "."
+
+
+class InventoryStore:
+    """
+    Indici per tenant (LRU), caricati al primo check_availability.
+
+    Args:
+        db_factory: Funzione senza argomenti che ritorna il client Firestore
+        max_tenants: Numero massimo di indici in memoria
+    """
+
+    def __init__(self, db_factory, max_tenants=MAX_TENANTS, refresh_interval=REFRESH_SECONDS,
+                 full_reload_interval=FULL_RELOAD_SECONDS, clock=time.monotonic):
+        self._db_factory = db_factory
+        self._max_tenants = max_tenants
+        self._refresh_interval = refresh_interval
+        self._full_reload_interval = full_reload_interval
+        self._clock = clock
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = self._indexes[user_id] = InventoryIndex(user_id, clock=self._clock)
+                while len(self._indexes) > self._max_tenants:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(user_id)
+
+        index.ensure_fresh(self._db_factory(), self._refresh_interval, self._full_reload_interval)
+        return index
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(user_id, None)
@@ -0,0 +1,328 @@
+"""
+Rollup analytics dei lead per tenant (giornalieri e mensili)
+
+Aggregati materializzati aggiornati a fine chiamata con incrementi
+atomici, nella stessa transazione che salva la chiamata: la dashboard
+legge pochi documenti per periodo invece di scansionare `calls`.
+
+Documenti in `lead_analytics`:
+- user_{user_id}_{YYYY-MM-DD}  -> giorno   (period='day')
+- user_{user_id}_{YYYY-MM}     -> mese     (period='month')
+
+Campi: calls, valid_leads (nome indicato), urgent, total_duration,
+budget_sum/budget_count (media budget), mappe di contatori by_zona,
+by_tipo_richiesta, by_tipo_immobile, by_feature e duration_histogram.
+Le chiavi delle mappe sono slug ('porta-romana', 'piano-alto').
+
+Giorno e mese sono quelli di started_at, sia a fine chiamata
+(incrementale) sia nel rebuild: i due percorsi danno gli stessi documenti.
+
+Rebuild dai documenti `calls` (migrazione, o dopo un backfill di
+client_info / lead_features):
+    python lead_analytics.py rebuild --month 2025-01
+"""
+import argparse
+import logging
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+import telemetry
+from clients import get_firestore
+from usage_rollup import month_bounds, month_key
+from zone_resolver import normalize_zone
+
+ANALYTICS_COLLECTION = 'lead_analytics'
+
+# Limiti superiori (secondi) delle fasce di durata; l'ultima è aperta
+DURATION_BUCKETS = (30, 60, 120, 300, 600)
+
+COUNTERS = ('calls', 'valid_leads', 'urgent', 'total_duration', 'budget_sum', 'budget_count')
+MAPS = ('by_zona', 'by_tipo_richiesta', 'by_tipo_immobile', 'by_feature', 'duration_histogram')
+
+NOT_SPECIFIED = 'Non specificato'
+MAX_KEY_LENGTH = 40
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+_AMOUNT = re.compile(r'(\d+(?:[.,]\d+)*)\s*(k|mila|mln|milion[ei])?\b', re.IGNORECASE)
+
+
+def day_key(when=None):
+    """Chiave giorno 'YYYY-MM-DD' (default: oggi)"""
+    when = when or datetime.now()
+    return when.strftime('%Y-%m-%d')
+
+
+def doc_id(user_id, bucket):
+    """bucket: 'YYYY-MM-DD' (giorno) o 'YYYY-MM' (mese)"""
+    return f"user_{user_id}_{bucket}"
+
+
+def slug(value):
+    """Testo libero dello structured output -> chiave di mappa (None se non specificato)"""
+    if not value or value == NOT_SPECIFIED:
+        return None
+    text = unicodedata.normalize('NFKD', str(value))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return _NON_ALNUM.sub('-', text).strip('-')[:MAX_KEY_LENGTH].strip('-') or None
+
+
+def duration_bucket(duration):
+    """'0-30', '30-60', ..., '600+' (secondi)"""
+    lower = 0
+    for upper in DURATION_BUCKETS:
+        if duration < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}+"
+
+
+def parse_budget(text):
+    """
+    Budget in € dal testo dello structured output.
+    '450.000 - 500.000 €' -> 475000, '300k' -> 300000, '1,2 milioni' -> 1200000
+    Ritorna None se non c'è un importo.
+    """
+    if not text or text == NOT_SPECIFIED:
+        return None
+    amounts = []
+    for number, unit in _AMOUNT.findall(str(text)):
+        if unit:
+            # Con unità la virgola/punto è decimale: '1,2 milioni'
+            value = float(number.replace('.', '').replace(',', '.') if number.count(',') == 1
+                          else number.replace(',', ''))
+            value *= 1000 if unit.lower() in ('k', 'mila') else 1000000
+        else:
+            # Senza unità punti e virgole sono separatori delle migliaia: '450.000'
+            value = float(re.sub(r'[.,]', '', number))
+        if value >= 1000:  # '2 locali', '3 piano' non sono budget
+            amounts.append(value)
+    if not amounts:
+        return None
+    return int((min(amounts) + max(amounts)) / 2)
+
+
+def call_counts(call_data, duration=None):
+    """
+    Contributo di una chiamata conclusa ai rollup: contatori e mappe con
+    valori interi (sommati dal rebuild, trasformati in Increment a caldo).
+    """
+    client_info = call_data.get('client_info') or {}
+    lead = call_data.get('lead_features') or {}
+    duration = duration if duration is not None else call_data.get('duration', 0)
+    duration = duration or 0
+
+    counts = {
+        'calls': 1,
+        'valid_leads': int(client_info.get('nome', NOT_SPECIFIED) not in ('', NOT_SPECIFIED)),
+        'urgent': int(bool(lead.get('urgent'))),
+        'total_duration': duration,
+        'by_zona': {},
+        'by_tipo_richiesta': {},
+        'by_tipo_immobile': {},
+        'by_feature': {},
+        'duration_histogram': {duration_bucket(duration): 1},
+    }
+    zona = client_info.get('zona')
+    zone_key = normalize_zone(zona) if zona and zona != NOT_SPECIFIED else None
+    if zone_key:
+        counts['by_zona'][zone_key[:MAX_KEY_LENGTH]] = 1
+    for field in ('tipo_richiesta', 'tipo_immobile'):
+        key = slug(client_info.get(field))
+        if key:
+            counts[f"by_{field}"][key] = 1
+    for feature in lead.get('features') or ():
+        key = slug(feature)
+        if key:
+            counts['by_feature'][key] = 1
+    budget = parse_budget(client_info.get('budget'))
+    if budget is not None:
+        counts['budget_sum'] = budget
+        counts['budget_count'] = 1
+    return counts
+
+
+def _increments(counts):
+    from google.cloud import firestore
+
+    return {
+        key: _increments(value) if isinstance(value, dict) else firestore.Increment(value)
+        for key, value in counts.items() if value
+    }
+
+
+def _header(user_id, period, bucket):
+    return {'user_id': user_id, 'period': period, 'bucket': bucket, 'month': bucket[:7]}
+
+
+def record_lead_analytics(db, call_data, user_id, duration=None, when=None, writer=None):
+    """
+    Incrementa i rollup giornaliero e mensile del tenant con una chiamata conclusa.
+
+    Args:
+        db: Firestore client
+        call_data: Documento della chiamata (client_info, lead_features)
+        user_id: Tenant (senza tenant non c'è niente da aggregare)
+        duration: Durata in secondi (default: call_data['duration'])
+        when: Inizio chiamata (started_at, come rebuild_lead_analytics;
+            default: adesso)
+        writer: WriteBatch/Transaction su cui accodare le scritture
+            (None = batch inviato subito)
+    """
+    if not user_id:
+        return
+    from google.cloud import firestore
+
+    when = when or datetime.now()
+    increments = _increments(call_counts(call_data, duration))
+    collection = db.collection(ANALYTICS_COLLECTION)
+    batch = writer or db.batch()
+    for period, bucket in (('day', day_key(when)), ('month', month_key(when))):
+        data = _header(user_id, period, bucket)
+        data.update(increments)
+        data['updated_at'] = firestore.SERVER_TIMESTAMP
+        batch.set(collection.document(doc_id(user_id, bucket)), data, merge=True)
+    if writer is None:
+        batch.commit()
+
+
+def add_counts(target, counts):
+    """Somma counts (contatori e mappe annidate) in target, in place"""
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            add_counts(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            target[key] = target.get(key, 0) + value
+    return target
+
+
+def period_buckets(start, end):
+    """
+    Bucket che coprono i giorni [start, end] (date): documenti mensili per
+    i mesi interi, giornalieri per i bordi. 90 giorni = ~3 mesi + qualche giorno.
+    """
+    buckets = []
+    day = start
+    while day <= end:
+        month_start = day.replace(day=1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        if day == month_start and next_month - timedelta(days=1) <= end:
+            buckets.append(month_key(day))
+            day = next_month
+        else:
+            buckets.append(day_key(day))
+            day += timedelta(days=1)
+    return buckets
+
+
+def get_lead_analytics(db, user_id, days=30, today=None):
+    """
+    Analytics del tenant negli ultimi `days` giorni (oggi compreso):
+    una sola get_all sui documenti rollup, indipendente dal numero di chiamate.
+
+    Returns:
+        dict con i contatori sommati, le mappe by_*, budget_average,
+        conversion_rate (% chiamate con lead valido) e daily
+        ({giorno: calls} per i giorni letti dai documenti giornalieri)
+    """
+    today = today or datetime.now().date()
+    buckets = period_buckets(today - timedelta(days=days - 1), today)
+    collection = db.collection(ANALYTICS_COLLECTION)
+    summary = {key: 0 for key in COUNTERS}
+    summary.update({key: {} for key in MAPS})
+    daily = {}
+    for snapshot in db.get_all([collection.document(doc_id(user_id, bucket)) for bucket in buckets]):
+        if not snapshot.exists:
+            continue
+        data = snapshot.to_dict()
+        add_counts(summary, {key: data[key] for key in COUNTERS + MAPS if key in data})
+        if data.get('period') == 'day':
+            daily[data['bucket']] = data.get('calls', 0)
+    telemetry.count('firestore_rpc', op='read')
+
+    summary['days'] = days
+    summary['reads'] = len(buckets)
+    summary['budget_average'] = summary['budget_sum'] / summary['budget_count'] if summary['budget_count'] else None
+    summary['conversion_rate'] = summary['valid_leads'] / summary['calls'] if summary['calls'] else 0.0
+    summary['daily'] = dict(sorted(daily.items()))
+    return summary
+
+
+def rebuild_lead_analytics(db, month):
+    """
+    Ricalcola da zero i rollup analytics di un mese (tutti i tenant)
+    scansionando `calls`; i documenti del mese rimasti senza chiamate
+    vengono eliminati.
+
+    Returns:
+        dict: {'calls': chiamate aggregate, 'docs': documenti scritti, 'deleted': eliminati}
+    """
+    from google.cloud import firestore
+
+    start, end = month_bounds(month)
+    calls = db.collection('calls')\
+        .where('started_at', '>=', start)\
+        .where('started_at', '<', end)\
+        .stream()
+
+    rollups = {}  # doc id -> (header, counts)
+    aggregated = 0
+    for call in calls:
+        call_data = call.to_dict()
+        user_id = call_data.get('user_id')
+        if not user_id or call_data.get('status') != 'completed':
+            continue
+        counts = call_counts(call_data)
+        started_at = call_data['started_at']
+        for period, bucket in (('day', day_key(started_at)), ('month', month)):
+            header, target = rollups.setdefault(doc_id(user_id, bucket), (_header(user_id, period, bucket), {}))
+            add_counts(target, counts)
+        aggregated += 1
+
+    collection = db.collection(ANALYTICS_COLLECTION)
+    stale = [snapshot.reference for snapshot in collection.where('month', '==', month).stream()
+             if snapshot.id not in rollups]
+
+    batch = db.batch()
+    pending = 0
+
+    def _flush():
+        nonlocal batch, pending
+        pending += 1
+        if pending >= 500:  # Limite scritture per batch Firestore
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    for key, (header, counts) in rollups.items():
+        batch.set(collection.document(key), {**header, **counts, 'updated_at': firestore.SERVER_TIMESTAMP})
+        _flush()
+    for ref in stale:
+        batch.delete(ref)
+        _flush()
+    if pending:
+        batch.commit()
+
+    logging.info(
+        f"Rebuilt lead analytics for {month}: {aggregated} calls, {len(rollups)} docs, {len(stale)} deleted"
+    )
+    return {'calls': aggregated, 'docs': len(rollups), 'deleted': len(stale)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gestione rollup analytics dei lead')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = subparsers.add_parser('rebuild', help='Ricalcola i rollup dai documenti calls')
+    rebuild.add_argument('--month', default=None, help='Mese YYYY-MM (default: corrente)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'rebuild':
+        result = rebuild_lead_analytics(get_firestore(), args.month or month_key())
+        print(f"{result['calls']} calls, {result['docs']} docs written, {result['deleted']} deleted")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Modalità digest delle notifiche lead (opt-in per tenant)
+
+Nelle ore di punta un agente con una zona popolare riceve un WhatsApp per
+ogni chiamata: una richiesta Twilio (e un messaggio fatturato) ciascuno.
+In modalità digest i lead per la stessa destinazione vengono raggruppati:
+
+- primo lead fuori finestra  -> inviato subito (messaggio completo), apre
+                                una finestra di `window_seconds`
+- lead dentro la finestra    -> bufferizzati in `lead_digests/{chiave}`
+- buffer a `burst_threshold` -> inviato subito come UN messaggio combinato
+- finestra scaduta           -> il buffer parte come digest (worker
+                                `flush_lead_digests`, o il lead successivo)
+- lead urgenti (🚨)          -> sempre inviati subito, fuori dal digest
+
+Configurazione tenant (users.notification_digest):
+    {"enabled": true, "window_seconds": 600, "burst_threshold": 5}
+
+Stato per destinazione aggiornato in transazione: più istanze del webhook
+non perdono né duplicano lead.
+"""
+import logging
+import time
+from datetime import datetime, timezone
+
+import functions_framework
+
+import telemetry
+from clients import get_firestore
+
+DIGEST_COLLECTION = 'lead_digests'
+
+DEFAULT_WINDOW_SECONDS = 600
+DEFAULT_BURST_THRESHOLD = 5
+RETRY_SECONDS = 60
+
+IMMEDIATE = 'immediate'
+BUFFERED = 'buffered'
+DIGEST = 'digest'
+
+
+def _utc(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc)
+
+
+def _epoch(value):
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class DigestConfig:
+    """Impostazioni digest di un tenant"""
+    __slots__ = ('enabled', 'window_seconds', 'burst_threshold')
+
+    def __init__(self, enabled=False, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 burst_threshold=DEFAULT_BURST_THRESHOLD):
+        self.enabled = bool(enabled)
+        self.window_seconds = max(int(window_seconds or DEFAULT_WINDOW_SECONDS), 1)
+        self.burst_threshold = max(int(burst_threshold or DEFAULT_BURST_THRESHOLD), 2)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return None
+        config = cls(data.get('enabled', False), data.get('window_seconds'), data.get('burst_threshold'))
+        return config if config.enabled else None
+
+    def __repr__(self):
+        return (f"DigestConfig(window_seconds={self.window_seconds!r}, "
+                f"burst_threshold={self.burst_threshold!r})")
+
+
+def digest_key(user_id, destination):
+    return f"{user_id or 'default'}|{destination}"
+
+
+def lead_entry(call_id, client_info, caller_number, lead_features, now, call_count=None):
+    """Riga compatta di un lead nel buffer (call_count: richiamata, vedi caller_profiles)"""
+    entry = {
+        'call_id': call_id,
+        'nome': client_info.get('nome', ''),
+        'telefono': client_info.get('telefono', '') or caller_number,
+        'tipo_richiesta': client_info.get('tipo_richiesta', ''),
+        'zona': client_info.get('zona', ''),
+        'tipo_immobile': client_info.get('tipo_immobile', ''),
+        'budget': client_info.get('budget', ''),
+        'features': list(lead_features.features) if lead_features else [],
+        'at': now,
+    }
+    if call_count and call_count > 1:
+        entry['call_count'] = call_count
+    return entry
+
+
+def submit_lead(db, config, user_id, destination, from_number, entry, clock=time.time, cc=None):
+    """
+    Decide in transazione cosa fare del lead per la destinazione.
+
+    Returns:
+        (IMMEDIATE, [entry])   -> inviare subito il messaggio completo
+        (BUFFERED, [])         -> nulla da inviare ora
+        (DIGEST, [entry, ...]) -> inviare subito un messaggio combinato
+    """
+    from google.cloud import firestore
+
+    ref = db.collection(DIGEST_COLLECTION).document(digest_key(user_id, destination))
+    transaction = db.transaction()
+    now = clock()
+
+    @firestore.transactional
+    def _run(transaction):
+        snapshot = ref.get(transaction=transaction)
+        telemetry.count('firestore_rpc', op='read')
+        state = snapshot.to_dict() if snapshot.exists else {}
+        leads = [lead for lead in state.get('leads') or () if lead.get('call_id') != entry['call_id']]
+        base = {
+            'user_id': user_id,
+            'destination': destination,
+            'from_number': from_number,
+            'cc': list(cc) if cc else None,
+            'window_seconds': config.window_seconds,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }
+
+        if now >= _epoch(state.get('window_until')):
+            # Nessuna finestra attiva: invia (con l'eventuale buffer residuo) e apri la finestra
+            batch = leads + [entry]
+            transaction.set(ref, dict(base, leads=[], flush_at=None, window_until=_utc(now + config.window_seconds)))
+            return (IMMEDIATE if len(batch) == 1 else DIGEST), batch
+
+        leads.append(entry)
+        if len(leads) >= config.burst_threshold:
+            transaction.set(ref, dict(base, leads=[], flush_at=None, window_until=_utc(now + config.window_seconds)))
+            return DIGEST, leads
+
+        transaction.set(ref, dict(base, leads=leads, flush_at=state.get('window_until'),
+                                  window_until=state.get('window_until')))
+        return BUFFERED, []
+
+    result = _run(transaction)
+    telemetry.count('firestore_rpc', op='commit')
+    telemetry.count('lead_digest', result=result[0])
+    return result
+
+
+def requeue(db, user_id, destination, leads, clock=time.time, delay=RETRY_SECONDS):
+    """
+    Rimette i lead nel buffer, da inviare tra `delay` secondi (invio fallito,
+    o digest delegato al worker in modalità outbox)
+    """
+    from google.cloud import firestore
+
+    ref = db.collection(DIGEST_COLLECTION).document(digest_key(user_id, destination))
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def _run(transaction):
+        snapshot = ref.get(transaction=transaction)
+        state = snapshot.to_dict() if snapshot.exists else {}
+        pending = {lead.get('call_id') for lead in state.get('leads') or ()}
+        merged = [lead for lead in leads if lead.get('call_id') not in pending] + list(state.get('leads') or ())
+        transaction.set(ref, {'leads': merged, 'flush_at': _utc(clock() + delay)}, merge=True)
+
+    _run(transaction)
+
+
+def _claim_due(db, ref, now):
+    """Prende il buffer scaduto in transazione. Ritorna lo stato o None."""
+    from google.cloud import firestore
+
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def _run(transaction):
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        state = snapshot.to_dict()
+        if not state.get('leads') or now < _epoch(state.get('flush_at')):
+            return None  # Già svuotato da un'altra istanza o non ancora scaduto
+        window = state.get('window_seconds') or DEFAULT_WINDOW_SECONDS
+        transaction.update(ref, {
+            'leads': [],
+            'flush_at': None,
+            'window_until': _utc(now + window),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        return state
+
+    return _run(transaction)
+
+
+def flush_due_digests(db, twilio=None, clock=time.time, limit=100):
+    """
+    Invia i digest con finestra scaduta.
+
+    Returns:
+        dict: digests (messaggi combinati inviati), leads, failed
+    """
+    from notification import send_whatsapp_digest
+
+    now = clock()
+    stats = {'digests': 0, 'leads': 0, 'failed': 0}
+    due = db.collection(DIGEST_COLLECTION).where('flush_at', '<=', _utc(now)).limit(limit).stream()
+    for snapshot in due:
+        state = _claim_due(db, snapshot.reference, now)
+        if state is None:
+            continue
+        leads = state['leads']
+        try:
+            send_whatsapp_digest(leads, state.get('destination'), state.get('from_number'), twilio=twilio,
+                                 cc=state.get('cc'))
+            stats['digests'] += 1
+            stats['leads'] += len(leads)
+        except Exception as e:
+            logging.error(f"Error sending lead digest to {state.get('destination')}: {e}")
+            requeue(db, state.get('user_id'), state.get('destination'), leads, clock)
+            stats['failed'] += 1
+
+    if stats['digests'] or stats['failed']:
+        logging.info(f"Lead digests flushed: {stats}")
+    return stats
+
+
+@functions_framework.http
+def flush_lead_digests(request):
+    """Entry point worker (Cloud Scheduler ogni minuto, non pubblico)"""
+    try:
+        return flush_due_digests(get_firestore())
+    except Exception as e:
+        logging.error(f"Error flushing lead digests: {e}")
+        return {'error': str(e)}, 500
@@ -0,0 +1,224 @@
+"""
+Estrazione caratteristiche richieste e urgenza dal lead
+
+Un unico matcher compilato (regex a trie con confini di parola, vince la
+frase più lunga) scansiona UNA volta note + parole del chiamante nel transcript e
+ritorna insieme caratteristiche ("Must-have") e flag di urgenza.
+
+Rispetto ai vecchi controlli `'box' in note`:
+- confini di parola: 'presto' non matcha 'prestito', 'luce' non 'traduce'
+- esclusioni: frasi più lunghe che "vincono" sulla parola ('box doccia',
+  'di nuovo', 'non è urgente') e non producono nulla
+- accenti opzionali ('più' matcha anche 'piu')
+
+Vocabolario configurabile per tenant (campo users.lead_vocabulary):
+    {
+        "features": {"giardino": ["giardino", "giardinetto"]},
+        "urgency": ["rogito a breve"],
+        "exclude": ["box doccia"]
+    }
+Le voci del tenant si aggiungono ai default; una feature con lista vuota
+disattiva quella di default.
+"""
+import json
+import re
+import unicodedata
+from functools import lru_cache
+
+# Etichetta (come appare nel messaggio WhatsApp) -> termini
+DEFAULT_FEATURES = {
+    'balcone': ['balcone', 'balconi', 'balconcino'],
+    'terrazzo': ['terrazzo', 'terrazza', 'terrazzi', 'terrazze', 'terrazzino'],
+    'luminoso': ['luminoso', 'luminosa', 'luminosi', 'luce', 'tanta luce', 'molta luce', 'soleggiato',
+                 'soleggiata', 'esposto al sole', 'esposizione a sud', 'ben esposto'],
+    'piano alto': ['piano alto', 'piani alti', 'ultimo piano', 'ultimi piani'],
+    'con ascensore': ['ascensore'],
+    'posto auto': ['garage', 'box', 'box auto', 'posto auto', 'posto macchina', 'autorimessa'],
+    'cantina': ['cantina', 'cantine'],
+    'ristrutturato': ['ristrutturato', 'ristrutturata', 'nuovo', 'nuova', 'nuova costruzione'],
+    'arredato': ['arredato', 'arredata', 'arredati', 'ammobiliato'],
+}
+
+DEFAULT_URGENCY = [
+    'urgente', 'urgenza', 'urgentemente', 'subito', 'immediato', 'immediatamente', 'veloce',
+    'velocemente', 'presto', 'al più presto', 'prima possibile', 'asap', 'fretta',
+]
+
+# Frasi che contengono un termine ma NON lo significano
+DEFAULT_EXCLUSIONS = [
+    'box doccia', 'di nuovo', 'nuovo numero', 'nuova richiesta', 'luce e gas', 'bolletta della luce',
+    'non è urgente', 'non urgente', 'nessuna urgenza', 'non ho fretta', 'senza fretta', 'nessuna fretta',
+    'presto per dirlo', 'troppo presto',
+]
+
+# Righe del transcript pronunciate dall'assistente (non dal chiamante)
+_ASSISTANT_LINE = re.compile(r'^\s*(?:ai|assistant|bot|assistente)\s*:', re.IGNORECASE)
+
+_URGENT = object()
+_EXCLUDED = object()
+
+
+def _fold(text):
+    """minuscolo, senza accenti, spazi compattati"""
+    text = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).lower().split())
+
+
+def _term_tokens(term):
+    """Token regex di un termine: spazi flessibili, lettere accentate opzionali"""
+    tokens = []
+    for char in term.strip().lower():
+        if char.isspace():
+            if not tokens or tokens[-1] != r'\s+':
+                tokens.append(r'\s+')
+            continue
+        base = _fold(char)
+        tokens.append(f"[{re.escape(char)}{re.escape(base)}]" if base != char else re.escape(char))
+    return tokens
+
+
+def _trie_pattern(terms):
+    """
+    Alternativa compilata come trie di prefissi ('box' + ' auto' | ' doccia'):
+    il motore regex di Python prova le alternative una per una, con il trie
+    ogni posizione del testo costa un solo confronto sul primo carattere.
+    Le continuazioni sono greedy, quindi vince la frase più lunga.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for token in _term_tokens(term):
+            node = node.setdefault(token, {})
+        node[''] = True
+
+    def _serialize(node):
+        alternatives = [token + _serialize(child) for token, child in sorted(node.items()) if token]
+        if not alternatives:
+            return ''
+        body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            return f"(?:{body})?"
+        return body
+
+    return _serialize(trie)
+
+
+class LeadFeatures:
+    """Risultato dell'estrazione"""
+    __slots__ = ('features', 'urgent')
+
+    def __init__(self, features=(), urgent=False):
+        self.features = list(features)
+        self.urgent = bool(urgent)
+
+    def to_dict(self):
+        return {'features': self.features, 'urgent': self.urgent}
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return None
+        return cls(data.get('features') or (), data.get('urgent', False))
+
+    def __repr__(self):
+        return f"LeadFeatures(features={self.features!r}, urgent={self.urgent!r})"
+
+
+class LeadFeatureExtractor:
+    """
+    Vocabolario compilato in un'unica regex.
+
+    Args:
+        features: Dict etichetta -> lista termini
+        urgency: Lista termini di urgenza
+        exclusions: Frasi da ignorare (prevalgono sui termini che contengono)
+    """
+
+    def __init__(self, features=DEFAULT_FEATURES, urgency=DEFAULT_URGENCY, exclusions=DEFAULT_EXCLUSIONS):
+        self._labels = {}     # termine normalizzato -> etichetta | _URGENT | _EXCLUDED
+        self._order = {}      # etichetta -> posizione (ordine stabile nel messaggio)
+        for label, terms in features.items():
+            self._order.setdefault(label, len(self._order))
+            for term in terms:
+                self._labels[_fold(term)] = label
+        for term in urgency:
+            self._labels[_fold(term)] = _URGENT
+        for term in exclusions:
+            self._labels[_fold(term)] = _EXCLUDED
+
+        terms = {term for terms in features.values() for term in terms} | set(urgency) | set(exclusions)
+        if terms:
+            self._pattern = re.compile(r'\b' + _trie_pattern(terms) + r'\b')
+        else:
+            self._pattern = None
+
+    def extract(self, note='', transcript=''):
+        """
+        Scansiona note + parole del chiamante nel transcript in un passaggio.
+        Returns LeadFeatures (caratteristiche in ordine di vocabolario).
+        """
+        text = '\n'.join(t for t in (_meaningful_note(note), caller_text(transcript)) if t)
+        if not text or self._pattern is None:
+            return LeadFeatures()
+
+        found = set()
+        urgent = False
+        labels = self._labels
+        for match in self._pattern.finditer(text.lower()):
+            label = labels.get(_fold(match.group()))
+            if label is _URGENT:
+                urgent = True
+            elif label is not None and label is not _EXCLUDED:
+                found.add(label)
+        return LeadFeatures(sorted(found, key=self._order.__getitem__), urgent)
+
+
+def _meaningful_note(note):
+    if not note or note == 'Nessuna':
+        return ''
+    return str(note)
+
+
+def caller_text(transcript):
+    """
+    Solo le righe del chiamante ('User: ...'): le domande dell'assistente
+    ("Le serve un box?") non sono richieste del cliente.
+    Transcript senza prefissi di turno viene usato per intero.
+    """
+    if not transcript:
+        return ''
+    lines = transcript.splitlines()
+    if not any(_ASSISTANT_LINE.match(line) for line in lines):
+        return transcript
+    return '\n'.join(line for line in lines if not _ASSISTANT_LINE.match(line))
+
+
+def merge_vocabulary(vocabulary):
+    """Default + voci del tenant -> (features, urgency, exclusions)"""
+    vocabulary = vocabulary or {}
+    features = {label: list(terms) for label, terms in DEFAULT_FEATURES.items()}
+    for label, terms in (vocabulary.get('features') or {}).items():
+        if terms:
+            features[label] = features.get(label, []) + [t for t in terms if t]
+        else:
+            features.pop(label, None)
+    urgency = DEFAULT_URGENCY + [t for t in vocabulary.get('urgency') or () if t]
+    exclusions = DEFAULT_EXCLUSIONS + [t for t in vocabulary.get('exclude') or () if t]
+    return features, urgency, exclusions
+
+
+@lru_cache(maxsize=256)
+def _compiled(vocabulary_key):
+    return LeadFeatureExtractor(*merge_vocabulary(json.loads(vocabulary_key)))
+
+
+def get_extractor(vocabulary=None):
+    """
+    Extractor compilato per un vocabolario tenant (cache per contenuto).
+    Compilato al primo uso, non all'import (cold start).
+    """
+    return _compiled(json.dumps(vocabulary or {}, sort_keys=True, ensure_ascii=False))
+
+
+def extract_lead_features(note='', transcript='', vocabulary=None):
+    return get_extractor(vocabulary).extract(note, transcript)
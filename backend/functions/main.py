@@ -1 +1,4 @@
 from vapi_webhook import vapi_webhook
+# Worker non pubblici invocati da Cloud Scheduler (vedi deploy-workers.sh)
+from notification_outbox import drain_notification_outbox
+from lead_digest import flush_lead_digests
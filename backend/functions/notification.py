@@ -1,25 +1,31 @@
 import os
-from twilio.rest import Client
 import logging
 from datetime import datetime
 
+import telemetry
+from clients import TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, get_firestore, get_twilio
+from lead_features import extract_lead_features
+from twilio_sender import send_many
+
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Twilio Client
-TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
-TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+# Twilio client condiviso e creato alla prima notifica (vedi clients.py)
 TWILIO_WHATSAPP_NUMBER = os.environ.get('TWILIO_WHATSAPP_NUMBER', 'whatsapp:+14155238886')
 
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-else:
-    twilio_client = None
+
+def format_whatsapp_number(number):
+    """Ensure the 'whatsapp:' prefix required by Twilio"""
+    if number.startswith('whatsapp:'):
+        return number
+    return f"whatsapp:{number}"
 
 
-def generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note):
+def generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note, features=None):
     """
     Analizza i dati del cliente e genera un riassunto intelligente
     di cosa proporgli basandosi su tipo richiesta, immobile, zona, budget, note.
+    `features` = caratteristiche già estratte (lead_features); se None
+    vengono estratte dalle sole note.
     """
     rec_parts = []
     
@@ -37,33 +43,11 @@ def generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note):
         if 'non specificato' not in budget_str and budget_str != 'n/a':
             rec_parts.append(f"Range prezzo: *{budget}*")
     
-    # Extract key requirements from notes
-    if note and note != 'Nessuna':
-        note_lower = note.lower()
-        
-        # Key features
-        features = []
-        if 'balcon' in note_lower:
-            features.append('balcone')
-        if 'terrazzo' in note_lower or 'terrazza' in note_lower:
-            features.append('terrazzo')
-        if 'luce' in note_lower or 'luminoso' in note_lower or 'sole' in note_lower:
-            features.append('luminoso')
-        if 'piano alto' in note_lower or 'ultimo piano' in note_lower:
-            features.append('piano alto')
-        if 'ascensore' in note_lower:
-            features.append('con ascensore')
-        if 'garage' in note_lower or 'box' in note_lower or 'posto auto' in note_lower:
-            features.append('posto auto')
-        if 'cantina' in note_lower:
-            features.append('cantina')
-        if 'ristrutturato' in note_lower or 'nuovo' in note_lower:
-            features.append('ristrutturato')
-        if 'arredato' in note_lower:
-            features.append('arredato')
-        
-        if features:
-            rec_parts.append(f"Must-have: {', '.join(features)}")
+    # Key requirements (note + parole del chiamante, vedi lead_features)
+    if features is None:
+        features = extract_lead_features(note).features
+    if features:
+        rec_parts.append(f"Must-have: {', '.join(features)}")
     
     # Build recommendation text
     if tipo_richiesta and tipo_richiesta.lower() == 'comprare':
@@ -78,7 +62,7 @@ def generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note):
     else:
         return f"→ *{action}*"
 
-def send_whatsapp_notification(client_info, caller_number, transcript='', call_id='', duration=0, destination_override=None, order_id=None):
+def send_whatsapp_notification(client_info, caller_number, transcript='', call_id='', duration=0, destination_override=None, order_id=None, twilio=None, from_number=None, lead_features=None, cc=None, caller=None):
     """
     Send WhatsApp notification with full summary to real estate agent.
     
@@ -90,38 +74,42 @@ def send_whatsapp_notification(client_info, caller_number, transcript='', call_i
         duration: Call duration in seconds
         destination_override: WhatsApp destination override (for zone routing)
         order_id: Order ID to get Twilio number from (if None, uses env var)
+        twilio: Twilio client override (default: shared client; fakes in tests)
+        from_number: Sender already resolved by the caller (skips the order lookup)
+        lead_features: LeadFeatures already extracted (default: extracted here from note + transcript)
+        cc: Extra WhatsApp recipients (other zone agents / CC), sent concurrently.
+            Only a failure towards the main destination raises (FanOutError,
+            with the CC already reached in `delivered`).
+        caller: Returning caller info {'call_count', 'first_seen'} (see caller_profiles)
     """
     
-    if not twilio_client:
+    twilio = twilio or get_twilio()
+    if not twilio:
         logging.error("Twilio client not initialized")
         return False
     
-    # Get Twilio WhatsApp number - priorità: order number > env var > default
-    from_number = TWILIO_WHATSAPP_NUMBER  # Default fallback
-    
-    if order_id:
-        try:
-            from google.cloud import firestore
-            db = firestore.Client()
-            order_ref = db.collection('orders').document(order_id)
-            order_doc = order_ref.get()
+    # Get Twilio WhatsApp number - priorità: from_number (tenant cache) > order number > env var > default
+    if not from_number:
+        from_number = TWILIO_WHATSAPP_NUMBER  # Default fallback
+        
+        if order_id:
+            try:
+                order_ref = get_firestore().collection('orders').document(order_id)
+                order_doc = order_ref.get()
+                telemetry.count('firestore_rpc', op='read')
             
-            if order_doc.exists:
-                order_data = order_doc.to_dict()
-                twilio_phone = order_data.get('twilio_phone_number')
-                if twilio_phone:
-                    # Format: ensure whatsapp: prefix
-                    if not twilio_phone.startswith('whatsapp:'):
-                        from_number = f"whatsapp:{twilio_phone}"
+                if order_doc.exists:
+                    order_data = order_doc.to_dict()
+                    twilio_phone = order_data.get('twilio_phone_number')
+                    if twilio_phone:
+                        from_number = format_whatsapp_number(twilio_phone)
+                        logging.info(f"Using Twilio number from order {order_id}: {from_number}")
                     else:
-                        from_number = twilio_phone
-                    logging.info(f"Using Twilio number from order {order_id}: {from_number}")
+                        logging.warning(f"Order {order_id} has no twilio_phone_number, using env var")
                 else:
-                    logging.warning(f"Order {order_id} has no twilio_phone_number, using env var")
-            else:
-                logging.warning(f"Order {order_id} not found, using env var")
-        except Exception as e:
-            logging.error(f"Error getting Twilio number from order {order_id}: {e}, using env var")
+                    logging.warning(f"Order {order_id} not found, using env var")
+            except Exception as e:
+                logging.error(f"Error getting Twilio number from order {order_id}: {e}, using env var")
     
     if not from_number:
         logging.error("No Twilio WhatsApp number available (neither from order nor env var)")
@@ -157,15 +145,19 @@ def send_whatsapp_notification(client_info, caller_number, transcript='', call_i
     
     summary = " ".join(summary_parts) if summary_parts else "Nuovo contatto"
     
-    # Check urgency
-    urgency_words = ['urgente', 'subito', 'immediato', 'veloce', 'presto', 'asap', 'urgenza']
-    urgency_found = any(word in str(note).lower() for word in urgency_words) if note != 'Nessuna' else False
-    urgency_symbol = "🚨" if urgency_found else "📞"
+    # Caratteristiche + urgenza in un unico passaggio su note e transcript
+    if lead_features is None:
+        lead_features = extract_lead_features(note, transcript)
+    urgency_symbol = "🚨" if lead_features.urgent else "📞"
     
     # Build intelligent summary message
     
-    # Header (include urgency symbol)
-    message_parts = [f"{urgency_symbol} *Nuovo Lead - {nome}*", ""]
+    # Header (include urgency symbol); richiamata: numero della chiamata e primo contatto
+    call_count = (caller or {}).get('call_count') or 0
+    if call_count > 1:
+        message_parts = [f"{urgency_symbol} *Lead di ritorno - {nome}*", format_returning_caller(caller), ""]
+    else:
+        message_parts = [f"{urgency_symbol} *Nuovo Lead - {nome}*", ""]
     
     # Create intelligent search summary
     search_summary = []
@@ -203,7 +195,7 @@ def send_whatsapp_notification(client_info, caller_number, transcript='', call_i
     message_parts.append("")
     
     # Generate smart recommendation based on collected data
-    recommendation = generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note)
+    recommendation = generate_recommendation(tipo_richiesta, tipo_immobile, zona, budget, note, lead_features.features)
     message_parts.append(recommendation)
     
     message = "\n".join(message_parts)
@@ -216,11 +208,15 @@ def send_whatsapp_notification(client_info, caller_number, transcript='', call_i
         logging.info(f"Message length: {len(message)} chars")
         logging.info(f"From: {TWILIO_WHATSAPP_NUMBER}")
         
-        message_response = twilio_client.messages.create(
-            body=message,
-            from_=from_number,  # Usa numero dall'ordine o env var
-            to=destination
-        )
+        telemetry.count('twilio_request')
+        if cc:
+            message_response = _fan_out(twilio, message, from_number, destination, cc)
+        else:
+            message_response = twilio.messages.create(
+                body=message,
+                from_=from_number,  # Usa numero dall'ordine o env var
+                to=destination
+            )
         
         logging.info(f"WhatsApp sent successfully! SID: {message_response.sid}, Status: {message_response.status}")
         return True
@@ -236,3 +232,99 @@ def send_whatsapp_notification(client_info, caller_number, transcript='', call_i
         logging.error(f"Twilio Auth Token configured: {bool(TWILIO_AUTH_TOKEN)}")
         # Rilancia l'eccezione per far sapere al chiamante che c'è un problema
         raise
+
+
+def format_returning_caller(caller):
+    """'🔁 Ha già chiamato: 3ª chiamata (prima il 12/03/2025)'"""
+    line = f"🔁 *Ha già chiamato:* {caller['call_count']}ª chiamata"
+    first_seen = caller.get('first_seen')
+    if hasattr(first_seen, 'strftime'):
+        line += f" (prima il {first_seen.strftime('%d/%m/%Y')})"
+    return line
+
+
+class FanOutError(Exception):
+    """Invio al destinatario principale fallito; `delivered` = CC già raggiunti"""
+
+    def __init__(self, error, delivered):
+        super().__init__(f"{type(error).__name__}: {error}")
+        self.delivered = delivered
+
+
+def _fan_out(twilio, body, from_number, destination, cc):
+    """
+    Invia a destinatario principale + CC in parallelo. Un CC fallito viene
+    solo loggato (rilanciare farebbe ripetere l'invio anche al principale);
+    ritorna la risposta del principale. Se fallisce il principale solleva
+    FanOutError con i CC raggiunti, da escludere al retry (vedi
+    notification_outbox): gli altri CC lo ricevono comunque in parallelo.
+    """
+    results = send_many(twilio, body, from_number, [destination] + list(cc))
+    for to, result in results[1:]:
+        if isinstance(result, Exception):
+            logging.error(f"WhatsApp CC to {to} failed: {type(result).__name__}: {result}")
+    if len(results) > 1:
+        logging.info(f"WhatsApp fan-out to {len(results)} recipients")
+    primary = results[0][1]
+    if isinstance(primary, Exception):
+        delivered = [to for to, result in results[1:] if not isinstance(result, Exception)]
+        raise FanOutError(primary, delivered) from primary
+    return primary
+
+
+# Limite corpo messaggio WhatsApp di Twilio
+WHATSAPP_MAX_CHARS = 1600
+
+
+def format_lead_line(index, lead):
+    """Una riga compatta per lead nel digest (vedi lead_digest.lead_entry)"""
+    def _known(value):
+        return value and value != 'Non specificato'
+
+    time_str = datetime.fromtimestamp(lead['at']).strftime('%H:%M') if lead.get('at') else ''
+    nome = lead.get('nome') if _known(lead.get('nome')) else 'Nuovo contatto'
+    details = [value for value in (lead.get('tipo_richiesta'), lead.get('tipo_immobile'),
+                                   lead.get('zona'), lead.get('budget')) if _known(value)]
+    if lead.get('features'):
+        details.append(', '.join(lead['features']))
+    line = f"{index}. {time_str} *{nome}* 📞 {lead.get('telefono', '')}"
+    if lead.get('call_count'):
+        line += f" 🔁 {lead['call_count']}ª chiamata"
+    if details:
+        line += "\n   " + " · ".join(details)
+    return line
+
+
+def send_whatsapp_digest(leads, destination=None, from_number=None, twilio=None, cc=None):
+    """
+    Invia più lead come un unico messaggio (spezzato solo oltre il limite
+    di caratteri WhatsApp), anche ai destinatari `cc`. Solleva eccezione se
+    Twilio fallisce verso la destinazione principale: il digest viene
+    rimesso in coda intero e al retry anche i CC lo ricevono di nuovo.
+    Returns numero di messaggi inviati.
+    """
+    twilio = twilio or get_twilio()
+    if not twilio:
+        raise RuntimeError('Twilio client not initialized')
+    from_number = from_number or TWILIO_WHATSAPP_NUMBER
+    destination = destination or os.environ.get('TWILIO_DESTINATION_WHATSAPP', 'whatsapp:+393394197445')
+
+    header = f"📋 *{len(leads)} nuovi lead*"
+    messages = []
+    current = header
+    for index, lead in enumerate(leads, 1):
+        line = format_lead_line(index, lead)
+        if len(current) + len(line) + 2 > WHATSAPP_MAX_CHARS:
+            messages.append(current)
+            current = "📋 *Nuovi lead (continua)*"
+        current += "\n\n" + line
+    messages.append(current)
+
+    for body in messages:
+        telemetry.count('twilio_request')
+        if cc:
+            _fan_out(twilio, body, from_number, destination, cc)
+        else:
+            twilio.messages.create(body=body, from_=from_number, to=destination)
+    logging.info(f"WhatsApp digest with {len(leads)} leads sent to {destination} in {len(messages)} message(s)")
+    return len(messages)
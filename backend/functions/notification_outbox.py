@@ -0,0 +1,217 @@
+"""
+Outbox asincrona per le notifiche WhatsApp
+
+Con NOTIFICATION_MODE=outbox il webhook non chiama Twilio: scrive un job
+compatto in `notification_outbox/{call_id}` e risponde subito a Vapi.
+Il worker `drain_notification_outbox` (Cloud Scheduler ogni minuto)
+svuota la coda a batch con retry, backoff esponenziale e dead-letter.
+
+Stati job: pending -> sent | dead
+Il doc id è il call_id: enqueue e invio sono idempotenti per chiamata.
+Durante l'invio il job viene "preso in carico" spostando next_attempt_at
+avanti di LEASE_SECONDS, così due worker non inviano lo stesso job e un
+worker crashato non blocca il job per sempre.
+Se l'invio al destinatario principale fallisce dopo che alcuni CC hanno
+ricevuto il messaggio, questi vengono registrati in `delivered` e saltati
+ai retry.
+"""
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+import functions_framework
+
+from clients import get_firestore
+from lead_digest import flush_due_digests
+from lead_features import LeadFeatures
+from notification import FanOutError, send_whatsapp_notification
+
+OUTBOX_COLLECTION = 'notification_outbox'
+
+MAX_ATTEMPTS = 5
+BASE_BACKOFF_SECONDS = 30
+LEASE_SECONDS = 120
+DEFAULT_BATCH_SIZE = 20
+
+
+def _utc(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc)
+
+
+def backoff_seconds(attempts):
+    """Backoff esponenziale con jitter: 30s, 60s, 120s, ... (±20%)"""
+    delay = BASE_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def enqueue_notification(db, call_id, client_info, caller_number, duration=0,
+                         destination=None, order_id=None, from_number=None, lead_features=None,
+                         cc=None, caller=None, clock=time.time):
+    """
+    Accoda una notifica per il worker. Idempotente per call_id.
+
+    Returns:
+        bool: True se accodata, False se già presente
+    """
+    from google.api_core import exceptions
+    from google.cloud import firestore
+
+    job = {
+        'call_id': call_id,
+        'client_info': client_info,
+        'caller_number': caller_number,
+        'duration': duration,
+        'destination': destination,
+        'order_id': order_id,
+        'from_number': from_number,
+        'lead_features': lead_features.to_dict() if lead_features else None,
+        'cc': list(cc) if cc else None,
+        'caller': caller,
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': _utc(clock()),
+        'created_at': firestore.SERVER_TIMESTAMP,
+    }
+    try:
+        db.collection(OUTBOX_COLLECTION).document(call_id).create(job)
+        return True
+    except exceptions.AlreadyExists:
+        logging.info(f"Notification for call {call_id} already queued")
+        return False
+
+
+def _claim(db, doc_ref, now):
+    """Prende in carico il job in transazione. Ritorna i dati o None."""
+    from google.cloud import firestore
+
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def _run(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        job = snapshot.to_dict()
+        next_attempt_at = job.get('next_attempt_at')
+        if job.get('status') != 'pending' or (next_attempt_at and next_attempt_at > _utc(now)):
+            return None  # Già inviato, dead, o preso da un altro worker
+        attempts = job.get('attempts', 0) + 1
+        transaction.update(doc_ref, {
+            'attempts': attempts,
+            'next_attempt_at': _utc(now + LEASE_SECONDS),
+        })
+        job['attempts'] = attempts
+        return job
+
+    return _run(transaction)
+
+
+def _send(job, twilio):
+    delivered = set(job.get('delivered') or ())
+    cc = [to for to in job.get('cc') or () if to not in delivered]
+    sent = send_whatsapp_notification(
+        job.get('client_info') or {},
+        job.get('caller_number', ''),
+        call_id=job.get('call_id', ''),
+        duration=job.get('duration', 0),
+        destination_override=job.get('destination'),
+        order_id=job.get('order_id'),
+        twilio=twilio,
+        from_number=job.get('from_number'),
+        lead_features=LeadFeatures.from_dict(job.get('lead_features')),
+        cc=cc,
+        caller=job.get('caller')
+    )
+    if not sent:
+        raise RuntimeError('WhatsApp notification not sent (Twilio not configured)')
+
+
+def process_job(db, doc_ref, twilio=None, clock=time.time):
+    """
+    Invia un singolo job. Ritorna 'sent', 'retry', 'dead' o 'skipped'.
+    """
+    from google.cloud import firestore
+
+    now = clock()
+    job = _claim(db, doc_ref, now)
+    if job is None:
+        return 'skipped'
+
+    call_id = job.get('call_id', doc_ref.id)
+    try:
+        _send(job, twilio)
+    except Exception as e:
+        attempts = job['attempts']
+        update = {'last_error': str(e)}
+        if isinstance(e, FanOutError) and e.delivered:
+            update['delivered'] = firestore.ArrayUnion(e.delivered)
+        if attempts >= MAX_ATTEMPTS:
+            logging.error(f"Notification for call {call_id} dead after {attempts} attempts: {e}")
+            doc_ref.update({
+                **update,
+                'status': 'dead',
+                'dead_at': firestore.SERVER_TIMESTAMP,
+            })
+            return 'dead'
+
+        delay = backoff_seconds(attempts)
+        logging.warning(f"Notification for call {call_id} failed (attempt {attempts}), retry in {delay:.0f}s: {e}")
+        doc_ref.update({
+            **update,
+            'next_attempt_at': _utc(clock() + delay),
+        })
+        return 'retry'
+
+    doc_ref.update({
+        'status': 'sent',
+        'sent_at': firestore.SERVER_TIMESTAMP,
+    })
+    logging.info(f"Outbox notification sent for call {call_id}")
+    return 'sent'
+
+
+def drain_outbox(db, batch_size=DEFAULT_BATCH_SIZE, max_batches=10, twilio=None, clock=time.time):
+    """
+    Svuota la coda a batch finché ci sono job scaduti (max max_batches).
+
+    Returns:
+        dict: conteggio esiti (sent/retry/dead/skipped)
+    """
+    stats = {'sent': 0, 'retry': 0, 'dead': 0, 'skipped': 0}
+
+    for _ in range(max_batches):
+        due = db.collection(OUTBOX_COLLECTION)\
+            .where('status', '==', 'pending')\
+            .where('next_attempt_at', '<=', _utc(clock()))\
+            .order_by('next_attempt_at')\
+            .limit(batch_size)\
+            .stream()
+
+        refs = [doc.reference for doc in due]
+        for doc_ref in refs:
+            stats[process_job(db, doc_ref, twilio=twilio, clock=clock)] += 1
+
+        if len(refs) < batch_size:
+            break
+
+    logging.info(f"Outbox drained: {stats}")
+    return stats
+
+
+@functions_framework.http
+def drain_notification_outbox(request):
+    """
+    Entry point worker (Cloud Scheduler, non pubblico).
+    Query param opzionale: batch_size.
+    """
+    batch_size = request.args.get('batch_size', type=int) or DEFAULT_BATCH_SIZE
+    try:
+        db = get_firestore()
+        stats = drain_outbox(db, batch_size=batch_size)
+        # Digest lead scaduti o delegati dal webhook (vedi lead_digest)
+        stats['digests'] = flush_due_digests(db)
+        return stats
+    except Exception as e:
+        logging.error(f"Error draining notification outbox: {e}")
+        return {'error': str(e)}, 500
@@ -0,0 +1,29 @@
+"""
+Limite di operazioni al secondo per i job batch (backfill, retention)
+
+Usato per non saturare Firestore in produzione: il job chiama
+Pacer.wait(n) prima di ogni commit di n write e dorme quanto serve per
+restare sotto il ritmo medio configurato.
+"""
+import time
+
+
+class Pacer:
+    """Limita le write al secondo (None = nessun limite)"""
+
+    def __init__(self, max_per_second, clock=time.monotonic, sleep=time.sleep):
+        self._max = max_per_second
+        self._clock = clock
+        self._sleep = sleep
+        self._start = None
+        self._count = 0
+
+    def wait(self, writes):
+        if not self._max:
+            return
+        if self._start is None:
+            self._start = self._clock()
+        self._count += writes
+        ahead = self._count / self._max - (self._clock() - self._start)
+        if ahead > 0:
+            self._sleep(ahead)
@@ -0,0 +1,221 @@
+"""
+Rate limiter per numero chiamante a costo costante
+
+Ogni numero ha un documento `rate_limits/{numero}` con contatori a bucket:
+- minutes: {epoch_minuto: n}  -> finestra oraria (max 60 bucket)
+- hours:   {epoch_ora: n}     -> finestra giornaliera (max 24 bucket)
+
+In-process teniamo una copia calda della finestra (LRU limitata), così
+verifica + registrazione costano UNA scrittura. La copia viene
+risincronizzata dal documento ogni `sync_interval` secondi per vedere
+le chiamate registrate da altre istanze. A freddo (numero nuovo per
+l'istanza o copia scaduta) serve anche una get: senza leggere il
+documento i conteggi delle altre istanze non si vedono, e una scrittura
+merge/Increment non ritorna i valori. Nel webhook quella get è in
+parallelo con la lettura del tenant (vedi vapi_webhook.start_call).
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import telemetry
+from clients import get_firestore
+
+RATE_LIMIT_COLLECTION = 'rate_limits'
+
+_HOUR = 3600
+_DAY = 86400
+
+
+class _Window:
+    """Contatori a bucket di un singolo numero"""
+    __slots__ = ('minutes', 'hours', 'synced_at')
+
+    def __init__(self, minutes=None, hours=None, synced_at=0.0):
+        self.minutes = minutes or {}
+        self.hours = hours or {}
+        self.synced_at = synced_at
+
+    def prune(self, now):
+        """Rimuove i bucket fuori finestra, ritorna le chiavi eliminate"""
+        minute_floor = int((now - _HOUR) // 60)
+        hour_floor = int((now - _DAY) // _HOUR)
+        stale_minutes = [k for k in self.minutes if int(k) <= minute_floor]
+        stale_hours = [k for k in self.hours if int(k) <= hour_floor]
+        for key in stale_minutes:
+            del self.minutes[key]
+        for key in stale_hours:
+            del self.hours[key]
+        return stale_minutes, stale_hours
+
+    def counts(self):
+        return sum(self.minutes.values()), sum(self.hours.values())
+
+
+class RateLimiter:
+    """
+    Limita le chiamate per numero su finestra oraria e giornaliera.
+
+    Args:
+        db: Firestore client (None = client condiviso, vedi clients.py)
+        max_per_hour: Chiamate massime nell'ultima ora
+        max_per_day: Chiamate massime nelle ultime 24 ore
+        clock: Funzione che ritorna epoch seconds (iniettabile nei test)
+        sync_interval: Secondi dopo cui la copia locale viene riletta
+        max_numbers: Numero massimo di finestre tenute in memoria
+    """
+
+    def __init__(self, db, max_per_hour, max_per_day, clock=time.time,
+                 sync_interval=60, max_numbers=10000):
+        self._db = db
+        self.max_per_hour = max_per_hour
+        self.max_per_day = max_per_day
+        self._clock = clock
+        self._sync_interval = sync_interval
+        self._max_numbers = max_numbers
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _doc(self, customer_number):
+        db = self._db or get_firestore()
+        return db.collection(RATE_LIMIT_COLLECTION).document(customer_number)
+
+    @staticmethod
+    def _window_from(doc, now):
+        data = doc.to_dict() if doc.exists else {}
+        return _Window(
+            {str(k): v for k, v in (data.get('minutes') or {}).items()},
+            {str(k): v for k, v in (data.get('hours') or {}).items()},
+            synced_at=now
+        )
+
+    def _cached(self, customer_number, now):
+        """Finestra locale ancora valida, o None se va riletta"""
+        with self._lock:
+            window = self._windows.get(customer_number)
+            if window is not None and now - window.synced_at < self._sync_interval:
+                self._windows.move_to_end(customer_number)
+                telemetry.count('cache', cache='rate_limit', result='hit')
+                return window
+        telemetry.count('cache', cache='rate_limit', result='miss')
+        return None
+
+    def _install(self, customer_number, window):
+        with self._lock:
+            self._windows[customer_number] = window
+            self._windows.move_to_end(customer_number)
+            while len(self._windows) > self._max_numbers:
+                self._windows.popitem(last=False)
+        return window
+
+    def _window(self, customer_number, now):
+        window = self._cached(customer_number, now)
+        if window is None:
+            window = self._install(customer_number, self._window_from(self._doc(customer_number).get(), now))
+            telemetry.count('firestore_rpc', op='read')
+        return window
+
+    def _record(self, customer_number, window, now):
+        """
+        Verifica i limiti sulla finestra e registra la chiamata in locale.
+        Returns il merge da scrivere sul documento, o None se rate limit superato.
+        """
+        with self._lock:
+            stale_minutes, stale_hours = window.prune(now)
+            calls_last_hour, calls_last_day = window.counts()
+
+            if calls_last_hour >= self.max_per_hour:
+                logging.warning(f"Rate limit exceeded for {customer_number}: {calls_last_hour} calls in 1 hour")
+                return None
+            if calls_last_day >= self.max_per_day:
+                logging.warning(f"Daily rate limit exceeded for {customer_number}: {calls_last_day} calls in 24h")
+                return None
+
+            minute_key = str(int(now // 60))
+            hour_key = str(int(now // _HOUR))
+            window.minutes[minute_key] = window.minutes.get(minute_key, 0) + 1
+            window.hours[hour_key] = window.hours.get(hour_key, 0) + 1
+
+        from google.cloud import firestore
+
+        minutes = {key: firestore.DELETE_FIELD for key in stale_minutes}
+        hours = {key: firestore.DELETE_FIELD for key in stale_hours}
+        minutes[minute_key] = firestore.Increment(1)
+        hours[hour_key] = firestore.Increment(1)
+        return {
+            'minutes': minutes,
+            'hours': hours,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }
+
+    def check_and_record(self, customer_number):
+        """
+        Verifica i limiti e, se OK, registra la chiamata.
+
+        Returns:
+            bool: True se OK, False se rate limit superato
+        """
+        ok, write = self.check_and_record_deferred(customer_number)
+        if write is not None:
+            write()
+        return ok
+
+    def check_and_record_deferred(self, customer_number):
+        """
+        Come check_and_record, senza eseguire la scrittura del bucket (la
+        decisione usa la finestra in-process, la scrittura serve alle
+        altre istanze e può avvenire dopo la risposta).
+
+        Returns:
+            (ok, write): write è la funzione che scrive il bucket (None se
+            non c'è niente da scrivere)
+        """
+        if not customer_number:
+            # Web call / numero nascosto: niente da limitare
+            return True, None
+
+        now = self._clock()
+        update = self._record(customer_number, self._window(customer_number, now), now)
+        if update is None:
+            return False, None
+
+        def write():
+            # Unica RPC: incremento bucket + pulizia bucket scaduti
+            self._doc(customer_number).set(update, merge=True)
+            telemetry.count('firestore_rpc', op='write')
+
+        return True, write
+
+    async def check_and_record_async(self, db, customer_number):
+        """
+        Come check_and_record, con Firestore AsyncClient (stessa finestra
+        in-process). La scrittura del bucket non viene attesa qui:
+
+        Returns:
+            (ok, write): write è la coroutine da attendere (None se non c'è
+            niente da scrivere), così il chiamante la sovrappone alle sue RPC
+        """
+        if not customer_number:
+            return True, None
+
+        now = self._clock()
+        ref = db.collection(RATE_LIMIT_COLLECTION).document(customer_number)
+        window = self._cached(customer_number, now)
+        if window is None:
+            window = self._install(customer_number, self._window_from(await ref.get(), now))
+            telemetry.count('firestore_rpc', op='read')
+
+        update = self._record(customer_number, window, now)
+        if update is None:
+            return False, None
+        telemetry.count('firestore_rpc', op='write')
+        return True, ref.set(update, merge=True)
+
+    def forget(self, customer_number=None):
+        """Scarta la copia locale (di un numero o di tutti)"""
+        with self._lock:
+            if customer_number is None:
+                self._windows.clear()
+            else:
+                self._windows.pop(customer_number, None)
@@ -0,0 +1,416 @@
+"""
+Retention delle chiamate: archivio NDJSON compresso + eliminazione da `calls`
+
+`calls` cresce senza limite: le query sulle chiamate, le liste della
+dashboard e i transcript inline lavorano su una collection (e indici)
+sempre più grandi. Gli aggregati restano nei rollup (usage_rollups,
+lead_analytics), quindi le chiamate oltre il periodo di retention del
+tenant possono uscire da Firestore.
+
+Retention per tenant: `users/{user_id}.retention_days`, altrimenti
+CALL_RETENTION_DAYS (default 365). Chiamate senza tenant: default.
+
+Pipeline, una pagina alla volta (memoria limitata dalla pagina):
+- query `started_at < adesso - retention minima`, ordinata per
+  started_at, a pagine con cursore start_after; le chiamate di tenant con
+  retention più lunga vengono saltate
+- chiamate senza started_at (inizio chiamata mai salvato): stesse query
+  su ended_at, poi su created_at; ogni passata considera solo le chiamate
+  senza i campi delle passate precedenti (AGE_FIELDS)
+- le chiamate scadute (con il transcript ricostruito dai chunk) diventano
+  righe NDJSON, compresse come un membro gzip e accodate al file di
+  archivio (un .ndjson.gz resta leggibile con zcat); fsync prima di
+  eliminare qualsiasi cosa
+- indice `<archivio>.idx`: una riga TSV per chiamata
+  (call_id, data di riferimento, offset, lunghezza del membro) -> lettura puntuale
+  di un solo membro con find_archived_call
+- eliminazione di chiamate e chunk transcript in batch da max 500 write
+- checkpoint in `retention_runs/{nome}`: offset confermati di archivio e
+  indice, id in eliminazione, passata e cursore. --resume tronca la coda
+  non confermata, completa le eliminazioni in sospeso e riparte: ogni
+  chiamata finisce nell'archivio una volta sola
+
+Uso:
+    python retention.py --archive-dir /mnt/archive --dry-run
+    python retention.py --archive-dir /mnt/archive --checkpoint retention-2025-03
+    python retention.py --archive-dir /mnt/archive --checkpoint retention-2025-03 --resume
+    python retention.py --archive-dir /mnt/archive --find CALL_ID
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from pacing import Pacer
+from transcript_store import TRANSCRIPT_SUBCOLLECTION, decompress_transcript, read_transcript_chunks
+
+CHECKPOINT_COLLECTION = 'retention_runs'
+DEFAULT_RETENTION_DAYS = int(os.environ.get('CALL_RETENTION_DAYS', '365'))
+DEFAULT_PAGE_SIZE = 200
+MAX_BATCH_WRITES = 500
+ARCHIVE_SUFFIX = '.ndjson.gz'
+INDEX_SUFFIX = '.idx'
+
+# Data di riferimento per l'età di una chiamata: il primo campo presente
+AGE_FIELDS = ('started_at', 'ended_at', 'created_at')
+
+
+def _json_default(value):
+    """Timestamp Firestore -> ISO 8601, bytes -> latin-1, resto -> str"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return str(value)
+
+
+def archive_record(call_id, call_data, chunks=None):
+    """Riga NDJSON di una chiamata: documento completo + transcript ricostruito"""
+    record = dict(call_data)
+    if not record.get('transcript') and chunks:
+        record['transcript'] = decompress_transcript(chunks)
+    record['_id'] = call_id
+    return json.dumps(record, ensure_ascii=False, default=_json_default, separators=(',', ':'))
+
+
+def _aware(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def age_field(call_data):
+    """Campo che data la chiamata (started_at, altrimenti ended_at/created_at) o None"""
+    return next((field for field in AGE_FIELDS if isinstance(call_data.get(field), datetime)), None)
+
+
+def load_retention(db, default_days=DEFAULT_RETENTION_DAYS):
+    """{user_id: giorni di retention} per i tenant con retention_days propria"""
+    retention = {}
+    for snapshot in db.collection('users').stream():
+        days = (snapshot.to_dict() or {}).get('retention_days')
+        if isinstance(days, (int, float)) and days > 0 and days != default_days:
+            retention[snapshot.id] = int(days)
+    return retention
+
+
+class ArchiveWriter:
+    """
+    File di archivio append-only + indice. Ogni append è un membro gzip
+    separato: l'indice punta al membro, non serve decomprimere il file.
+    """
+
+    def __init__(self, path, offset=0, index_offset=0):
+        self.path = path
+        self.index_path = path[:-len(ARCHIVE_SUFFIX)] + INDEX_SUFFIX
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._data = open(path, 'ab')
+        self._index = open(self.index_path, 'ab')
+        # Coda scritta dopo l'ultimo checkpoint (run interrotto): via
+        self._data.truncate(offset)
+        self._index.truncate(index_offset)
+        self.offset = offset
+        self.index_offset = index_offset
+
+    def append(self, records):
+        """
+        records: [(call_id, data di riferimento iso, riga NDJSON)] -> un membro gzip.
+        Ritorna dopo fsync di archivio e indice.
+        """
+        member = gzip.compress(''.join(line + '\n' for _, _, line in records).encode('utf-8'), compresslevel=6)
+        self._data.write(member)
+        index = ''.join(f"{call_id}\t{dated}\t{self.offset}\t{len(member)}\n"
+                        for call_id, dated, _ in records).encode('utf-8')
+        self._index.write(index)
+        for handle in (self._data, self._index):
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.offset += len(member)
+        self.index_offset += len(index)
+        return len(member)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+def find_archived_call(archive_dir, call_id):
+    """
+    Documento archiviato di una chiamata (dict, None se assente): indice
+    letto riga per riga, poi un solo membro gzip decompresso.
+    """
+    prefix = f"{call_id}\t"
+    for index_path in sorted(glob.glob(os.path.join(archive_dir, f"*{INDEX_SUFFIX}"))):
+        with open(index_path, encoding='utf-8') as index:
+            entry = next((line for line in index if line.startswith(prefix)), None)
+        if entry is None:
+            continue
+        _, _, offset, length = entry.rstrip('\n').split('\t')
+        with open(index_path[:-len(INDEX_SUFFIX)] + ARCHIVE_SUFFIX, 'rb') as data:
+            data.seek(int(offset))
+            member = gzip.decompress(data.read(int(length)))
+        for line in member.decode('utf-8').splitlines():
+            record = json.loads(line)
+            if record.get('_id') == call_id:
+                return record
+    return None
+
+
+class Retention:
+    """
+    Archiviazione ed eliminazione a pagine delle chiamate scadute.
+
+    Args:
+        db: Firestore client
+        archive_dir: Directory dei file di archivio (disco locale o bucket montato)
+        default_days: Retention dei tenant senza retention_days
+        page_size: Documenti letti per pagina
+        dry_run: Conta le chiamate scadute senza archiviare né eliminare
+        checkpoint: Nome del run per checkpoint/resume (anche nome del file di archivio)
+        max_deletes_per_second: Limite di eliminazione (None = nessuno)
+        now: Istante di riferimento (default: adesso)
+    """
+
+    def __init__(self, db, archive_dir, default_days=DEFAULT_RETENTION_DAYS, page_size=DEFAULT_PAGE_SIZE,
+                 dry_run=False, checkpoint=None, max_deletes_per_second=None, now=None):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.default_days = default_days
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.checkpoint = checkpoint
+        self.now = _aware(now or datetime.now(timezone.utc))
+        self.name = checkpoint or self.now.strftime('calls-%Y%m%d-%H%M%S')
+        self._pacer = Pacer(max_deletes_per_second)
+        self.stats = {'scanned': 0, 'archived': 0, 'retained': 0, 'deleted_docs': 0,
+                      'archive_bytes': 0, 'commits': 0}
+        self._retention = {}
+        self._cursor_field = AGE_FIELDS[0]
+        self._cursor = None
+        self._offsets = (0, 0)
+        self._pending = []  # [(call_id, transcript_chunks)] archiviati ma non ancora eliminati
+        self._resumed = False
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.archive_dir, f"{self.name}{ARCHIVE_SUFFIX}")
+
+    def _checkpoint_ref(self):
+        return self.db.collection(CHECKPOINT_COLLECTION).document(self.checkpoint)
+
+    def resume(self):
+        """Riprende stato, offset e cursore dall'ultimo checkpoint. Ritorna False se assente."""
+        snapshot = self._checkpoint_ref().get()
+        if not snapshot.exists:
+            return False
+        state = snapshot.to_dict()
+        self.stats.update(state.get('stats') or {})
+        self._offsets = (state.get('archive_offset', 0), state.get('index_offset', 0))
+        self._pending = [tuple(item) for item in state.get('pending') or []]
+        self._cursor_field = state.get('cursor_field') or AGE_FIELDS[0]
+        self._cursor = state.get('cursor')
+        if state.get('now'):
+            self.now = _aware(state['now'])  # Stesse soglie del run originale
+        self._resumed = True
+        logging.info(f"Resuming retention '{self.checkpoint}' ({self.stats['archived']} archived, "
+                     f"{len(self._pending)} pending deletes)")
+        return True
+
+    def _save_checkpoint(self, writer, done=False):
+        if not self.checkpoint or self.dry_run:
+            return
+        from google.cloud import firestore
+
+        self._checkpoint_ref().set({
+            'archive': self.archive_path,
+            'archive_offset': writer.offset if writer else self._offsets[0],
+            'index_offset': writer.index_offset if writer else self._offsets[1],
+            'pending': [list(item) for item in self._pending],
+            'cursor_field': self._cursor_field,
+            'cursor': self._cursor,
+            'now': self.now,
+            'stats': self.stats,
+            'done': done,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+
+    def cutoff(self, user_id):
+        days = self._retention.get(user_id, self.default_days) if user_id else self.default_days
+        return self.now - timedelta(days=days)
+
+    def _pages(self, field, after=None):
+        """Pagine di chiamate con `field` più vecchio della retention minima, per `field`"""
+        shortest = min([self.default_days] + list(self._retention.values()))
+        query = self.db.collection('calls').where(field, '<', self.now - timedelta(days=shortest))
+        if after is not None:
+            # Resume: i documenti prima del cursore sono stati archiviati ed eliminati
+            # o appartengono a tenant con retention più lunga
+            query = query.where(field, '>=', after)
+        query = query.order_by(field)
+        cursor = None
+        while True:
+            page_query = query.limit(self.page_size)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            page = list(page_query.stream())
+            if not page:
+                return
+            cursor = page[-1]
+            yield page
+
+    def _expired(self, page, field):
+        """
+        (chiamate scadute, chiamate considerate) della pagina. Nelle passate
+        di ripiego le chiamate datate da un campo precedente sono già state
+        considerate e vengono ignorate.
+        """
+        expired = []
+        considered = 0
+        for snapshot in page:
+            data = snapshot.to_dict() or {}
+            if age_field(data) != field:
+                continue
+            considered += 1
+            if _aware(data[field]) < self.cutoff(data.get('user_id')):
+                expired.append((snapshot, data))
+        return expired, considered
+
+    def _delete_pending(self):
+        """Elimina chiamate e chunk transcript archiviati (idempotente)"""
+        if self.dry_run or not self._pending:
+            self._pending = []
+            return
+        calls = self.db.collection('calls')
+        batch = self.db.batch()
+        pending = 0
+        for call_id, chunk_count in self._pending:
+            ref = calls.document(call_id)
+            refs = [ref.collection(TRANSCRIPT_SUBCOLLECTION).document(f"{index:04d}")
+                    for index in range(chunk_count or 0)]
+            for target in refs + [ref]:
+                if pending >= MAX_BATCH_WRITES:
+                    self._commit(batch, pending)
+                    batch = self.db.batch()
+                    pending = 0
+                batch.delete(target)
+                pending += 1
+        if pending:
+            self._commit(batch, pending)
+        self._pending = []
+
+    def _commit(self, batch, pending):
+        self._pacer.wait(pending)
+        batch.commit()
+        self.stats['deleted_docs'] += pending
+        self.stats['commits'] += 1
+
+    def _archive_page(self, writer, expired, field):
+        page = [snapshot for snapshot, _ in expired]
+        chunks = read_transcript_chunks(self.db, page)
+        records = []
+        for snapshot, data in expired:
+            dated = _aware(data[field]).isoformat()
+            records.append((snapshot.id, dated, archive_record(snapshot.id, data, chunks.get(snapshot.id))))
+        self.stats['archive_bytes'] += writer.append(records)
+        self._pending = [(snapshot.id, data.get('transcript_chunks') or 0) for snapshot, data in expired]
+
+    def _run_pass(self, writer, field, after):
+        """Una passata (started_at o campo di ripiego), dal cursore `after`"""
+        for page in self._pages(field, after):
+            expired, considered = self._expired(page, field)
+            self.stats['scanned'] += considered
+            self.stats['retained'] += considered - len(expired)
+            self.stats['archived'] += len(expired)
+            self._cursor = page[-1].to_dict().get(field)
+            if expired and writer is not None:
+                self._archive_page(writer, expired, field)
+                self._save_checkpoint(writer)  # Archivio confermato prima di eliminare
+                self._delete_pending()
+            self._save_checkpoint(writer)
+            logging.info(
+                f"Retention ({field}): {self.stats['scanned']} scanned, {self.stats['archived']} archived, "
+                f"{self.stats['deleted_docs']} docs deleted"
+            )
+
+    def run(self):
+        """
+        Esegue la retention. Returns dict con stats, file di archivio,
+        secondi e chiamate archiviate al secondo.
+        """
+        start = time.perf_counter()
+        self._retention = load_retention(self.db, self.default_days)
+        writer = None
+        if not self.dry_run:
+            if not self._resumed and os.path.exists(self.archive_path) and os.path.getsize(self.archive_path):
+                raise FileExistsError(f"{self.archive_path} esiste già: usare --resume o un altro --checkpoint")
+            writer = ArchiveWriter(self.archive_path, *self._offsets)
+        try:
+            # Run interrotto tra archivio ed eliminazione: completa le eliminazioni
+            self._delete_pending()
+            self._save_checkpoint(writer)
+            for field in AGE_FIELDS[AGE_FIELDS.index(self._cursor_field):]:
+                after = self._cursor if field == self._cursor_field else None
+                self._cursor_field, self._cursor = field, after
+                self._run_pass(writer, field, after)
+            self._save_checkpoint(writer, done=True)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        elapsed = time.perf_counter() - start
+        return {
+            'stats': dict(self.stats),
+            'archive': None if self.dry_run else self.archive_path,
+            'tenants_with_custom_retention': len(self._retention),
+            'seconds': elapsed,
+            'calls_per_second': self.stats['archived'] / elapsed if elapsed else 0.0,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archivia ed elimina le chiamate oltre la retention del tenant')
+    parser.add_argument('--archive-dir', required=True, help='Directory dei file .ndjson.gz e .idx')
+    parser.add_argument('--default-days', type=int, default=DEFAULT_RETENTION_DAYS,
+                        help='Retention dei tenant senza retention_days')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help='Solo conteggi, nessuna scrittura')
+    parser.add_argument('--max-deletes-per-second', type=float, default=None)
+    parser.add_argument('--checkpoint', default=None, help='Nome del run (cursore in retention_runs)')
+    parser.add_argument('--resume', action='store_true', help="Riprende dall'ultimo checkpoint")
+    parser.add_argument('--find', default=None, metavar='CALL_ID', help='Stampa una chiamata archiviata')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.find:
+        record = find_archived_call(args.archive_dir, args.find)
+        if record is None:
+            print(f"{args.find} non trovata in {args.archive_dir}")
+            return 1
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+        return 0
+    if args.resume and not args.checkpoint:
+        parser.error('--resume richiede --checkpoint')
+
+    from clients import get_firestore
+    retention = Retention(get_firestore(), args.archive_dir, args.default_days, args.page_size, args.dry_run,
+                          args.checkpoint, args.max_deletes_per_second)
+    if args.resume and not retention.resume():
+        parser.error(f"Checkpoint '{args.checkpoint}' non trovato")
+
+    report = retention.run()
+    stats = report['stats']
+    print(f"scanned {stats['scanned']}, archived {stats['archived']}{' (dry run)' if args.dry_run else ''}, "
+          f"retained {stats['retained']}, {stats['deleted_docs']} docs deleted in {stats['commits']} commits")
+    if report['archive']:
+        print(f"archive: {report['archive']} ({stats['archive_bytes']:,} bytes)")
+    print(f"{report['seconds']:.1f}s, {report['calls_per_second']:.0f} calls/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
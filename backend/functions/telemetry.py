@@ -0,0 +1,228 @@
+"""
+Tracing e metriche per gli hot path del webhook
+
+Con TELEMETRY_ENABLED=1:
+- span temporizzati (firma, rate limit, costi, tenant, persistenza, notifica)
+- contatori (RPC Firestore, hit/miss cache)
+- un record JSON strutturato per richiesta su stdout (Cloud Logging lo indicizza)
+- registry in-process esportabile in formato testo Prometheus
+
+Disabilitato (default): span() ritorna un context manager no-op condiviso e
+count() esce subito, quindi l'overhead è una lettura di variabile globale.
+"""
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+ENABLED = os.environ.get('TELEMETRY_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+METRIC_PREFIX = 'vapi_webhook'
+DURATION_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_current_trace = contextvars.ContextVar('telemetry_trace', default=None)
+
+# Logger dedicato: una riga JSON per richiesta, senza prefissi di formato
+_trace_logger = logging.getLogger('telemetry')
+_trace_logger.propagate = False
+if not _trace_logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    _trace_logger.addHandler(_handler)
+    _trace_logger.setLevel(logging.INFO)
+
+
+class MetricsRegistry:
+    """Contatori e istogrammi in-process, thread-safe"""
+
+    def __init__(self, buckets=DURATION_BUCKETS_MS):
+        self._buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self._buckets), 0.0, 0]
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters), {k: [list(v[0]), v[1], v[2]] for k, v in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def export_prometheus(self):
+        """Esporta le metriche in formato testo Prometheus (exposition 0.0.4)"""
+        counters, histograms = self.snapshot()
+        lines = []
+
+        for name in sorted({k[0] for k in counters}):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (_, labels), value in sorted((k, v) for k, v in counters.items() if k[0] == name):
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+        for name in sorted({k[0] for k in histograms}):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (_, labels), (bucket_counts, total, count) in sorted(
+                    (k, v) for k, v in histograms.items() if k[0] == name):
+                for bound, bucket_count in zip(self._buckets, bucket_counts):
+                    lines.append(f"{metric}_bucket{_format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+registry = MetricsRegistry()
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def annotate(self, **fields):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        registry.observe('span_duration_ms', elapsed_ms, (('span', self.name),))
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append((self.name, elapsed_ms, exc_type is None))
+        return False
+
+
+class _RequestTrace:
+    """Trace di una richiesta: raccoglie span e contatori, poi emette JSON"""
+    __slots__ = ('trace_id', 'fields', 'spans', 'counters', 'start', '_token')
+
+    def __init__(self, **fields):
+        self.trace_id = uuid.uuid4().hex
+        self.fields = fields
+        self.spans = []
+        self.counters = {}
+        self.start = 0.0
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def annotate(self, **fields):
+        self.fields.update(fields)
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self.start) * 1000
+        _current_trace.reset(self._token)
+        event_type = self.fields.get('event_type') or 'unknown'
+        registry.observe('request_duration_ms', duration_ms, (('event_type', event_type),))
+
+        record = {
+            'severity': 'ERROR' if exc_type else 'INFO',
+            'message': 'webhook_trace',
+            'trace_id': self.trace_id,
+            'duration_ms': round(duration_ms, 3),
+            'spans': [
+                {'name': name, 'ms': round(ms, 3), 'ok': ok} for name, ms, ok in self.spans
+            ],
+            'counters': self.counters,
+        }
+        record.update(self.fields)
+        _trace_logger.info(json.dumps(record, default=str))
+        return False
+
+
+def enable(enabled=True):
+    """Attiva/disattiva a runtime (test, benchmark)"""
+    global ENABLED
+    ENABLED = enabled
+
+
+def request_trace(**fields):
+    """Context manager che apre la trace della richiesta corrente"""
+    if not ENABLED:
+        return _NOOP
+    return _RequestTrace(**fields)
+
+
+def annotate(**fields):
+    """Aggiunge campi (es. event_type, call_id) al record della richiesta"""
+    if not ENABLED:
+        return
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def span(name):
+    """Context manager che misura un blocco dell'hot path"""
+    if not ENABLED:
+        return _NOOP
+    return _Span(name)
+
+
+def count(name, value=1, **labels):
+    """Incrementa un contatore (registry + trace della richiesta corrente)"""
+    if not ENABLED:
+        return
+    label_items = tuple(sorted(labels.items()))
+    registry.inc(name, value, label_items)
+    trace = _current_trace.get()
+    if trace is not None:
+        key = name if not labels else f"{name}[{','.join(f'{k}={v}' for k, v in label_items)}]"
+        trace.counters[key] = trace.counters.get(key, 0) + value
+
+
+def export_prometheus():
+    return registry.export_prometheus()
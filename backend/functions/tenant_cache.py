@@ -0,0 +1,532 @@
+"""
+Cache del contesto tenant per assistant_id
+
+Un'unica entry per assistant contiene tutto ciò che serve al webhook:
+user_id, order_id, numero Twilio mittente, zone_assignments e l'indice
+zone compilato (zone_resolver.ZoneIndex), vocabolario lead, impostazioni
+digest notifiche e destinatari in copia (CC) del tenant.
+Così routing zona e notifica non rileggono users/orders a ogni chiamata.
+
+- LRU con dimensione massima
+- TTL per entry positive, TTL breve per entry negative (assistant sconosciuti)
+- Invalidazione esplicita
+- Contatori hit/miss
+- Single-flight: richieste concorrenti per un tenant freddo fanno UN fetch;
+  l'attesa è limitata (wait_timeout), poi il thread carica da sé
+- Opzionale (TenantListeners): listener on_snapshot su orders/users dei
+  tenant in cache, che aggiornano o invalidano le entry appena il cliente
+  modifica zone o numero Twilio; il TTL resta come rete di sicurezza
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import telemetry
+from notification import format_whatsapp_number
+from lead_digest import DigestConfig
+from lead_features import get_extractor
+from zone_resolver import ZoneIndex
+
+
+class TenantContext:
+    """Dati tenant necessari al webhook (immutabile per convenzione)"""
+    __slots__ = ('assistant_id', 'user_id', 'order_id', 'from_number', 'zone_assignments',
+                 'zone_aliases', 'lead_vocabulary', 'digest', 'notification_cc', 'duplicate_window',
+                 '_zone_index', '_lead_extractor')
+
+    def __init__(self, assistant_id, user_id, order_id=None, from_number=None, zone_assignments=None,
+                 zone_aliases=None, lead_vocabulary=None, digest=None, notification_cc=None,
+                 duplicate_window=0):
+        self.assistant_id = assistant_id
+        self.user_id = user_id
+        self.order_id = order_id
+        self.from_number = from_number
+        self.zone_assignments = zone_assignments or {}
+        self.zone_aliases = zone_aliases or {}
+        self.lead_vocabulary = lead_vocabulary or {}
+        self.digest = digest  # DigestConfig se il tenant ha attivato il digest lead
+        self.notification_cc = notification_cc or ()  # WhatsApp in copia su ogni lead
+        self.duplicate_window = duplicate_window  # Secondi (0 = richiamate sempre notificate)
+        self._zone_index = None
+        self._lead_extractor = None
+
+    @property
+    def zone_index(self):
+        """Indice zone compilato al primo uso, poi riusato finché l'entry è in cache"""
+        if self._zone_index is None:
+            self._zone_index = ZoneIndex(self.zone_assignments, self.zone_aliases)
+        return self._zone_index
+
+    @property
+    def lead_extractor(self):
+        """Matcher caratteristiche/urgenza con il vocabolario del tenant"""
+        if self._lead_extractor is None:
+            self._lead_extractor = get_extractor(self.lead_vocabulary)
+        return self._lead_extractor
+
+    def __repr__(self):
+        return f"TenantContext(assistant_id={self.assistant_id!r}, user_id={self.user_id!r}, order_id={self.order_id!r})"
+
+
+def number_list(value):
+    """Numero singolo o lista di numeri -> lista senza vuoti"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return [item for item in value if item]
+
+
+def build_tenant_context(assistant_id, order_id, order_data, user_data):
+    """TenantContext da documenti order e user già letti (user_data None se assente)"""
+    user_id = order_data.get('user_id')
+    zone_assignments = {}
+    zone_aliases = {}
+    lead_vocabulary = {}
+    digest = None
+    notification_cc = ()
+    duplicate_window = 0
+    if user_data is not None:
+        zone_assignments = user_data.get('zone_assignments') or {}
+        zone_aliases = user_data.get('zone_aliases') or {}
+        lead_vocabulary = user_data.get('lead_vocabulary') or {}
+        digest = DigestConfig.from_dict(user_data.get('notification_digest'))
+        notification_cc = tuple(format_whatsapp_number(n) for n in number_list(user_data.get('notification_cc')))
+        duplicate_window = max(int(user_data.get('duplicate_lead_window') or 0), 0)
+    else:
+        logging.warning(f"User profile not found for {user_id}")
+
+    twilio_phone = order_data.get('twilio_phone_number')
+    return TenantContext(
+        assistant_id,
+        user_id,
+        order_id,
+        format_whatsapp_number(twilio_phone) if twilio_phone else None,
+        zone_assignments,
+        zone_aliases,
+        lead_vocabulary,
+        digest,
+        notification_cc,
+        duplicate_window
+    )
+
+
+def _orders_query(db, assistant_id):
+    return db.collection('orders').where('vapi_assistant_id', '==', assistant_id).limit(1)
+
+
+def load_tenant_context(db, assistant_id):
+    """
+    Carica il contesto da Firestore: order per vapi_assistant_id + user.
+    Returns TenantContext o None se l'assistant non è associato a nessuno.
+    """
+    orders = _orders_query(db, assistant_id).stream()
+    telemetry.count('firestore_rpc', op='read')
+    for order in orders:
+        order_data = order.to_dict()
+        user_id = order_data.get('user_id')
+        if not user_id:
+            return None
+
+        user_doc = db.collection('users').document(user_id).get()
+        telemetry.count('firestore_rpc', op='read')
+        return build_tenant_context(assistant_id, order.id, order_data,
+                                    user_doc.to_dict() if user_doc.exists else None)
+    return None
+
+
+async def load_tenant_context_async(db, assistant_id):
+    """Come load_tenant_context, con Firestore AsyncClient"""
+    telemetry.count('firestore_rpc', op='read')
+    async for order in _orders_query(db, assistant_id).stream():
+        order_data = order.to_dict()
+        user_id = order_data.get('user_id')
+        if not user_id:
+            return None
+
+        user_doc = await db.collection('users').document(user_id).get()
+        telemetry.count('firestore_rpc', op='read')
+        return build_tenant_context(assistant_id, order.id, order_data,
+                                    user_doc.to_dict() if user_doc.exists else None)
+    return None
+
+
+# Marker di peek(): entry assente o scaduta (None è una entry negativa valida)
+MISS = object()
+
+
+class _Flight:
+    """Caricamento in corso: gli altri thread aspettano il risultato"""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TenantCache:
+    """
+    Cache LRU di TenantContext per assistant_id.
+
+    Args:
+        loader: Funzione assistant_id -> TenantContext | None
+        max_size: Numero massimo di entry (positive + negative)
+        ttl: Secondi di validità di una entry positiva
+        negative_ttl: Secondi di validità di una entry negativa
+        clock: Funzione tempo monotono (iniettabile nei test)
+        wait_timeout: Secondi massimi di attesa del caricamento di un altro
+            thread (es. RPC bloccata); oltre si carica direttamente
+
+    `on_load` (se impostato) riceve ogni TenantContext caricato o inserito
+    con put(), fuori dal lock: vedi TenantListeners.
+    """
+
+    def __init__(self, loader, max_size=1000, ttl=900, negative_ttl=60, clock=time.monotonic,
+                 wait_timeout=None):
+        self._loader = loader
+        self._wait_timeout = wait_timeout
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # assistant_id -> (context | None, expires_at)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.on_load = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.wait_timeouts = 0
+
+    def get(self, assistant_id):
+        """Ritorna il TenantContext (o None se sconosciuto), caricandolo se serve"""
+        if not assistant_id:
+            return None
+
+        with self._lock:
+            cached = self._lookup(assistant_id)
+            if cached is not MISS:
+                return cached
+            flight = self._inflight.get(assistant_id)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[assistant_id] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self._wait_timeout):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            return self._load_direct(assistant_id)
+
+        try:
+            context = self._loader(assistant_id)
+        except Exception as e:
+            # Errori non vengono cachati: la prossima richiesta ritenta
+            flight.error = e
+            with self._lock:
+                del self._inflight[assistant_id]
+            flight.done.set()
+            raise
+
+        flight.value = context
+        with self._lock:
+            self.loads += 1
+            self._store(assistant_id, context)
+            del self._inflight[assistant_id]
+        flight.done.set()
+        self._loaded(context)
+        return context
+
+    def _load_direct(self, assistant_id):
+        """Caricamento del leader oltre wait_timeout: carica senza aspettarlo"""
+        logging.warning(f"Tenant load for {assistant_id} still in flight after {self._wait_timeout}s, "
+                        f"loading directly")
+        telemetry.count('cache', cache='tenant', result='wait_timeout')
+        context = self._loader(assistant_id)
+        with self._lock:
+            self.wait_timeouts += 1
+            self.loads += 1
+            self._store(assistant_id, context)
+        self._loaded(context)
+        return context
+
+    def _loaded(self, context):
+        if context is None or self.on_load is None:
+            return
+        try:
+            self.on_load(context)
+        except Exception as e:
+            logging.error(f"Error in tenant cache load hook for {context.assistant_id}: {e}")
+
+    def _lookup(self, assistant_id):
+        """Entry valida (contesto o None negativo) o MISS. Da chiamare con il lock."""
+        entry = self._entries.get(assistant_id)
+        if entry is not None and entry[1] > self._clock():
+            self._entries.move_to_end(assistant_id)
+            if entry[0] is None:
+                self.negative_hits += 1
+                telemetry.count('cache', cache='tenant', result='negative_hit')
+            else:
+                self.hits += 1
+                telemetry.count('cache', cache='tenant', result='hit')
+            return entry[0]
+
+        self.misses += 1
+        telemetry.count('cache', cache='tenant', result='miss')
+        return MISS
+
+    def peek(self, assistant_id):
+        """
+        Entry in cache senza caricarla: TenantContext, None (assistant
+        sconosciuto) o MISS. Usata dal percorso asyncio, che carica da sé.
+        """
+        with self._lock:
+            return self._lookup(assistant_id)
+
+    def _store(self, assistant_id, context, ttl=None):
+        if ttl is None:
+            ttl = self._ttl if context is not None else self._negative_ttl
+        self._entries[assistant_id] = (context, self._clock() + ttl)
+        self._entries.move_to_end(assistant_id)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, context, assistant_id=None):
+        """Inserisce/aggiorna esplicitamente un contesto (None = entry negativa per assistant_id)"""
+        with self._lock:
+            if context is not None:
+                self._store(context.assistant_id, context)
+            elif assistant_id:
+                self._store(assistant_id, None)
+        self._loaded(context)
+
+    def refresh(self, context, ttl=None):
+        """
+        Sostituisce il contesto di un assistant SOLO se è ancora in cache
+        (non resuscita entry evicted o invalidate), con TTL opzionale.
+
+        Returns:
+            bool: True se l'entry è stata aggiornata
+        """
+        with self._lock:
+            if context.assistant_id not in self._entries:
+                return False
+            self._store(context.assistant_id, context, ttl)
+            return True
+
+    def invalidate(self, assistant_id=None):
+        """Invalida una entry (o tutta la cache se assistant_id è None)"""
+        with self._lock:
+            if assistant_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(assistant_id, None)
+
+    def invalidate_user(self, user_id):
+        """Invalida tutte le entry di uno user (es. zone_assignments modificate)"""
+        with self._lock:
+            for assistant_id in [k for k, (ctx, _) in self._entries.items() if ctx and ctx.user_id == user_id]:
+                del self._entries[assistant_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'wait_timeouts': self.wait_timeouts,
+            }
+
+
+# Documento sottoscritto ma snapshot iniziale non ancora arrivato
+_PENDING = object()
+
+
+class _Watched:
+    """Documento orders/users sotto listener e assistant che ne dipendono"""
+    __slots__ = ('watch', 'data', 'assistants')
+
+    def __init__(self):
+        self.watch = None
+        self.data = _PENDING
+        self.assistants = set()
+
+
+def _close_watch(watch):
+    """
+    unsubscribe() su un thread a parte: può essere chiamato dal callback
+    dello stesso listener (Watch.close fa join del proprio thread) e non
+    deve girare sotto il lock dei listener.
+    """
+    threading.Thread(target=watch.unsubscribe, name='tenant-unwatch', daemon=True).start()
+
+
+class TenantListeners:
+    """
+    Listener on_snapshot sui documenti `orders/{order_id}` e `users/{user_id}`
+    dei tenant caricati in cache: ogni modifica ricostruisce il
+    TenantContext (zone, numero Twilio, digest, CC) senza attendere il TTL.
+
+    - Order cancellato, riassegnato ad altro assistant o ad altro user:
+      entry invalidata, la prossima richiesta ricarica e risottoscrive
+    - Le entry sotto listener hanno `ttl` (più lungo di quello della
+      cache): solo rete di sicurezza se uno stream si interrompe
+    - Al massimo `max_tenants` tenant sotto listener (2 stream ciascuno):
+      oltre, i più vecchi tornano al solo TTL della cache
+    - Assistant sconosciuti (entry negative) restano a TTL breve
+
+    Args:
+        cache: TenantCache da tenere aggiornata (collega cache.on_load)
+        db_factory: Funzione che ritorna il client Firestore (sincrono)
+        ttl: Secondi di validità delle entry sotto listener
+        max_tenants: Tenant massimi sotto listener
+    """
+
+    def __init__(self, cache, db_factory, ttl=3600, max_tenants=100):
+        self._cache = cache
+        self._db_factory = db_factory
+        self.ttl = ttl
+        self._max_tenants = max_tenants
+        self._tenants = OrderedDict()  # assistant_id -> (order_id, user_id), ordine di sottoscrizione
+        self._orders = {}
+        self._users = {}
+        self._lock = threading.RLock()
+        self.updates = 0
+        self.invalidations = 0
+        cache.on_load = self.watch
+
+    def watch(self, context):
+        """Mette sotto listener order e user di un contesto appena caricato"""
+        assistant_id, order_id, user_id = context.assistant_id, context.order_id, context.user_id
+        if not (order_id and user_id):
+            return
+
+        subscribe = []
+        with self._lock:
+            if self._tenants.get(assistant_id) == (order_id, user_id):
+                # Ricaricato dopo il TTL: già sotto listener, riallunga la validità
+                self._rebuild(assistant_id)
+                return
+            self._unwatch(assistant_id)
+            self._tenants[assistant_id] = (order_id, user_id)
+            for collection, docs, doc_id in (('orders', self._orders, order_id), ('users', self._users, user_id)):
+                watched = docs.get(doc_id)
+                if watched is None:
+                    watched = docs[doc_id] = _Watched()
+                    subscribe.append((collection, docs, doc_id, watched))
+                watched.assistants.add(assistant_id)
+            if not subscribe:
+                self._rebuild(assistant_id)  # Stesso user di un altro assistant: dati già arrivati
+            while len(self._tenants) > self._max_tenants:
+                self._release(next(iter(self._tenants)))
+
+        # Fuori dal lock: lo snapshot iniziale può arrivare sincrono (emulatore/fake)
+        db = self._db_factory()
+        for collection, docs, doc_id, watched in subscribe:
+            callback = self._on_order if collection == 'orders' else self._on_user
+            watch = db.collection(collection).document(doc_id).on_snapshot(
+                lambda snapshots, changes, read_time, doc_id=doc_id, callback=callback: callback(doc_id, snapshots)
+            )
+            with self._lock:
+                if docs.get(doc_id) is watched:
+                    watched.watch = watch
+                    continue
+            _close_watch(watch)  # Rilasciato mentre sottoscrivevamo
+        telemetry.count('tenant_listener', event='watch')
+
+    def _on_order(self, order_id, snapshots):
+        try:
+            with self._lock:
+                watched = self._orders.get(order_id)
+                if watched is None:
+                    return
+                snapshot = snapshots[-1]
+                data = snapshot.to_dict() if snapshot.exists else None
+                for assistant_id in list(watched.assistants):
+                    if data is None or data.get('vapi_assistant_id') != assistant_id \
+                            or data.get('user_id') != self._tenants[assistant_id][1]:
+                        logging.info(f"Order {order_id} detached from assistant {assistant_id}, invalidating")
+                        self._unwatch(assistant_id)
+                        self._cache.invalidate(assistant_id)
+                        self.invalidations += 1
+                        telemetry.count('tenant_listener', event='invalidate')
+                        continue
+                    watched.data = data
+                    self._rebuild(assistant_id)
+        except Exception as e:
+            logging.error(f"Error applying order snapshot {order_id}: {e}")
+
+    def _on_user(self, user_id, snapshots):
+        try:
+            with self._lock:
+                watched = self._users.get(user_id)
+                if watched is None:
+                    return
+                snapshot = snapshots[-1]
+                watched.data = snapshot.to_dict() if snapshot.exists else None
+                for assistant_id in list(watched.assistants):
+                    self._rebuild(assistant_id)
+        except Exception as e:
+            logging.error(f"Error applying user snapshot {user_id}: {e}")
+
+    def _build(self, assistant_id):
+        """Contesto dai dati ricevuti dai listener, o None se manca ancora uno snapshot"""
+        order_id, user_id = self._tenants[assistant_id]
+        order_data = self._orders[order_id].data
+        user_data = self._users[user_id].data
+        if order_data is _PENDING or user_data is _PENDING:
+            return None
+        return build_tenant_context(assistant_id, order_id, order_data, user_data)
+
+    def _rebuild(self, assistant_id):
+        context = self._build(assistant_id)
+        if context is not None and self._cache.refresh(context, self.ttl):
+            self.updates += 1
+            telemetry.count('tenant_listener', event='update')
+
+    def _release(self, assistant_id):
+        """Fuori dai listener: l'entry resta in cache con il TTL normale"""
+        context = self._build(assistant_id)
+        self._unwatch(assistant_id)
+        if context is None:
+            self._cache.invalidate(assistant_id)
+        else:
+            self._cache.refresh(context)
+
+    def _unwatch(self, assistant_id):
+        ids = self._tenants.pop(assistant_id, None)
+        if ids is None:
+            return
+        for docs, doc_id in ((self._orders, ids[0]), (self._users, ids[1])):
+            watched = docs.get(doc_id)
+            if watched is None:
+                continue
+            watched.assistants.discard(assistant_id)
+            if not watched.assistants:
+                del docs[doc_id]
+                if watched.watch is not None:
+                    _close_watch(watched.watch)
+
+    def close(self):
+        """Chiude tutti i listener (le entry restano con il loro TTL)"""
+        with self._lock:
+            for assistant_id in list(self._tenants):
+                self._unwatch(assistant_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tenants': len(self._tenants),
+                'listeners': len(self._orders) + len(self._users),
+                'updates': self.updates,
+                'invalidations': self.invalidations,
+            }
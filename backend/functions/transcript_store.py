@@ -0,0 +1,193 @@
+"""
+Transcript delle chiamate fuori dal documento `calls/{call_id}`
+
+Il transcript completo rendeva i documenti delle chiamate grandi: ogni
+query lista della dashboard e ogni scansione di `calls` lo scaricava, e i
+documenti crescevano verso il limite di 1 MiB.
+
+Ora:
+- `calls/{call_id}` tiene solo campi compatti + metadati del transcript
+  (transcript_chars, transcript_chunks, transcript_encoding, transcript_preview)
+- il testo è salvato gzip in `calls/{call_id}/transcript/{0000..}`, a chunk
+  da CHUNK_BYTES (bytes Firestore), e letto solo quando si apre la chiamata
+
+Migrazione dei documenti esistenti (transcript inline):
+    python transcript_store.py migrate --dry-run
+    python transcript_store.py migrate --page-size 200
+"""
+import argparse
+import gzip
+import logging
+import sys
+
+TRANSCRIPT_SUBCOLLECTION = 'transcript'
+ENCODING = 'gzip'
+CHUNK_BYTES = 512 * 1024    # ben sotto il limite di 1 MiB per documento
+PREVIEW_CHARS = 160
+MAX_BATCH_WRITES = 500
+
+
+def compress_transcript(transcript):
+    """Testo -> lista di chunk bytes (stream gzip spezzato)"""
+    data = gzip.compress(transcript.encode('utf-8'), compresslevel=6)
+    return [data[i:i + CHUNK_BYTES] for i in range(0, len(data), CHUNK_BYTES)] or [b'']
+
+
+def decompress_transcript(chunks):
+    return gzip.decompress(b''.join(chunks)).decode('utf-8')
+
+
+def transcript_fields(transcript, chunks):
+    """Campi compatti da tenere sul documento della chiamata"""
+    return {
+        'transcript_chars': len(transcript),
+        'transcript_chunks': len(chunks),
+        'transcript_encoding': ENCODING,
+        'transcript_preview': transcript[:PREVIEW_CHARS],
+    }
+
+
+def _chunk_ref(db, call_id, index):
+    return db.collection('calls').document(call_id).collection(TRANSCRIPT_SUBCOLLECTION).document(f"{index:04d}")
+
+
+def write_transcript(db, writer, call_id, transcript, chunks=None):
+    """
+    Scrive i chunk con `writer` (transaction o batch) e ritorna i campi da
+    aggiungere al documento della chiamata. Passare `chunks` già compressi
+    per non ricomprimere a ogni retry della transazione.
+    """
+    if not transcript:
+        return {}
+    if chunks is None:
+        chunks = compress_transcript(transcript)
+    for index, chunk in enumerate(chunks):
+        writer.set(_chunk_ref(db, call_id, index), {'index': index, 'data': chunk})
+    return transcript_fields(transcript, chunks)
+
+
+def read_transcript(db, call_id, call_data=None):
+    """
+    Transcript completo di una chiamata ('' se assente).
+    Documenti non ancora migrati: usa il campo inline.
+    """
+    if call_data is None:
+        snapshot = db.collection('calls').document(call_id).get()
+        if not snapshot.exists:
+            return ''
+        call_data = snapshot.to_dict()
+
+    if call_data.get('transcript'):
+        return call_data['transcript']
+    count = call_data.get('transcript_chunks') or 0
+    if not count:
+        return ''
+
+    refs = [_chunk_ref(db, call_id, index) for index in range(count)]
+    snapshots = sorted(db.get_all(refs), key=lambda snap: snap.id)
+    return decompress_transcript([snap.to_dict()['data'] for snap in snapshots if snap.exists])
+
+
+def read_transcript_chunks(db, snapshots):
+    """
+    Chunk compressi dei transcript di più chiamate in una sola get_all
+    (job a pagine: backfill, retention). Returns {call_id: [chunk, ...]}
+    """
+    refs = []
+    for snapshot in snapshots:
+        count = (snapshot.to_dict() or {}).get('transcript_chunks') or 0
+        refs.extend(_chunk_ref(db, snapshot.id, index) for index in range(count))
+    chunks = {}
+    if refs:
+        for chunk in sorted(db.get_all(refs), key=lambda snap: snap.reference.path):
+            if chunk.exists:
+                call_id = chunk.reference.path.split('/')[1]
+                chunks.setdefault(call_id, []).append(chunk.to_dict()['data'])
+    return chunks
+
+
+def migrate_inline_transcripts(db, page_size=200, dry_run=False, limit=None):
+    """
+    Sposta i transcript inline nella subcollection, a pagine per document id.
+    Idempotente: i documenti già migrati (senza campo `transcript`) vengono saltati.
+
+    Returns:
+        dict: scanned, migrated, inline_bytes, compressed_bytes
+    """
+    from google.cloud import firestore
+
+    stats = {'scanned': 0, 'migrated': 0, 'inline_bytes': 0, 'compressed_bytes': 0}
+    collection = db.collection('calls')
+    last = None
+
+    while limit is None or stats['scanned'] < limit:
+        query = collection.order_by('__name__').limit(page_size)
+        if last is not None:
+            query = query.start_after(last)
+        page = list(query.stream())
+        if not page:
+            break
+        last = page[-1]
+
+        batch = db.batch()
+        pending = 0
+        for snapshot in page:
+            stats['scanned'] += 1
+            transcript = (snapshot.to_dict() or {}).get('transcript')
+            if not isinstance(transcript, str):
+                continue
+
+            chunks = compress_transcript(transcript) if transcript else []
+            stats['migrated'] += 1
+            stats['inline_bytes'] += len(transcript.encode('utf-8'))
+            stats['compressed_bytes'] += sum(len(chunk) for chunk in chunks)
+            if dry_run:
+                continue
+
+            if pending + len(chunks) + 1 > MAX_BATCH_WRITES:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+            update = write_transcript(db, batch, snapshot.id, transcript, chunks) if transcript else {}
+            update['transcript'] = firestore.DELETE_FIELD
+            batch.update(snapshot.reference, update)
+            pending += len(chunks) + 1
+
+        if pending:
+            batch.commit()
+        logging.info(f"Transcript migration: {stats['scanned']} scanned, {stats['migrated']} migrated")
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transcript delle chiamate (subcollection compressa)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    migrate = sub.add_parser('migrate', help='Sposta i transcript inline nella subcollection')
+    migrate.add_argument('--page-size', type=int, default=200)
+    migrate.add_argument('--limit', type=int, default=None, help='Massimo documenti da scansionare')
+    migrate.add_argument('--dry-run', action='store_true', help='Solo conteggi, nessuna scrittura')
+
+    read = sub.add_parser('read', help='Stampa il transcript di una chiamata')
+    read.add_argument('call_id')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from clients import get_firestore
+    db = get_firestore()
+
+    if args.command == 'migrate':
+        stats = migrate_inline_transcripts(db, args.page_size, args.dry_run, args.limit)
+        ratio = stats['compressed_bytes'] / stats['inline_bytes'] if stats['inline_bytes'] else 0
+        print(f"scanned {stats['scanned']}, migrated {stats['migrated']}"
+              f"{' (dry run)' if args.dry_run else ''}: "
+              f"{stats['inline_bytes']} -> {stats['compressed_bytes']} bytes ({ratio:.0%})")
+    else:
+        print(read_transcript(db, args.call_id))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,369 @@
+"""
+Sender Twilio resiliente (API REST Messages, senza SDK)
+
+`messages.create` dell'SDK fa una sola richiesta: nessun retry, timeout
+unico e nessuna protezione quando Twilio è degradato (ogni notifica
+aspetta il timeout intero). TwilioSender parla direttamente con l'API
+REST e aggiunge:
+
+- requests.Session condivisa con pool keep-alive (HTTPAdapter)
+- timeout espliciti separati per connessione e lettura
+- retry limitati con backoff esponenziale e jitter ("full jitter") su
+  429 e 5xx, rispettando Retry-After; timeout di lettura NON ritentati
+  (Twilio potrebbe aver già accettato il messaggio: niente doppioni)
+- circuit breaker: dopo N fallimenti consecutivi fallisce subito per
+  `reset_seconds`, poi lascia passare una richiesta di prova
+- fan-out concorrente su più destinatari (più agenti per zona, CC)
+- base URL configurabile (TWILIO_API_BASE_URL): un server HTTP locale
+  può sostituire Twilio nei benchmark
+
+Espone `messages.create(body=, from_=, to=)` come il client SDK, quindi è
+intercambiabile con twilio.rest.Client e con i fake dei benchmark.
+
+RetryingClient applica la stessa politica (retry con jitter su 429/5xx e
+errori di connessione, niente retry sui timeout di lettura, circuit
+breaker) a un client twilio.rest: è il client di default (vedi clients.py).
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+DEFAULT_BASE_URL = 'https://api.twilio.com'
+API_VERSION = '2010-04-01'
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_RETRY_AFTER_SECONDS = 10
+
+MAX_FANOUT_WORKERS = 8
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class TwilioError(Exception):
+    """Invio fallito. `retryable` = errore transitorio (429/5xx/rete)"""
+
+    def __init__(self, message, status=None, code=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.retryable = retryable
+
+
+class CircuitOpenError(TwilioError):
+    """Circuit breaker aperto: richiesta non inviata"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"Twilio circuit open, retry in {retry_in:.0f}s", retryable=True)
+        self.retry_in = retry_in
+
+
+class SentMessage:
+    """Risposta di Messages.json (stessi attributi usati del MessageInstance SDK)"""
+    __slots__ = ('sid', 'status', 'to')
+
+    def __init__(self, sid, status, to):
+        self.sid = sid
+        self.status = status
+        self.to = to
+
+    def __repr__(self):
+        return f"SentMessage(sid={self.sid!r}, status={self.status!r}, to={self.to!r})"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker thread-safe.
+
+    closed    -> richieste normali; `failure_threshold` fallimenti
+                 transitori consecutivi lo aprono
+    open      -> allow() falso per `reset_seconds`
+    half_open -> passa una sola richiesta di prova: successo chiude,
+                 fallimento riapre
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.reset_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def retry_in(self):
+        with self._lock:
+            return max(self.reset_seconds - (self._clock() - self._opened_at), 0.0)
+
+    def allow(self):
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.reset_seconds:
+                    return False
+                self._state = HALF_OPEN
+            if self._probing:
+                return False  # Una sola prova alla volta
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logging.info("Twilio circuit closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logging.warning(f"Twilio circuit open after {self._failures} consecutive failures")
+                    telemetry.count('twilio_circuit_open')
+                self._state = OPEN
+                self._opened_at = self._clock()
+
+    def release(self):
+        """Richiesta di prova conclusa senza esito sul servizio (es. errore 4xx)"""
+        with self._lock:
+            self._probing = False
+
+
+def backoff_delay(attempt, base=0.25, cap=4.0, rng=random):
+    """Full jitter: uniforme tra 0 e min(cap, base * 2^attempt)"""
+    return rng.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return min(float(value), MAX_RETRY_AFTER_SECONDS) if value else None
+    except ValueError:
+        return None
+
+
+class TwilioSender:
+    """
+    Client Messages Twilio con pool, timeout, retry e circuit breaker.
+
+    Args:
+        account_sid, auth_token: Credenziali Twilio
+        base_url: Endpoint API (default api.twilio.com; server locale nei benchmark)
+        connect_timeout, read_timeout: Timeout in secondi
+        max_attempts: Tentativi totali per messaggio (1 = nessun retry)
+        backoff_base, backoff_cap: Parametri del backoff con jitter (secondi)
+        pool_maxsize: Connessioni keep-alive verso l'host
+        breaker: CircuitBreaker condiviso (default: uno per sender)
+        sleep: Funzione di attesa tra i retry (iniettabile)
+    """
+
+    def __init__(self, account_sid, auth_token, base_url=DEFAULT_BASE_URL, connect_timeout=3.05,
+                 read_timeout=10.0, max_attempts=3, backoff_base=0.25, backoff_cap=4.0, pool_maxsize=10,
+                 breaker=None, sleep=time.sleep):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.account_sid = account_sid
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+        self._requests = requests
+
+        self.session = requests.Session()
+        self.session.auth = (account_sid, auth_token)
+        # Retry gestiti qui (con jitter e breaker), non dall'adapter
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.messages = self  # Compatibilità con client.messages.create dell'SDK
+
+    @property
+    def messages_url(self):
+        return f"{self.base_url}/{API_VERSION}/Accounts/{self.account_sid}/Messages.json"
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        """
+        Invia un messaggio. Stessa firma di client.messages.create.
+
+        Raises:
+            CircuitOpenError: Twilio degradato, richiesta non inviata
+            TwilioError: errore definitivo (4xx) o retry esauriti
+        """
+        data = {'Body': body, 'From': from_, 'To': to}
+        for key, value in kwargs.items():
+            data[''.join(part.capitalize() for part in key.split('_'))] = value
+        return _send_with_retry(self, lambda: self._post(data), to)
+
+    def _post(self, data):
+        requests = self._requests
+        try:
+            response = self.session.post(self.messages_url, data=data, timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout as e:
+            raise TwilioError(f"connect timeout: {e}", retryable=True)
+        except requests.exceptions.ReadTimeout as e:
+            # La richiesta è arrivata: un retry potrebbe duplicare il messaggio
+            raise TwilioError(f"read timeout: {e}", retryable=False)
+        except requests.exceptions.ConnectionError as e:
+            raise TwilioError(f"connection error: {e}", retryable=True)
+
+        if response.status_code < 300:
+            payload = response.json()
+            return SentMessage(payload.get('sid'), payload.get('status'), payload.get('to'))
+
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {}
+        error = TwilioError(
+            f"HTTP {response.status_code}: {payload.get('message') or response.reason}",
+            status=response.status_code,
+            code=payload.get('code'),
+            retryable=response.status_code in RETRY_STATUSES,
+        )
+        error.retry_after = _retry_after(response) if response.status_code in (429, 503) else None
+        raise error
+
+    def close(self):
+        self.session.close()
+
+
+class RetryingClient:
+    """
+    Client twilio.rest con la politica di TwilioSender: retry limitati con
+    backoff e jitter su 429/5xx ed errori di connessione, timeout di
+    lettura non ritentati, circuit breaker. Gli errori diventano
+    TwilioError. Stessi argomenti di TwilioSender per i retry.
+
+    Args:
+        client: twilio.rest.Client (HTTPAdapter senza retry propri)
+    """
+
+    def __init__(self, client, max_attempts=3, backoff_base=0.25, backoff_cap=4.0, breaker=None, sleep=time.sleep):
+        self.client = client
+        self.max_attempts = max(int(max_attempts), 1)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+        self.messages = self
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        """Come TwilioSender.create, inviando con client.messages.create"""
+        def _send():
+            try:
+                return self.client.messages.create(body=body, from_=from_, to=to, **kwargs)
+            except Exception as e:
+                raise _sdk_error(e) from e
+
+        return _send_with_retry(self, _send, to)
+
+
+def _sdk_error(error):
+    """Eccezione del client twilio.rest -> TwilioError (retryable come in TwilioSender._post)"""
+    import requests
+    from twilio.base.exceptions import TwilioRestException
+
+    if isinstance(error, TwilioRestException):
+        return TwilioError(f"HTTP {error.status}: {error.msg}", status=error.status, code=error.code,
+                           retryable=error.status in RETRY_STATUSES)
+    if isinstance(error, requests.exceptions.ReadTimeout):
+        return TwilioError(f"read timeout: {error}", retryable=False)
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return TwilioError(f"connection error: {error}", retryable=True)
+    return TwilioError(str(error))
+
+
+def _send_with_retry(client, send, to):
+    """
+    Retry e circuit breaker attorno a `send()` (solleva TwilioError).
+    `client`: TwilioSender o RetryingClient (breaker, max_attempts, backoff).
+
+    Raises:
+        CircuitOpenError: Twilio degradato, richiesta non inviata
+        TwilioError: errore definitivo (4xx) o retry esauriti
+    """
+    breaker = client.breaker
+    if not breaker.allow():
+        telemetry.count('twilio_request', result='circuit_open')
+        raise CircuitOpenError(breaker.retry_in())
+
+    attempt = 0
+    while True:
+        try:
+            message = send()
+        except TwilioError as e:
+            attempt += 1
+            if not e.retryable:
+                breaker.release()
+                telemetry.count('twilio_request', result='error')
+                raise
+            if attempt >= client.max_attempts:
+                breaker.record_failure()
+                telemetry.count('twilio_request', result='error')
+                raise
+            delay = getattr(e, 'retry_after', None)
+            if delay is None:
+                delay = backoff_delay(attempt - 1, client.backoff_base, client.backoff_cap)
+            logging.warning(f"Twilio send to {to} failed ({e}), retry {attempt} in {delay:.2f}s")
+            telemetry.count('twilio_retry')
+            client._sleep(delay)
+            continue
+        breaker.record_success()
+        telemetry.count('twilio_request', result='ok')
+        return message
+
+
+_fanout_executor = None
+_fanout_lock = threading.Lock()
+
+
+def _executor():
+    global _fanout_executor
+    if _fanout_executor is None:
+        with _fanout_lock:
+            if _fanout_executor is None:
+                _fanout_executor = ThreadPoolExecutor(max_workers=MAX_FANOUT_WORKERS,
+                                                      thread_name_prefix='twilio-fanout')
+    return _fanout_executor
+
+
+def send_many(twilio, body, from_number, destinations):
+    """
+    Invia lo stesso messaggio a più destinatari in parallelo.
+    Funziona con qualsiasi client con `messages.create` (sender, SDK, fake).
+
+    Returns:
+        list di (destinazione, SentMessage o eccezione), nell'ordine dato
+    """
+    def _send(destination):
+        try:
+            return twilio.messages.create(body=body, from_=from_number, to=destination)
+        except Exception as e:
+            return e
+
+    destinations = list(dict.fromkeys(d for d in destinations if d))
+    if len(destinations) <= 1:
+        return [(d, _send(d)) for d in destinations]
+    futures = [_executor().submit(_send, d) for d in destinations]
+    return [(d, future.result()) for d, future in zip(destinations, futures)]
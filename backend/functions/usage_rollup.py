@@ -0,0 +1,268 @@
+"""
+Rollup mensili di utilizzo (chiamate, secondi, costo stimato)
+
+Aggregati materializzati aggiornati in modo incrementale a fine chiamata,
+così il controllo costi legge UN documento invece di scansionare `calls`.
+
+Documenti in `usage_rollups`:
+- global_{YYYY-MM}            -> totali piattaforma
+- user_{user_id}_{YYYY-MM}    -> totali per tenant
+
+Rebuild una tantum dai dati esistenti:
+    python usage_rollup.py rebuild --month 2025-01
+"""
+import argparse
+import logging
+import time
+from datetime import datetime
+
+import telemetry
+from clients import get_firestore
+
+ROLLUP_COLLECTION = 'usage_rollups'
+
+# Stima costi (€0.06/minuto media con Vapi)
+COST_PER_MINUTE_EUR = 0.06
+
+# Cache in-process del rollup globale (evita una read per ogni chiamata)
+_ROLLUP_CACHE_TTL_SECONDS = 60
+_rollup_cache = {}
+
+
+def month_key(when=None):
+    """Chiave mese 'YYYY-MM' (default: mese corrente)"""
+    when = when or datetime.now()
+    return when.strftime('%Y-%m')
+
+
+def global_doc_id(month):
+    return f"global_{month}"
+
+
+def tenant_doc_id(user_id, month):
+    return f"user_{user_id}_{month}"
+
+
+def estimate_cost(total_duration):
+    """Costo stimato in € a partire dai secondi totali"""
+    return (total_duration / 60) * COST_PER_MINUTE_EUR
+
+
+def _increments(month, duration, user_id=None):
+    from google.cloud import firestore
+
+    data = {
+        'month': month,
+        'call_count': firestore.Increment(1),
+        'total_duration': firestore.Increment(duration),
+        'estimated_cost': firestore.Increment(estimate_cost(duration)),
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }
+    if user_id:
+        data['user_id'] = user_id
+    return data
+
+
+def record_call_usage(db, duration, user_id=None, when=None, writer=None):
+    """
+    Incrementa i rollup globale e per tenant con una chiamata conclusa.
+
+    Args:
+        db: Firestore client
+        duration: Durata chiamata in secondi
+        user_id: Tenant proprietario (opzionale)
+        when: Inizio chiamata (started_at, stesso mese di
+            rebuild_monthly_rollups; default: adesso)
+        writer: WriteBatch/Transaction su cui accodare le scritture.
+            Se None, le scritture vengono inviate subito in un unico batch;
+            altrimenti il chiamante invoca bump_cached_usage dopo il commit.
+    """
+    duration = duration or 0
+    month = month_key(when)
+    collection = db.collection(ROLLUP_COLLECTION)
+
+    batch = writer or db.batch()
+    batch.set(collection.document(global_doc_id(month)), _increments(month, duration), merge=True)
+    if user_id:
+        batch.set(
+            collection.document(tenant_doc_id(user_id, month)),
+            _increments(month, duration, user_id),
+            merge=True
+        )
+    if writer is None:
+        batch.commit()
+        bump_cached_usage(duration, month)
+
+
+def bump_cached_usage(duration, month=None):
+    """
+    Aggiorna la copia in cache dopo il commit, così il prossimo check costi
+    non rilegge. Da chiamare quando record_call_usage usa un writer esterno.
+    """
+    duration = duration or 0
+    month = month or month_key()
+    cached = _rollup_cache.get(month)
+    if cached:
+        usage, cached_at = cached
+        _rollup_cache[month] = ({
+            'call_count': usage['call_count'] + 1,
+            'total_duration': usage['total_duration'] + duration,
+            'estimated_cost': usage['estimated_cost'] + estimate_cost(duration),
+        }, cached_at)
+
+
+def _cached_usage(month, max_age):
+    cached = _rollup_cache.get(month)
+    if cached and time.monotonic() - cached[1] < max_age:
+        telemetry.count('cache', cache='usage_rollup', result='hit')
+        return cached[0]
+    telemetry.count('cache', cache='usage_rollup', result='miss')
+    return None
+
+
+def _cache_usage(month, doc):
+    telemetry.count('firestore_rpc', op='read')
+    data = doc.to_dict() if doc.exists else {}
+    usage = {
+        'call_count': data.get('call_count', 0),
+        'total_duration': data.get('total_duration', 0),
+        'estimated_cost': data.get('estimated_cost', 0.0),
+    }
+    _rollup_cache.clear()  # Tiene solo il mese corrente
+    _rollup_cache[month] = (usage, time.monotonic())
+    return usage
+
+
+def get_monthly_usage(db, month=None, max_age=_ROLLUP_CACHE_TTL_SECONDS):
+    """
+    Ritorna l'utilizzo globale del mese: dict con call_count,
+    total_duration, estimated_cost. Una sola read, con cache in-process.
+    """
+    month = month or month_key()
+    usage = _cached_usage(month, max_age)
+    if usage is None:
+        usage = _cache_usage(month, db.collection(ROLLUP_COLLECTION).document(global_doc_id(month)).get())
+    return usage
+
+
+async def get_monthly_usage_async(db, month=None, max_age=_ROLLUP_CACHE_TTL_SECONDS):
+    """Come get_monthly_usage, con Firestore AsyncClient (stessa cache)"""
+    month = month or month_key()
+    usage = _cached_usage(month, max_age)
+    if usage is None:
+        usage = _cache_usage(month, await db.collection(ROLLUP_COLLECTION).document(global_doc_id(month)).get())
+    return usage
+
+
+def month_bounds(month):
+    """Inizio (incluso) e fine (esclusa) del mese 'YYYY-MM', per le query su started_at"""
+    start = datetime.strptime(month, '%Y-%m')
+    if start.month == 12:
+        end = datetime(start.year + 1, 1, 1)
+    else:
+        end = datetime(start.year, start.month + 1, 1)
+    return start, end
+
+
+def rebuild_monthly_rollups(db, month):
+    """
+    Ricalcola da zero i rollup di un mese scansionando `calls`.
+    Da usare una tantum (migrazione) o per correggere derive. Conta solo
+    le chiamate concluse, come record_call_usage a fine chiamata (non
+    quelle in corso o mai chiuse da end-of-call-report).
+
+    Returns:
+        dict: totali globali ricalcolati
+    """
+    start, end = month_bounds(month)
+    calls = db.collection('calls')\
+        .where('started_at', '>=', start)\
+        .where('started_at', '<', end)\
+        .stream()
+
+    totals = {'call_count': 0, 'total_duration': 0}
+    per_tenant = {}
+
+    for call in calls:
+        call_data = call.to_dict()
+        if call_data.get('status') != 'completed':
+            continue
+        duration = call_data.get('duration', 0) or 0
+        totals['call_count'] += 1
+        totals['total_duration'] += duration
+
+        user_id = call_data.get('user_id')
+        if user_id:
+            tenant = per_tenant.setdefault(user_id, {'call_count': 0, 'total_duration': 0})
+            tenant['call_count'] += 1
+            tenant['total_duration'] += duration
+
+    return write_monthly_rollups(db, month, totals, per_tenant)
+
+
+def write_monthly_rollups(db, month, totals, per_tenant):
+    """
+    Sovrascrive i rollup di un mese con totali già calcolati
+    ({'call_count', 'total_duration'} globali e per user_id).
+    """
+    from google.cloud import firestore
+
+    totals = dict(totals)
+    collection = db.collection(ROLLUP_COLLECTION)
+    batch = db.batch()
+    pending = 0
+
+    def _write(doc_id, values, user_id=None):
+        nonlocal batch, pending
+        data = {
+            'month': month,
+            'call_count': values['call_count'],
+            'total_duration': values['total_duration'],
+            'estimated_cost': estimate_cost(values['total_duration']),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }
+        if user_id:
+            data['user_id'] = user_id
+        batch.set(collection.document(doc_id), data)
+        pending += 1
+        if pending >= 500:  # Limite scritture per batch Firestore
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    _write(global_doc_id(month), totals)
+    for user_id, values in per_tenant.items():
+        _write(tenant_doc_id(user_id, month), values, user_id)
+    if pending:
+        batch.commit()
+
+    _rollup_cache.pop(month, None)
+
+    totals['estimated_cost'] = estimate_cost(totals['total_duration'])
+    logging.info(
+        f"Rebuilt usage rollups for {month}: {totals['call_count']} calls, "
+        f"{totals['total_duration']}s, {len(per_tenant)} tenants"
+    )
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gestione rollup mensili di utilizzo')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = subparsers.add_parser('rebuild', help='Ricalcola i rollup dai documenti calls')
+    rebuild.add_argument('--month', default=None, help='Mese YYYY-MM (default: corrente)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'rebuild':
+        totals = rebuild_monthly_rollups(get_firestore(), args.month or month_key())
+        print(
+            f"{totals['call_count']} calls, {totals['total_duration']}s, "
+            f"~€{totals['estimated_cost']:.2f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -10,26 +10,41 @@ PROTEZIONI ANTI-BOT:
 """
 import os
 import functions_framework
-from google.cloud import firestore
-from google.cloud.firestore import Timestamp
-from notification import send_whatsapp_notification
+import telemetry
+from clients import get_firestore
+from notification import format_whatsapp_number, send_whatsapp_digest, send_whatsapp_notification
+from usage_rollup import bump_cached_usage, get_monthly_usage, month_key, record_call_usage
+from lead_analytics import record_lead_analytics
+from caller_profiles import CallerProfiles, lookup_profile, record_caller_profile
+from rate_limiter import RateLimiter
+from notification_outbox import enqueue_notification
+from tenant_cache import TenantCache, TenantListeners, load_tenant_context, number_list
+from inventory import InventoryStore, format_availability, search_parameters
+from zone_resolver import normalize_zone
+from lead_features import extract_lead_features
+from transcript_store import compress_transcript, write_transcript
+from idempotency import IdempotencyGuard
+from lead_digest import BUFFERED, DIGEST, lead_entry, requeue, submit_lead
+from events import ASSISTANT_REQUEST, END_OF_CALL_REPORT, FUNCTION_CALL, decode_event
+import contextvars
 import logging
-import json
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent import futures
+from datetime import datetime, timedelta, timezone
 import hmac
 import hashlib
 
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Firestore
-db = firestore.Client()
+# COLD START: google.cloud.firestore e twilio NON vengono importati qui.
+# Client condivisi creati alla prima richiesta (vedi clients.py), sentinel
+# Firestore importati dentro le funzioni. Regressioni: benchmarks/bench_cold_start.py
 
 # Zone matching helper
 def normalize_zone_name(zone_text):
-    """Normalizza nome zona per matching (es: 'porta romana' -> 'porta-romana')"""
-    if not zone_text:
-        return None
-    return zone_text.lower().strip().replace(' ', '-')
+    """Normalizza nome zona per matching (es: 'P.ta Romana, Milano' -> 'porta-romana')"""
+    return normalize_zone(zone_text) or None
 
 # Vapi credentials
 VAPI_API_KEY = os.environ.get('VAPI_API_KEY', '')
@@ -39,9 +54,44 @@ MAX_CALLS_PER_NUMBER_PER_HOUR = 20  # Un cliente reale non chiama 20 volte in 1
 MAX_CALLS_PER_NUMBER_PER_DAY = 50   # Protezione contro spam su stesso numero
 COST_ALERT_THRESHOLD = 100.0  # Alert se costi superano €100/mese
 
-# Cache per assistant_id -> user_id mapping (TTL 15 minuti)
-_assistant_cache = {}
-_cache_ttl = timedelta(minutes=15)
+# Il primo saluto aspetta la risposta ad assistant-request: oltre il budget
+# si risponde con il firstMessage di default (vedi handle_assistant_request)
+ASSISTANT_REQUEST_BUDGET_MS = int(os.environ.get('ASSISTANT_REQUEST_BUDGET_MS', '1000'))
+CALL_START_WORKERS = 16  # Avvio chiamata atteso dalla richiesta (vedi start_call)
+RPC_WORKERS = 16         # RPC in parallelo dentro start_call (non attendono altri task)
+DEFERRED_WORKERS = 8     # Lavoro non essenziale finito dopo la risposta (controllo costi)
+
+# Notifiche: 'inline' (Twilio nel webhook) o 'outbox' (coda + worker)
+NOTIFICATION_MODE = os.environ.get('NOTIFICATION_MODE', 'inline')
+
+# Cache tenant: 'ttl' (solo scadenza) o 'listen' (listener on_snapshot su orders/users)
+TENANT_CACHE_MODE = os.environ.get('TENANT_CACHE_MODE', 'ttl')
+
+_rate_limiter = RateLimiter(None, MAX_CALLS_PER_NUMBER_PER_HOUR, MAX_CALLS_PER_NUMBER_PER_DAY)
+
+# Cache contesto tenant per assistant_id (LRU, TTL 15 minuti, negative 1 minuto);
+# un caricamento altrui si attende al massimo il budget di assistant-request
+_tenant_cache = TenantCache(lambda assistant_id: load_tenant_context(get_firestore(), assistant_id),
+                            wait_timeout=ASSISTANT_REQUEST_BUDGET_MS / 1000)
+
+# Modifiche a zone / numero Twilio visibili subito, TTL 1 ora come rete di sicurezza
+_tenant_listeners = None
+if TENANT_CACHE_MODE == 'listen':
+    _tenant_listeners = TenantListeners(
+        _tenant_cache, get_firestore,
+        ttl=int(os.environ.get('TENANT_CACHE_LISTEN_TTL', '3600')),
+        max_tenants=int(os.environ.get('TENANT_CACHE_MAX_LISTENERS', '100'))
+    )
+
+# Inventario immobili per check_availability (indice in memoria per tenant)
+_inventory_store = InventoryStore(get_firestore)
+
+# Profili chiamante per (tenant, numero): richiamate riconosciute con una get, poi cache
+_caller_profiles = CallerProfiles(get_firestore, ttl=int(os.environ.get('CALLER_PROFILE_TTL', '300')))
+
+# Dedup dei retry Vapi per call_id + tipo evento: end-of-call-report con
+# marker durevole (billing + WhatsApp), assistant-request solo in-process
+_idempotency = IdempotencyGuard(get_firestore, durable_events=('end-of-call-report',))
 
 
 def verify_vapi_signature(request):
@@ -49,79 +99,129 @@ def verify_vapi_signature(request):
     Verifica che la richiesta venga davvero da Vapi.ai
     Vapi firma ogni richiesta con HMAC per sicurezza
     """
+    return verify_signature(request.headers.get('x-vapi-signature', ''), request.get_data())
+
+
+def verify_signature(signature, body):
+    """Verifica firma su header e body già letti (condivisa con vapi_webhook_async)"""
     # Se VAPI_API_KEY non è configurato, rifiuta tutte le richieste per sicurezza
     if not VAPI_API_KEY:
         logging.error("VAPI_API_KEY not configured - rejecting all webhook requests")
         return False
     
-    # Ottieni firma dall'header
-    signature = request.headers.get('x-vapi-signature', '')
-    
     if not signature:
         logging.warning("Missing x-vapi-signature header - rejecting request")
         return False
     
     # Verifica firma HMAC
     try:
-        body = request.get_data()
-        expected_signature = hmac.new(
-            VAPI_API_KEY.encode(),
-            body,
-            hashlib.sha256
-        ).hexdigest()
-        
-        return hmac.compare_digest(signature, expected_signature)
+        return signature_matches(signature, body)
     except Exception as e:
         logging.error(f"Error verifying signature: {e}")
         return False
 
 
-def check_rate_limit(customer_number):
-    """
-    Rate limiting intelligente per numero chiamante.
-    Blocca SOLO se stesso numero chiama troppo spesso (protezione spam).
-    NON limita chiamate totali (clienti diversi possono chiamare liberamente).
+def signature_matches(signature, body):
+    """HMAC-SHA256 del body con VAPI_API_KEY (condivisa con vapi_webhook_async)"""
+    expected_signature = hmac.new(
+        VAPI_API_KEY.encode(),
+        body,
+        hashlib.sha256
+    ).hexdigest()
     
-    Returns:
-        bool: True se OK, False se rate limit superato
+    return hmac.compare_digest(signature, expected_signature)
+
+
+# Pool di assistant-request (creati alla prima richiesta): avvio chiamata
+# atteso con deadline, RPC parallele, lavoro differito. I task del pool
+# 'rpc' non attendono mai altri task (niente deadlock a pool pieno).
+# _deferred = future ancora in corso
+_executors = {}
+_executors_lock = threading.Lock()
+_deferred = set()
+
+
+def _executor(name, workers):
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = _executors[name] = futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix=f"webhook-{name}")
+    return executor
+
+
+def run_deferred(fn, *args, what=''):
     """
-    try:
-        # Conta chiamate ultimo ora
-        one_hour_ago = datetime.now() - timedelta(hours=1)
-        one_hour_ago_timestamp = Timestamp.from_datetime(one_hour_ago)
-        
-        recent_calls = db.collection('calls')\
-            .where('customer_number', '==', customer_number)\
-            .where('started_at', '>=', one_hour_ago_timestamp)\
-            .stream()
-        
-        calls_last_hour = len(list(recent_calls))
-        
-        if calls_last_hour >= MAX_CALLS_PER_NUMBER_PER_HOUR:
-            logging.warning(f"Rate limit exceeded for {customer_number}: {calls_last_hour} calls in 1 hour")
-            return False
-        
-        # Conta chiamate ultimo giorno
-        one_day_ago = datetime.now() - timedelta(days=1)
-        one_day_ago_timestamp = Timestamp.from_datetime(one_day_ago)
-        
-        daily_calls = db.collection('calls')\
-            .where('customer_number', '==', customer_number)\
-            .where('started_at', '>=', one_day_ago_timestamp)\
-            .stream()
-        
-        calls_last_day = len(list(daily_calls))
-        
-        if calls_last_day >= MAX_CALLS_PER_NUMBER_PER_DAY:
-            logging.warning(f"Daily rate limit exceeded for {customer_number}: {calls_last_day} calls in 24h")
+    Esegue fn(*args) nel pool del lavoro differito senza attenderlo: la
+    risposta parte subito, gli errori vengono solo loggati.
+    """
+    def _run():
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.error(f"Error in deferred {what}: {e}")
+
+    return _track(_executor('deferred', DEFERRED_WORKERS).submit(_run))
+
+
+def _track(future):
+    with _executors_lock:
+        _deferred.add(future)
+    future.add_done_callback(_deferred_done)
+    return future
+
+
+def _deferred_done(future):
+    with _executors_lock:
+        _deferred.discard(future)
+
+
+def drain_deferred(timeout=None):
+    """
+    Attende il lavoro in background (differito e controlli oltre il budget),
+    compreso quello avviato nel frattempo. Per shutdown e benchmark.
+    Returns True se tutto completato entro `timeout`.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _executors_lock:
+            pending = list(_deferred)
+        if not pending:
+            return True
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if futures.wait(pending, remaining).not_done:
             return False
-        
-        return True
-        
+
+
+def run_within(deadline, fn, *args):
+    """
+    fn(*args) nel pool di avvio chiamata, atteso fino a `deadline`
+    (monotonic). Ritorna None se non finisce in tempo: il lavoro prosegue
+    in background.
+    """
+    future = _track(_executor('call-start', CALL_START_WORKERS).submit(contextvars.copy_context().run, fn, *args))
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except futures.TimeoutError:
+        return None
+
+
+def _submit_rpc(fn, *args):
+    return _track(_executor('rpc', RPC_WORKERS).submit(contextvars.copy_context().run, fn, *args))
+
+
+def get_tenant_context(assistant_id):
+    """
+    Contesto tenant (user, order, numero Twilio, zone) da assistant_id.
+    Servito dalla cache in-process; None se assistant sconosciuto.
+    """
+    try:
+        return _tenant_cache.get(assistant_id)
     except Exception as e:
-        logging.error(f"Error checking rate limit: {e}")
-        # In caso di errore, permetti chiamata (fail-open per non bloccare clienti)
-        return True
+        logging.error(f"Error getting tenant context for assistant {assistant_id}: {e}")
+        return None
 
 
 def get_user_id_from_assistant(assistant_id):
@@ -129,71 +229,36 @@ def get_user_id_from_assistant(assistant_id):
     Ottieni user_id da assistant_id con caching per performance.
     Returns user_id, order_id tuple o (None, None) se non trovato.
     """
-    if not assistant_id:
+    tenant = get_tenant_context(assistant_id)
+    if tenant is None:
         return None, None
-    
-    # Check cache
-    now = datetime.now()
-    if assistant_id in _assistant_cache:
-        cached_data, cached_time = _assistant_cache[assistant_id]
-        if now - cached_time < _cache_ttl:
-            logging.debug(f"Cache hit for assistant {assistant_id}")
-            return cached_data['user_id'], cached_data.get('order_id')
-    
-    # Query Firestore
-    try:
-        orders = db.collection('orders').where('vapi_assistant_id', '==', assistant_id).limit(1).stream()
-        for order in orders:
-            order_data = order.to_dict()
-            user_id = order_data.get('user_id')
-            order_id = order.id
-            if user_id:
-                # Update cache
-                _assistant_cache[assistant_id] = {
-                    'user_id': user_id,
-                    'order_id': order_id
-                }, now
-                logging.debug(f"Cached assistant {assistant_id} -> user {user_id}")
-                return user_id, order_id
-    except Exception as e:
-        logging.error(f"Error getting user_id from assistant: {e}")
-    
-    return None, None
+    return tenant.user_id, tenant.order_id
 
 
-def get_agent_for_zone(zona, user_id):
+def get_agent_for_zone(zona, tenant):
     """
-    Trova l'agente assegnato a una specifica zona per un utente specifico.
-    Legge da Firestore le zone_assignments configurate dall'utente.
+    Trova l'agente assegnato a una specifica zona per un tenant specifico.
+    Usa l'indice zone del contesto tenant in cache (nessuna read): alias,
+    abbreviazioni e refusi vengono risolti da zone_resolver.
     Ritorna WhatsApp dell'agente o default.
     """
     try:
-        if not zona or zona == 'Non specificato' or not user_id:
-            # Nessuna zona o user_id -> usa default
-            return None
-        
-        # Normalizza zona per matching
-        zone_normalized = normalize_zone_name(zona)
-        
-        # Query Firestore per zone assignments usando user_id dinamico
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            logging.warning(f"User profile not found for {user_id}, using default WhatsApp")
+        if not zona or zona == 'Non specificato' or tenant is None:
+            # Nessuna zona o tenant -> usa default
             return None
         
-        user_data = user_doc.to_dict()
-        zone_assignments = user_data.get('zone_assignments', {})
+        # Risolve il testo libero sull'id zona del tenant
+        zone_id = tenant.zone_index.resolve(zona)
         
         # Check se zona ha agente assegnato
-        if zone_normalized in zone_assignments:
-            agent_whatsapp = zone_assignments[zone_normalized].get('whatsapp')
-            logging.info(f"Zona '{zona}' assegnata a {agent_whatsapp} per user {user_id}")
+        if zone_id is not None:
+            # 'whatsapp' può essere una lista (più agenti): il primo è il destinatario principale
+            agent_whatsapp = next(iter(number_list(tenant.zone_assignments[zone_id].get('whatsapp'))), None)
+            logging.info(f"Zona '{zona}' -> '{zone_id}' assegnata a {agent_whatsapp} per user {tenant.user_id}")
             return f"whatsapp:{agent_whatsapp}" if agent_whatsapp else None
         
         # Fallback: nessuna assegnazione specifica
-        logging.info(f"Zona '{zona}' non assegnata per user {user_id}, uso default")
+        logging.info(f"Zona '{zona}' non assegnata per user {tenant.user_id}, uso default")
         return None
         
     except Exception as e:
@@ -201,109 +266,195 @@ def get_agent_for_zone(zona, user_id):
         return None
 
 
-def update_monthly_call_count(user_id):
+def get_notification_cc(zona, tenant, destination):
     """
-    Aggiorna contatore chiamate mensili per user e verifica overage.
+    Destinatari in copia del lead (fan-out): altri agenti della zona
+    ('whatsapp' come lista), 'cc' della zona e notification_cc del tenant.
+    Esclude il destinatario principale. Lista vuota se non configurati.
     """
+    if tenant is None:
+        return []
     try:
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            logging.warning(f"User {user_id} not found for call count update")
-            return
-        
-        user_data = user_doc.to_dict()
-        current_month_start = user_data.get('current_month_start')
-        
-        # Se è nuovo mese, resetta contatore
-        now = datetime.now()
-        month_start = datetime(now.year, now.month, 1)
-        
-        # Converti Firestore Timestamp a datetime se necessario
-        if current_month_start:
-            if hasattr(current_month_start, 'to_datetime'):
-                current_month_start_dt = current_month_start.to_datetime()
-            elif isinstance(current_month_start, datetime):
-                current_month_start_dt = current_month_start
-            else:
-                current_month_start_dt = month_start  # Fallback
+        cc = []
+        if zona and zona != 'Non specificato':
+            zone_id = tenant.zone_index.resolve(zona)  # Memoizzato: nessun costo dopo get_agent_for_zone
+            if zone_id is not None:
+                assignment = tenant.zone_assignments[zone_id]
+                numbers = number_list(assignment.get('whatsapp'))[1:] + number_list(assignment.get('cc'))
+                cc.extend(format_whatsapp_number(n) for n in numbers)
+        cc.extend(tenant.notification_cc)
+        return [d for d in dict.fromkeys(cc) if d != destination]
+    except Exception as e:
+        logging.error(f"Error getting notification CC: {e}")
+        return []
+
+
+def _to_naive_utc(value):
+    """Firestore ritorna datetime UTC timezone-aware: normalizza a naive UTC"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _monthly_call_update(user_data, now):
+    """
+    Calcola il nuovo contatore mensile (reset se nuovo mese).
+    Returns (update_data, monthly_calls)
+    """
+    from google.cloud import firestore
+    
+    current_month_start = user_data.get('current_month_start')
+    month_start = datetime(now.year, now.month, 1)
+    
+    # Converti Firestore Timestamp a datetime se necessario
+    if current_month_start:
+        if hasattr(current_month_start, 'to_datetime'):
+            current_month_start_dt = current_month_start.to_datetime()
+        elif isinstance(current_month_start, datetime):
+            current_month_start_dt = current_month_start
         else:
-            current_month_start_dt = month_start
-        
-        update_data = {}
-        
-        if current_month_start_dt < month_start:
-            # Nuovo mese - resetta
-            update_data['monthly_calls'] = 1
-            update_data['current_month_start'] = firestore.SERVER_TIMESTAMP
-            logging.info(f"New month detected for {user_id}, resetting call count")
+            current_month_start_dt = month_start  # Fallback
+    else:
+        current_month_start_dt = month_start
+    
+    if _to_naive_utc(current_month_start_dt) < month_start:
+        # Nuovo mese - resetta
+        return {
+            'monthly_calls': 1,
+            'current_month_start': firestore.SERVER_TIMESTAMP
+        }, 1
+    
+    # Stesso mese - incrementa (valore letto nella stessa transazione)
+    monthly_calls = (user_data.get('monthly_calls') or 0) + 1
+    return {'monthly_calls': monthly_calls}, monthly_calls
+
+
+def record_completed_call(call_id, call_data, user_id, duration, transcript='', profile=None, notified=True):
+    """
+    Salva la chiamata conclusa, aggiorna il contatore mensile dello user, i
+    rollup di utilizzo e analytics e il profilo del chiamante (`profile`
+    già letto, vedi caller_profiles) in UNA transazione (read user + commit).
+    Il transcript va compresso nella subcollection `transcript` (vedi
+    transcript_store): il documento della chiamata resta compatto.
+    Corretto anche con chiamate concorrenti dello stesso tenant: in caso di
+    conflitto Firestore ritenta la transazione (anche sul reset mensile).
+    
+    Returns:
+        dict con monthly_calls, monthly_calls_limit, subscription_plan
+        (None se user assente)
+    """
+    from google.cloud import firestore
+    
+    db = get_firestore()
+    call_ref = db.collection('calls').document(call_id)
+    user_ref = db.collection('users').document(user_id) if user_id else None
+    transaction = db.transaction()
+    
+    # Compressione fuori dalla transazione (non va ripetuta sui retry)
+    chunks = compress_transcript(transcript) if transcript else None
+    
+    @firestore.transactional
+    def _run(transaction):
+        user_doc = None
+        if user_ref is not None:
+            user_doc = user_ref.get(transaction=transaction)
+            telemetry.count('firestore_rpc', op='read')
+        return write_completed_call(db, transaction, call_ref, user_ref, user_doc, call_data,
+                                    user_id, duration, transcript, chunks, profile, notified)
+    
+    usage = _run(transaction)
+    telemetry.count('firestore_rpc', op='commit')
+    bump_cached_usage(duration, month_key(call_data['started_at']))
+    if profile is not None:
+        _caller_profiles.remember(profile.after_call(call_id, call_data.get('client_info'), notified))
+    return usage
+
+
+def write_completed_call(db, transaction, call_ref, user_ref, user_doc, call_data, user_id, duration,
+                         transcript, chunks, profile=None, notified=True):
+    """
+    Accoda in transazione le scritture di fine chiamata, dato lo user già
+    letto nella stessa transazione (user_doc None se la chiamata non ha
+    tenant). Condivisa con il percorso asyncio. Returns usage come
+    record_completed_call.
+    """
+    usage = None
+    if user_doc is not None:
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            update_data, monthly_calls = _monthly_call_update(user_data, datetime.now())
+            transaction.update(user_ref, update_data)
+            usage = {
+                'monthly_calls': monthly_calls,
+                'monthly_calls_limit': user_data.get('monthly_calls_limit', 0),
+                'subscription_plan': user_data.get('subscription_plan'),
+            }
         else:
-            # Stesso mese - incrementa
-            update_data['monthly_calls'] = firestore.Increment(1)
-        
-        user_ref.update(update_data)
-        
-        # Verifica overage dopo update
-        user_doc = user_ref.get()
-        user_data = user_doc.to_dict()
-        monthly_calls = user_data.get('monthly_calls', 0)
-        monthly_limit = user_data.get('monthly_calls_limit', 0)
-        plan_id = user_data.get('subscription_plan')
-        
-        if monthly_calls > monthly_limit and plan_id and monthly_limit > 0:
-            overage_calls = monthly_calls - monthly_limit
-            logging.warning(
-                f"User {user_id} exceeded limit: {monthly_calls}/{monthly_limit} "
-                f"(+{overage_calls} overage calls)"
-            )
-            # TODO: Creare Stripe invoice item per overage (una volta al mese)
-            # Questo richiede integrazione con Stripe API
-        
-    except Exception as e:
-        logging.error(f"Error updating monthly call count for {user_id}: {e}")
+            logging.warning(f"User {user_id} not found for call count update")
+    
+    call_doc = dict(call_data)
+    call_doc.update(write_transcript(db, transaction, call_ref.id, transcript, chunks))
+    transaction.set(call_ref, call_doc, merge=True)
+    # Stessa chiave dei rebuild (mese/giorno di started_at), non la data di fine
+    started_at = call_data['started_at']
+    record_call_usage(db, duration, user_id, when=started_at, writer=transaction)
+    record_lead_analytics(db, call_data, user_id, duration, when=started_at, writer=transaction)
+    if profile is not None:
+        record_caller_profile(db, transaction, profile, call_ref.id, call_data.get('client_info'), notified)
+    return usage
+
+
+def check_overage(user_id, usage):
+    """
+    Verifica overage sui valori ritornati da record_completed_call
+    (nessuna read-after-write).
+    """
+    monthly_calls = usage.get('monthly_calls', 0)
+    monthly_limit = usage.get('monthly_calls_limit', 0) or 0
+    plan_id = usage.get('subscription_plan')
+    
+    if monthly_calls > monthly_limit and plan_id and monthly_limit > 0:
+        overage_calls = monthly_calls - monthly_limit
+        logging.warning(
+            f"User {user_id} exceeded limit: {monthly_calls}/{monthly_limit} "
+            f"(+{overage_calls} overage calls)"
+        )
+        # TODO: Creare Stripe invoice item per overage (una volta al mese)
+        # Questo richiede integrazione con Stripe API
 
 
 def check_cost_alerts():
     """
     Monitora costi e invia alert se anomalie.
-    Conta chiamate mese corrente e stima costi.
+    Usa il rollup mensile aggiornato a fine chiamata (vedi usage_rollup).
     """
     try:
-        # Conta chiamate mese corrente
-        now = datetime.now()
-        month_start = datetime(now.year, now.month, 1)
-        month_start_timestamp = Timestamp.from_datetime(month_start)
-        
-        monthly_calls = db.collection('calls')\
-            .where('started_at', '>=', month_start_timestamp)\
-            .stream()
-        
-        total_calls = 0
-        total_duration = 0
-        
-        for call in monthly_calls:
-            call_data = call.to_dict()
-            total_calls += 1
-            total_duration += call_data.get('duration', 0)
-        
-        # Stima costi (€0.06/minuto media con Vapi)
-        estimated_cost = (total_duration / 60) * 0.06
-        
-        logging.info(f"Monthly stats: {total_calls} calls, {total_duration}s total, ~€{estimated_cost:.2f}")
-        
-        # Alert se supera soglia
-        if estimated_cost > COST_ALERT_THRESHOLD:
-            logging.warning(f"⚠️ COST ALERT: Monthly costs at €{estimated_cost:.2f} (threshold: €{COST_ALERT_THRESHOLD})")
-            # TODO: Invia email/WhatsApp alert all'owner
-        
-        return estimated_cost
+        # Legge il rollup mensile materializzato (1 read, con cache) invece
+        # di scansionare tutte le chiamate del mese
+        with telemetry.span('cost_check'):
+            return cost_alert(get_monthly_usage(get_firestore()))
         
     except Exception as e:
         logging.error(f"Error checking costs: {e}")
         return 0
 
 
+def cost_alert(usage):
+    """Logga le statistiche del mese e l'alert se i costi superano la soglia"""
+    total_calls = usage['call_count']
+    total_duration = usage['total_duration']
+    estimated_cost = usage['estimated_cost']
+    
+    logging.info(f"Monthly stats: {total_calls} calls, {total_duration}s total, ~€{estimated_cost:.2f}")
+    
+    # Alert se supera soglia
+    if estimated_cost > COST_ALERT_THRESHOLD:
+        logging.warning(f"⚠️ COST ALERT: Monthly costs at €{estimated_cost:.2f} (threshold: €{COST_ALERT_THRESHOLD})")
+        # TODO: Invia email/WhatsApp alert all'owner
+    
+    return estimated_cost
+
+
 @functions_framework.http
 def vapi_webhook(request):
     """
@@ -318,31 +469,44 @@ def vapi_webhook(request):
     - assistant-request: Inizio chiamata
     - end-of-call-report: Fine chiamata con dati estratti
     - function-call: (opzionale) chiamate a funzioni custom
+    
+    I retry Vapi dello stesso evento ricevono la risposta originale
+    senza side effect (vedi idempotency.py).
     """
+    with telemetry.request_trace():
+        return _process_webhook(request)
+
+
+def _process_webhook(request):
+    # Body letto una sola volta: firma e decode sugli stessi bytes
+    body = request.get_data()
     
     # PROTEZIONE 1: Verifica firma Vapi
-    if not verify_vapi_signature(request):
+    with telemetry.span('verify_signature'):
+        signature_ok = verify_signature(request.headers.get('x-vapi-signature', ''), body)
+    if not signature_ok:
         logging.warning("Invalid Vapi signature - possible attack")
         return {'error': 'Unauthorized'}, 401
     
-    # Parse evento
+    # Parse evento (vedi events.py)
     try:
-        event_data = request.get_json()
-        event_type = event_data.get('message', {}).get('type', '')
+        with telemetry.span('decode'):
+            event = decode_event(body)
+        telemetry.annotate(event_type=event.type)
         
-        logging.info(f"Received Vapi event: {event_type}")
+        logging.info(f"Received Vapi event: {event.type}")
         
-        if event_type == 'assistant-request':
-            return handle_assistant_request(event_data)
+        if event.type == ASSISTANT_REQUEST:
+            return _idempotency.run(event.call_id, event.type, lambda: handle_assistant_request(event))
         
-        elif event_type == 'end-of-call-report':
-            return handle_end_of_call(event_data)
+        elif event.type == END_OF_CALL_REPORT:
+            return _idempotency.run(event.call_id, event.type, lambda: handle_end_of_call(event))
         
-        elif event_type == 'function-call':
-            return handle_function_call(event_data)
+        elif event.type == FUNCTION_CALL:
+            return handle_function_call(event)
         
         else:
-            logging.info(f"Unhandled event type: {event_type}")
+            logging.info(f"Unhandled event type: {event.type}")
             return {'status': 'ok'}
             
     except Exception as e:
@@ -350,85 +514,155 @@ def vapi_webhook(request):
         return {'error': str(e)}, 500
 
 
-def handle_assistant_request(event_data):
+# Risposte assistant-request (condivise con vapi_webhook_async)
+RATE_LIMITED_RESPONSE = {
+    'error': {
+        'message': 'Hai chiamato troppo frequentemente. Riprova più tardi.',
+        'endCall': True
+    }
+}
+
+ASSISTANT_RESPONSE = {
+    'assistant': {
+        'firstMessage': "Buongiorno! Sono l'assistente virtuale di Iconacasa Milano. Come posso aiutarla oggi?"
+    }
+}
+
+
+def call_start_data(call_id, customer_number, user_id, order_id, assistant_id):
+    """Documento `calls/{call_id}` all'inizio della chiamata"""
+    from google.cloud import firestore
+    
+    call_data = {
+        'call_id': call_id,
+        'customer_number': customer_number,
+        'started_at': firestore.SERVER_TIMESTAMP,
+        'status': 'in_progress'
+    }
+    if user_id:
+        call_data['user_id'] = user_id
+    if order_id:
+        call_data['order_id'] = order_id
+    if assistant_id:
+        call_data['assistant_id'] = assistant_id
+    return call_data
+
+
+def late_start_fields(call_data):
     """
-    Gestisce richiesta iniziale dell'assistente.
-    INCLUDE rate limiting per protezione spam.
+    Campi di call_start_data da aggiungere a una chiamata che
+    end-of-call-report ha già salvato: niente status (resta 'completed') né
+    started_at (rollup e analytics sono già stati contati su quello, vedi
+    call_started_at). Condivisa con il percorso asyncio.
     """
-    message = event_data.get('message', {})
-    call = message.get('call', {})
-    call_id = call.get('id', '')
-    customer_number = call.get('customer', {}).get('number', '')
-    assistant_id = call.get('assistantId') or message.get('assistantId') or event_data.get('assistantId', '')
-    
-    logging.info(f"New call started: {call_id} from {customer_number}, assistant: {assistant_id}")
-    
-    # PROTEZIONE 2: Rate limiting per numero
-    if not check_rate_limit(customer_number):
-        logging.warning(f"Rate limit exceeded for {customer_number}, rejecting call")
-        return {
-            'error': {
-                'message': 'Hai chiamato troppo frequentemente. Riprova più tardi.',
-                'endCall': True
-            }
-        }
-    
-    check_cost_alerts()
-    
-    # Trova order associato tramite assistant_id (con caching)
-    user_id, order_id = get_user_id_from_assistant(assistant_id)
-    
-    # Salva inizio chiamata in Firestore
+    return {key: value for key, value in call_data.items() if key not in ('status', 'started_at')}
+
+
+def save_call_start(call_id, customer_number, user_id, order_id, assistant_id):
+    """
+    Documento di inizio chiamata. create, non set: se end-of-call-report
+    ha già salvato la chiamata (assistant-request oltre il budget, retry)
+    vengono aggiunti solo i campi di late_start_fields.
+    """
+    from google.api_core import exceptions
+
+    call_data = call_start_data(call_id, customer_number, user_id, order_id, assistant_id)
+    call_ref = get_firestore().collection('calls').document(call_id)
     try:
-        call_data = {
-            'call_id': call_id,
-            'customer_number': customer_number,
-            'started_at': firestore.SERVER_TIMESTAMP,
-            'status': 'in_progress'
-        }
-        if user_id:
-            call_data['user_id'] = user_id
-        if order_id:
-            call_data['order_id'] = order_id
-        if assistant_id:
-            call_data['assistant_id'] = assistant_id
-            
-        db.collection('calls').document(call_id).set(call_data)
+        try:
+            call_ref.create(call_data)
+        except exceptions.AlreadyExists:
+            logging.info(f"Call {call_id} already saved, adding start fields only")
+            call_ref.set(late_start_fields(call_data), merge=True)
+        telemetry.count('firestore_rpc', op='write')
     except Exception as e:
         logging.error(f"Error saving call start: {e}")
-    
-    # Ritorna configurazione assistente (opzionale - può sovrascrivere default)
-    return {
-        'assistant': {
-            'firstMessage': "Buongiorno! Sono l'assistente virtuale di Iconacasa Milano. Come posso aiutarla oggi?"
-        }
-    }
 
 
-def handle_end_of_call(event_data):
+def _write_rate_limit(write, customer_number):
+    try:
+        write()
+    except Exception as e:
+        logging.error(f"Error saving rate limit for {customer_number}: {e}")
+
+
+def start_call(call_id, customer_number, assistant_id):
     """
-    Gestisce fine chiamata e dati estratti.
-    Questo è dove processiamo lo structured output e inviamo notifiche.
+    Rate limit e registrazione della chiamata, con le RPC indipendenti in
+    parallelo: decisione rate limit | tenant, poi bucket rate limit |
+    documento di inizio chiamata. Entrambe le scritture sono completate
+    quando ritorna (servono al rate limit tra istanze e a started_at).
+    Il rate limit blocca SOLO lo stesso numero che chiama troppo spesso
+    (protezione spam), non le chiamate totali.
+
+    Returns:
+        bool: True se la chiamata è ammessa, False se rate limit superato
     """
-    message = event_data.get('message', {})
-    call = message.get('call', {})
+    # Trova order associato tramite assistant_id (con caching), intanto decide il rate limit
+    tenant = _submit_rpc(get_user_id_from_assistant, assistant_id)
+    try:
+        ok, write = _rate_limiter.check_and_record_deferred(customer_number)
+    except Exception as e:
+        logging.error(f"Error checking rate limit: {e}")
+        ok, write = True, None  # Fail-open: un errore non blocca i clienti
+    if not ok:
+        return False
+
+    bucket = _submit_rpc(_write_rate_limit, write, customer_number) if write is not None else None
+    with telemetry.span('persistence'):
+        user_id, order_id = tenant.result()
+        save_call_start(call_id, customer_number, user_id, order_id, assistant_id)
+        if bucket is not None:
+            bucket.result()
+    return True
+
+
+def handle_assistant_request(event):
+    """
+    Gestisce richiesta iniziale dell'assistente (events.AssistantRequest).
+    INCLUDE rate limiting per protezione spam.
     
-    call_id = call.get('id', '')
-    customer_number = call.get('customer', {}).get('number', '')
-    duration = call.get('duration', 0)
-    ended_reason = call.get('endedReason', 'unknown')
+    Il primo saluto aspetta questa risposta: start_call (rate limit,
+    bucket e documento di inizio chiamata, RPC in parallelo) viene atteso
+    entro ASSISTANT_REQUEST_BUDGET_MS. Dopo la risposta gira solo il
+    controllo costi (solo log/alert): su Cloud Functions la CPU viene
+    limitata a risposta inviata e il lavoro in background può slittare o
+    perdersi. Budget esaurito: firstMessage di default, fail-open come per
+    gli errori del rate limit; start_call prosegue in background (best
+    effort, end-of-call-report salva comunque started_at).
+    """
+    deadline = time.monotonic() + ASSISTANT_REQUEST_BUDGET_MS / 1000
+    call_id = event.call_id
+    customer_number = event.customer_number
+    assistant_id = event.assistant_id
     
-    # Estrai dati strutturati (structured output configurato in Vapi)
-    structured_data = message.get('structuredData', {})
+    logging.info(f"New call started: {call_id} from {customer_number}, assistant: {assistant_id}")
     
-    # Estrai trascrizione completa
-    transcript = message.get('transcript', '')
+    # Solo log/alert, non serve alla risposta: può finire dopo
+    run_deferred(check_cost_alerts, what='cost check')
     
-    logging.info(f"Call ended: {call_id}, duration: {duration}s, reason: {ended_reason}")
-    logging.info(f"Structured data: {structured_data}")
+    # PROTEZIONE 2: Rate limiting per numero (+ registrazione chiamata)
+    with telemetry.span('rate_limit'):
+        rate_limit_ok = run_within(deadline, start_call, call_id, customer_number, assistant_id)
+    if rate_limit_ok is None:
+        logging.warning(f"Assistant request budget ({ASSISTANT_REQUEST_BUDGET_MS} ms) exhausted for call "
+                        f"{call_id}, answering with default firstMessage")
+        telemetry.count('assistant_request', result='deadline_fallback')
+        return ASSISTANT_RESPONSE
+    if not rate_limit_ok:
+        logging.warning(f"Rate limit exceeded for {customer_number}, rejecting call")
+        return RATE_LIMITED_RESPONSE
     
-    # Prepara client_info per notifica WhatsApp
-    client_info = {
+    # Ritorna configurazione assistente (opzionale - può sovrascrivere default)
+    return ASSISTANT_RESPONSE
+
+
+def build_client_info(structured_data, customer_number):
+    """
+    client_info del lead dallo structured output Vapi.
+    Usata anche da backfill.py per ricalcolare le chiamate storiche.
+    """
+    return {
         'nome': structured_data.get('nome', '') or 'Non specificato',
         'telefono': structured_data.get('telefono', '') or customer_number,
         'tipo_richiesta': structured_data.get('tipo_richiesta', '') or 'Non specificato',
@@ -437,89 +671,295 @@ def handle_end_of_call(event_data):
         'budget': structured_data.get('budget', '') or 'Non specificato',
         'note': structured_data.get('note', '') or ''
     }
-    
-    # Trova order associato tramite assistant_id (con caching)
-    assistant_id = call.get('assistantId') or message.get('assistantId') or event_data.get('assistantId', '')
-    user_id, order_id = get_user_id_from_assistant(assistant_id)
-    
-    # ROUTING INTELLIGENTE: trova agente giusto per zona (usa user_id dinamico)
-    destination_whatsapp = get_agent_for_zone(client_info['zona'], user_id)
-    logging.info(f"Routing chiamata zona '{client_info['zona']}' a: {destination_whatsapp} (user: {user_id})")
-    
-    # Salva chiamata completa in Firestore
-    try:
-        call_data = {
-            'call_id': call_id,
-            'customer_number': customer_number,
+
+
+def call_started_at(event):
+    """
+    started_at salvato a fine chiamata: startedAt di Vapi, altrimenti
+    adesso meno la durata. Rollup e analytics incrementali usano questo
+    valore, i rebuild lo rileggono da `calls`: stesso mese/giorno.
+    """
+    return event.started_at or datetime.now(timezone.utc) - timedelta(seconds=event.duration or 0)
+
+
+class CompletedCall:
+    """
+    Fine chiamata già elaborata (routing, caratteristiche lead, documento
+    da salvare): tutto ciò che non fa I/O, condiviso tra percorso sincrono
+    e asyncio.
+    """
+    __slots__ = ('call_id', 'customer_number', 'duration', 'transcript', 'client_info', 'tenant',
+                 'destination', 'cc', 'lead', 'call_data', 'profile', 'notify_info', 'duplicate')
+
+    def __init__(self, event, tenant, profile=None):
+        self.call_id = event.call_id
+        self.customer_number = event.customer_number
+        self.duration = event.duration
+        ended_reason = event.ended_reason
+        self.tenant = tenant
+        
+        # Dati strutturati (structured output configurato in Vapi)
+        structured_data = event.structured_data
+        
+        # Trascrizione completa
+        self.transcript = event.transcript
+        
+        logging.info(f"Call ended: {self.call_id}, duration: {self.duration}s, reason: {ended_reason}")
+        logging.info(f"Structured data: {structured_data}")
+        
+        # Prepara client_info per notifica WhatsApp
+        client_info = self.client_info = build_client_info(structured_data, self.customer_number)
+        
+        # ROUTING INTELLIGENTE: trova agente giusto per zona (zone del tenant in cache)
+        with telemetry.span('zone_routing'):
+            self.destination = get_agent_for_zone(client_info['zona'], tenant)
+            self.cc = get_notification_cc(client_info['zona'], tenant, self.destination)
+        logging.info(f"Routing chiamata zona '{client_info['zona']}' a: {self.destination} (user: {self.user_id})")
+        
+        # Caratteristiche richieste + urgenza: un solo passaggio su note e transcript
+        with telemetry.span('lead_features'):
+            if tenant is not None:
+                self.lead = tenant.lead_extractor.extract(client_info['note'], self.transcript)
+            else:
+                self.lead = extract_lead_features(client_info['note'], self.transcript)
+        
+        from google.cloud import firestore
+        
+        call_data = self.call_data = {
+            'call_id': self.call_id,
+            'customer_number': self.customer_number,
             'client_info': client_info,
             'structured_data': structured_data,
-            'transcript': transcript,
-            'duration': duration,
+            'lead_features': self.lead.to_dict(),
+            'duration': self.duration,
             'ended_reason': ended_reason,
+            'started_at': call_started_at(event),
             'ended_at': firestore.SERVER_TIMESTAMP,
             'status': 'completed'
         }
-        if user_id:
-            call_data['user_id'] = user_id
-        if order_id:
-            call_data['order_id'] = order_id
-        if assistant_id:
-            call_data['assistant_id'] = assistant_id
-            
-        db.collection('calls').document(call_id).set(call_data, merge=True)
-        
-        logging.info(f"Call data saved to Firestore: {call_id}")
-        
-        # Aggiorna contatore chiamate mensili per user (se presente)
-        if user_id:
-            update_monthly_call_count(user_id)
-        
-    except Exception as e:
-        logging.error(f"Error saving call data: {e}")
+        if self.user_id:
+            call_data['user_id'] = self.user_id
+        if self.order_id:
+            call_data['order_id'] = self.order_id
+        if event.assistant_id:
+            call_data['assistant_id'] = event.assistant_id
+        if self.destination:
+            call_data['assigned_agent'] = self.destination
+        
+        # Chiamante già noto (caller_profiles): lead completato con i dati delle
+        # chiamate precedenti, richiamate senza novità non rinotificate
+        self.profile = profile
+        self.notify_info = client_info
+        self.duplicate = False
+        if profile is not None:
+            call_data['caller_call_count'] = profile.call_count + 1
+            self.notify_info = profile.enrich(client_info)
+            self.duplicate = tenant is not None and not self.lead.urgent and \
+                profile.is_near_duplicate(client_info, tenant.duplicate_window)
+    
+    @property
+    def user_id(self):
+        return self.tenant.user_id if self.tenant else None
+    
+    @property
+    def order_id(self):
+        return self.tenant.order_id if self.tenant else None
+    
+    @property
+    def should_notify(self):
+        """Notifica WhatsApp solo se abbiamo almeno il nome o numero"""
+        return self.notify_info['nome'] != 'Non specificato' or self.notify_info['telefono'] != self.customer_number
     
-    # Invia notifica WhatsApp solo se abbiamo almeno il nome o numero
-    if client_info['nome'] != 'Non specificato' or client_info['telefono'] != customer_number:
+    @property
+    def notified(self):
+        """L'agente riceve un lead per questa chiamata (last_notified_at del profilo)"""
+        return self.should_notify and not self.duplicate
+    
+    def notify(self):
+        """Notifica del lead (bloccante: Twilio / outbox / digest). Fail-open."""
+        if not self.should_notify:
+            logging.warning(f"Skipping WhatsApp notification - insufficient data for call {self.call_id}")
+            return
+        if self.duplicate:
+            logging.info(f"Skipping WhatsApp notification - near-duplicate lead from {self.customer_number} "
+                         f"(call {self.call_id})")
+            telemetry.count('notification', result='duplicate_suppressed')
+            return
         try:
-            send_whatsapp_notification(
-                client_info, 
-                customer_number, 
-                transcript, 
-                call_id, 
-                duration,
-                destination_whatsapp,  # Agente specifico per zona
-                order_id  # Passa order_id per usare numero Twilio del cliente
-            )
-            logging.info(f"WhatsApp notification sent to {destination_whatsapp} for call {call_id}")
+            with telemetry.span('notification'):
+                _notify(self.call_id, self.notify_info, self.customer_number, self.transcript, self.duration,
+                        self.destination, self.order_id, self.tenant.from_number if self.tenant else None,
+                        self.lead, self.tenant, self.cc,
+                        self.profile.notification_info() if self.profile is not None else None)
         except Exception as e:
             logging.error(f"Error sending WhatsApp notification: {e}")
-    else:
-        logging.warning(f"Skipping WhatsApp notification - insufficient data for call {call_id}")
+
+
+def handle_end_of_call(event):
+    """
+    Gestisce fine chiamata e dati estratti (events.EndOfCallReport).
+    Questo è dove processiamo lo structured output e inviamo notifiche.
+    """
+    # Trova order associato tramite assistant_id (con caching)
+    with telemetry.span('tenant_lookup'):
+        tenant = get_tenant_context(event.assistant_id)
+    profile = lookup_profile(_caller_profiles, tenant, event.customer_number)
+    
+    completed = CompletedCall(event, tenant, profile)
+    
+    # Salva chiamata completa in Firestore
+    try:
+        # Chiamata + contatore mensile + rollup in un'unica transazione
+        with telemetry.span('persistence'):
+            usage = record_completed_call(completed.call_id, completed.call_data, completed.user_id,
+                                          completed.duration, completed.transcript, completed.profile,
+                                          completed.notified)
+    except Exception as e:
+        # Errore -> 500 e marker di idempotenza rilasciato: il retry di Vapi
+        # salva di nuovo invece di ricevere un successo in cache
+        logging.error(f"Error saving call data: {e}")
+        raise
+    finally:
+        # Il lead arriva comunque all'agente (al peggio due volte se il retry salva)
+        completed.notify()
+    
+    logging.info(f"Call data saved to Firestore: {completed.call_id}")
+    
+    if usage:
+        check_overage(completed.user_id, usage)
     
     return {'status': 'success'}
 
 
-def handle_function_call(event_data):
+def _notify(call_id, client_info, customer_number, transcript, duration,
+            destination_whatsapp, order_id, from_number, lead=None, tenant=None, cc=None, caller=None):
     """
-    Gestisce chiamate a funzioni custom (opzionale).
-    Può essere usato per integrazioni real-time durante la chiamata.
+    Invia (inline) o accoda (outbox) la notifica WhatsApp del lead, con
+    eventuali CC. `caller`: chiamante già noto (CallerProfile.notification_info)
+    """
+    digest = tenant.digest if tenant is not None else None
+    if digest is not None and not (lead is not None and lead.urgent):
+        if _digest_lead(call_id, client_info, customer_number, destination_whatsapp,
+                        from_number, lead, tenant, cc, caller):
+            return
+    
+    if NOTIFICATION_MODE == 'outbox':
+        # Accoda e rispondi subito: Twilio lo chiama il worker
+        enqueue_notification(
+            get_firestore(),
+            call_id,
+            client_info,
+            customer_number,
+            duration,
+            destination_whatsapp,
+            order_id,
+            from_number=from_number,
+            lead_features=lead,
+            cc=cc,
+            caller=caller
+        )
+        telemetry.count('firestore_rpc', op='write')
+        logging.info(f"WhatsApp notification queued for call {call_id}")
+    else:
+        send_whatsapp_notification(
+            client_info, 
+            customer_number, 
+            transcript, 
+            call_id, 
+            duration,
+            destination_whatsapp,  # Agente specifico per zona
+            order_id,  # Passa order_id per usare numero Twilio del cliente
+            from_number=from_number,  # Numero Twilio già risolto dal tenant context
+            lead_features=lead,  # Caratteristiche/urgenza già estratte
+            cc=cc,  # Altri agenti della zona / CC del tenant (fan-out concorrente)
+            caller=caller  # Richiamata: "3ª chiamata" nel messaggio
+        )
+        logging.info(f"WhatsApp notification sent to {destination_whatsapp} for call {call_id}")
+
+
+def _digest_lead(call_id, client_info, customer_number, destination_whatsapp, from_number, lead, tenant,
+                 cc=None, caller=None):
+    """
+    Modalità digest del tenant (vedi lead_digest). Ritorna True se il lead
+    è stato gestito (bufferizzato o inviato in un digest), False se va
+    notificato subito come messaggio singolo.
     """
-    message = event_data.get('message', {})
-    function_call = message.get('functionCall', {})
+    db = get_firestore()
+    destination = destination_whatsapp or os.environ.get('TWILIO_DESTINATION_WHATSAPP', 'whatsapp:+393394197445')
+    entry = lead_entry(call_id, client_info, customer_number, lead, time.time(),
+                       caller.get('call_count') if caller else None)
+    try:
+        action, leads = submit_lead(db, tenant.digest, tenant.user_id, destination, from_number, entry, cc=cc)
+    except Exception as e:
+        # Fail-open: in caso di errore il lead parte come messaggio singolo
+        logging.error(f"Error buffering lead {call_id} for digest: {e}")
+        return False
     
-    function_name = function_call.get('name', '')
-    parameters = function_call.get('parameters', {})
+    if action == BUFFERED:
+        logging.info(f"Lead {call_id} buffered for digest to {destination}")
+        return True
+    if action != DIGEST:
+        return False
+    
+    if NOTIFICATION_MODE == 'outbox':
+        # Twilio solo nel worker: il digest parte al prossimo flush
+        requeue(db, tenant.user_id, destination, leads, delay=0)
+        logging.info(f"Lead digest for {destination} ({len(leads)} leads) queued for worker")
+        return True
+    try:
+        send_whatsapp_digest(leads, destination, from_number, cc=cc)
+        logging.info(f"Lead digest sent to {destination}: {len(leads)} leads")
+    except Exception as e:
+        logging.error(f"Error sending lead digest to {destination}: {e}")
+        requeue(db, tenant.user_id, destination, leads)
+    return True
+
+
+def handle_function_call(event):
+    """
+    Gestisce chiamate a funzioni custom (events.FunctionCall, opzionale).
+    Può essere usato per integrazioni real-time durante la chiamata.
+    """
+    logging.info(f"Function call: {event.name} with params {event.parameters}")
     
-    logging.info(f"Function call: {function_name} with params {parameters}")
+    # Check disponibilità immobile in tempo reale (inventario in memoria)
+    if event.name == 'check_availability':
+        return check_availability(event.assistant_id, event.parameters)
     
-    # Esempio: check disponibilità immobile in tempo reale
-    if function_name == 'check_availability':
-        # Qui potresti fare query a database immobili
+    return {'result': 'Function not implemented'}
+
+
+def check_availability(assistant_id, parameters):
+    """
+    Cerca negli annunci del tenant e risponde con una frase breve da leggere
+    al chiamante. In caso di errore l'assistente non inventa disponibilità.
+    """
+    try:
+        with telemetry.span('tenant_lookup'):
+            tenant = get_tenant_context(assistant_id)
+        if tenant is None:
+            raise ValueError(f"unknown assistant {assistant_id}")
+
+        with telemetry.span('inventory'):
+            query = search_parameters(parameters)
+            result = _inventory_store.get(tenant.user_id).search(**query)
+
+        logging.info(f"check_availability for {tenant.user_id}: {result.total} matches for {query}")
         return {
             'result': {
-                'available': True,
-                'message': 'Abbiamo 3 appartamenti disponibili in quella zona'
+                'available': result.total > 0,
+                'count': result.total,
+                'message': format_availability(result),
+                'listings': [listing.to_dict() for listing in result.examples]
+            }
+        }
+    except Exception as e:
+        logging.error(f"Error checking availability: {e}")
+        return {
+            'result': {
+                'available': False,
+                'message': "In questo momento non riesco a verificare le disponibilità. "
+                           "Un agente la ricontatterà con le proposte adatte."
             }
         }
-    
-    return {'result': 'Function not implemented'}
 
@@ -0,0 +1,331 @@
+"""
+Variante asyncio del webhook Vapi (Firestore AsyncClient)
+
+Il percorso sincrono (vapi_webhook.py) esegue le RPC Firestore una dopo
+l'altra e occupa un thread per richiesta. Qui le RPC indipendenti partono
+insieme e una sola istanza serve molte richieste in volo sullo stesso
+event loop:
+
+assistant-request:   rate limit, atteso entro ASSISTANT_REQUEST_BUDGET_MS
+                     rollup costi | tenant + inizio chiamata | bucket rate
+                     limit in background, dopo la risposta
+end-of-call-report:  tenant (di norma in cache), profilo chiamante (idem)
+                     poi transazione chiamata + utilizzo | notifica lead
+
+Stessa logica e stesse cache in-process (tenant, rate limit, rollup,
+dedup eventi) del percorso sincrono: cambia solo l'I/O. Il lavoro
+bloccante (Twilio, outbox/digest, function-call sull'inventario) gira in
+un pool di thread limitato (ASYNC_BLOCKING_THREADS, default 16).
+
+Avvio come app ASGI (functions-framework >= 3.9):
+    functions-framework --source vapi_webhook_async.py --target vapi_webhook_async --asgi
+
+Non è esportato da main.py: functions_framework.aio (Starlette) costa
+~230 ms di import e peserebbe sul cold start del webhook sincrono.
+Regressioni: benchmarks/bench_async_webhook.py
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import functions_framework.aio
+
+import telemetry
+from caller_profiles import PROFILE_COLLECTION, normalize_number, profile_id
+from clients import get_async_firestore
+from events import ASSISTANT_REQUEST, END_OF_CALL_REPORT, FUNCTION_CALL, decode_event
+from tenant_cache import MISS, load_tenant_context_async
+from transcript_store import compress_transcript
+from usage_rollup import bump_cached_usage, get_monthly_usage_async, month_key
+from vapi_webhook import (
+    ASSISTANT_REQUEST_BUDGET_MS,
+    ASSISTANT_RESPONSE,
+    RATE_LIMITED_RESPONSE,
+    CompletedCall,
+    _caller_profiles,
+    _idempotency,
+    _rate_limiter,
+    _tenant_cache,
+    call_start_data,
+    check_overage,
+    cost_alert,
+    handle_function_call,
+    late_start_fields,
+    verify_signature,
+    write_completed_call,
+)
+
+BLOCKING_THREADS = int(os.environ.get('ASYNC_BLOCKING_THREADS', '16'))
+
+_blocking = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix='webhook-blocking')
+
+# Caricamenti tenant in corso (single-flight sull'event loop)
+_tenant_loads = {}
+
+# Task in background (controllo costi, avvio chiamata oltre il budget):
+# riferimenti tenuti finché non finiscono, altrimenti il garbage collector
+# li cancella
+_background = set()
+
+
+async def run_blocking(fn, *args):
+    """Esegue fn nel pool bloccante, con la trace telemetry della richiesta"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_blocking, context.run, fn, *args)
+
+
+async def get_tenant_context_async(db, assistant_id):
+    """
+    Contesto tenant dalla cache condivisa con il percorso sincrono; al
+    miss UN caricamento per assistant, atteso da tutte le richieste.
+    """
+    if not assistant_id:
+        return None
+    try:
+        cached = _tenant_cache.peek(assistant_id)
+        if cached is not MISS:
+            return cached
+        task = _tenant_loads.get(assistant_id)
+        if task is None:
+            task = _tenant_loads[assistant_id] = asyncio.ensure_future(load_tenant_context_async(db, assistant_id))
+            task.add_done_callback(lambda done: _tenant_loaded(assistant_id, done))
+        return await asyncio.shield(task)
+    except Exception as e:
+        logging.error(f"Error getting tenant context for assistant {assistant_id}: {e}")
+        return None
+
+
+def _tenant_loaded(assistant_id, task):
+    _tenant_loads.pop(assistant_id, None)
+    # Errori non vengono cachati: la prossima richiesta ritenta
+    if not task.cancelled() and task.exception() is None:
+        _tenant_cache.put(task.result(), assistant_id)
+
+
+async def check_rate_limit_async(db, customer_number):
+    """Rate limit per numero. Returns (ok, scrittura bucket da attendere o None)"""
+    try:
+        return await _rate_limiter.check_and_record_async(db, customer_number)
+    except Exception as e:
+        logging.error(f"Error checking rate limit: {e}")
+        return True, None  # Fail-open come il percorso sincrono
+
+
+async def check_cost_alerts_async(db):
+    try:
+        return cost_alert(await get_monthly_usage_async(db))
+    except Exception as e:
+        logging.error(f"Error checking costs: {e}")
+        return 0
+
+
+async def _await_logged(write, what):
+    try:
+        await write
+    except Exception as e:
+        logging.error(f"Error saving {what}: {e}")
+
+
+def spawn(coroutine):
+    """Avvia coroutine in background senza attenderla (errori gestiti dalla coroutine)"""
+    task = asyncio.ensure_future(coroutine)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def drain_background():
+    """Attende i task in background in corso (shutdown, benchmark)"""
+    while _background:
+        await asyncio.gather(*list(_background), return_exceptions=True)
+
+
+async def save_call_start_async(db, call_id, customer_number, tenant, assistant_id):
+    """Come vapi_webhook.save_call_start: chiamata già salvata -> solo late_start_fields"""
+    from google.api_core import exceptions
+
+    call_data = call_start_data(call_id, customer_number, tenant.user_id if tenant else None,
+                                tenant.order_id if tenant else None, assistant_id)
+    call_ref = db.collection('calls').document(call_id)
+    try:
+        try:
+            await call_ref.create(call_data)
+        except exceptions.AlreadyExists:
+            logging.info(f"Call {call_id} already saved, adding start fields only")
+            await call_ref.set(late_start_fields(call_data), merge=True)
+        telemetry.count('firestore_rpc', op='write')
+    except Exception as e:
+        logging.error(f"Error saving call start: {e}")
+
+
+async def start_call_async(db, call_id, customer_number, assistant_id):
+    """
+    Come vapi_webhook.start_call: decisione rate limit | tenant, poi
+    bucket | inizio chiamata. Ritorna a scritture completate.
+    """
+    tenant = asyncio.ensure_future(get_tenant_context_async(db, assistant_id))
+    ok, write = await check_rate_limit_async(db, customer_number)
+    if not ok:
+        tenant.cancel()
+        return False
+    with telemetry.span('persistence'):
+        writes = [save_call_start_async(db, call_id, customer_number, await tenant, assistant_id)]
+        if write is not None:
+            writes.append(_await_logged(write, f"rate limit for {customer_number}"))
+        await asyncio.gather(*writes)
+    return True
+
+
+async def handle_assistant_request_async(event, db):
+    """
+    Come handle_assistant_request: start_call_async (rate limit, bucket,
+    inizio chiamata) atteso entro il budget, solo il controllo costi dopo
+    la risposta. Oltre il budget l'avvio chiamata prosegue in background.
+    """
+    deadline = time.monotonic() + ASSISTANT_REQUEST_BUDGET_MS / 1000
+    call_id = event.call_id
+    customer_number = event.customer_number
+    assistant_id = event.assistant_id
+
+    logging.info(f"New call started: {call_id} from {customer_number}, assistant: {assistant_id}")
+
+    spawn(check_cost_alerts_async(db))
+
+    started = spawn(start_call_async(db, call_id, customer_number, assistant_id))
+    with telemetry.span('rate_limit'):
+        try:
+            rate_limit_ok = await asyncio.wait_for(asyncio.shield(started), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            logging.warning(f"Assistant request budget ({ASSISTANT_REQUEST_BUDGET_MS} ms) exhausted for call "
+                            f"{call_id}, answering with default firstMessage")
+            telemetry.count('assistant_request', result='deadline_fallback')
+            return ASSISTANT_RESPONSE
+    if not rate_limit_ok:
+        logging.warning(f"Rate limit exceeded for {customer_number}, rejecting call")
+        return RATE_LIMITED_RESPONSE
+    return ASSISTANT_RESPONSE
+
+
+async def record_completed_call_async(db, completed):
+    """Come vapi_webhook.record_completed_call, in una transazione asincrona"""
+    from google.cloud import firestore
+
+    call_ref = db.collection('calls').document(completed.call_id)
+    user_ref = db.collection('users').document(completed.user_id) if completed.user_id else None
+    transcript = completed.transcript
+    chunks = compress_transcript(transcript) if transcript else None
+
+    @firestore.async_transactional
+    async def _run(transaction):
+        user_doc = None
+        if user_ref is not None:
+            user_doc = await user_ref.get(transaction=transaction)
+            telemetry.count('firestore_rpc', op='read')
+        return write_completed_call(db, transaction, call_ref, user_ref, user_doc, completed.call_data,
+                                    completed.user_id, completed.duration, transcript, chunks,
+                                    completed.profile, completed.notified)
+
+    usage = await _run(db.transaction())
+    telemetry.count('firestore_rpc', op='commit')
+    bump_cached_usage(completed.duration, month_key(completed.call_data['started_at']))
+    if completed.profile is not None:
+        _caller_profiles.remember(completed.profile.after_call(
+            completed.call_id, completed.client_info, completed.notified))
+    return usage
+
+
+async def get_caller_profile_async(db, tenant, customer_number):
+    """Come caller_profiles.lookup_profile: cache condivisa, get asincrona al miss"""
+    if tenant is None or not tenant.user_id or not normalize_number(customer_number):
+        return None
+    try:
+        with telemetry.span('caller_profile'):
+            profile = _caller_profiles.peek(tenant.user_id, customer_number)
+            if profile is None:
+                ref = db.collection(PROFILE_COLLECTION).document(profile_id(tenant.user_id, customer_number))
+                snapshot = await ref.get()
+                telemetry.count('firestore_rpc', op='read')
+                profile = _caller_profiles.loaded(tenant.user_id, customer_number,
+                                                  snapshot.to_dict() if snapshot.exists else None)
+            return profile
+    except Exception as e:
+        logging.error(f"Error loading caller profile for {customer_number}: {e}")
+        return None
+
+
+async def _persist_completed_call(db, completed):
+    try:
+        with telemetry.span('persistence'):
+            usage = await record_completed_call_async(db, completed)
+    except Exception as e:
+        logging.error(f"Error saving call data: {e}")
+        raise
+    logging.info(f"Call data saved to Firestore: {completed.call_id}")
+    if usage:
+        check_overage(completed.user_id, usage)
+
+
+async def handle_end_of_call_async(event, db):
+    """Come handle_end_of_call: salvataggio e notifica del lead in parallelo"""
+    with telemetry.span('tenant_lookup'):
+        tenant = await get_tenant_context_async(db, event.assistant_id)
+    profile = await get_caller_profile_async(db, tenant, event.customer_number)
+
+    completed = CompletedCall(event, tenant, profile)
+    saved, _ = await asyncio.gather(
+        _persist_completed_call(db, completed),
+        run_blocking(completed.notify),
+        return_exceptions=True,
+    )
+    if isinstance(saved, Exception):
+        raise saved  # Come handle_end_of_call: 500, il retry di Vapi salva di nuovo
+    return {'status': 'success'}
+
+
+@functions_framework.aio.http
+async def vapi_webhook_async(request):
+    """
+    Entry point ASGI del webhook Vapi: stessi eventi, protezioni e dedup
+    di vapi_webhook.vapi_webhook.
+    """
+    with telemetry.request_trace():
+        return await process_webhook_async(request.headers.get('x-vapi-signature', ''), await request.body())
+
+
+async def process_webhook_async(signature, body):
+    with telemetry.span('verify_signature'):
+        signature_ok = verify_signature(signature, body)
+    if not signature_ok:
+        logging.warning("Invalid Vapi signature - possible attack")
+        return {'error': 'Unauthorized'}, 401
+
+    try:
+        with telemetry.span('decode'):
+            event = decode_event(body)
+        telemetry.annotate(event_type=event.type)
+
+        logging.info(f"Received Vapi event: {event.type}")
+
+        if event.type == ASSISTANT_REQUEST:
+            db = get_async_firestore()
+            return await _idempotency.run_async(db, event.call_id, event.type,
+                                                lambda: handle_assistant_request_async(event, db))
+
+        elif event.type == END_OF_CALL_REPORT:
+            db = get_async_firestore()
+            return await _idempotency.run_async(db, event.call_id, event.type,
+                                                lambda: handle_end_of_call_async(event, db))
+
+        elif event.type == FUNCTION_CALL:
+            return await run_blocking(handle_function_call, event)
+
+        else:
+            logging.info(f"Unhandled event type: {event.type}")
+            return {'status': 'ok'}
+
+    except Exception as e:
+        logging.error(f"Error processing webhook: {e}")
+        return {'error': str(e)}, 500
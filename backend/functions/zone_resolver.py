@@ -0,0 +1,177 @@
+"""
+Risoluzione zona -> agente
+
+Il testo della zona arriva dall'estrazione dell'AI ("P.ta Romana",
+"zona Porta Romana", "porta romana milano", "Città Studi", ...), mentre le
+zone_assignments del tenant sono indicizzate per id ('porta-romana').
+
+ZoneIndex compila UNA volta per tenant:
+- chiavi esatte (id normalizzati e variante senza trattini)
+- alias globali (DEFAULT_ALIASES) + alias del tenant (campo users.zone_aliases)
+
+La risoluzione prova, in ordine:
+1. match esatto sul testo normalizzato (accenti, punteggiatura, abbreviazioni,
+   prefissi "zona/quartiere", suffissi "milano/mi")
+2. sottosequenze contigue di token (es. "via tal dei tali porta romana")
+3. fuzzy limitato (difflib) per refusi ("navilgi")
+I risultati sono memoizzati per indice.
+"""
+import difflib
+import re
+import unicodedata
+
+import telemetry
+
+# Alias globali (Milano): alias -> id zona. Usati solo se la zona target
+# è tra le zone_assignments del tenant.
+DEFAULT_ALIASES = {
+    'centrale': 'stazione-centrale',
+    'stazione': 'stazione-centrale',
+    'piazza-duca-d-aosta': 'stazione-centrale',
+    'darsena': 'navigli',
+    'naviglio': 'navigli',
+    'naviglio-grande': 'navigli',
+    'naviglio-pavese': 'navigli',
+    'porta-ticinese': 'ticinese',
+    'colonne-di-san-lorenzo': 'ticinese',
+    'nolo': 'loreto',
+    'porta-nuova': 'garibaldi',
+    'corso-como': 'garibaldi',
+    'gae-aulenti': 'garibaldi',
+    'politecnico': 'citta-studi',
+    'piola': 'citta-studi',
+    'stadio': 'san-siro',
+    'meazza': 'san-siro',
+    'citylife': 'fiera',
+    'city-life': 'fiera',
+    'tre-torri': 'fiera',
+    'cordusio': 'centro',
+    'san-babila': 'centro',
+    'montenapoleone': 'centro',
+    'quadrilatero': 'centro',
+}
+
+# Abbreviazioni stradali comuni nelle trascrizioni/estrazioni
+_ABBREVIATIONS = (
+    (re.compile(r'\bp\.?\s?ta\b'), 'porta'),
+    (re.compile(r'\bp\.?\s?le\b'), 'piazzale'),
+    (re.compile(r'\bp\.?\s?z?za\b'), 'piazza'),
+    (re.compile(r'\bv\.?\s?le\b'), 'viale'),
+    (re.compile(r'\bc\.?\s?so\b'), 'corso'),
+    (re.compile(r'\bs\.\s?'), 'san '),
+)
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+# Token di contorno da togliere in testa/coda ("zona di Porta Romana, Milano")
+_PREFIX_TOKENS = frozenset((
+    'zona', 'zone', 'quartiere', 'quartieri', 'area', 'municipio', 'vicino', 'presso', 'verso',
+    'in', 'a', 'al', 'alla', 'allo', 'ai', 'di', 'del', 'della', 'dello', 'dei', 'nel', 'nella', 'nello',
+))
+_LEADING_TOKENS = _PREFIX_TOKENS | {'milano'}
+_SUFFIX_TOKENS = frozenset(('milano', 'mi', 'citta', 'zona', 'quartiere', 'area'))
+
+MAX_FUZZY_INPUT = 40     # oltre questa lunghezza niente fuzzy
+MAX_NGRAM_TOKENS = 8     # testo più lungo: si considerano solo i primi token
+FUZZY_CUTOFF = 0.8
+MEMO_SIZE = 256
+
+
+def normalize_zone(text):
+    """
+    Normalizza il testo zona in una chiave con trattini.
+    'P.ta Romana, Milano' -> 'porta-romana'; 'Città Studi' -> 'citta-studi'
+    Ritorna '' se non resta nulla.
+    """
+    tokens = _tokens(text)
+    return '-'.join(tokens)
+
+
+def _tokens(text):
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    for pattern, replacement in _ABBREVIATIONS:
+        text = pattern.sub(replacement, text)
+    tokens = [t for t in _NON_ALNUM.split(text) if t]
+
+    # Toglie contorno solo se resta qualcosa ("Milano" da solo resta "milano")
+    while len(tokens) > 1 and tokens[0] in _LEADING_TOKENS:
+        tokens.pop(0)
+    while len(tokens) > 1 and tokens[-1] in _SUFFIX_TOKENS:
+        tokens.pop()
+    return tokens
+
+
+class ZoneIndex:
+    """
+    Indice compilato delle zone di un tenant.
+
+    Args:
+        zone_assignments: Dict id_zona -> {'whatsapp', 'name'} (da users)
+        aliases: Alias del tenant (alias -> id_zona), hanno precedenza sui globali
+        default_aliases: Alias globali
+    """
+
+    def __init__(self, zone_assignments, aliases=None, default_aliases=DEFAULT_ALIASES):
+        self._keys = {}
+        for zone_id in zone_assignments or {}:
+            key = normalize_zone(zone_id)
+            if key:
+                self._keys.setdefault(key, zone_id)
+                self._keys.setdefault(key.replace('-', ''), zone_id)
+
+        canonical = dict(self._keys)
+        for table in (default_aliases or {}, aliases or {}):
+            for alias, target in table.items():
+                zone_id = canonical.get(normalize_zone(target))
+                alias_key = normalize_zone(alias)
+                if zone_id is not None and alias_key:
+                    self._keys[alias_key] = zone_id
+                    self._keys[alias_key.replace('-', '')] = zone_id
+
+        self._fuzzy_keys = [k for k in self._keys if '-' in k or len(k) > 3]
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def resolve(self, text):
+        """Ritorna l'id zona (chiave di zone_assignments) o None"""
+        if not self._keys or not text:
+            return None
+        try:
+            return self._memo[text]
+        except KeyError:
+            pass
+
+        zone_id, how = self._resolve(_tokens(text))
+        telemetry.count('zone_resolve', result=how)
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo.clear()
+        self._memo[text] = zone_id
+        return zone_id
+
+    def _resolve(self, tokens):
+        if not tokens:
+            return None, 'miss'
+
+        key = '-'.join(tokens)
+        zone_id = self._keys.get(key)
+        if zone_id is not None:
+            return zone_id, 'exact'
+
+        # Sottosequenze contigue, dalla più lunga (preferisce "porta-romana" a "romana")
+        window = tokens[:MAX_NGRAM_TOKENS]
+        for size in range(len(window), 0, -1):
+            for start in range(len(window) - size + 1):
+                zone_id = self._keys.get('-'.join(window[start:start + size]))
+                if zone_id is not None:
+                    return zone_id, 'contained'
+
+        if len(key) <= MAX_FUZZY_INPUT:
+            match = difflib.get_close_matches(key, self._fuzzy_keys, n=1, cutoff=FUZZY_CUTOFF)
+            if match:
+                return self._keys[match[0]], 'fuzzy'
+        return None, 'miss'
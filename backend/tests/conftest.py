@@ -0,0 +1,89 @@
+"""
+Fixture comuni ai test del backend: moduli di backend/functions importabili,
+Firestore e Twilio finti (benchmarks/fakes.py) iniettati in clients e cache
+in-process svuotate a ogni test (istanza nuova).
+
+Uso:
+    python -m pytest -q backend/tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import harness  # noqa: E402
+
+harness.setup_path()
+
+import clients  # noqa: E402
+import usage_rollup  # noqa: E402
+import vapi_webhook  # noqa: E402
+from fakes import FakeAsyncFirestore, FakeFirestore, FakeTwilio  # noqa: E402
+
+N_TENANTS = 2
+
+
+def reset_process_state():
+    """Istanza nuova: cache in-process vuote"""
+    vapi_webhook._tenant_cache.invalidate()
+    vapi_webhook._rate_limiter.forget()
+    vapi_webhook._idempotency.forget()
+    vapi_webhook._caller_profiles.forget()
+    usage_rollup._rollup_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def process_state():
+    reset_process_state()
+    yield
+    vapi_webhook.drain_deferred(timeout=10)
+    reset_process_state()
+
+
+@pytest.fixture
+def db():
+    """Firestore finto con N_TENANTS tenant, iniettato in clients"""
+    db = FakeFirestore()
+    harness.seed_dataset(db, 0, n_tenants=N_TENANTS)
+    db.reset_counters()
+    clients.set_firestore(db)
+    yield db
+    clients.set_firestore(None)
+
+
+@pytest.fixture
+def async_db():
+    """Firestore asincrono finto (stessi dati del sincrono in .sync)"""
+    db = FakeAsyncFirestore()
+    harness.seed_dataset(db.sync, 0, n_tenants=N_TENANTS)
+    db.reset_counters()
+    clients.set_async_firestore(db)
+    clients.set_firestore(db.sync)  # Notifiche nel pool bloccante
+    yield db
+    clients.set_async_firestore(None)
+    clients.set_firestore(None)
+
+
+@pytest.fixture
+def twilio():
+    twilio = FakeTwilio()
+    clients.set_twilio(twilio)
+    yield twilio
+    clients.set_twilio(None)
+
+
+class Clock:
+    """Clock finto per lease, finestre e TTL"""
+
+    def __init__(self, now=1_750_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
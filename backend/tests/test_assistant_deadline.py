@@ -0,0 +1,146 @@
+"""
+Test di assistant-request con budget di latenza (handle_assistant_request e
+handle_assistant_request_async) contro Firestore finto con latenza
+iniettata: risposta entro il budget, scritture essenziali prima della
+risposta o dopo il drain, ordine con end-of-call-report, rate limit.
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+import harness
+import vapi_webhook
+import vapi_webhook_async
+
+BUDGET_MS = 200
+MARGIN_MS = 50  # Scheduling dei thread / event loop oltre il budget
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(vapi_webhook, 'ASSISTANT_REQUEST_BUDGET_MS', BUDGET_MS)
+    monkeypatch.setattr(vapi_webhook_async, 'ASSISTANT_REQUEST_BUDGET_MS', BUDGET_MS)
+
+
+class Webhook:
+    """Eventi firmati sul percorso `mode`, Firestore con latenza impostabile"""
+
+    def __init__(self, mode, db, sync_db):
+        self.mode = mode
+        self.db = db
+        self.sync_db = sync_db
+        self.loop = asyncio.new_event_loop() if mode == 'async' else None
+
+    def latency(self, ms):
+        self.db.read_latency = self.db.write_latency = ms / 1000
+
+    def send(self, payload):
+        body = json.dumps(payload).encode()
+        if self.mode == 'sync':
+            return vapi_webhook.vapi_webhook(harness.signed_request(body))
+        return self.loop.run_until_complete(vapi_webhook_async.process_webhook_async(harness.sign(body), body))
+
+    def timed(self, payload):
+        start = time.perf_counter()
+        response = self.send(payload)
+        return response, (time.perf_counter() - start) * 1000
+
+    def drain(self):
+        if self.mode == 'sync':
+            vapi_webhook.drain_deferred(timeout=10)
+        else:
+            self.loop.run_until_complete(vapi_webhook_async.drain_background())
+
+    def call(self, call_id):
+        return self.sync_db.collection('calls').document(call_id).get().to_dict() or {}
+
+    def bucket(self, number):
+        return self.sync_db.collection('rate_limits').document(number).get().exists
+
+    def close(self):
+        if self.loop is not None:
+            self.drain()
+            self.loop.close()
+
+
+@pytest.fixture(params=['sync', 'async'])
+def webhook(request, twilio):
+    if request.param == 'sync':
+        db = sync_db = request.getfixturevalue('db')
+    else:
+        db = request.getfixturevalue('async_db')
+        sync_db = db.sync
+    vapi_webhook.get_tenant_context(harness.tenant_ids(0)[0])  # Istanza calda: tenant in cache
+    hook = Webhook(request.param, db, sync_db)
+    yield hook
+    hook.latency(0)
+    hook.close()
+
+
+def assistant_request(call_id, number):
+    return harness.make_event('assistant-request', call_id, number, harness.tenant_ids(0)[0])
+
+
+def end_of_call(call_id, number):
+    return harness.make_event('end-of-call-report', call_id, number, harness.tenant_ids(0)[0])
+
+
+def test_fast_firestore_writes_before_response(webhook):
+    webhook.latency(5)
+    for i in range(5):
+        response, elapsed = webhook.timed(assistant_request(f"fast-{i}", f"+39346000000{i}"))
+        assert response == vapi_webhook.ASSISTANT_RESPONSE
+        assert elapsed <= BUDGET_MS + MARGIN_MS
+        # Niente lavoro essenziale dopo la risposta
+        webhook.latency(0)
+        assert webhook.call(f"fast-{i}").get('started_at')
+        assert webhook.bucket(f"+39346000000{i}")
+        webhook.latency(5)
+
+
+def test_slow_firestore_answers_within_budget(webhook):
+    webhook.latency(BUDGET_MS * 2)
+    response, elapsed = webhook.timed(assistant_request('slow-1', '+393460000001'))
+
+    assert response == vapi_webhook.ASSISTANT_RESPONSE  # firstMessage di default
+    assert elapsed <= BUDGET_MS + MARGIN_MS
+    webhook.drain()
+    webhook.latency(0)
+    assert webhook.call('slow-1').get('started_at')
+    assert webhook.bucket('+393460000001')
+
+
+def test_end_of_call_after_slow_start_stays_completed(webhook):
+    webhook.latency(BUDGET_MS * 2)
+    webhook.send(assistant_request('race-1', '+393460000001'))
+    webhook.latency(0)
+    assert webhook.send(end_of_call('race-1', '+393460000001')) == {'status': 'success'}
+    webhook.drain()
+
+    call = webhook.call('race-1')
+    assert call['status'] == 'completed'
+    assert call.get('started_at')
+
+
+def test_late_assistant_request_keeps_started_at(webhook):
+    payload = end_of_call('late-1', '+393460000001')
+    assert webhook.send(payload) == {'status': 'success'}
+    started_at = vapi_webhook.decode_event(json.dumps(payload).encode()).started_at
+
+    assert webhook.send(assistant_request('late-1', '+393460000001')) == vapi_webhook.ASSISTANT_RESPONSE
+    webhook.drain()
+
+    call = webhook.call('late-1')
+    assert call['status'] == 'completed'
+    assert call['started_at'] == started_at
+
+
+def test_rate_limit_still_enforced(webhook):
+    webhook.latency(1)
+    responses = [webhook.send(assistant_request(f"spam-{i}", '+393460000000'))
+                 for i in range(vapi_webhook.MAX_CALLS_PER_NUMBER_PER_HOUR + 1)]
+
+    assert responses[:-1] == [vapi_webhook.ASSISTANT_RESPONSE] * vapi_webhook.MAX_CALLS_PER_NUMBER_PER_HOUR
+    assert responses[-1] == vapi_webhook.RATE_LIMITED_RESPONSE
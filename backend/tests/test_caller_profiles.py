@@ -0,0 +1,136 @@
+"""
+Test dei profili chiamante (caller_profiles.py): merge dei dati noti,
+richiamate vicine, cache con TTL e richiamate via webhook sui percorsi
+sincrono e asyncio.
+"""
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import caller_profiles
+import clients
+import harness
+import vapi_webhook
+import vapi_webhook_async
+from caller_profiles import CallerProfile, CallerProfiles
+
+CALM_TRANSCRIPT = ("AI: Buongiorno! Come posso aiutarla?\nUser: Cerco un trilocale da comprare in zona "
+                   "Porta Romana, con balcone.\nAI: Perfetto, la ricontattiamo noi.")
+NUMBER = '+393471234567'
+WINDOW = 600
+NOW = datetime(2025, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_normalize_number():
+    assert caller_profiles.normalize_number('whatsapp:+39 347 123 4567') == NUMBER
+    assert caller_profiles.profile_id('u@example.com', '+39 347-123-4567') == f"u@example.com_{NUMBER}"
+
+
+def test_enrich_keeps_known_values():
+    profile = CallerProfile('u', NUMBER, 1, client_info={'nome': 'Giulia Bianchi', 'budget': '300.000 €'})
+    merged = profile.enrich({'nome': 'Non specificato', 'budget': '450.000 €', 'zona': ''})
+    assert merged == {'nome': 'Giulia Bianchi', 'budget': '450.000 €', 'zona': ''}
+
+
+def test_after_call_merges_and_counts():
+    profile = CallerProfile('u', NUMBER, client_info={'nome': 'Giulia Bianchi'})
+    after = profile.after_call('call-1', {'nome': 'Non specificato', 'zona': 'Brera'}, notified=True, now=NOW)
+    assert after.call_count == 1 and after.returning
+    assert after.client_info == {'nome': 'Giulia Bianchi', 'zona': 'Brera'}
+    assert after.first_seen == after.last_seen == after.last_notified_at == NOW
+
+    later = after.after_call('call-2', {}, notified=False, now=NOW + timedelta(hours=1))
+    assert later.call_count == 2 and later.first_seen == NOW and later.last_notified_at == NOW
+    assert later.notification_info() == {'call_count': 3, 'first_seen': NOW}
+    assert profile.notification_info() is None
+
+
+@pytest.mark.parametrize('client_info, elapsed, window, duplicate', [
+    ({'nome': 'giulia  bianchi', 'budget': 'Non specificato'}, 60, WINDOW, True),
+    ({'budget': '600.000 €'}, 60, WINDOW, False),
+    ({}, WINDOW + 1, WINDOW, False),
+    ({}, 60, 0, False),
+])
+def test_is_near_duplicate(client_info, elapsed, window, duplicate):
+    profile = CallerProfile('u', NUMBER, 1, client_info={'nome': 'Giulia Bianchi', 'budget': '450.000 €'},
+                            last_notified_at=NOW.replace(tzinfo=None))
+    assert profile.is_near_duplicate(client_info, window, now=NOW + timedelta(seconds=elapsed)) is duplicate
+
+
+def test_cache_reads_profile_once_until_ttl(db, clock):
+    profiles = CallerProfiles(clients.get_firestore, ttl=300, clock=clock)
+    db.seed(f"{caller_profiles.PROFILE_COLLECTION}/{caller_profiles.profile_id('u', NUMBER)}",
+            {'call_count': 2, 'client_info': {'nome': 'Giulia Bianchi'}})
+
+    assert profiles.get('u', NUMBER).call_count == 2
+    assert profiles.get('u', 'whatsapp:' + NUMBER).call_count == 2
+    assert db.counters()['reads'] == 1
+
+    clock.now += 301
+    assert profiles.get('u', NUMBER).call_count == 2
+    assert profiles.stats() == {'size': 1, 'hits': 1, 'loads': 2}
+
+
+def test_unknown_number_is_new_caller(db):
+    profile = CallerProfiles(clients.get_firestore).get('u', NUMBER)
+    assert profile.call_count == 0 and not profile.returning
+
+
+@pytest.fixture(params=['sync', 'async'])
+def webhook(request, twilio):
+    """Invia end-of-call-report firmati sul percorso del parametro; tenant 1 con finestra duplicati"""
+    if request.param == 'sync':
+        sync_db = request.getfixturevalue('db')
+    else:
+        sync_db = request.getfixturevalue('async_db').sync
+    user_id = harness.tenant_ids(1)[1]
+    sync_db.collection('users').document(user_id).update({'duplicate_lead_window': WINDOW})
+
+    def _send(call_id, tenant=0, note='', **fields):
+        payload = harness.make_event('end-of-call-report', call_id, NUMBER, harness.tenant_ids(tenant)[0])
+        payload['message']['transcript'] = CALM_TRANSCRIPT
+        payload['message']['structuredData'].update(note=note, **fields)
+        body = json.dumps(payload).encode()
+        if request.param == 'sync':
+            return vapi_webhook.vapi_webhook(harness.signed_request(body))
+        return asyncio.run(vapi_webhook_async.process_webhook_async(harness.sign(body), body))
+
+    _send.db = sync_db
+    return _send
+
+
+def test_repeat_calls_update_profile_and_message(webhook, twilio):
+    user_id = harness.tenant_ids(0)[1]
+    assert webhook('repeat-1', budget='Non specificato') == {'status': 'success'}
+    assert webhook('repeat-2', nome='Non specificato', budget='300.000 €') == {'status': 'success'}
+    assert webhook('repeat-3') == {'status': 'success'}
+
+    first, second, third = (message['body'] for message in twilio.sent)
+    assert 'Lead di ritorno' not in first
+    assert 'Lead di ritorno' in second and '2ª chiamata' in second and 'Giulia Bianchi' in second
+    assert '3ª chiamata' in third
+
+    doc = webhook.db.collection(caller_profiles.PROFILE_COLLECTION).document(
+        caller_profiles.profile_id(user_id, NUMBER)).get().to_dict()
+    assert doc['call_count'] == 3
+    assert doc['client_info']['nome'] == 'Giulia Bianchi'
+    assert doc['last_call_id'] == 'repeat-3'
+    assert vapi_webhook._caller_profiles.stats()['loads'] == 1
+
+
+def test_duplicate_window_skips_repeat_without_news(webhook, twilio):
+    sent = []
+    for call_id, tenant, fields in (
+        ('dup-1', 1, {}),
+        ('dup-2', 1, {}),  # Stesse informazioni entro la finestra
+        ('dup-3', 1, {'budget': '600.000 €'}),
+        ('dup-4', 1, {'budget': '600.000 €', 'note': 'Urgente, entro un mese'}),
+        ('dup-5', 0, {}),  # Tenant senza finestra
+        ('dup-6', 0, {}),
+    ):
+        before = len(twilio.sent)
+        assert webhook(call_id, tenant, **fields) == {'status': 'success'}
+        sent.append(len(twilio.sent) - before)
+    assert sent == [1, 0, 1, 1, 1, 1]
@@ -0,0 +1,255 @@
+"""
+Test di IdempotencyGuard (idempotency.py) e del dedup nel webhook:
+replay concorrenti dello stesso evento, leader che fallisce, lease scaduta.
+"""
+import asyncio
+import json
+import threading
+
+import pytest
+
+import clients
+import harness
+import idempotency
+import vapi_webhook
+import vapi_webhook_async
+
+EVENT = 'end-of-call-report'
+NUMBER = '+393471234567'
+
+
+def replay(fns):
+    """Esegue le funzioni insieme (barriera), ritorna le risposte in ordine"""
+    barrier = threading.Barrier(len(fns))
+    results = [None] * len(fns)
+
+    def _worker(i, fn):
+        barrier.wait()
+        results[i] = fn()
+
+    threads = [threading.Thread(target=_worker, args=(i, fn)) for i, fn in enumerate(fns)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def end_of_call(call_id):
+    assistant_id, user_id, _ = harness.tenant_ids(0)
+    return user_id, harness.make_event(EVENT, call_id, NUMBER, assistant_id)
+
+
+def monthly_calls(db, user_id):
+    return db.collection('users').document(user_id).get().to_dict().get('monthly_calls', 0)
+
+
+def marker(db, call_id):
+    return db.collection(idempotency.EVENTS_COLLECTION).document(idempotency.event_key(call_id, EVENT)).get()
+
+
+class Handler:
+    """Handler che conta le esecuzioni; trattiene il leader finché `release` non è settato"""
+
+    def __init__(self, release=None, fail_times=0):
+        self.calls = 0
+        self.release = release
+        self.fail_times = fail_times
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            fail = self.calls <= self.fail_times
+        if self.release is not None:
+            self.release.wait(5)
+        if fail:
+            raise RuntimeError('handler failure')
+        return {'status': 'success', 'n': self.calls}
+
+
+def test_concurrent_replays_one_instance_run_handler_once(db):
+    guard = idempotency.IdempotencyGuard(clients.get_firestore)
+    handler = Handler()
+
+    responses = replay([lambda: guard.run('call-1', EVENT, handler)] * 8)
+
+    assert handler.calls == 1
+    assert responses == [{'status': 'success', 'n': 1}] * 8
+    assert marker(db, 'call-1').to_dict()['status'] == 'done'
+
+
+def test_concurrent_replays_across_instances_run_handler_once(db):
+    guards = [idempotency.IdempotencyGuard(clients.get_firestore) for _ in range(4)]
+    handler = Handler()
+
+    responses = replay([lambda g=guards[i % 4]: g.run('call-1', EVENT, handler) for i in range(16)])
+
+    assert handler.calls == 1
+    assert all(r in ({'status': 'success', 'n': 1}, idempotency.IN_PROGRESS_RESPONSE) for r in responses)
+    # Dopo il completamento ogni istanza risponde con la risposta originale
+    assert [g.run('call-1', EVENT, handler) for g in guards] == [{'status': 'success', 'n': 1}] * 4
+    assert handler.calls == 1
+
+
+def test_replay_while_leader_runs_on_other_instance_gets_409(db):
+    release = threading.Event()
+    leader = Handler(release=release)
+    first, second = (idempotency.IdempotencyGuard(clients.get_firestore) for _ in range(2))
+    thread = threading.Thread(target=first.run, args=('call-1', EVENT, leader))
+    thread.start()
+    try:
+        while not marker(db, 'call-1').exists:
+            pass
+        assert second.run('call-1', EVENT, Handler()) == idempotency.IN_PROGRESS_RESPONSE
+    finally:
+        release.set()
+        thread.join()
+    assert second.run('call-1', EVENT, Handler()) == {'status': 'success', 'n': 1}
+
+
+def test_concurrent_end_of_call_replays_have_one_side_effect(db, twilio):
+    user_id, payload = end_of_call('replay-1')
+    requests = [harness.signed_request(payload) for _ in range(8)]
+
+    responses = replay([lambda r=r: vapi_webhook.vapi_webhook(r) for r in requests])
+
+    assert monthly_calls(db, user_id) == 1
+    assert len(twilio.sent) == 1
+    assert all(r in ({'status': 'success'}, idempotency.IN_PROGRESS_RESPONSE) for r in responses)
+
+
+def test_concurrent_end_of_call_replays_async(async_db, twilio):
+    user_id, payload = end_of_call('replay-async-1')
+    body = json.dumps(payload).encode()
+
+    async def _run():
+        responses = await asyncio.gather(*(
+            vapi_webhook_async.process_webhook_async(harness.sign(body), body) for _ in range(8)
+        ))
+        await vapi_webhook_async.drain_background()
+        return responses
+
+    responses = asyncio.run(_run())
+
+    assert responses == [{'status': 'success'}] * 8
+    assert monthly_calls(async_db.sync, user_id) == 1
+    assert len(twilio.sent) == 1
+
+
+def test_failed_leader_releases_marker_and_retry_runs(db):
+    guard = idempotency.IdempotencyGuard(clients.get_firestore)
+    handler = Handler(fail_times=1)
+
+    with pytest.raises(RuntimeError):
+        guard.run('call-1', EVENT, handler)
+    # Nessun successo in cache né marker: il retry esegue di nuovo l'handler
+    assert not marker(db, 'call-1').exists
+
+    assert guard.run('call-1', EVENT, handler) == {'status': 'success', 'n': 2}
+    assert idempotency.IdempotencyGuard(clients.get_firestore).run('call-1', EVENT, handler) == \
+        {'status': 'success', 'n': 2}
+    assert handler.calls == 2
+
+
+def test_failed_leader_on_other_instance_lets_replay_run(db):
+    release = threading.Event()
+    first, second = (idempotency.IdempotencyGuard(clients.get_firestore) for _ in range(2))
+    errors = []
+
+    def _leader():
+        try:
+            first.run('call-1', EVENT, Handler(release=release, fail_times=1))
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_leader)
+    thread.start()
+    while not marker(db, 'call-1').exists:
+        pass
+    assert second.run('call-1', EVENT, Handler()) == idempotency.IN_PROGRESS_RESPONSE
+    release.set()
+    thread.join()
+
+    assert len(errors) == 1
+    assert second.run('call-1', EVENT, Handler()) == {'status': 'success', 'n': 1}
+
+
+def test_failed_save_returns_500_and_retry_saves(db, twilio, monkeypatch):
+    user_id, payload = end_of_call('replay-fail-1')
+    record = vapi_webhook.record_completed_call
+    failures = [RuntimeError('Firestore unavailable')]
+
+    def _flaky(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return record(*args, **kwargs)
+
+    monkeypatch.setattr(vapi_webhook, 'record_completed_call', _flaky)
+
+    body, status = vapi_webhook.vapi_webhook(harness.signed_request(payload))
+    assert status == 500
+    assert not marker(db, 'replay-fail-1').exists
+    assert not db.collection('calls').document('replay-fail-1').get().exists
+    assert len(twilio.sent) == 1  # Il lead arriva comunque all'agente
+
+    assert vapi_webhook.vapi_webhook(harness.signed_request(payload)) == {'status': 'success'}
+    assert db.collection('calls').document('replay-fail-1').get().to_dict()['status'] == 'completed'
+    assert monthly_calls(db, user_id) == 1
+    assert vapi_webhook.vapi_webhook(harness.signed_request(payload)) == {'status': 'success'}
+    assert monthly_calls(db, user_id) == 1
+
+
+def test_failed_save_async_returns_500_and_retry_saves(async_db, twilio, monkeypatch):
+    user_id, payload = end_of_call('replay-fail-async-1')
+    body = json.dumps(payload).encode()
+    record = vapi_webhook_async.record_completed_call_async
+    failures = [RuntimeError('Firestore unavailable')]
+
+    async def _flaky(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return await record(*args, **kwargs)
+
+    monkeypatch.setattr(vapi_webhook_async, 'record_completed_call_async', _flaky)
+
+    async def _send():
+        response = await vapi_webhook_async.process_webhook_async(harness.sign(body), body)
+        await vapi_webhook_async.drain_background()
+        return response
+
+    assert asyncio.run(_send())[1] == 500
+    assert not marker(async_db.sync, 'replay-fail-async-1').exists
+
+    assert asyncio.run(_send()) == {'status': 'success'}
+    assert monthly_calls(async_db.sync, user_id) == 1
+
+
+def test_lease_expiry_is_taken_over_once(db, clock):
+    crashed = idempotency.IdempotencyGuard(clients.get_firestore, clock=clock)
+    # Istanza crashata a metà: marker processing mai completato
+    crashed._claim(idempotency.event_key('call-1', EVENT), 'call-1', EVENT)
+    retry = idempotency.IdempotencyGuard(clients.get_firestore, clock=clock)
+    handler = Handler()
+
+    clock.now += idempotency.LEASE_SECONDS - 1
+    assert retry.run('call-1', EVENT, handler) == idempotency.IN_PROGRESS_RESPONSE
+    assert handler.calls == 0
+
+    clock.now += 2
+    responses = replay([lambda: retry.run('call-1', EVENT, handler)] * 4)
+    assert handler.calls == 1
+    assert responses == [{'status': 'success', 'n': 1}] * 4
+    assert marker(db, 'call-1').to_dict()['status'] == 'done'
+
+
+@pytest.mark.parametrize('lease_seconds', [5, 60])
+def test_custom_lease_seconds(db, clock, lease_seconds):
+    crashed = idempotency.IdempotencyGuard(clients.get_firestore, lease_seconds=lease_seconds, clock=clock)
+    crashed._claim(idempotency.event_key('call-1', EVENT), 'call-1', EVENT)
+    retry = idempotency.IdempotencyGuard(clients.get_firestore, lease_seconds=lease_seconds, clock=clock)
+
+    clock.now += lease_seconds - 1
+    assert retry.run('call-1', EVENT, Handler()) == idempotency.IN_PROGRESS_RESPONSE
+    clock.now += 2
+    assert retry.run('call-1', EVENT, Handler()) == {'status': 'success', 'n': 1}
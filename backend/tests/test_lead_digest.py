@@ -0,0 +1,173 @@
+"""
+Test della modalità digest delle notifiche lead (lead_digest.py) con clock
+finto e Twilio finto: invio immediato, buffer nella finestra, burst, flush
+del worker, requeue dopo un invio fallito e submit concorrenti.
+"""
+import threading
+
+import pytest
+
+import harness
+import lead_digest
+import vapi_webhook
+from fakes import FakeTwilio
+from lead_features import LeadFeatures
+
+USER_ID = 'agency0@example.com'
+DESTINATION = 'whatsapp:+393330000001'
+FROM_NUMBER = 'whatsapp:+390200000000'
+CONFIG = lead_digest.DigestConfig(True, window_seconds=600, burst_threshold=3)
+
+
+def entry(call_id, clock):
+    info = {'nome': f"Cliente {call_id}", 'zona': 'Porta Romana', 'tipo_richiesta': 'comprare'}
+    return lead_digest.lead_entry(call_id, info, '+393471234567', LeadFeatures(['balcone'], False), clock())
+
+
+def submit(db, clock, call_id):
+    return lead_digest.submit_lead(db, CONFIG, USER_ID, DESTINATION, FROM_NUMBER, entry(call_id, clock), clock=clock)
+
+
+def call_ids(leads):
+    return [lead['call_id'] for lead in leads]
+
+
+def buffered(db):
+    ref = db.collection(lead_digest.DIGEST_COLLECTION).document(lead_digest.digest_key(USER_ID, DESTINATION))
+    return call_ids(ref.get().to_dict()['leads'])
+
+
+def test_config_from_dict():
+    assert lead_digest.DigestConfig.from_dict(None) is None
+    assert lead_digest.DigestConfig.from_dict({'enabled': False}) is None
+    config = lead_digest.DigestConfig.from_dict({'enabled': True, 'window_seconds': 0, 'burst_threshold': 1})
+    assert config.window_seconds == lead_digest.DEFAULT_WINDOW_SECONDS
+    assert config.burst_threshold == 2
+
+
+def test_first_lead_immediate_then_buffered_in_window(db, clock):
+    action, leads = submit(db, clock, 'call-1')
+    assert action == lead_digest.IMMEDIATE and call_ids(leads) == ['call-1']
+
+    clock.now += 60
+    assert submit(db, clock, 'call-2') == (lead_digest.BUFFERED, [])
+    assert buffered(db) == ['call-2']
+
+
+def test_burst_threshold_sends_one_digest(db, clock):
+    submit(db, clock, 'call-1')
+    assert submit(db, clock, 'call-2')[0] == lead_digest.BUFFERED
+    assert submit(db, clock, 'call-3')[0] == lead_digest.BUFFERED
+
+    action, leads = submit(db, clock, 'call-4')
+    assert action == lead_digest.DIGEST and call_ids(leads) == ['call-2', 'call-3', 'call-4']
+    assert buffered(db) == []
+
+
+def test_resubmitted_lead_is_not_duplicated(db, clock):
+    submit(db, clock, 'call-1')
+    submit(db, clock, 'call-2')
+    submit(db, clock, 'call-2')  # Retry del webhook
+    assert buffered(db) == ['call-2']
+
+
+def test_lead_after_window_sends_buffer_with_it(db, clock):
+    submit(db, clock, 'call-1')
+    submit(db, clock, 'call-2')
+
+    clock.now += CONFIG.window_seconds
+    action, leads = submit(db, clock, 'call-3')
+    assert action == lead_digest.DIGEST and call_ids(leads) == ['call-2', 'call-3']
+
+
+def test_flush_sends_due_digests_once(db, clock, twilio):
+    submit(db, clock, 'call-1')
+    submit(db, clock, 'call-2')
+    submit(db, clock, 'call-3')
+
+    clock.now += CONFIG.window_seconds - 1
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock) == {'digests': 0, 'leads': 0, 'failed': 0}
+
+    clock.now += 1
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock) == {'digests': 1, 'leads': 2, 'failed': 0}
+    assert len(twilio.sent) == 1
+    assert twilio.sent[0]['to'] == DESTINATION and twilio.sent[0]['from_'] == FROM_NUMBER
+    assert '2 nuovi lead' in twilio.sent[0]['body']
+    assert buffered(db) == []
+
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock)['digests'] == 0
+    assert len(twilio.sent) == 1
+
+
+def test_failed_flush_requeues_and_retries(db, clock):
+    twilio = FakeTwilio(fail_times=1)
+    submit(db, clock, 'call-1')
+    submit(db, clock, 'call-2')
+
+    clock.now += CONFIG.window_seconds
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock)['failed'] == 1
+    assert buffered(db) == ['call-2']
+
+    clock.now += lead_digest.RETRY_SECONDS - 1
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock)['digests'] == 0
+    clock.now += 1
+    assert lead_digest.flush_due_digests(db, twilio=twilio, clock=clock) == {'digests': 1, 'leads': 1, 'failed': 0}
+    assert len(twilio.sent) == 1
+
+
+def test_concurrent_submits_hand_out_every_lead_once(db, clock):
+    n_threads, per_thread = 8, 10
+    handed_out = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(n_threads)
+
+    def _worker(t):
+        barrier.wait()
+        for i in range(per_thread):
+            _, leads = submit(db, clock, f"t{t}-{i}")
+            with lock:
+                handed_out.extend(call_ids(leads))
+
+    threads = [threading.Thread(target=_worker, args=(t,)) for t in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    handed_out.extend(buffered(db))
+    assert sorted(handed_out) == sorted(f"t{t}-{i}" for t in range(n_threads) for i in range(per_thread))
+
+
+@pytest.fixture
+def digest_tenant(db):
+    assistant_id, user_id, _ = harness.tenant_ids(0)
+    db.collection('users').document(user_id).update({
+        'notification_digest': {'enabled': True, 'window_seconds': 600, 'burst_threshold': 3},
+    })
+    return assistant_id
+
+
+def end_of_call(assistant_id, call_id, number, note):
+    payload = harness.make_event('end-of-call-report', call_id, number, assistant_id)
+    message = payload['message']
+    message['structuredData']['note'] = note
+    message['transcript'] = f"User: {note}"
+    return harness.signed_request(payload)
+
+
+def test_webhook_buffers_leads_of_digest_tenant(db, twilio, digest_tenant):
+    for n in (1, 2):
+        request = end_of_call(digest_tenant, f"digest-{n}", f"+39347000000{n}", 'Balcone, nessuna fretta')
+        assert vapi_webhook.vapi_webhook(request) == {'status': 'success'}
+    vapi_webhook.drain_deferred(timeout=10)
+
+    assert len(twilio.sent) == 1
+    (state,) = db.collection(lead_digest.DIGEST_COLLECTION).where('user_id', '==', USER_ID).get()
+    assert call_ids(state.to_dict()['leads']) == ['digest-2']
+
+    # Urgente: fuori dal digest anche dentro la finestra
+    request = end_of_call(digest_tenant, 'digest-3', '+393470000003', 'Urgente, entro tre mesi')
+    assert vapi_webhook.vapi_webhook(request) == {'status': 'success'}
+    vapi_webhook.drain_deferred(timeout=10)
+    assert len(twilio.sent) == 2
+    assert call_ids(state.reference.get().to_dict()['leads']) == ['digest-2']
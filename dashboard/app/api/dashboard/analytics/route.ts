@@ -2,11 +2,48 @@ import { NextRequest, NextResponse } from 'next/server';
 import { getServerSession } from 'next-auth/next';
 import { authOptions } from '@/lib/auth';
 import { db } from '@/lib/firebase';
-import { Timestamp } from 'firebase-admin/firestore';
+import { getZoneName } from '@/lib/milanZones';
+
+// Rollup scritti dal backend a fine chiamata (backend/functions/lead_analytics.py)
+const ANALYTICS_COLLECTION = 'lead_analytics';
+const COUNTERS = ['calls', 'valid_leads', 'urgent', 'total_duration', 'budget_sum', 'budget_count'];
+const MAPS = ['by_zona', 'by_tipo_richiesta', 'by_tipo_immobile', 'by_feature', 'duration_histogram'];
+
+const dayKey = (date: Date) => date.toISOString().slice(0, 10);
+
+/**
+ * Bucket che coprono gli ultimi `days` giorni: documenti mensili per i mesi
+ * interi, giornalieri per i bordi (come period_buckets nel backend)
+ */
+function periodBuckets(days: number): string[] {
+  const end = new Date();
+  end.setUTCHours(0, 0, 0, 0);
+  const day = new Date(end);
+  day.setUTCDate(day.getUTCDate() - (days - 1));
+  const buckets: string[] = [];
+  while (day <= end) {
+    const nextMonth = new Date(Date.UTC(day.getUTCFullYear(), day.getUTCMonth() + 1, 1));
+    const lastOfMonth = new Date(nextMonth.getTime() - 86400000);
+    if (day.getUTCDate() === 1 && lastOfMonth <= end) {
+      buckets.push(dayKey(day).slice(0, 7));
+      day.setTime(nextMonth.getTime());
+    } else {
+      buckets.push(dayKey(day));
+      day.setUTCDate(day.getUTCDate() + 1);
+    }
+  }
+  return buckets;
+}
+
+const label = (key: string) => key.replace(/-/g, ' ').replace(/^./, c => c.toUpperCase());
+
+const sumOf = (map: Record<string, number>, match: (key: string) => boolean) =>
+  Object.entries(map).filter(([key]) => match(key)).reduce((total, [, count]) => total + count, 0);
 
 /**
- * GET /api/dashboard/analytics
- * Calcola analytics reali dalle chiamate dell'utente
+ * GET /api/dashboard/analytics?days=30
+ * Analytics dai rollup giornalieri/mensili: pochi documenti per periodo,
+ * indipendente dal numero di chiamate dell'utente
  */
 export async function GET(request: NextRequest) {
   try {
@@ -16,95 +53,39 @@ export async function GET(request: NextRequest) {
       return NextResponse.json({ error: 'Non autenticato' }, { status: 401 });
     }
 
-    // Recupera tutte le chiamate completate dell'utente
-    let callsSnapshot;
-    try {
-      callsSnapshot = await db
-        .collection('calls')
-        .where('status', '==', 'completed')
-        .where('user_id', '==', session.user.email)
-        .get();
-    } catch (error) {
-      // Fallback: recupera tutte e filtra
-      const allCalls = await db
-        .collection('calls')
-        .where('status', '==', 'completed')
-        .get();
-      
-      callsSnapshot = {
-        docs: allCalls.docs.filter(doc => {
-          const data = doc.data();
-          return data.user_id === session.user.email || !data.user_id;
-        })
-      };
-    }
+    const requestedDays = parseInt(request.nextUrl.searchParams.get('days') || '30');
+    const days = Math.min(Math.max(isNaN(requestedDays) ? 30 : requestedDays, 1), 366);
 
-    const calls = callsSnapshot.docs.map(doc => doc.data());
-    
-    // Calcola analytics
-    let comprareCount = 0;
-    let vendereCount = 0;
-    const zonesMap = new Map<string, number>();
-    const propertyTypesMap = new Map<string, number>();
-    const featuresMap = new Map<string, number>();
-    const budgets: number[] = [];
-    let validLeads = 0;
+    const userId = session.user.email;
+    const refs = periodBuckets(days).map(bucket =>
+      db.collection(ANALYTICS_COLLECTION).doc(`user_${userId}_${bucket}`)
+    );
+    const snapshots = await db.getAll(...refs);
 
-    calls.forEach(call => {
-      const clientInfo = call.client_info || {};
-      const tipoRichiesta = (clientInfo.tipo_richiesta || '').toLowerCase();
-      
-      // Intent breakdown
-      if (tipoRichiesta.includes('comprare') || tipoRichiesta.includes('acquistare')) {
-        comprareCount++;
-      } else if (tipoRichiesta.includes('vendere') || tipoRichiesta.includes('vendita')) {
-        vendereCount++;
-      }
-      
-      // Valid lead (ha almeno nome o telefono valido)
-      if (clientInfo.nome && clientInfo.nome !== 'Non specificato') {
-        validLeads++;
-      }
-      
-      // Zones
-      if (clientInfo.zona && clientInfo.zona !== 'Non specificato') {
-        zonesMap.set(clientInfo.zona, (zonesMap.get(clientInfo.zona) || 0) + 1);
-      }
-      
-      // Property types
-      if (clientInfo.tipo_immobile && clientInfo.tipo_immobile !== 'Non specificato') {
-        propertyTypesMap.set(
-          clientInfo.tipo_immobile,
-          (propertyTypesMap.get(clientInfo.tipo_immobile) || 0) + 1
-        );
-      }
-      
-      // Budget parsing
-      if (clientInfo.budget && clientInfo.budget !== 'Non specificato') {
-        const budgetStr = clientInfo.budget.replace(/[^\d]/g, '');
-        const budgetNum = parseInt(budgetStr);
-        if (!isNaN(budgetNum) && budgetNum > 0) {
-          budgets.push(budgetNum);
-        }
-      }
-      
-      // Features from notes
-      if (clientInfo.note && clientInfo.note !== 'Nessuna') {
-        const noteLower = clientInfo.note.toLowerCase();
-        const features = [
-          'balcone', 'terrazzo', 'luminoso', 'sole', 'piano alto', 'ascensore',
-          'garage', 'box', 'posto auto', 'cantina', 'ristrutturato', 'nuovo', 'arredato'
-        ];
-        
-        features.forEach(feature => {
-          if (noteLower.includes(feature)) {
-            featuresMap.set(feature, (featuresMap.get(feature) || 0) + 1);
-          }
+    const counters: Record<string, number> = Object.fromEntries(COUNTERS.map(key => [key, 0]));
+    const maps: Record<string, Record<string, number>> = Object.fromEntries(MAPS.map(key => [key, {}]));
+    snapshots.forEach(snapshot => {
+      const data = snapshot.data();
+      if (!data) return;
+      COUNTERS.forEach(key => {
+        counters[key] += data[key] || 0;
+      });
+      MAPS.forEach(key => {
+        Object.entries((data[key] || {}) as Record<string, number>).forEach(([entry, count]) => {
+          maps[key][entry] = (maps[key][entry] || 0) + count;
         });
-      }
+      });
     });
 
-    const totalCalls = calls.length;
+    // Intent breakdown (chiavi slug: 'comprare', 'acquistare-casa', 'vendita'...)
+    const comprareCount = sumOf(maps.by_tipo_richiesta, key => key.includes('compr') || key.includes('acquist'));
+    const vendereCount = sumOf(maps.by_tipo_richiesta, key => key.includes('vend'));
+    const zonesMap = new Map(Object.entries(maps.by_zona).map(([zona, count]) => [getZoneName(zona), count]));
+    const propertyTypesMap = new Map(Object.entries(maps.by_tipo_immobile).map(([tipo, count]) => [label(tipo), count]));
+    const featuresMap = new Map(Object.entries(maps.by_feature).map(([feature, count]) => [label(feature), count]));
+    const validLeads = counters.valid_leads;
+
+    const totalCalls = counters.calls;
     const totalIntent = comprareCount + vendereCount;
     
     // Calculate percentages
@@ -132,15 +113,15 @@ export async function GET(request: NextRequest) {
     const totalFeatures = Array.from(featuresMap.values()).reduce((a, b) => a + b, 0);
     const topFeatures = Array.from(featuresMap.entries())
       .map(([feature, count]) => ({
-        feature: feature.charAt(0).toUpperCase() + feature.slice(1),
+        feature,
         percentage: totalFeatures > 0 ? Math.round((count / totalFeatures) * 100) : 0
       }))
       .sort((a, b) => b.percentage - a.percentage)
       .slice(0, 5);
     
     // Average budget
-    const averageBudget = budgets.length > 0
-      ? `€${Math.round(budgets.reduce((a, b) => a + b, 0) / budgets.length).toLocaleString('it-IT')}`
+    const averageBudget = counters.budget_count > 0
+      ? `€${Math.round(counters.budget_sum / counters.budget_count).toLocaleString('it-IT')}`
       : 'N/A';
     
     // Conversion rate
@@ -157,6 +138,9 @@ export async function GET(request: NextRequest) {
       conversionRate,
       totalCalls,
       validLeads,
+      urgentLeads: counters.urgent,
+      durationHistogram: maps.duration_histogram,
+      days,
     });
 
   } catch (error: any) {
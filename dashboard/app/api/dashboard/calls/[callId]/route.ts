@@ -0,0 +1,71 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getServerSession } from 'next-auth/next';
+import { gunzipSync } from 'zlib';
+import { authOptions } from '@/lib/auth';
+import { db } from '@/lib/firebase';
+import { Call } from '@/lib/firebase';
+
+/**
+ * GET /api/dashboard/calls/[callId]
+ * Dettaglio chiamata con transcript completo.
+ * Il transcript è salvato gzip a chunk in calls/{callId}/transcript
+ * (vedi backend/functions/transcript_store.py); le chiamate non ancora
+ * migrate lo hanno ancora inline.
+ */
+export async function GET(
+  request: NextRequest,
+  context: { params: Promise<{ callId: string }> }
+) {
+  try {
+    const session = await getServerSession(authOptions);
+
+    if (!session?.user?.email) {
+      return NextResponse.json({ error: 'Non autenticato' }, { status: 401 });
+    }
+
+    const { callId } = await context.params;
+    const callRef = db.collection('calls').doc(callId);
+    const callDoc = await callRef.get();
+
+    if (!callDoc.exists) {
+      return NextResponse.json({ error: 'Chiamata non trovata' }, { status: 404 });
+    }
+
+    const data = callDoc.data() as Call & { user_id?: string };
+
+    // Verifica che la chiamata appartenga al cliente
+    if (data.user_id && data.user_id !== session.user.email) {
+      return NextResponse.json({ error: 'Non autorizzato' }, { status: 403 });
+    }
+
+    let transcript = data.transcript || '';
+    if (!transcript && data.transcript_chunks) {
+      const chunksSnapshot = await callRef.collection('transcript').orderBy('index').get();
+      const compressed = Buffer.concat(
+        chunksSnapshot.docs.map((doc) => Buffer.from(doc.data().data))
+      );
+      transcript = gunzipSync(compressed).toString('utf-8');
+    }
+
+    return NextResponse.json({
+      call: {
+        id: callDoc.id,
+        call_id: data.call_id,
+        customer_number: data.customer_number,
+        status: data.status,
+        started_at: data.started_at?.toDate?.()?.toISOString() || new Date().toISOString(),
+        ended_at: data.ended_at?.toDate?.()?.toISOString() || null,
+        duration: data.duration || 0,
+        transcript,
+        client_info: data.client_info || {},
+      },
+    });
+
+  } catch (error: any) {
+    console.error('Error fetching call detail:', error);
+    return NextResponse.json(
+      { error: 'Errore durante il recupero della chiamata' },
+      { status: 500 }
+    );
+  }
+}
@@ -51,7 +51,8 @@ export async function GET(request: NextRequest) {
         started_at: data.started_at?.toDate?.()?.toISOString() || new Date().toISOString(),
         ended_at: data.ended_at?.toDate?.()?.toISOString() || null,
         duration: data.duration || 0,
-        transcript: data.transcript || '',
+        // Transcript completo: GET /api/dashboard/calls/[callId]
+        transcript_preview: data.transcript_preview || (data.transcript || '').slice(0, 160),
         client_info: data.client_info || {},
       };
     });
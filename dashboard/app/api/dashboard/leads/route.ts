@@ -81,7 +81,7 @@ export async function GET(request: NextRequest) {
         status: status as 'nuovo' | 'contattato' | 'chiuso',
         timestamp: data.ended_at?.toDate?.()?.toLocaleString('it-IT') || new Date().toLocaleString('it-IT'),
         duration: data.duration || 0,
-        transcript: data.transcript || '',
+        transcript_preview: data.transcript_preview || (data.transcript || '').slice(0, 160),
         call_id: data.call_id,
       };
     });
@@ -27,6 +27,7 @@ export async function GET(request: NextRequest) {
     return NextResponse.json({
       agents: userData?.agents || [],
       zoneAssignments: userData?.zone_assignments || {},
+      zoneAliases: userData?.zone_aliases || {},
     });
 
   } catch (error: any) {
@@ -51,7 +52,7 @@ export async function POST(request: NextRequest) {
     }
 
     const body = await request.json();
-    const { agents, zoneAssignments } = body;
+    const { agents, zoneAssignments, zoneAliases } = body;
 
     // Aggiorna user profile
     const updateData: any = {};
@@ -64,6 +65,11 @@ export async function POST(request: NextRequest) {
       updateData.zone_assignments = zoneAssignments;
     }
 
+    // Alias zona del tenant (es. { "darsena": "navigli" }), usati dal webhook
+    if (zoneAliases !== undefined) {
+      updateData.zone_aliases = zoneAliases;
+    }
+
     updateData.updated_at = new Date();
 
     await db.collection('users').doc(session.user.email).update(updateData);
@@ -12,6 +12,7 @@ interface Call {
   ended_at: string;
   duration: number;
   transcript?: string;
+  transcript_preview?: string;
   client_info?: {
     nome?: string;
     telefono?: string;
@@ -26,6 +27,7 @@ export default function CallsPage() {
   const [filter, setFilter] = useState<'all' | 'completed' | 'failed' | 'in_progress'>('all');
   const [selectedCall, setSelectedCall] = useState<Call | null>(null);
   const [loading, setLoading] = useState(true);
+  const [loadingDetail, setLoadingDetail] = useState(false);
 
   useEffect(() => {
     loadCalls();
@@ -45,6 +47,22 @@ export default function CallsPage() {
     }
   };
 
+  // Il transcript completo non è nella lista: si carica all'apertura
+  const openCall = async (call: Call) => {
+    setSelectedCall(call);
+    setLoadingDetail(true);
+    try {
+      const response = await fetch(`/api/dashboard/calls/${call.id}`);
+      if (!response.ok) throw new Error('Failed to fetch call');
+      const data = await response.json();
+      setSelectedCall((current) => (current?.id === call.id ? { ...current, ...data.call } : current));
+    } catch (error) {
+      console.error('Error loading call detail:', error);
+    } finally {
+      setLoadingDetail(false);
+    }
+  };
+
   const filteredCalls = calls.filter(call => {
     if (filter === 'all') return true;
     return call.status === filter;
@@ -169,7 +187,7 @@ export default function CallsPage() {
               </div>
 
               <button
-                onClick={() => setSelectedCall(call)}
+                onClick={() => openCall(call)}
                 className="px-4 py-2 bg-blue-600 hover:bg-blue-700 text-white text-sm rounded-lg transition ml-4"
               >
                 Dettagli
@@ -246,12 +264,15 @@ export default function CallsPage() {
                 </div>
               )}
 
-              {selectedCall.transcript && (
+              {(selectedCall.transcript || selectedCall.transcript_preview) && (
                 <div>
                   <div className="text-sm text-slate-600 mb-2">Trascrizione</div>
                   <div className="p-4 bg-slate-50 rounded-lg text-slate-900 max-h-64 overflow-y-auto">
-                    {selectedCall.transcript}
+                    {selectedCall.transcript || `${selectedCall.transcript_preview}…`}
                   </div>
+                  {loadingDetail && !selectedCall.transcript && (
+                    <div className="text-xs text-slate-500 mt-1">Caricamento trascrizione...</div>
+                  )}
                 </div>
               )}
 
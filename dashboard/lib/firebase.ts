@@ -65,7 +65,11 @@ export interface Call {
     note: string;
   };
   structured_data: any;
-  transcript: string;
+  transcript?: string; // solo chiamate non migrate, vedi calls/{id}/transcript
+  transcript_chars?: number;
+  transcript_chunks?: number;
+  transcript_encoding?: 'gzip';
+  transcript_preview?: string;
   duration: number;
   ended_reason: string;
   started_at: any;
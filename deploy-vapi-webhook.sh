@@ -13,6 +13,7 @@ cd "$(dirname "$0")/backend/functions" || exit
 # export TWILIO_ACCOUNT_SID="your_account_sid"
 # export TWILIO_AUTH_TOKEN="your_auth_token"
 # export VAPI_API_KEY="your_vapi_key"
+# export NOTIFICATION_MODE="outbox"   # opzionale, default inline (worker: ./deploy-workers.sh)
 
 if [ -z "$TWILIO_ACCOUNT_SID" ] || [ -z "$TWILIO_AUTH_TOKEN" ] || [ -z "$VAPI_API_KEY" ]; then
     echo "❌ Errore: Configura le variabili d'ambiente prima di eseguire lo script"
@@ -33,7 +34,7 @@ gcloud functions deploy vapi-webhook \
   --region europe-west1 \
   --memory 512MB \
   --timeout 540s \
-  --set-env-vars "VAPI_API_KEY=${VAPI_API_KEY},TWILIO_ACCOUNT_SID=${TWILIO_ACCOUNT_SID},TWILIO_AUTH_TOKEN=${TWILIO_AUTH_TOKEN}"
+  --set-env-vars "VAPI_API_KEY=${VAPI_API_KEY},TWILIO_ACCOUNT_SID=${TWILIO_ACCOUNT_SID},TWILIO_AUTH_TOKEN=${TWILIO_AUTH_TOKEN},NOTIFICATION_MODE=${NOTIFICATION_MODE:-inline}"
 
 # Verifica risultato
 if [ $? -eq 0 ]; then
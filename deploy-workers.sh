@@ -0,0 +1,117 @@
+#!/bin/bash
+
+# ⏱️ Script per deployare i worker notifiche su Google Cloud + Cloud Scheduler
+# Usa: ./deploy-workers.sh
+#
+# Un solo worker, in base a NOTIFICATION_MODE (come vapi-webhook):
+# - outbox: drain-notification-outbox (coda notification_outbox + digest lead)
+# - inline: flush-lead-digests (solo digest lead scaduti, la coda è vuota)
+#
+# I worker NON sono pubblici (--no-allow-unauthenticated, a differenza di
+# vapi-webhook che Vapi chiama da fuori): Cloud Scheduler li invoca ogni
+# minuto con un token OIDC del service account $SCHEDULER_SA, che ha solo
+# il ruolo cloudfunctions.invoker sul worker.
+
+echo "⏱️ Deploy worker notifiche..."
+
+# Vai nella cartella functions
+cd "$(dirname "$0")/backend/functions" || exit
+
+# ⚠️ SICUREZZA: Usa solo variabili d'ambiente, mai credenziali hardcoded
+# export TWILIO_ACCOUNT_SID="your_account_sid"
+# export TWILIO_AUTH_TOKEN="your_auth_token"
+# export NOTIFICATION_MODE="outbox"   # opzionale, default inline (come vapi-webhook)
+
+if [ -z "$TWILIO_ACCOUNT_SID" ] || [ -z "$TWILIO_AUTH_TOKEN" ]; then
+    echo "❌ Errore: Configura le variabili d'ambiente prima di eseguire lo script"
+    echo "   export TWILIO_ACCOUNT_SID=\"your_account_sid\""
+    echo "   export TWILIO_AUTH_TOKEN=\"your_auth_token\""
+    exit 1
+fi
+
+REGION="europe-west1"
+PROJECT_ID="${PROJECT_ID:-$(gcloud config get-value project 2>/dev/null)}"
+NOTIFICATION_MODE="${NOTIFICATION_MODE:-inline}"
+SCHEDULER_SA_NAME="notification-scheduler"
+SCHEDULER_SA="${SCHEDULER_SA_NAME}@${PROJECT_ID}.iam.gserviceaccount.com"
+
+if [ -z "$PROJECT_ID" ]; then
+    echo "❌ Errore: nessun progetto (gcloud config set project ai-centralinista-2025)"
+    exit 1
+fi
+
+# Service account usato da Cloud Scheduler per il token OIDC
+if ! gcloud iam service-accounts describe "$SCHEDULER_SA" >/dev/null 2>&1; then
+    echo "⏳ Creo service account $SCHEDULER_SA..."
+    gcloud iam service-accounts create "$SCHEDULER_SA_NAME" \
+      --display-name "Cloud Scheduler - worker notifiche" || exit 1
+fi
+
+# deploy_worker <nome funzione> <entry point> <schedule cron>
+deploy_worker() {
+    local name="$1" entry_point="$2" schedule="$3"
+
+    echo "⏳ Deploy $name..."
+    gcloud functions deploy "$name" \
+      --runtime python311 \
+      --trigger-http \
+      --no-allow-unauthenticated \
+      --source . \
+      --entry-point "$entry_point" \
+      --region "$REGION" \
+      --memory 512MB \
+      --timeout 540s \
+      --set-env-vars "TWILIO_ACCOUNT_SID=${TWILIO_ACCOUNT_SID},TWILIO_AUTH_TOKEN=${TWILIO_AUTH_TOKEN},NOTIFICATION_MODE=${NOTIFICATION_MODE}" \
+      || return 1
+
+    # Solo il service account dello scheduler può invocarla
+    gcloud functions add-iam-policy-binding "$name" \
+      --region "$REGION" \
+      --member "serviceAccount:${SCHEDULER_SA}" \
+      --role roles/cloudfunctions.invoker >/dev/null || return 1
+
+    local url
+    url=$(gcloud functions describe "$name" --region "$REGION" --format 'value(httpsTrigger.url)')
+
+    # Job Cloud Scheduler con token OIDC (audience = URL della funzione)
+    local action=create
+    if gcloud scheduler jobs describe "$name" --location "$REGION" >/dev/null 2>&1; then
+        action=update
+    fi
+    gcloud scheduler jobs "$action" http "$name" \
+      --location "$REGION" \
+      --schedule "$schedule" \
+      --uri "$url" \
+      --http-method POST \
+      --oidc-service-account-email "$SCHEDULER_SA" \
+      --oidc-token-audience "$url" || return 1
+
+    echo "✅ $name: $url (Cloud Scheduler \"$schedule\")"
+}
+
+if [ "$NOTIFICATION_MODE" = "outbox" ]; then
+    WORKER=drain-notification-outbox
+    deploy_worker "$WORKER" drain_notification_outbox "* * * * *" || FAILED=1
+else
+    WORKER=flush-lead-digests
+    deploy_worker "$WORKER" flush_lead_digests "* * * * *" || FAILED=1
+fi
+
+# Verifica risultato
+if [ -z "$FAILED" ]; then
+    echo ""
+    echo "✅ Deploy worker completato!"
+    echo ""
+    echo "📋 Prossimi passi:"
+    echo "1. Cambiando NOTIFICATION_MODE rilancia ./deploy-vapi-webhook.sh con lo stesso valore"
+    echo "   (ed elimina il job/funzione dell'altra modalità)"
+    echo "2. Prova un'esecuzione: gcloud scheduler jobs run $WORKER --location $REGION"
+else
+    echo ""
+    echo "❌ Errore durante il deploy dei worker"
+    echo "Verifica:"
+    echo "- Sei autenticato? (gcloud auth login)"
+    echo "- Il progetto è corretto? (gcloud config set project ai-centralinista-2025)"
+    echo "- Le API sono abilitate? (gcloud services enable cloudfunctions.googleapis.com cloudscheduler.googleapis.com)"
+    exit 1
+fi